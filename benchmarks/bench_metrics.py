@@ -0,0 +1,42 @@
+"""
+Benchmarks of the evaluation metrics: instance matching, its label overlap matrix and the detection metrics.
+"""
+import numpy as np
+
+from benchmarks.common import benchmark, synthetic_labels, synthetic_points, VOXELS_PER_OBJECT
+from biapy.utils.matching import matching, _label_overlap
+from biapy.engine.metrics import detection_metrics
+
+
+def _label_pair(shape):
+    """Ground truth labels and a prediction with shifted objects, some of them merged or missing."""
+    y_true = synthetic_labels(shape, seed=0)
+    y_pred = np.roll(y_true, 1, axis=(0, 1, 2))
+    rng = np.random.default_rng(1)
+    n = int(y_true.max())
+    relabel = np.arange(n + 1, dtype=y_true.dtype)
+    relabel[1:][rng.random(n) < 0.1] = 0
+    merged = rng.random(n) < 0.1
+    relabel[1:][merged] = np.maximum(relabel[1:][merged] - 1, 0)
+    return y_true, relabel[y_pred]
+
+
+@benchmark("metrics.matching")
+def instance_matching(shape):
+    y_true, y_pred = _label_pair(shape)
+    return lambda: matching(y_true, y_pred, thresh=0.5)
+
+
+@benchmark("metrics._label_overlap")
+def label_overlap(shape):
+    y_true, y_pred = _label_pair(shape)
+    return lambda: _label_overlap(y_true, y_pred)
+
+
+@benchmark("metrics.detection_metrics")
+def detection(shape):
+    n_points = int(np.prod(shape) // VOXELS_PER_OBJECT)
+    true = synthetic_points(shape, n_points, seed=0)
+    pred = true[: int(0.9 * n_points)] + np.random.default_rng(1).normal(0, 2, (int(0.9 * n_points), 3))
+    pred = np.concatenate([pred, synthetic_points(shape, n_points // 10, seed=2)])
+    return lambda: detection_metrics(true, pred, tolerance=5)
@@ -0,0 +1,32 @@
+"""
+Benchmarks of the instance segmentation and detection post-processing: marker-controlled watershed over ``BC``
+probabilities and removal of close points.
+"""
+import numpy as np
+
+from benchmarks.common import (
+    benchmark,
+    accepts_argument,
+    synthetic_labels,
+    synthetic_bc_probabilities,
+    synthetic_points,
+)
+from biapy.data.post_processing.post_processing import watershed_by_channels, remove_close_points
+
+
+@benchmark("post_processing.watershed_by_channels")
+def watershed(shape):
+    probs = synthetic_bc_probabilities(synthetic_labels(shape))
+    ths = {"TYPE": "manual", "TH_BINARY_MASK": 0.5, "TH_CONTOUR": 0.2, "TH_FOREGROUND": 0.4}
+    return lambda: watershed_by_channels(probs, "BC", ths=dict(ths))
+
+
+@benchmark("post_processing.remove_close_points")
+def close_points(shape):
+    # Around two points per object, so many of them are close to each other
+    points = synthetic_points(shape, 2 * int(synthetic_labels(shape).max()))
+    kwargs = {}
+    # Scores are only accepted by recent versions
+    if accepts_argument(remove_close_points, "scores"):
+        kwargs["scores"] = np.random.default_rng(0).random(len(points))
+    return lambda: remove_close_points(points, 5.0, [1, 1, 1], ndim=3, **kwargs)
@@ -0,0 +1,46 @@
+"""
+Benchmarks of the 3D tiling functions: cropping a volume into overlapping patches, merging them back and extracting
+patches one by one as done in ``TEST.BY_CHUNKS``.
+"""
+import numpy as np
+
+from benchmarks.common import benchmark
+from biapy.data.data_3D_manipulation import (
+    crop_3D_data_with_overlap,
+    merge_3D_data_with_overlap,
+    extract_3D_patch_with_overlap_yield,
+)
+
+OVERLAP = (0.25, 0.25, 0.25)
+PADDING = (4, 16, 16)
+
+
+def _patch_shape(shape):
+    return (min(shape[0], 32), min(shape[1], 128), min(shape[2], 128), 1)
+
+
+@benchmark("tiling.crop_3D_data_with_overlap")
+def crop(shape):
+    data = np.random.default_rng(0).random(shape + (1,), dtype=np.float32)
+    return lambda: crop_3D_data_with_overlap(data, _patch_shape(shape), overlap=OVERLAP, padding=PADDING, verbose=False)
+
+
+@benchmark("tiling.merge_3D_data_with_overlap")
+def merge(shape):
+    data = np.random.default_rng(0).random(shape + (1,), dtype=np.float32)
+    patches = crop_3D_data_with_overlap(data, _patch_shape(shape), overlap=OVERLAP, padding=PADDING, verbose=False)
+    return lambda: merge_3D_data_with_overlap(patches, shape + (1,), overlap=OVERLAP, padding=PADDING, verbose=False)
+
+
+@benchmark("tiling.extract_3D_patch_with_overlap_yield")
+def extract(shape):
+    data = np.random.default_rng(0).random(shape + (1,), dtype=np.float32)
+
+    def run():
+        patches = extract_3D_patch_with_overlap_yield(
+            data, _patch_shape(shape), "ZYXC", overlap=OVERLAP, padding=PADDING
+        )
+        for _ in patches:
+            pass
+
+    return run
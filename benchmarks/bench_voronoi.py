@@ -0,0 +1,47 @@
+"""
+Benchmarks of the Voronoi filling of the unlabeled voxels of a cyst, over the whole volume and block-wise.
+"""
+import numpy as np
+from skimage.segmentation import watershed
+
+from benchmarks.common import benchmark, accepts_argument, VOXELS_PER_OBJECT
+from biapy.data.post_processing.post_processing import voronoi_on_mask
+
+# Fraction of the cyst voxels left unlabeled
+UNLABELED = 0.3
+
+
+def synthetic_cyst(shape, unlabeled=UNLABELED, seed=0):
+    """Hollow ellipsoid split in cells, with part of their voxels unlabeled, and a mask channel of it."""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing="ij"), -1)
+    radius = np.sqrt((grid**2).sum(-1))
+    cyst = (radius > 0.45) & (radius < 0.85)
+
+    coords = np.argwhere(cyst)
+    ncells = max(2, len(coords) // VOXELS_PER_OBJECT)
+    seeds = np.zeros(shape, dtype=np.int32)
+    for i, c in enumerate(coords[rng.choice(len(coords), ncells, replace=False)]):
+        seeds[tuple(c)] = i + 1
+    labels = watershed(np.zeros(shape), seeds, mask=cyst).astype(np.uint16)
+    labels[rng.random(shape) < unlabeled] = 0
+
+    mask = np.zeros(shape + (3,), dtype=np.float32)
+    mask[..., 2] = cyst
+    return labels, mask
+
+
+@benchmark("post_processing.voronoi_on_mask")
+def voronoi(shape):
+    labels, mask = synthetic_cyst(shape)
+    return lambda: voronoi_on_mask(labels.copy(), mask, th=0.5)
+
+
+@benchmark("post_processing.voronoi_on_mask_blocks")
+def voronoi_blocks(shape):
+    # Block-wise processing is only available in recent versions
+    if not accepts_argument(voronoi_on_mask, "block_size"):
+        return None
+    labels, mask = synthetic_cyst(shape)
+    block_size = [max(1, s // 2) for s in shape]
+    return lambda: voronoi_on_mask(labels.copy(), mask, th=0.5, block_size=block_size)
@@ -0,0 +1,184 @@
+"""
+Shared utilities of the benchmark suite: synthetic data creation, benchmark registration and measurement of time and
+peak memory.
+"""
+import io
+import time
+import inspect
+import contextlib
+import tracemalloc
+import numpy as np
+from skimage.segmentation import expand_labels, find_boundaries
+
+# Volume shapes, in (z, y, x) order, the benchmarks are run with
+SIZES = {
+    "small": (32, 128, 128),
+    "medium": (64, 256, 256),
+    "large": (128, 512, 512),
+}
+
+# Average number of voxels of each synthetic object
+VOXELS_PER_OBJECT = 4000
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function receives a volume shape, creates its input data and returns a
+    function without arguments that runs the code to measure, or ``None`` if the benchmarked code is not available in
+    the installed BiaPy version.
+
+    Parameters
+    ----------
+    name : str
+        Name of the benchmark. E.g. ``tiling.crop_3D_data_with_overlap``.
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def accepts_argument(func, name):
+    """
+    Whether ``func`` has an argument called ``name``. Used to only pass arguments added in recent BiaPy versions, so
+    the same benchmarks can be run against older releases.
+
+    Parameters
+    ----------
+    func : Callable
+        Function to check.
+
+    name : str
+        Name of the argument.
+
+    Returns
+    -------
+    accepts : bool
+        Whether ``name`` is an argument of ``func``.
+    """
+    return name in inspect.signature(func).parameters
+
+
+def synthetic_labels(shape, n_objects=None, seed=0):
+    """
+    Create a labeled volume with roughly spherical touching objects.
+
+    Parameters
+    ----------
+    shape : Tuple of ints
+        Shape of the volume. E.g. ``(z, y, x)``.
+
+    n_objects : int, optional
+        Number of objects. If not provided it is calculated from ``VOXELS_PER_OBJECT``.
+
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    labels : Numpy array
+        Labeled volume of ``uint32`` type.
+    """
+    rng = np.random.default_rng(seed)
+    if n_objects is None:
+        n_objects = max(1, int(np.prod(shape) // VOXELS_PER_OBJECT))
+    seeds = np.zeros(shape, dtype=np.uint32)
+    coords = tuple(rng.integers(0, s, n_objects) for s in shape)
+    seeds[coords] = np.arange(1, n_objects + 1, dtype=np.uint32)
+    # Radius of a sphere of VOXELS_PER_OBJECT voxels, so most objects touch but some background remains
+    radius = (VOXELS_PER_OBJECT * 3 / (4 * np.pi)) ** (1 / 3)
+    return expand_labels(seeds, distance=radius)
+
+
+def synthetic_bc_probabilities(labels, seed=0):
+    """
+    Create the foreground and contour probabilities (``BC`` channels) of a labeled volume, with noise.
+
+    Parameters
+    ----------
+    labels : Numpy array
+        Labeled volume. E.g. ``(z, y, x)``.
+
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    probs : Numpy array
+        Probabilities of ``float32`` type. E.g. ``(z, y, x, 2)``.
+    """
+    rng = np.random.default_rng(seed)
+    probs = np.stack([labels > 0, find_boundaries(labels, mode="inner")], axis=-1).astype(np.float32)
+    probs += rng.normal(0, 0.1, probs.shape).astype(np.float32)
+    return np.clip(probs, 0, 1)
+
+
+def synthetic_points(shape, n_points, seed=0):
+    """
+    Create random points within a volume.
+
+    Parameters
+    ----------
+    shape : Tuple of ints
+        Shape of the volume. E.g. ``(z, y, x)``.
+
+    n_points : int
+        Number of points.
+
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    points : Numpy array
+        Coordinates of the points. E.g. ``(n_points, 3)``.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 1, (n_points, len(shape))) * np.array(shape)
+
+
+def measure(func, repeat=3):
+    """
+    Measure the wall time and the peak memory allocated by ``func``. Its output is discarded.
+
+    The time is measured in ``repeat`` runs. The peak memory is measured in an additional run, as tracing the
+    allocations slows the code down. Only memory allocated through Python and NumPy is traced.
+
+    Parameters
+    ----------
+    func : Callable
+        Function without arguments to measure.
+
+    repeat : int, optional
+        Number of timed runs.
+
+    Returns
+    -------
+    result : dict
+        Minimum, median and all the times in seconds, and the peak memory in MiB.
+    """
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "time_min": min(times),
+        "time_median": float(np.median(times)),
+        "times": times,
+        "peak_memory_mib": peak / 2**20,
+    }
@@ -0,0 +1,151 @@
+"""
+Run BiaPy micro-benchmarks on CPU with synthetic data and save their time and peak memory as JSON, so the results
+of different versions can be compared.
+
+Usage examples (from BiaPy's root directory):
+    python -m benchmarks.run --sizes small medium --output results.json
+    python -m benchmarks.run --filter tiling --repeat 5
+    python -m benchmarks.run --compare baseline.json results.json
+"""
+import os
+import sys
+import json
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+
+from benchmarks.common import BENCHMARKS, SIZES, measure
+
+# Modules that register benchmarks
+BENCHMARK_MODULES = [
+    "benchmarks.bench_tiling",
+    "benchmarks.bench_post_processing",
+    "benchmarks.bench_voronoi",
+    "benchmarks.bench_metrics",
+]
+
+
+def environment():
+    """Versions and hardware the benchmarks are run with."""
+    import numpy as np
+    import scipy
+    import skimage
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        )
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "scikit-image": skimage.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run(sizes, name_filter="", repeat=3):
+    """
+    Run the registered benchmarks.
+
+    Parameters
+    ----------
+    sizes : List of str
+        Names of the volume sizes to use. Keys of ``SIZES``.
+
+    name_filter : str, optional
+        Only run the benchmarks that contain this string in their name.
+
+    repeat : int, optional
+        Number of timed runs of each benchmark.
+
+    Returns
+    -------
+    results : dict
+        Environment information and a list with the measures of each benchmark and size.
+    """
+    import importlib
+
+    for module in BENCHMARK_MODULES:
+        importlib.import_module(module)
+
+    results = {"environment": environment(), "repeat": repeat, "benchmarks": []}
+    for name in sorted(BENCHMARKS):
+        if name_filter not in name:
+            continue
+        for size in sizes:
+            shape = SIZES[size]
+            func = BENCHMARKS[name](shape)
+            if func is None:
+                print("{:<45} {:<7} not available in this version".format(name, size))
+                continue
+            result = measure(func, repeat=repeat)
+            print(
+                "{:<45} {:<7} {:>10.3f} s {:>10.1f} MiB".format(
+                    name, size, result["time_min"], result["peak_memory_mib"]
+                )
+            )
+            results["benchmarks"].append({"name": name, "size": size, "shape": list(shape), **result})
+            del func
+    return results
+
+
+def compare(baseline_file, results_file):
+    """
+    Print the time and peak memory ratios between two result files. Ratios below 1 mean the second one is
+    faster or uses less memory.
+
+    Parameters
+    ----------
+    baseline_file : str
+        JSON file with the reference results.
+
+    results_file : str
+        JSON file with the results to compare.
+    """
+    with open(baseline_file, "r") as f:
+        baseline = {(b["name"], b["size"]): b for b in json.load(f)["benchmarks"]}
+    with open(results_file, "r") as f:
+        results = json.load(f)["benchmarks"]
+
+    print("{:<45} {:<7} {:>12} {:>12} {:>8} {:>8}".format("Benchmark", "Size", "Base (s)", "New (s)", "Time", "Memory"))
+    for r in results:
+        b = baseline.get((r["name"], r["size"]))
+        if b is None:
+            continue
+        time_ratio = r["time_min"] / b["time_min"] if b["time_min"] > 0 else float("nan")
+        mem_ratio = r["peak_memory_mib"] / b["peak_memory_mib"] if b["peak_memory_mib"] > 0 else float("nan")
+        print(
+            "{:<45} {:<7} {:>12.3f} {:>12.3f} {:>7.2f}x {:>7.2f}x".format(
+                r["name"], r["size"], b["time_min"], r["time_min"], time_ratio, mem_ratio
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run BiaPy benchmarks", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=list(SIZES.keys()))
+    parser.add_argument("--filter", default="", help="Only run benchmarks containing this string in their name")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs of each benchmark")
+    parser.add_argument("--output", default="", help="JSON file to save the results into")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), help="Compare two result files")
+    args = vars(parser.parse_args())
+
+    if args["compare"] is not None:
+        compare(*args["compare"])
+        sys.exit(0)
+
+    results = run(args["sizes"], name_filter=args["filter"], repeat=args["repeat"])
+    if args["output"] != "":
+        with open(args["output"], "w") as f:
+            json.dump(results, f, indent=4)
+        print("Results saved in {}".format(args["output"]))
@@ -22,6 +22,7 @@ from bioimageio.spec.model.v0_5 import (
     HttpUrl,
     LicenseId,
     PytorchStateDictWeightsDescr,
+    TorchscriptWeightsDescr,
     AxisId,
     BatchAxis,
     ChannelAxis,
@@ -180,6 +181,35 @@ class BiaPy:
         self.cfg.merge_from_list(["SYSTEM.NUM_CPUS", self.cpu_count])
 
         check_configuration(self.cfg, self.job_identifier)
+
+        # Choose the patch and batch size that fit in the memory budget
+        if self.cfg.TRAIN.ENABLE and self.cfg.TRAIN.AUTO_PATCH_BATCH.ENABLE:
+            from biapy.models import find_patch_and_batch_size
+
+            best, _ = find_patch_and_batch_size(
+                self.cfg,
+                self.device,
+                self.cfg.TRAIN.AUTO_PATCH_BATCH.MEMORY_BUDGET,
+                self.cfg.TRAIN.AUTO_PATCH_BATCH.PATCH_SIZES,
+                self.cfg.TRAIN.AUTO_PATCH_BATCH.BATCH_SIZES,
+                steps=self.cfg.TRAIN.AUTO_PATCH_BATCH.STEPS,
+            )
+            # All the processes need to train with the same sizes
+            if is_dist_avail_and_initialized():
+                selected = [best]
+                dist.broadcast_object_list(selected, src=0)
+                best = selected[0]
+            if best is None:
+                raise ValueError(
+                    "None of the candidates of 'TRAIN.AUTO_PATCH_BATCH' fits in {}GB".format(
+                        self.cfg.TRAIN.AUTO_PATCH_BATCH.MEMORY_BUDGET
+                    )
+                )
+            self.cfg.merge_from_list(
+                ["DATA.PATCH_SIZE", tuple(best["patch_size"]), "TRAIN.BATCH_SIZE", int(best["batch_size"])]
+            )
+            check_configuration(self.cfg, self.job_identifier)
+
         print("Configuration details:")
         print(self.cfg)
 
@@ -774,19 +804,23 @@ class BiaPy:
                 self.workflow.bmz_config["original_model_spec_version"],
             )
 
-        # Only exporting in pytorch_state_dict
+        # Weights in pytorch_state_dict
         pytorch_state_dict = PytorchStateDictWeightsDescr(
             source=state_dict_source,
             sha256=state_dict_sha256,
             architecture=pytorch_architecture,
             pytorch_version=Version(torch.__version__),
         )
-        # torchscript = TorchscriptWeightsDescr(
-        #     source=self.workflow.bmz_config['original_bmz_config'].weights.torchscript.source,
-        #     sha256=self.workflow.bmz_config['original_bmz_config'].weights.torchscript.sha256,
-        #     pytorch_version=Version(torch.__version__),
-        #     parent="pytorch_state_dict", # these weights were converted from the pytorch_state_dict weights ones.
-        # ),
+        # Add the TorchScript weights too if they were exported during inference ('TEST.BACKEND.TYPE' = 'torchscript')
+        torchscript = None
+        torchscript_file = self.workflow.bmz_config.get("torchscript_file", None)
+        if not reuse_original_bmz_config and torchscript_file is not None and os.path.exists(torchscript_file):
+            torchscript = TorchscriptWeightsDescr(
+                source=Path(torchscript_file),
+                sha256=Sha256(create_file_sha256sum(torchscript_file)),
+                pytorch_version=Version(torch.__version__),
+                parent="pytorch_state_dict",  # these weights were converted from the pytorch_state_dict weights ones.
+            )
 
         # Export model to BMZ format
         model_descr = ModelDescr(
@@ -801,7 +835,7 @@ class BiaPy:
             outputs=outputs,
             weights=WeightsDescr(
                 pytorch_state_dict=pytorch_state_dict,
-                # torchscript,
+                torchscript=torchscript,
             ),
             tags=tags,
             covers=covers,
@@ -31,6 +31,12 @@ class Config:
         _C.SYSTEM.SEED = 0
         # Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.
         _C.SYSTEM.PIN_MEM = True
+        # Keep the DataLoader worker processes alive between epochs instead of creating them again at the start of each
+        # one. This way the workers do not repeat their start up (e.g. re-opening the H5/Zarr files the patches are read
+        # from). Only used when 'SYSTEM.NUM_WORKERS' > 0
+        _C.SYSTEM.PERSISTENT_WORKERS = True
+        # Number of batches loaded in advance by each DataLoader worker. Only used when 'SYSTEM.NUM_WORKERS' > 0
+        _C.SYSTEM.PREFETCH_FACTOR = 2
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Problem specification
@@ -112,6 +118,18 @@ class Config:
         # Whether to apply or not the watershed to create instances slice by slice in a 3D problem. This can solve instances invading
         # others if the objects in Z axis overlap too much.
         _C.PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICES = False
+        # Number of processes used in the watershed: per-slice morphology of seeds/foreground, per-slice watershed (when
+        # 'WATERSHED_BY_2D_SLICES' is enabled) and block-wise watershed (when 'WATERSHED_BLOCK_SIZE' is set). 1 to run
+        # serially and 0 to use all available cores
+        _C.PROBLEM.INSTANCE_SEG.WATERSHED_NUM_WORKERS = 1
+        # Block shape, in (z,y,x) order, to split 3D volumes into to run the watershed block-wise, in parallel if
+        # 'WATERSHED_NUM_WORKERS' > 1. Empty to run a single watershed over the whole volume. E.g. [128, 512, 512]
+        _C.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE = []
+        # Voxels added on each side of every watershed block, in (z,y,x) order, so instances that cross block borders grow
+        # with enough context. It should be close to the expected instance radius
+        _C.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_HALO = [8, 32, 32]
+        # Maximum number of values subsampled from each channel to compute Otsu thresholds when 'DATA_MW_TH_TYPE' is 'auto'
+        _C.PROBLEM.INSTANCE_SEG.DATA_MW_TH_OTSU_MAX_SAMPLES = 16777216
 
         ### DETECTION
         _C.PROBLEM.DETECTION = CN()
@@ -139,6 +157,10 @@ class Config:
         # To apply a structured mask as is proposed in Noise2Void to alleviate the limitation of the method of not removing effectively
         # the structured noise (section 4.4 of their paper).
         _C.PROBLEM.DENOISING.N2V_STRUCTMASK = False
+        # Whether to create the Noise2Void masks for the whole batch in the training device (GPU) instead of doing it
+        # per patch in the data loader workers, so they only need to load the data. Only 'uniform_withCP', 'normal_additive'
+        # and 'identity' values of 'PROBLEM.DENOISING.N2V_MANIPULATOR' are supported.
+        _C.PROBLEM.DENOISING.N2V_ON_DEVICE = False
 
         ### SUPER_RESOLUTION
         _C.PROBLEM.SUPER_RESOLUTION = CN()
@@ -159,6 +181,17 @@ class Config:
         _C.PROBLEM.SELF_SUPERVISED.RESIZING_FACTOR = 4
         # Number between [0, 1] indicating the std of the Gaussian noise N(0,std).
         _C.PROBLEM.SELF_SUPERVISED.NOISE = 0.2
+        # Whether to crappify the sampled patches on the fly instead of creating a degraded copy of each image in
+        # 'DATA.*.SSL_SOURCE_DIR' before training. With this, a new degradation is drawn each epoch and no extra disk
+        # space is used. Only the test data is still crappified offline so the test metrics are reproducible.
+        _C.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY = False
+        # Whether to crappify the whole batch on the training device (GPU) instead of doing it per patch in the data
+        # loader workers. Only used when 'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY' is True.
+        _C.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE = False
+        # Whether to draw, for each sample, the resizing factor uniformly from [1, RESIZING_FACTOR] and the noise level
+        # from [0, NOISE] instead of using always those values. Only used when 'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY'
+        # is True.
+        _C.PROBLEM.SELF_SUPERVISED.RANDOM_DEGRADATION = False
 
         ### IMAGE_TO_IMAGE
         _C.PROBLEM.IMAGE_TO_IMAGE = CN()
@@ -207,11 +240,19 @@ class Config:
         _C.DATA.NORMALIZATION.TYPE = "div"
         # Whether to apply the normalization by sample ("image") or by all dataset statistics ("dataset").
         # Used with 'DATA.NORMALIZATION.PERC_CLIP' == 'True' and/or when 'DATA.NORMALIZATION.TYPE' == 'custom'.
-        # Options: ["image", "dataset"]
+        # Options: ["image", "dataset"]. Dataset statistics are computed image by image (in chunks for Zarr/H5 files), so
+        # they are also available when the training data is not loaded in memory, and saved in 'PATHS.LWR_X_FILE',
+        # 'PATHS.UPR_X_FILE', 'PATHS.MEAN_INFO_FILE' and 'PATHS.STD_INFO_FILE'
         _C.DATA.NORMALIZATION.APPLICATION_MODE = "image"
         # Custom normalization variables: mean and std (they are calculated if not provided)
         _C.DATA.NORMALIZATION.CUSTOM_MEAN = -1.0
         _C.DATA.NORMALIZATION.CUSTOM_STD = -1.0
+        # Whether to normalize training and validation batches on the device instead of in the generators. The samples are
+        # sent in their original dtype (e.g. uint8/uint16), so less data is copied to the GPU, and the percentile clipping
+        # and normalization are done there for the whole batch. Per-image statistics ("image" APPLICATION_MODE and the
+        # range check of 'div') are computed over each patch instead of over the whole image it was extracted from.
+        # Test data is still normalized in the generator
+        _C.DATA.NORMALIZATION.ON_DEVICE = False
 
         # If 'DATA.PATCH_SIZE' selected has 3 channels, e.g. RGB images are expected, so will force grayscale images to be
         # converted into RGB (e.g. in ImageNet some of the images are grayscale)
@@ -273,6 +314,15 @@ class Config:
         _C.DATA.PREPROCESS.VAL = False
         # Apply preprocessing to testing dataset
         _C.DATA.PREPROCESS.TEST = False
+        # Number of processes used to preprocess the images. 1 to run serially and 0 to use all available cores
+        _C.DATA.PREPROCESS.NUM_WORKERS = 1
+        # Whether to store the preprocessed images on disk so they are reused in later runs (opt-in). Each image is
+        # cached under a key derived from the SHA-256 hash of its file and from the preprocessing options, so changing
+        # any of them invalidates it. Be aware that a full copy of each preprocessed image is written in
+        # 'DATA.PREPROCESS.CACHE_DIR' and that every source file is read once more to hash it
+        _C.DATA.PREPROCESS.CACHE = False
+        # Directory where the preprocessed images are cached
+        _C.DATA.PREPROCESS.CACHE_DIR = os.path.join(job_dir, "preprocess_cache")
 
         # Resize datasets
         _C.DATA.PREPROCESS.RESIZE = CN()
@@ -371,6 +421,13 @@ class Config:
         _C.DATA.TEST.OVERLAP = (0, 0)
         # Padding to be done in (y,x)/(z,y,xz) when reconstructing test data. Useful to avoid patch 'border effect'
         _C.DATA.TEST.PADDING = (0, 0)
+        # How to merge the overlapping regions of the predicted patches. Options:
+        #   - 'average': all the patches contribute the same.
+        #   - 'spline': each patch is weighted with a squared spline window so the pixels near its borders contribute less.
+        #   - 'gaussian': each patch is weighted with a Gaussian window (sigma = 1/8 of the patch size).
+        # With 'spline' or 'gaussian' seamless results can be obtained with less overlap, e.g. 0.25 instead of 0.5,
+        # which reduces the number of patches to predict. Also applied when 'TEST.BY_CHUNKS.ENABLE' is selected
+        _C.DATA.TEST.BLENDING = "average"
         # Whether to use median values to fill padded pixels or zeros
         _C.DATA.TEST.MEDIAN_PADDING = False
         # Directory where binary masks to apply to resulting images should be. Used when _C.TEST.POST_PROCESSING.APPLY_MASK  == True
@@ -706,6 +763,11 @@ class Config:
         _C.MODEL.ISOTROPY = [True, True, True, True, True]
         # Include extra convolutional layers with larger kernel at the beginning and end of the U-Net-like model.
         _C.MODEL.LARGER_IO = False
+        # Whether to use activation (gradient) checkpointing during training: the activations of each encoder/decoder level
+        # (or transformer block) are not stored but recomputed in the backward pass. It reduces memory, allowing larger
+        # 'DATA.PATCH_SIZE' and 'TRAIN.BATCH_SIZE', at the cost of ~30% more compute per step. Only available for 'unet',
+        # 'resunet', 'attention_unet', 'seunet', 'multiresunet', 'unetr', 'mae' and 'vit'
+        _C.MODEL.ACTIVATION_CHECKPOINTING = False
         # Checkpoint: set to True to load previous training weigths (needed for inference or to make fine-tunning)
         _C.MODEL.LOAD_CHECKPOINT = False
         # When loading checkpoints whether if only model's weights are going to be loaded or optimizer, epochs and loss_scaler.
@@ -826,6 +888,20 @@ class Config:
         # If memory or # gpus is limited, use this variable to maintain the effective batch size, which is
         # batch_size (per gpu) * nodes * (gpus per node) * accum_iter.
         _C.TRAIN.ACCUM_ITER = 1
+        # Choose 'DATA.PATCH_SIZE' and 'TRAIN.BATCH_SIZE' before training among the candidates below. The peak memory
+        # and time per step of each candidate are measured with a dry-run forward/backward pass on random data, and the
+        # fastest one (voxels per second) that fits in 'TRAIN.AUTO_PATCH_BATCH.MEMORY_BUDGET' is used. It takes into
+        # account 'MODEL.ACTIVATION_CHECKPOINTING'. Only available with a CUDA device
+        _C.TRAIN.AUTO_PATCH_BATCH = CN()
+        _C.TRAIN.AUTO_PATCH_BATCH.ENABLE = False
+        # Memory available for training, in GB
+        _C.TRAIN.AUTO_PATCH_BATCH.MEMORY_BUDGET = 8.0
+        # Candidate patch sizes, in 'DATA.PATCH_SIZE' format. E.g. [[64, 128, 128, 1], [96, 192, 192, 1]]
+        _C.TRAIN.AUTO_PATCH_BATCH.PATCH_SIZES = []
+        # Candidate batch sizes
+        _C.TRAIN.AUTO_PATCH_BATCH.BATCH_SIZES = [1, 2, 4]
+        # Number of measured steps per candidate, after one warm-up step
+        _C.TRAIN.AUTO_PATCH_BATCH.STEPS = 3
         # Number of epochs to train the model
         _C.TRAIN.EPOCHS = 360
         # Epochs to wait with no validation data improvement until the training is stopped
@@ -900,6 +976,27 @@ class Config:
         _C.TEST.BY_CHUNKS.SAVE_OUT_TIF = False
         # In how many iterations the H5 writer needs to flush the data. No need to do so with Zarr files.
         _C.TEST.BY_CHUNKS.FLUSH_EACH = 100
+        # Codec used to compress the H5/Zarr files written. Options available: ["default", "blosc-lz4", "blosc-zstd",
+        # "gzip", "none"]. "default" uses gzip in H5 files, so they can be opened by any HDF5 reader (e.g. Fiji or
+        # MATLAB), and "blosc-lz4" in Zarr files. Blosc codecs, applied with byte shuffling, are much faster than gzip
+        # but in H5 files they need the 'hdf5plugin' package, both to write the files and to read them later. The files
+        # are chunked following 'DATA.PATCH_SIZE' and the axes order ('TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER'), so each
+        # patch written touches as few chunks as possible.
+        _C.TEST.BY_CHUNKS.COMPRESSION = "default"
+        # Compression level, from 0 (no compression) to 9
+        _C.TEST.BY_CHUNKS.COMPRESSION_LEVEL = 5
+        # Number of threads used by Blosc to compress each chunk when writing Zarr files. 0 means all the cores available
+        _C.TEST.BY_CHUNKS.COMPRESSION_THREADS = 0
+        # Whether to build downsampled levels of the final prediction while it is written, so the Zarr file becomes an OME-Zarr
+        # multiscale image that can be opened directly in viewers. The full resolution array is still named 'data' and the
+        # levels 'data_s1', 'data_s2', etc. Only available when 'TEST.BY_CHUNKS.FORMAT' is 'Zarr'. The OME-Zarr axes order
+        # requirements are only met when 'TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER' follows 'TCZYX' order, e.g. 'CZYX' or 'ZYX'.
+        _C.TEST.BY_CHUNKS.PYRAMID = CN()
+        _C.TEST.BY_CHUNKS.PYRAMID.ENABLE = False
+        # Number of downsampled levels
+        _C.TEST.BY_CHUNKS.PYRAMID.LEVELS = 3
+        # Downsampling factor between consecutive levels in (z, y, x) order. Each voxel of a level is the mean of the voxels it covers
+        _C.TEST.BY_CHUNKS.PYRAMID.DOWNSCALE = [1, 2, 2]
         # Order of the axes of the image when using Zarr/H5 images in test data.
         _C.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER = "TZCYX"
         # Order of the axes of the mask when using Zarr/H5 images in test data.
@@ -922,6 +1019,33 @@ class Config:
         #      memory to process the entire prediction image with 'entire_pred'.
         #    * 'entire_pred': the predicted image will be loaded in memory and processed entirely (be aware of your  memory budget)
         _C.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE = "chunk_by_chunk"
+        # Backend used to run the model during inference. Only available when 'MODEL.SOURCE' is "biapy". Options:
+        #    * 'eager': the model is called as a regular Pytorch module.
+        #    * 'compile': the model is compiled with 'torch.compile'.
+        #    * 'torchscript': the model is traced, frozen and optimized with TorchScript.
+        #    * 'onnx': the model is exported to ONNX and run with ONNX Runtime in the CPU ('onnxruntime' package needed).
+        # The input shape of the non-eager backends is fixed to 'DATA.PATCH_SIZE' (inputs with other shape, e.g. with
+        # 'TEST.FULL_IMG', are passed through the eager model).
+        _C.TEST.BACKEND = CN()
+        _C.TEST.BACKEND.TYPE = "eager"
+        # Whether to fold BatchNorm layers into the preceding convolutions. Only applied in non-eager backends
+        _C.TEST.BACKEND.FOLD_BN = True
+        # Whether to store the exported artifacts next to the checkpoint, named after its hash and the device, so they
+        # are reused by later jobs. Only used by 'torchscript' and 'onnx'. 'compile' relies on the inductor cache, whose
+        # location can be set with the TORCHINDUCTOR_CACHE_DIR environment variable before launching the job
+        _C.TEST.BACKEND.CACHE = True
+
+        # INT8 post-training quantization for CPU inference. Only available when 'MODEL.SOURCE' is "biapy". Convolutions of
+        # 'unet', 'resunet', 'resunet++', 'attention_unet', 'multiresunet', 'seunet', 'resunet_se', 'edsr', 'rcan', 'dfcan'
+        # and 'wdsr' are statically quantized whereas only the linear layers are quantized (dynamically) in 'vit' and 'unetr'.
+        # The quantized model is cached next to the checkpoint, so training data is only needed the first time to calibrate it
+        _C.TEST.QUANTIZATION = CN()
+        _C.TEST.QUANTIZATION.ENABLE = False
+        # Number of training patches used to calibrate the activation ranges
+        _C.TEST.QUANTIZATION.CALIBRATION_SAMPLES = 64
+        # Whether to compare the loss and metrics of the quantized model against the fp32 one in the validation set. The
+        # report is saved in 'PATHS.QUANTIZATION_REPORT'
+        _C.TEST.QUANTIZATION.REPORT = True
         # Enable verbosity
         _C.TEST.VERBOSE = True
         # Make test-time augmentation. Infer over 8 possible rotations for 2D img and 16 when 3D
@@ -993,6 +1117,10 @@ class Config:
         # account points on the first/last slices and with a border of 15 pixel for x and y axes, this variable could be defined
         # as [1, 15, 15].
         _C.TEST.DET_IGNORE_POINTS_OUTSIDE_BOX = []
+        # Format of the files with the ids of the predicted and GT points of each class, saved in 'PATHS.RESULT_DIR.DET_ASSOC_POINTS'
+        # when GT is available. Only the points are saved, one row per point with its id and coordinates. Options: 'none' (do not save
+        # them), 'csv' and 'parquet' ('pyarrow' or 'fastparquet' package needed)
+        _C.TEST.DET_PRED_IDS_FORMAT = "csv"
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Post-processing
@@ -1022,6 +1150,8 @@ class Config:
         # 'perimeter', 'sphericity' (3D)
         _C.TEST.POST_PROCESSING.MEASURE_PROPERTIES = CN()
         _C.TEST.POST_PROCESSING.MEASURE_PROPERTIES.ENABLE = False
+        # Number of processes used to measure the instances. 1 to run serially and 0 to use all available cores
+        _C.TEST.POST_PROCESSING.MEASURE_PROPERTIES.NUM_WORKERS = 1
         # Remove instances by the conditions based in each instance properties. The three variables, TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.PROPS,
         # TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.VALUES and TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.SIGN will compose a list
         # of conditions to remove the instances. They are list of list of conditions. For instance, the conditions can be like this: [['A'], ['B','C']]. Then, if the instance satisfies
@@ -1093,6 +1223,12 @@ class Config:
         # Threshold to be applied to the 'M' channel when expanding the instances with Voronoi. Need to be in [0,1] range.
         # Leave it to 0 to adjust the threhold with Otsu
         _C.TEST.POST_PROCESSING.VORONOI_TH = 0.0
+        # Block shape, in (z,y,x) order, to apply Voronoi block-wise in 3D and bound the memory used. Empty to process the
+        # whole volume at once, except in 'TEST.BY_CHUNKS' where 'DATA.PATCH_SIZE' is used. E.g. [128, 512, 512]
+        _C.TEST.POST_PROCESSING.VORONOI_BLOCK_SIZE = []
+        # Voxels added on each side of every Voronoi block, in (z,y,x) order. It should be close to the largest distance
+        # between a voxel to fill and its closest instance
+        _C.TEST.POST_PROCESSING.VORONOI_BLOCK_HALO = [8, 32, 32]
         # Set it to try to repare large instances by merging their neighbors with them and removing possible central holes.
         # Its value determines which instances are going to be repared by size (number of pixels that compose the instance)
         # This option is useful when PROBLEM.INSTANCE_SEG.DATA_CHANNELS is 'BP', as multiple central seeds may appear in big
@@ -1122,6 +1258,9 @@ class Config:
         _C.TEST.POST_PROCESSING.DET_WATERSHED_DONUTS_PATCH = [13, 120, 120]
         # Diameter (in pixels) that a cell need to have to be considered as donuts type
         _C.TEST.POST_PROCESSING.DET_WATERSHED_DONUTS_NUCLEUS_DIAMETER = 30
+        # Number of processes used to dilate the 'donuts' type cells and, when 'PROBLEM.DETECTION.DATA_CHECK_MW' is enabled,
+        # to save the files used to analize them. 1 to run serially and 0 to use all available cores
+        _C.TEST.POST_PROCESSING.DET_WATERSHED_NUM_WORKERS = 1
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Auxiliary paths
@@ -1182,9 +1321,10 @@ class Config:
         _C.PATHS.CHECKPOINT = os.path.join(job_dir, "checkpoints")
         # Checkpoint file to load/store the model weights
         _C.PATHS.CHECKPOINT_FILE = ""
-        # Name of the folder to store the probability map to avoid recalculating it on every run
+        # Name of the folder to store the foreground-biased crop samplers ('DATA.PROBABILITY_MAP') to avoid recalculating
+        # them on every run
         _C.PATHS.PROB_MAP_DIR = os.path.join(job_dir, "prob_map")
-        _C.PATHS.PROB_MAP_FILENAME = "prob_map.npy"
+        _C.PATHS.PROB_MAP_FILENAME = "crop_samplers.npz"
         # Watershed debugging folder
         _C.PATHS.WATERSHED_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, "watershed")
         # Custom mean normalization paths
@@ -1197,6 +1337,10 @@ class Config:
         _C.PATHS.UPR_Y_FILE = os.path.join(_C.PATHS.CHECKPOINT, "upper_bound_Y_perc.npy")
         # Path where the images used in MAE will be saved suring inference
         _C.PATHS.MAE_OUT_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, "MAE_checks")
+        # File where the metric drift of the quantized model is saved
+        _C.PATHS.QUANTIZATION_REPORT = os.path.join(_C.PATHS.RESULT_DIR.PATH, "quantization_report.json")
+        # Directory where the time spent in each stage is saved when 'LOG.STAGE_TIMING' is enabled
+        _C.PATHS.STAGE_TIMING_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, "stage_timing")
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Logging
@@ -1206,6 +1350,13 @@ class Config:
         _C.LOG.TENSORBOARD_LOG_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, "tensorboard")
         _C.LOG.LOG_FILE_PREFIX = job_identifier
         _C.LOG.CHART_CREATION_FREQ = 5
+        # Whether to record the wall time and the voxels processed by each stage of training (data loading, forward,
+        # backward, metrics and validation) and inference (loading, normalization, cropping in patches, test-time
+        # augmentation, forward, merging, post-processing, metrics and writing). At the end of each phase a summary
+        # table is printed and saved, together with a trace that can be opened in 'chrome://tracing' or Perfetto, in
+        # 'PATHS.STAGE_TIMING_DIR'. CUDA is synchronized after the forward passes to measure them correctly, which may
+        # slow down a bit the run.
+        _C.LOG.STAGE_TIMING = False
 
         self._C = _C
 
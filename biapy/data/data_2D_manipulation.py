@@ -714,6 +714,7 @@ def merge_data_with_overlap(
     verbose=True,
     out_dir=None,
     prefix="",
+    blending="average",
 ):
     """
     Merge data with an amount of overlap.
@@ -750,6 +751,11 @@ def merge_data_with_overlap(
     prefix : str, optional
         Prefix to save overlap map with.
 
+    blending : str, optional
+        How to merge the overlapping regions of ``data``. Options: ``average``, to average all the patches, and
+        ``spline`` or ``gaussian``, to weight each patch with a window of that type so the pixels near the patch
+        borders contribute less. ``data_mask`` is always averaged.
+
     Returns
     -------
     merged_data : 4D Numpy array
@@ -861,6 +867,9 @@ def merge_data_with_overlap(
     if (overlap[0] >= 1 or overlap[0] < 0) and (overlap[1] >= 1 or overlap[1] < 0):
         raise ValueError("'overlap' values must be floats between range [0, 1)")
 
+    if blending not in ["average", "spline", "gaussian"]:
+        raise ValueError("'blending' needs to be one between ['average', 'spline', 'gaussian']")
+
     padding = tuple(padding[i] for i in [1, 0])
 
     # Remove the padding
@@ -883,6 +892,11 @@ def merge_data_with_overlap(
     ov_map_counter = np.zeros(original_shape[:-1] + (1,), dtype=np.int32)
     if out_dir is not None:
         crop_grid = np.zeros(original_shape[1:], dtype=np.int32)
+    if blending != "average":
+        from biapy.data.post_processing.smooth_tiled_predictions import blending_window
+
+        window = blending_window(data.shape[1:3], mode=blending)
+        weight_map = np.zeros(original_shape[:-1] + (1,), dtype=np.float32)
 
     # Calculate overlapping variables
     overlap_x = 1 if overlap[0] == 0 else 1 - overlap[0]
@@ -931,11 +945,23 @@ def merge_data_with_overlap(
                 d_y = 0 if (y * step_y + data.shape[1]) < original_shape[1] else last_y
                 d_x = 0 if (x * step_x + data.shape[2]) < original_shape[2] else last_x
 
-                merged_data[
-                    z,
-                    y * step_y - d_y : y * step_y + data.shape[1] - d_y,
-                    x * step_x - d_x : x * step_x + data.shape[2] - d_x,
-                ] += data[c]
+                if blending != "average":
+                    merged_data[
+                        z,
+                        y * step_y - d_y : y * step_y + data.shape[1] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[2] - d_x,
+                    ] += (data[c] * window)
+                    weight_map[
+                        z,
+                        y * step_y - d_y : y * step_y + data.shape[1] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[2] - d_x,
+                    ] += window
+                else:
+                    merged_data[
+                        z,
+                        y * step_y - d_y : y * step_y + data.shape[1] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[2] - d_x,
+                    ] += data[c]
 
                 if data_mask is not None:
                     merged_data_mask[
@@ -970,7 +996,10 @@ def merge_data_with_overlap(
 
                 c += 1
 
-    merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
+    if blending != "average":
+        merged_data = np.true_divide(merged_data, weight_map).astype(data.dtype)
+    else:
+        merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
     if data_mask is not None:
         merged_data_mask = np.true_divide(merged_data_mask, ov_map_counter).astype(data_mask.dtype)
 
@@ -1,6 +1,7 @@
 import math
 import os
 import h5py
+from collections import OrderedDict
 import numpy as np
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split, StratifiedKFold
@@ -13,6 +14,12 @@ from biapy.utils.util import (
 )
 from biapy.utils.misc import is_main_process
 
+# Maximum number of H5/Zarr files kept open by each process in ``_OPEN_FILES_CACHE``
+MAX_OPEN_FILES = 32
+# Open H5/Zarr files, per process, to read patches from. Keys are ``(pid, filepath, data_path)`` and values
+# ``(file, data)`` tuples as returned by ``read_chunked_data``/``read_chunked_nested_data``
+_OPEN_FILES_CACHE = OrderedDict()
+
 
 def load_and_prepare_3D_data(
     train_path,
@@ -940,7 +947,9 @@ def load_3D_efficient_files(
     return data_info, data_total_patches
 
 
-def load_img_part_from_efficient_file(filepath, patch_coords, data_axis_order="ZYXC", data_path=None):
+def load_img_part_from_efficient_file(
+    filepath, patch_coords, data_axis_order="ZYXC", data_path=None, cache_file=False
+):
     """
     Loads from ``filepath`` the patch determined by ``patch_coords``.
 
@@ -958,12 +967,19 @@ def load_img_part_from_efficient_file(filepath, patch_coords, data_axis_order="Z
     data_path : str, optional
         Path to find the data within the Zarr file. E.g. 'volumes.labels.neuron_ids'.
 
+    cache_file : bool, optional
+        Keep the file open after reading the patch, and reuse it in next calls, through
+        :func:`~get_cached_efficient_file`. Useful when many patches are read from the same file, e.g. by the
+        DataLoader workers.
+
     Returns
     -------
     img : Numpy array
         Extracted patch. E.g. ``(z, y, x, channels)``.
     """
-    if data_path is not None:
+    if cache_file:
+        imgfile, img = get_cached_efficient_file(filepath, data_path)
+    elif data_path is not None:
         imgfile, img = read_chunked_nested_data(filepath, data_path)
     else:
         imgfile, img = read_chunked_data(filepath)
@@ -983,12 +999,71 @@ def load_img_part_from_efficient_file(filepath, patch_coords, data_axis_order="Z
     )
     img = np.squeeze(np.array(img[data_ordered_slices]))
 
-    if isinstance(imgfile, h5py.File):
+    if not cache_file and isinstance(imgfile, h5py.File):
         imgfile.close()
 
     return img
 
 
+def get_cached_efficient_file(filepath, data_path=None):
+    """
+    Returns ``filepath`` opened, reusing the file already opened by this process if there is one. Up to
+    ``MAX_OPEN_FILES`` files are kept open, closing the least recently used one when that number is exceeded.
+
+    The cache is keyed by process id so each DataLoader worker opens its own handles: H5 files opened before
+    forking can not be safely shared with the child processes.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the Zarr/H5 file.
+
+    data_path : str, optional
+        Path to find the data within the Zarr file. E.g. 'volumes.labels.neuron_ids'.
+
+    Returns
+    -------
+    file : str or h5py.File
+        Opened file.
+
+    data : Zarr or H5 dataset
+        Data of the file.
+    """
+    pid = os.getpid()
+    key = (pid, filepath, data_path)
+    if key in _OPEN_FILES_CACHE:
+        _OPEN_FILES_CACHE.move_to_end(key)
+        return _OPEN_FILES_CACHE[key]
+
+    # Forget the handles inherited from the parent process. They are not closed as they still belong to it
+    for k in [k for k in _OPEN_FILES_CACHE if k[0] != pid]:
+        del _OPEN_FILES_CACHE[k]
+
+    if data_path is not None:
+        opened = read_chunked_nested_data(filepath, data_path)
+    else:
+        opened = read_chunked_data(filepath)
+    _OPEN_FILES_CACHE[key] = opened
+
+    while len(_OPEN_FILES_CACHE) > MAX_OPEN_FILES:
+        _, (file, _) = _OPEN_FILES_CACHE.popitem(last=False)
+        if isinstance(file, h5py.File):
+            file.close()
+
+    return opened
+
+
+def close_cached_efficient_files():
+    """
+    Closes all the files opened by this process through :func:`~get_cached_efficient_file`.
+    """
+    pid = os.getpid()
+    for key in list(_OPEN_FILES_CACHE):
+        file, _ = _OPEN_FILES_CACHE.pop(key)
+        if key[0] == pid and isinstance(file, h5py.File):
+            file.close()
+
+
 def crop_3D_data_with_overlap(
     data,
     vol_shape,
@@ -1126,34 +1201,9 @@ def crop_3D_data_with_overlap(
                 )
             )
 
-    padded_data = np.pad(
-        data,
-        (
-            (padding[0], padding[0]),
-            (padding[1], padding[1]),
-            (padding[2], padding[2]),
-            (0, 0),
-        ),
-        "reflect",
-    )
+    padded_data = pad_3D_data_for_crop(data, padding, median_padding=median_padding)
     if data_mask is not None:
-        padded_data_mask = np.pad(
-            data_mask,
-            (
-                (padding[0], padding[0]),
-                (padding[1], padding[1]),
-                (padding[2], padding[2]),
-                (0, 0),
-            ),
-            "reflect",
-        )
-    if median_padding:
-        padded_data[0 : padding[0], :, :, :] = np.median(data[0, :, :, :])
-        padded_data[padding[0] + data.shape[0] : 2 * padding[0] + data.shape[0], :, :, :] = np.median(data[-1, :, :, :])
-        padded_data[:, 0 : padding[1], :, :] = np.median(data[:, 0, :, :])
-        padded_data[:, padding[1] + data.shape[1] : 2 * padding[1] + data.shape[0], :, :] = np.median(data[:, -1, :, :])
-        padded_data[:, :, 0 : padding[2], :] = np.median(data[:, :, 0, :])
-        padded_data[:, :, padding[2] + data.shape[2] : 2 * padding[2] + data.shape[2], :] = np.median(data[:, :, -1, :])
+        padded_data_mask = pad_3D_data_for_crop(data_mask, padding)
     padded_vol_shape = vol_shape
 
     # Calculate overlapping variables
@@ -1241,6 +1291,130 @@ def crop_3D_data_with_overlap(
         return cropped_data
 
 
+def pad_3D_data_for_crop(data, padding, median_padding=False):
+    """
+    Pad 3D data as done in :func:`~crop_3D_data_with_overlap` before extracting the patches.
+
+    Parameters
+    ----------
+    data : 4D Numpy array
+        Data to pad. E.g. ``(z, y, x, channels)``.
+
+    padding : tuple of ints
+        Size of padding to be added on each axis ``(z, y, x)``. E.g. ``(24, 24, 24)``.
+
+    median_padding : bool, optional
+        If ``True`` the padding value is the median value. If ``False``, the added values are zero.
+
+    Returns
+    -------
+    padded_data : 4D Numpy array
+        Padded data. E.g. ``(z + 2*padding[0], y + 2*padding[1], x + 2*padding[2], channels)``.
+    """
+    padded_data = np.pad(
+        data,
+        (
+            (padding[0], padding[0]),
+            (padding[1], padding[1]),
+            (padding[2], padding[2]),
+            (0, 0),
+        ),
+        "reflect",
+    )
+    if median_padding:
+        padded_data[0 : padding[0], :, :, :] = np.median(data[0, :, :, :])
+        padded_data[padding[0] + data.shape[0] : 2 * padding[0] + data.shape[0], :, :, :] = np.median(data[-1, :, :, :])
+        padded_data[:, 0 : padding[1], :, :] = np.median(data[:, 0, :, :])
+        padded_data[:, padding[1] + data.shape[1] : 2 * padding[1] + data.shape[1], :, :] = np.median(data[:, -1, :, :])
+        padded_data[:, :, 0 : padding[2], :] = np.median(data[:, :, 0, :])
+        padded_data[:, :, padding[2] + data.shape[2] : 2 * padding[2] + data.shape[2], :] = np.median(data[:, :, -1, :])
+    return padded_data
+
+
+def get_3D_overlap_tiling(orig_vol_shape, vol_shape, overlap=(0, 0, 0), padding=(0, 0, 0)):
+    """
+    Calculate the position of the patches extracted by :func:`~crop_3D_data_with_overlap`, without extracting them.
+    The patches are ordered as in that function, i.e. as ``itertools.product(*starts)``.
+
+    Parameters
+    ----------
+    orig_vol_shape : tuple of ints
+        Shape of the volume to crop. E.g. ``(z, y, x)``.
+
+    vol_shape : tuple of ints
+        Shape of the patches, including the padding. E.g. ``(z, y, x)``.
+
+    overlap : Tuple of 3 floats, optional
+        Amount of minimum overlap on x, y and z dimensions. The values must be on range ``[0, 1)``. E.g. ``(z, y, x)``.
+
+    padding : tuple of ints, optional
+        Size of padding to be added on each axis ``(z, y, x)``. E.g. ``(24, 24, 24)``.
+
+    Returns
+    -------
+    starts : List of 3 lists of ints
+        Start coordinate of the patches on each axis, in ``orig_vol_shape`` coordinates (or in the padded volume
+        coordinates if the padding is taken into account in the patch). E.g. ``[[0, 40], [0, 40, 80], [0, 40, 80]]``.
+    """
+    starts = []
+    for i in range(3):
+        core = vol_shape[i] - 2 * padding[i]
+        ov = 1 if overlap[i] == 0 else 1 - overlap[i]
+        step = int(core * ov)
+        n_patches = math.ceil(orig_vol_shape[i] / step)
+        last = 0 if n_patches == 1 else ((n_patches - 1) * step + vol_shape[i]) - (orig_vol_shape[i] + 2 * padding[i])
+        ov_per_block = last // (n_patches - 1) if n_patches > 1 else 0
+        step -= ov_per_block
+        last -= ov_per_block * (n_patches - 1)
+        starts.append([j * step - (0 if (j * step + core) < orig_vol_shape[i] else last) for j in range(n_patches)])
+    return starts
+
+
+def get_3D_merge_normalization(starts, patch_shape, orig_vol_shape, blending="average"):
+    """
+    Calculate in closed form the sum of the weights that each pixel receives when merging the patches placed in
+    ``starts``. As the patches form a regular grid and the weights are separable, the weight map of the volume is the
+    outer product of the returned 1D arrays, so there is no need to create a full size counter.
+
+    Parameters
+    ----------
+    starts : List of 3 lists of ints
+        Start coordinate of the patches on each axis. See :func:`~get_3D_overlap_tiling`.
+
+    patch_shape : tuple of ints
+        Shape of the patches without the padding. E.g. ``(z, y, x)``.
+
+    orig_vol_shape : tuple of ints
+        Shape of the merged volume. E.g. ``(z, y, x)``.
+
+    blending : str, optional
+        How the overlapping regions are merged. Options: ``average``, ``spline`` and ``gaussian``.
+
+    Returns
+    -------
+    windows : List of 3 1D Numpy arrays
+        Weight of each pixel of the patch on each axis.
+
+    norms : List of 3 1D Numpy arrays
+        Sum of weights of each pixel of the volume on each axis.
+    """
+    if blending != "average":
+        from biapy.data.post_processing.smooth_tiled_predictions import blending_window_1D
+
+    windows, norms = [], []
+    for i in range(3):
+        if blending == "average":
+            window = np.ones(patch_shape[i], dtype=np.float32)
+        else:
+            window = blending_window_1D(patch_shape[i], mode=blending)
+        norm = np.zeros(orig_vol_shape[i], dtype=np.float32)
+        for start in starts[i]:
+            norm[start : start + patch_shape[i]] += window
+        windows.append(window)
+        norms.append(norm)
+    return windows, norms
+
+
 def merge_3D_data_with_overlap(
     data,
     orig_vol_shape,
@@ -1248,6 +1422,7 @@ def merge_3D_data_with_overlap(
     overlap=(0, 0, 0),
     padding=(0, 0, 0),
     verbose=True,
+    blending="average",
 ):
     """
     Merge 3D subvolumes in a 3D volume with a defined overlap.
@@ -1276,6 +1451,11 @@ def merge_3D_data_with_overlap(
     verbose : bool, optional
          To print information about the crop to be made.
 
+    blending : str, optional
+        How to merge the overlapping regions of ``data``. Options: ``average``, to average all the patches, and
+        ``spline`` or ``gaussian``, to weight each patch with a window of that type so the pixels near the patch
+        borders contribute less. ``data_mask`` is always averaged.
+
     Returns
     -------
     merged_data : 4D Numpy array
@@ -1333,6 +1513,9 @@ def merge_3D_data_with_overlap(
     ):
         raise ValueError("'overlap' values must be floats between range [0, 1)")
 
+    if blending not in ["average", "spline", "gaussian"]:
+        raise ValueError("'blending' needs to be one between ['average', 'spline', 'gaussian']")
+
     if verbose:
         print("### MERGE-3D-OV-CROP ###")
         print("Merging {} images into {} with overlapping . . .".format(data.shape, orig_vol_shape))
@@ -1359,7 +1542,13 @@ def merge_3D_data_with_overlap(
             :,
         ]
         merged_data_mask = np.zeros(orig_vol_shape[:3] + (data_mask.shape[-1],), dtype=np.float32)
-    ov_map_counter = np.zeros((orig_vol_shape[:-1] + (1,)), dtype=np.uint16)
+    if blending != "average":
+        from biapy.data.post_processing.smooth_tiled_predictions import blending_window
+
+        window = blending_window(data.shape[1:4], mode=blending)
+        weight_map = np.zeros((orig_vol_shape[:-1] + (1,)), dtype=np.float32)
+    if blending == "average" or data_mask is not None:
+        ov_map_counter = np.zeros((orig_vol_shape[:-1] + (1,)), dtype=np.uint16)
 
     # Calculate overlapping variables
     overlap_z = 1 if overlap[0] == 0 else 1 - overlap[0]
@@ -1422,11 +1611,23 @@ def merge_3D_data_with_overlap(
                 d_y = 0 if (y * step_y + data.shape[2]) < orig_vol_shape[1] else last_y
                 d_x = 0 if (x * step_x + data.shape[3]) < orig_vol_shape[2] else last_x
 
-                merged_data[
-                    z * step_z - d_z : (z * step_z) + data.shape[1] - d_z,
-                    y * step_y - d_y : y * step_y + data.shape[2] - d_y,
-                    x * step_x - d_x : x * step_x + data.shape[3] - d_x,
-                ] += data[c]
+                if blending != "average":
+                    merged_data[
+                        z * step_z - d_z : (z * step_z) + data.shape[1] - d_z,
+                        y * step_y - d_y : y * step_y + data.shape[2] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[3] - d_x,
+                    ] += (data[c] * window)
+                    weight_map[
+                        z * step_z - d_z : (z * step_z) + data.shape[1] - d_z,
+                        y * step_y - d_y : y * step_y + data.shape[2] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[3] - d_x,
+                    ] += window
+                else:
+                    merged_data[
+                        z * step_z - d_z : (z * step_z) + data.shape[1] - d_z,
+                        y * step_y - d_y : y * step_y + data.shape[2] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[3] - d_x,
+                    ] += data[c]
 
                 if data_mask is not None:
                     merged_data_mask[
@@ -1435,14 +1636,18 @@ def merge_3D_data_with_overlap(
                         x * step_x - d_x : x * step_x + data.shape[3] - d_x,
                     ] += data_mask[c]
 
-                ov_map_counter[
-                    z * step_z - d_z : (z * step_z) + data.shape[1] - d_z,
-                    y * step_y - d_y : y * step_y + data.shape[2] - d_y,
-                    x * step_x - d_x : x * step_x + data.shape[3] - d_x,
-                ] += 1
+                if blending == "average" or data_mask is not None:
+                    ov_map_counter[
+                        z * step_z - d_z : (z * step_z) + data.shape[1] - d_z,
+                        y * step_y - d_y : y * step_y + data.shape[2] - d_y,
+                        x * step_x - d_x : x * step_x + data.shape[3] - d_x,
+                    ] += 1
                 c += 1
 
-    merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
+    if blending != "average":
+        merged_data = np.true_divide(merged_data, weight_map).astype(data.dtype)
+    else:
+        merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
 
     if verbose:
         print("**** New data shape is: {}".format(merged_data.shape))
@@ -9,12 +9,16 @@ from torch.utils.data import (
 import numpy as np
 from tqdm import tqdm
 
-from biapy.utils.util import save_tif
+from skimage.io import imread
+
+from biapy.utils.util import save_tif, read_chunked_data
 from biapy.data.pre_processing import (
     calculate_2D_volume_prob_map,
     calculate_3D_volume_prob_map,
     save_tif,
     percentile_clip,
+    DatasetStatistics,
+    load_crop_samplers,
 )
 from biapy.data.generators.pair_data_2D_generator import Pair2DImageDataGenerator
 from biapy.data.generators.pair_data_3D_generator import Pair3DImageDataGenerator
@@ -77,14 +81,13 @@ def create_train_val_augmentors(
         Number of training steps per epoch.
     """
 
-    # Calculate the probability map per image
+    # Calculate the foreground-biased crop sampler of each image
     prob_map = None
     if cfg.DATA.PROBABILITY_MAP and cfg.DATA.EXTRACT_RANDOM_PATCH:
-        if os.path.exists(cfg.PATHS.PROB_MAP_DIR):
-            print("Loading probability map")
-            prob_map_file = os.path.join(cfg.PATHS.PROB_MAP_DIR, cfg.PATHS.PROB_MAP_FILENAME)
-            num_files = len(next(os.walk(cfg.PATHS.PROB_MAP_DIR))[2])
-            prob_map = cfg.PATHS.PROB_MAP_DIR if num_files > 1 else np.load(prob_map_file)
+        prob_map_file = os.path.join(cfg.PATHS.PROB_MAP_DIR, cfg.PATHS.PROB_MAP_FILENAME)
+        if os.path.exists(prob_map_file):
+            print("Loading crop samplers from {}".format(prob_map_file))
+            prob_map = load_crop_samplers(prob_map_file)
         else:
             f_name = calculate_2D_volume_prob_map if cfg.PROBLEM.NDIM == "2D" else calculate_3D_volume_prob_map
             prob_map = f_name(
@@ -95,23 +98,47 @@ def create_train_val_augmentors(
                 save_dir=cfg.PATHS.PROB_MAP_DIR,
             )
 
+    if cfg.DATA.TRAIN.IN_MEMORY:
+        data_mode = "in_memory"
+    else:
+        if (
+            cfg.PROBLEM.NDIM == "3D"
+            and X_train is not None
+            and (isinstance(X_train, list) or isinstance(X_train, dict))
+            and isinstance(X_train[0], dict)
+            and "filepath" in X_train[0]
+            and (".zarr" in X_train[0]["filepath"] or ".h5" in X_train[0]["filepath"])
+        ):
+            data_mode = "chunked_data"
+        else:
+            data_mode = "not_in_memory"
+
     # Normalization checks
     norm_dict = {}
     norm_dict["type"] = cfg.DATA.NORMALIZATION.TYPE
     norm_dict["mask_norm"] = "as_mask"
     norm_dict["application_mode"] = cfg.DATA.NORMALIZATION.APPLICATION_MODE
     norm_dict["enable"] = True
+    norm_dict["on_device"] = cfg.DATA.NORMALIZATION.ON_DEVICE
 
     # Percentile clipping
+    x_stats = None
     if cfg.DATA.NORMALIZATION.PERC_CLIP:
         norm_dict["lower_bound"] = cfg.DATA.NORMALIZATION.PERC_LOWER
         norm_dict["upper_bound"] = cfg.DATA.NORMALIZATION.PERC_UPPER
         if cfg.DATA.NORMALIZATION.APPLICATION_MODE == "dataset":
+            print("Train/Val normalization: computing the percentiles of the training data . . .")
+            x_stats = compute_dataset_statistics(X_train, data_mode, cfg.DATA.TRAIN.PATH)
             (
-                X_train,
                 norm_dict["dataset_X_lower_value"],
                 norm_dict["dataset_X_upper_value"],
-            ) = percentile_clip(X_train, norm_dict["lower_bound"], norm_dict["upper_bound"])
+            ) = x_stats.clip_values(norm_dict["lower_bound"], norm_dict["upper_bound"])
+            if data_mode == "in_memory":
+                X_train, _, _ = percentile_clip(
+                    X_train,
+                    lwr_perc_val=norm_dict["dataset_X_lower_value"],
+                    uppr_perc_val=norm_dict["dataset_X_upper_value"],
+                )
             os.makedirs(os.path.dirname(cfg.PATHS.LWR_X_FILE), exist_ok=True)
             np.save(cfg.PATHS.LWR_X_FILE, norm_dict["dataset_X_lower_value"])
             np.save(cfg.PATHS.UPR_X_FILE, norm_dict["dataset_X_upper_value"])
@@ -124,9 +151,13 @@ def create_train_val_augmentors(
                 print("Train/Val normalization: trying to load std from {}".format(cfg.PATHS.STD_INFO_FILE))
                 if not os.path.exists(cfg.PATHS.MEAN_INFO_FILE) or not os.path.exists(cfg.PATHS.STD_INFO_FILE):
                     print("Train/Val normalization: mean and/or std files not found. Calculating it for the first time")
-                    if isinstance(X_train, np.ndarray):
-                        norm_dict["mean"] = np.mean(X_train)
-                        norm_dict["std"] = np.std(X_train)
+                    if x_stats is None:
+                        x_stats = compute_dataset_statistics(X_train, data_mode, cfg.DATA.TRAIN.PATH)
+                    # Statistics of the data after the percentile clipping, if any
+                    norm_dict["mean"], norm_dict["std"] = x_stats.moments(
+                        norm_dict.get("dataset_X_lower_value", None),
+                        norm_dict.get("dataset_X_upper_value", None),
+                    )
                     os.makedirs(os.path.dirname(cfg.PATHS.MEAN_INFO_FILE), exist_ok=True)
                     np.save(cfg.PATHS.MEAN_INFO_FILE, norm_dict["mean"])
                     np.save(cfg.PATHS.STD_INFO_FILE, norm_dict["std"])
@@ -156,26 +187,18 @@ def create_train_val_augmentors(
             f_name = Pair3DImageDataGenerator
 
     ndim = 3 if cfg.PROBLEM.NDIM == "3D" else 2
-    if cfg.PROBLEM.TYPE != "DENOISING":
+    # Crappify the patches on the fly in the generator unless it is done in the training device
+    ssl_crappify_on_the_fly = (
+        cfg.PROBLEM.TYPE == "SELF_SUPERVISED"
+        and cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "crappify"
+        and cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY
+    )
+    ssl_crappify_in_generator = ssl_crappify_on_the_fly and not cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE
+    if cfg.PROBLEM.TYPE != "DENOISING" and not ssl_crappify_on_the_fly:
         data_paths = [cfg.DATA.TRAIN.PATH, cfg.DATA.TRAIN.GT_PATH]
     else:
         data_paths = [cfg.DATA.TRAIN.PATH]
 
-    if cfg.DATA.TRAIN.IN_MEMORY:
-        data_mode = "in_memory"
-    else:
-        if (
-            cfg.PROBLEM.NDIM == "3D"
-            and X_train is not None
-            and (isinstance(X_train, list) or isinstance(X_train, dict))
-            and isinstance(X_train[0], dict)
-            and "filepath" in X_train[0]
-            and (".zarr" in X_train[0]["filepath"] or ".h5" in X_train[0]["filepath"])
-        ):
-            data_mode = "chunked_data"
-        else:
-            data_mode = "not_in_memory"
-
     if cfg.PROBLEM.TYPE == "CLASSIFICATION" or (
         cfg.PROBLEM.TYPE == "SELF_SUPERVISED" and cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking"
     ):
@@ -327,12 +350,19 @@ def create_train_val_augmentors(
         if cfg.PROBLEM.TYPE == "INSTANCE_SEG":
             dic["instance_problem"] = True
         elif cfg.PROBLEM.TYPE in ["SELF_SUPERVISED", "SUPER_RESOLUTION"]:
-            norm_dict["mask_norm"] = "as_image"
+            # With on the fly crappify the target is created from the already normalized image
+            if not ssl_crappify_on_the_fly:
+                norm_dict["mask_norm"] = "as_image"
+            if ssl_crappify_in_generator:
+                dic["ssl_crappify"] = True
+                dic["ssl_resizing_factor"] = cfg.PROBLEM.SELF_SUPERVISED.RESIZING_FACTOR
+                dic["ssl_noise"] = cfg.PROBLEM.SELF_SUPERVISED.NOISE
+                dic["ssl_random_degradation"] = cfg.PROBLEM.SELF_SUPERVISED.RANDOM_DEGRADATION
         elif cfg.PROBLEM.TYPE == "IMAGE_TO_IMAGE":
             norm_dict["mask_norm"] = "as_image"
             if cfg.PROBLEM.IMAGE_TO_IMAGE.MULTIPLE_RAW_ONE_TARGET_LOADER:
                 dic["multiple_raw_images"] = True
-        elif cfg.PROBLEM.TYPE == "DENOISING":
+        elif cfg.PROBLEM.TYPE == "DENOISING" and not cfg.PROBLEM.DENOISING.N2V_ON_DEVICE:
             dic["n2v"] = True
             dic["n2v_perc_pix"] = cfg.PROBLEM.DENOISING.N2V_PERC_PIX
             dic["n2v_manipulator"] = cfg.PROBLEM.DENOISING.N2V_MANIPULATOR
@@ -346,11 +376,17 @@ def create_train_val_augmentors(
         and cfg.DATA.NORMALIZATION.PERC_CLIP
         and cfg.DATA.NORMALIZATION.APPLICATION_MODE == "dataset"
     ):
+        y_stats = compute_dataset_statistics(Y_train, data_mode, cfg.DATA.TRAIN.GT_PATH)
         (
-            Y_train,
             norm_dict["dataset_Y_lower_value"],
             norm_dict["dataset_Y_upper_value"],
-        ) = percentile_clip(Y_train, norm_dict["lower_bound"], norm_dict["upper_bound"])
+        ) = y_stats.clip_values(norm_dict["lower_bound"], norm_dict["upper_bound"])
+        if data_mode == "in_memory":
+            Y_train, _, _ = percentile_clip(
+                Y_train,
+                lwr_perc_val=norm_dict["dataset_Y_lower_value"],
+                uppr_perc_val=norm_dict["dataset_Y_upper_value"],
+            )
         np.save(cfg.PATHS.LWR_Y_FILE, norm_dict["dataset_Y_lower_value"])
         np.save(cfg.PATHS.UPR_Y_FILE, norm_dict["dataset_Y_upper_value"])
         print(f"Y_train clipped using the following values: {norm_dict}")
@@ -381,23 +417,25 @@ def create_train_val_augmentors(
             else:
                 val_data_mode = "not_in_memory"
 
+    # Validation data not in memory is clipped by the generator when loading each sample
     if (
-        norm_dict["mask_norm"] == "as_image"
-        and cfg.DATA.NORMALIZATION.PERC_CLIP
+        cfg.DATA.NORMALIZATION.PERC_CLIP
         and cfg.DATA.NORMALIZATION.APPLICATION_MODE == "dataset"
+        and val_data_mode == "in_memory"
     ):
         X_val, _, _ = percentile_clip(
             X_val,
             lwr_perc_val=norm_dict["dataset_X_lower_value"],
             uppr_perc_val=norm_dict["dataset_X_upper_value"],
         )
-        Y_val, _, _ = percentile_clip(
-            Y_val,
-            lwr_perc_val=norm_dict["dataset_Y_lower_value"],
-            uppr_perc_val=norm_dict["dataset_Y_upper_value"],
-        )
         print(f"X_val clipped using the following values: {norm_dict}")
-        print(f"Y_val clipped using the following values: {norm_dict}")
+        if norm_dict["mask_norm"] == "as_image":
+            Y_val, _, _ = percentile_clip(
+                Y_val,
+                lwr_perc_val=norm_dict["dataset_Y_lower_value"],
+                uppr_perc_val=norm_dict["dataset_Y_upper_value"],
+            )
+            print(f"Y_val clipped using the following values: {norm_dict}")
 
     if cfg.PROBLEM.TYPE == "CLASSIFICATION" or (
         cfg.PROBLEM.TYPE == "SELF_SUPERVISED" and cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking"
@@ -417,7 +455,7 @@ def create_train_val_augmentors(
             data_mode=val_data_mode,
         )
     else:
-        if cfg.PROBLEM.TYPE != "DENOISING":
+        if cfg.PROBLEM.TYPE != "DENOISING" and not ssl_crappify_on_the_fly:
             data_paths = [cfg.DATA.VAL.PATH, cfg.DATA.VAL.GT_PATH]
         else:
             data_paths = [cfg.DATA.VAL.PATH]
@@ -440,12 +478,19 @@ def create_train_val_augmentors(
         if cfg.PROBLEM.TYPE == "INSTANCE_SEG":
             dic["instance_problem"] = True
         elif cfg.PROBLEM.TYPE in ["SELF_SUPERVISED", "SUPER_RESOLUTION"]:
-            norm_dict["mask_norm"] = "as_image"
+            # With on the fly crappify the target is created from the already normalized image
+            if not ssl_crappify_on_the_fly:
+                norm_dict["mask_norm"] = "as_image"
+            if ssl_crappify_in_generator:
+                dic["ssl_crappify"] = True
+                dic["ssl_resizing_factor"] = cfg.PROBLEM.SELF_SUPERVISED.RESIZING_FACTOR
+                dic["ssl_noise"] = cfg.PROBLEM.SELF_SUPERVISED.NOISE
+                dic["ssl_random_degradation"] = cfg.PROBLEM.SELF_SUPERVISED.RANDOM_DEGRADATION
         elif cfg.PROBLEM.TYPE == "IMAGE_TO_IMAGE":
             norm_dict["mask_norm"] = "as_image"
             if cfg.PROBLEM.IMAGE_TO_IMAGE.MULTIPLE_RAW_ONE_TARGET_LOADER:
                 dic["multiple_raw_images"] = True
-        elif cfg.PROBLEM.TYPE == "DENOISING":
+        elif cfg.PROBLEM.TYPE == "DENOISING" and not cfg.PROBLEM.DENOISING.N2V_ON_DEVICE:
             dic["n2v"] = True
             dic["n2v_perc_pix"] = cfg.PROBLEM.DENOISING.N2V_PERC_PIX
             dic["n2v_manipulator"] = cfg.PROBLEM.DENOISING.N2V_MANIPULATOR
@@ -478,6 +523,12 @@ def create_train_val_augmentors(
     print("Effective batch size: %d" % total_batch_size)
     sampler_train = DistributedSampler(train_generator, num_replicas=world_size, rank=global_rank, shuffle=True)
     print("Sampler_train = %s" % str(sampler_train))
+    # Keep the workers, and the files they have opened, alive between epochs. These options can only be passed to
+    # the DataLoader when multiprocessing loading is used
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs["persistent_workers"] = cfg.SYSTEM.PERSISTENT_WORKERS
+        worker_kwargs["prefetch_factor"] = cfg.SYSTEM.PREFETCH_FACTOR
     train_dataset = DataLoader(
         train_generator,
         sampler=sampler_train,
@@ -485,6 +536,7 @@ def create_train_val_augmentors(
         num_workers=num_workers,
         pin_memory=cfg.SYSTEM.PIN_MEM,
         drop_last=False,
+        **worker_kwargs,
     )
 
     # Validation dataset
@@ -507,11 +559,75 @@ def create_train_val_augmentors(
         num_workers=num_workers,
         pin_memory=cfg.SYSTEM.PIN_MEM,
         drop_last=False,
+        **worker_kwargs,
     )
 
     return train_dataset, val_dataset, data_norm, num_training_steps_per_epoch
 
 
+def compute_dataset_statistics(
+    data: Any,
+    data_mode: str,
+    data_path: Optional[str] = None,
+    max_chunk_size: int = 2**26,
+) -> DatasetStatistics:
+    """
+    Compute the statistics used to normalize a dataset (percentiles, mean and std) image by image, and each image in
+    chunks along its first axis, so the whole dataset never needs to be loaded at once.
+
+    Parameters
+    ----------
+    data : 4D/5D Numpy array, list of 3D/4D Numpy arrays or list of dicts
+        Data as given to the generators. Only used when ``data_mode`` is ``"in_memory"`` or ``"chunked_data"``.
+
+    data_mode : str
+        How the data is provided. One between ``"in_memory"``, ``"not_in_memory"`` and ``"chunked_data"``.
+
+    data_path : str, optional
+        Directory of the images. Used when ``data_mode`` is ``"not_in_memory"``.
+
+    max_chunk_size : int, optional
+        Maximum number of values added to the statistics at once.
+
+    Returns
+    -------
+    stats : DatasetStatistics
+        Statistics of the dataset.
+    """
+    stats = DatasetStatistics()
+
+    def _update(img):
+        # Zarr/H5 datasets and memory-mapped .npy files are only read chunk by chunk
+        step = max(1, max_chunk_size // max(1, int(np.prod(img.shape[1:]))))
+        for i in range(0, img.shape[0], step):
+            stats.update(np.asarray(img[i : i + step]))
+
+    if data_mode == "in_memory":
+        for img in tqdm(data, total=len(data)):
+            _update(img)
+    elif data_mode == "chunked_data":
+        for filepath in tqdm(sorted({sample["filepath"] for sample in data})):
+            fid, img = read_chunked_data(filepath)
+            _update(img)
+            if hasattr(fid, "close"):
+                fid.close()
+    else:
+        assert data_path is not None
+        ids = sorted(next(os.walk(data_path))[2])
+        if len(ids) == 0:  # Zarr folders
+            ids = sorted(next(os.walk(data_path))[1])
+        for id_ in tqdm(ids, total=len(ids)):
+            f = os.path.join(data_path, id_)
+            if id_.endswith(".npy"):
+                img = np.load(f, mmap_mode="r")
+            elif id_.endswith(".zarr") or id_.endswith(".h5") or id_.endswith(".hdf5"):
+                _, img = read_chunked_data(f)
+            else:
+                img = imread(f)
+            _update(img)
+    return stats
+
+
 def create_test_augmentor(
     cfg: type[Config],
     X_test: Any,
@@ -11,6 +11,8 @@ from scipy.ndimage.morphology import binary_dilation
 from scipy.ndimage import rotate
 from typing import Tuple, Any, Union, Optional, List
 
+from biapy.data.pre_processing import ForegroundCropSampler
+
 
 def cutout(
     img: np.ndarray,
@@ -1015,7 +1017,7 @@ def random_crop_pair(
     random_crop_size: Tuple[int, ...],
     val: bool = False,
     draw_prob_map_points: bool = False,
-    img_prob: Optional[np.ndarray] = None,
+    crop_sampler: Optional[ForegroundCropSampler] = None,
     weight_map: Optional[np.ndarray] = None,
     scale: Tuple[int, ...] = (1, 1),
 ) -> Union[
@@ -1046,8 +1048,8 @@ def random_crop_pair(
     draw_prob_map_points : bool, optional
         To return the pixel chosen to be the center of the crop.
 
-    img_prob : Numpy 3D array, optional
-        Probability of each pixel to be chosen as the center of the crop. E. .g. ``(y, x, channels)``.
+    crop_sampler : ForegroundCropSampler, optional
+        Sampler of the pixel chosen as the center of the crop.
 
     weight_map : bool, optional
         Weight map of the given image. E.g. ``(y, x, channels)``.
@@ -1086,17 +1088,10 @@ def random_crop_pair(
     if val:
         y, x, oy, ox = 0, 0, 0, 0
     else:
-        if img_prob is not None:
-            prob = img_prob.ravel()
-
-            # Generate the random coordinates based on the distribution
-            choices = np.prod(img_prob.shape)
-            index = np.random.choice(choices, size=1, p=prob)
-            coordinates = np.unravel_index(index, img_prob.shape)
-            x = int(coordinates[1][0])
-            y = int(coordinates[0][0])
-            ox = int(coordinates[1][0])
-            oy = int(coordinates[0][0])
+        if crop_sampler is not None:
+            # Draw the central pixel of the crop
+            y, x = crop_sampler.sample()
+            oy, ox = y, x
 
             # Adjust the coordinates to be the origin of the crop and control to
             # not be out of the image
@@ -1170,7 +1165,7 @@ def random_3D_crop_pair(
     mask: np.ndarray,
     random_crop_size: Tuple[int, ...],
     val: bool = False,
-    img_prob: Optional[np.ndarray] = None,
+    crop_sampler: Optional[ForegroundCropSampler] = None,
     weight_map: Optional[np.ndarray] = None,
     draw_prob_map_points: bool = False,
     scale: Tuple[int, ...] = (1, 1, 1),
@@ -1199,8 +1194,8 @@ def random_3D_crop_pair(
         If the image provided is going to be used in the validation data. This forces to crop from the origin, e.g.
         ``(0, 0)`` point.
 
-    img_prob : Numpy 4D array, optional
-        Probability of each pixel to be chosen as the center of the crop. E. g. ``(z, y, x, channels)``.
+    crop_sampler : ForegroundCropSampler, optional
+        Sampler of the voxel chosen as the center of the crop.
 
     weight_map : bool, optional
         Weight map of the given image. E.g. ``(y, x, channels)``.
@@ -1251,19 +1246,10 @@ def random_3D_crop_pair(
     if val:
         x, y, z, ox, oy, oz = 0, 0, 0, 0, 0, 0
     else:
-        if img_prob is not None:
-            prob = img_prob.ravel()
-
-            # Generate the random coordinates based on the distribution
-            choices = np.prod(img_prob.shape)
-            index = np.random.choice(choices, size=1, p=prob)
-            coordinates = np.unravel_index(index, shape=img_prob.shape)
-            x = int(coordinates[2])
-            y = int(coordinates[1])
-            z = int(coordinates[0])
-            ox = int(coordinates[2])
-            oy = int(coordinates[1])
-            oz = int(coordinates[0])
+        if crop_sampler is not None:
+            # Draw the central voxel of the crop
+            z, y, x = crop_sampler.sample()
+            oz, oy, ox = z, y, x
 
             # Adjust the coordinates to be the origin of the crop and control to
             # not be out of the volume
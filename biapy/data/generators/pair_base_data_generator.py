@@ -21,7 +21,13 @@ from torch.utils.data import Dataset
 
 from biapy.utils.util import pad_and_reflect, read_chunked_data
 from biapy.data.generators.augmentors import *
-from biapy.data.pre_processing import normalize, norm_range01, percentile_clip
+from biapy.data.pre_processing import (
+    normalize,
+    norm_range01,
+    percentile_clip,
+    crappify,
+    ForegroundCropSampler,
+)
 from biapy.utils.misc import is_main_process
 from biapy.data.data_3D_manipulation import load_img_part_from_efficient_file
 
@@ -295,9 +301,9 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
     resolution : 2D tuple of floats, optional
         Resolution of the given data ``(y,x)``. E.g. ``(8,8)``.
 
-    prob_map : 4D Numpy array or str, optional
-        If it is an array, it should represent the probability map used to make random crops when
-        ``random_crops_in_DA`` is set. If str given should be the path to read these maps from.
+    prob_map : list of ForegroundCropSampler, optional
+        Sampler of the central pixel of the random crops of each image, used when ``random_crops_in_DA`` is set. See
+        :func:`~biapy.data.pre_processing.calculate_2D_volume_prob_map`.
 
     val : bool, optional
         Advise the generator that the images will be to validate the model to not make random crops (as the val.
@@ -333,6 +339,20 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         Nested lists equivalent to ndarray. Must have odd length in each dimension (center pixel is blind spot). ``None``
         implies normal N2V masking.
 
+    ssl_crappify : bool, optional
+        Whether to crappify the sampled patches on the fly to create the input of the self-supervised ``crappify``
+        pretext task. The original patch is used as the target. Used in SELF_SUPERVISED problem type.
+
+    ssl_resizing_factor : float, optional
+        Downsizing factor used to crappify the patches. See :func:`~biapy.data.pre_processing.crappify`.
+
+    ssl_noise : float, optional
+        Number between ``[0,1]`` indicating the std of the Gaussian noise N(0,std) used to crappify the patches.
+
+    ssl_random_degradation : bool, optional
+        Whether to draw, for each patch, the resizing factor from ``[1, ssl_resizing_factor]`` and the noise level
+        from ``[0, ssl_noise]``.
+
     norm_dict : dict, optional
         Normalization instructions.
 
@@ -437,7 +457,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         random_crops_in_DA: bool = False,
         shape: Tuple[int, int, int] = (256, 256, 1),
         resolution: Tuple[int, ...] = (-1,),
-        prob_map: np.ndarray | str | None = None,
+        prob_map: List[ForegroundCropSampler] | None = None,
         val: bool = False,
         n_classes: int = 1,
         extra_data_factor: int = 1,
@@ -446,6 +466,10 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         n2v_manipulator="uniform_withCP",
         n2v_neighborhood_radius: int = 5,
         n2v_structMask=np.array([[0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0]]),
+        ssl_crappify: bool = False,
+        ssl_resizing_factor: float = 4,
+        ssl_noise: float = 0.2,
+        ssl_random_degradation: bool = False,
         norm_dict: Dict | None = None,
         instance_problem: bool = False,
         random_crop_scale: Tuple[int, ...] = (1, 1),
@@ -461,6 +485,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         self.val = val
         self.convert_to_rgb = convert_to_rgb
         self.norm_dict = norm_dict
+        self.norm_on_device = norm_dict.get("on_device", False)
         self.data_mode = data_mode
         self.multiple_raw_images = multiple_raw_images
 
@@ -764,6 +789,12 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
             self.value_manipulation = get_value_manipulation(n2v_manipulator, n2v_neighborhood_radius)
             self.n2v_structMask = n2v_structMask
             self.apply_structN2Vmask_func = apply_structN2Vmask if self.ndim == 2 else apply_structN2Vmask3D
+
+        # Self-supervised options
+        self.ssl_crappify = ssl_crappify
+        self.ssl_resizing_factor = ssl_resizing_factor
+        self.ssl_noise = ssl_noise
+        self.ssl_random_degradation = ssl_random_degradation
         if data_mode == "in_memory":
             del _X
             if self.Y_provided:
@@ -771,13 +802,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
 
         self.prob_map = None
         if random_crops_in_DA and prob_map is not None:
-            if isinstance(prob_map, str):
-                f = sorted(next(os.walk(prob_map))[2])
-                self.prob_map = []
-                for i in range(len(f)):
-                    self.prob_map.append(os.path.join(prob_map, f[i]))
-            else:
-                self.prob_map = prob_map
+            self.prob_map = prob_map
 
         if extra_data_factor > 1:
             self.extra_data_factor = extra_data_factor
@@ -1018,18 +1043,27 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 if self.Y_provided:
                     mask = np.squeeze(mask)
         else:  # self.data_mode == "chunked_data"
-            img = load_img_part_from_efficient_file(self.X[idx]["filepath"], self.X[idx]["patch_coords"])
+            img = load_img_part_from_efficient_file(
+                self.X[idx]["filepath"], self.X[idx]["patch_coords"], cache_file=True
+            )
             if self.Y_provided and self.Y is not None:
-                mask = load_img_part_from_efficient_file(self.Y[idx]["filepath"], self.Y[idx]["patch_coords"])
+                mask = load_img_part_from_efficient_file(
+                    self.Y[idx]["filepath"], self.Y[idx]["patch_coords"], cache_file=True
+                )
         if self.Y_provided:
             img, mask = self.ensure_shape(img, mask)
         else:
             img = self.ensure_shape(img, None)
 
-        if self.norm_dict["enable"] and not first_load and img is not None:
+        # With 'norm_on_device' X (and Y when normalized as an image) is normalized in the device by the workflow
+        if self.norm_dict["enable"] and not first_load and img is not None and not self.norm_on_device:
             img = self.norm_X(img)
         if self.Y_provided:
-            if self.norm_dict["enable"] and not first_load:
+            if (
+                self.norm_dict["enable"]
+                and not first_load
+                and not (self.norm_on_device and self.norm_dict["mask_norm"] == "as_image")
+            ):
                 mask = self.norm_Y(mask)
             return img, mask
         else:
@@ -1056,6 +1090,13 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 lower=self.norm_dict["lower_bound"],
                 upper=self.norm_dict["upper_bound"],
             )
+        elif "dataset_X_lower_value" in self.norm_dict and self.data_mode != "in_memory":
+            # In memory data is clipped once, when the generator is created
+            img, _, _ = percentile_clip(
+                img,
+                lwr_perc_val=self.norm_dict["dataset_X_lower_value"],
+                uppr_perc_val=self.norm_dict["dataset_X_upper_value"],
+            )
 
         if self.norm_dict["type"] == "div":
             img, _ = norm_range01(img)
@@ -1095,6 +1136,12 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                     lower=self.norm_dict["lower_bound"],
                     upper=self.norm_dict["upper_bound"],
                 )
+            elif "dataset_Y_lower_value" in self.norm_dict and self.data_mode != "in_memory":
+                mask, _, _ = percentile_clip(
+                    mask,
+                    lwr_perc_val=self.norm_dict["dataset_Y_lower_value"],
+                    uppr_perc_val=self.norm_dict["dataset_Y_upper_value"],
+                )
 
             if self.norm_dict["type"] == "div":
                 mask, _ = norm_range01(mask)
@@ -1145,14 +1192,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
 
         # Apply random crops if it is selected
         if self.random_crops_in_DA:
-            # Capture probability map
-            if self.prob_map is not None:
-                if isinstance(self.prob_map, list):
-                    img_prob = np.load(self.prob_map[index])
-                else:
-                    img_prob = self.prob_map[index]
-            else:
-                img_prob = None
+            crop_sampler = self.prob_map[index % self.real_length] if self.prob_map is not None else None
 
             # Pad and reflect img/mask if necessary
             img = pad_and_reflect(img, self.shape, verbose=False)
@@ -1163,7 +1203,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 mask,
                 self.shape[: self.ndim],
                 self.val,
-                img_prob=img_prob,
+                crop_sampler=crop_sampler,
                 scale=self.random_crop_scale,
             )
 
@@ -1178,15 +1218,26 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
 
         # Prepare mask when denoising with Noise2Void
         if self.n2v:
-            img, mask = self.prepare_n2v(img)
+            img, mask = self.prepare_n2v(img, index)
+
+        # Create the degraded input when doing self-supervised pretraining
+        if self.ssl_crappify:
+            img, mask = self.prepare_ssl_crappify(img, index)
 
         # If no normalization was applied, as is done with torchvision models, it can be an image of uint16
-        # so we need to convert it to
-        if img.dtype == np.uint16:
+        # so we need to convert it to. When normalizing in the device the original dtype is kept if Pytorch supports it
+        if img.dtype == np.uint16 and not (self.norm_on_device and hasattr(torch, "uint16")):
             img = torch.from_numpy(img.copy().astype(np.float32))
         else:
             img = torch.from_numpy(img.copy())
-        mask = torch.from_numpy(mask.copy().astype(np.float32))
+        if (
+            self.norm_on_device
+            and self.norm_dict["mask_norm"] == "as_image"
+            and (mask.dtype != np.uint16 or hasattr(torch, "uint16"))
+        ):
+            mask = torch.from_numpy(mask.copy())
+        else:
+            mask = torch.from_numpy(mask.copy().astype(np.float32))
 
         return img, mask
 
@@ -1588,14 +1639,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
 
             # Apply random crops if it is selected
             if self.random_crops_in_DA:
-                # Capture probability map
-                if self.prob_map is not None:
-                    if isinstance(self.prob_map, list):
-                        img_prob = np.load(self.prob_map[pos])
-                    else:
-                        img_prob = self.prob_map[pos]
-                else:
-                    img_prob = None
+                crop_sampler = self.prob_map[pos % self.real_length] if self.prob_map is not None else None
 
                 if self.ndim == 2:
                     img, mask, oy, ox, s_y, s_x = random_crop_pair(  # type: ignore
@@ -1603,7 +1647,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                         mask,
                         self.shape[:2],
                         self.val,
-                        img_prob=img_prob,
+                        crop_sampler=crop_sampler,
                         draw_prob_map_points=True,
                         scale=self.random_crop_scale,
                     )
@@ -1613,7 +1657,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                         mask,
                         self.shape[:3],
                         self.val,
-                        img_prob=img_prob,
+                        crop_sampler=crop_sampler,
                         draw_prob_map_points=True,
                     )
                 if save_to_dir:
@@ -1646,9 +1690,12 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                 sample_x[i], sample_y[i] = self.apply_transform(sample_x[i], sample_y[i], e_im=e_img, e_mask=e_mask)
 
             if self.n2v and not self.val:
-                img, mask = self.prepare_n2v(img)
+                img, mask = self.prepare_n2v(img, pos)
                 sample_y[i] = mask
 
+            if self.ssl_crappify:
+                sample_x[i], sample_y[i] = self.prepare_ssl_crappify(sample_x[i], pos)
+
             if save_to_dir:
                 self.save_aug_samples(sample_x[i], sample_y[i], orig_images, i, pos, out_dir, point_dict)
 
@@ -1685,7 +1732,7 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
                     im[k, j] = [v] * im.shape[-1]
         return im
 
-    def prepare_n2v(self, _img):
+    def prepare_n2v(self, _img, index=0):
         """
         Creates Noise2Void mask.
 
@@ -1694,6 +1741,9 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         _img : 3D/4D Numpy array
             Image to wipe some pixels from. E.g. ``(y, x, channels)`` in ``2D`` or ``(z, y, x, channels)`` in ``3D``.
 
+        index : int, optional
+            Index of the sample. In validation it seeds the random generator so each sample gets always the same mask.
+
         Returns
         -------
         img : 3D/4D Numpy array
@@ -1705,24 +1755,62 @@ class PairBaseDataGenerator(Dataset, metaclass=ABCMeta):
         img = _img.copy()
         mask = np.zeros(img.shape[:-1] + (img.shape[-1] * 2,), dtype=np.float32)
 
-        if self.val:
-            np.random.seed(0)
+        # Same mask each epoch for validation. A local generator is used to not reset the global random state
+        rng = np.random.default_rng(self.seed + index) if self.val else None
 
         for c in range(self.Y_channels):
-            coords = self.get_stratified_coords(box_size=self.box_size, shape=self.shape)
+            coords = self.get_stratified_coords(box_size=self.box_size, shape=self.shape, rng=rng)
             indexing = coords + (c,)
             indexing_mask = coords + (c + self.Y_channels,)
             y_val = img[indexing]
-            x_val = self.value_manipulation(img[..., c], coords, self.ndim, self.n2v_structMask)
+            x_val = self.value_manipulation(img[..., c], coords, self.ndim, self.n2v_structMask, rng=rng)
 
             mask[indexing] = y_val
             mask[indexing_mask] = 1
             img[indexing] = x_val
 
             if self.n2v_structMask is not None:
-                self.apply_structN2Vmask_func(img[..., c], coords, self.n2v_structMask)
+                self.apply_structN2Vmask_func(img[..., c], coords, self.n2v_structMask, rng=rng)
         return img, mask
 
+    def prepare_ssl_crappify(self, img, index=0):
+        """
+        Crappifies the image to create the input of the self-supervised ``crappify`` pretext task.
+
+        Parameters
+        ----------
+        img : 3D/4D Numpy array
+            Image to crappify. E.g. ``(y, x, channels)`` in ``2D`` or ``(z, y, x, channels)`` in ``3D``.
+
+        index : int, optional
+            Index of the sample. In validation it seeds the random generator so each sample gets always the same
+            degradation.
+
+        Returns
+        -------
+        crappified_img : 3D/4D Numpy array
+            Crappified image. E.g. ``(y, x, channels)`` in ``2D`` or ``(z, y, x, channels)`` in ``3D``.
+
+        target : 3D/4D Numpy array
+            Original image to be recovered. E.g. ``(y, x, channels)`` in ``2D`` or ``(z, y, x, channels)`` in ``3D``.
+        """
+        # Same degradation each epoch for validation. A local generator is used to not reset the global random state
+        rng = np.random.default_rng(self.seed + index) if self.val else np.random
+
+        resizing_factor, noise_level = self.ssl_resizing_factor, self.ssl_noise
+        if self.ssl_random_degradation:
+            resizing_factor = rng.uniform(1, self.ssl_resizing_factor)
+            noise_level = rng.uniform(0, self.ssl_noise)
+
+        crappified_img = crappify(
+            img,
+            resizing_factor=resizing_factor,
+            add_noise=noise_level > 0,
+            noise_level=noise_level,
+            rng=rng,
+        )
+        return crappified_img, img.copy()
+
     def get_data_normalization(self) -> Dict:
         """Get data normalization."""
         return self.norm_dict
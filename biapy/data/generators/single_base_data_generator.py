@@ -227,6 +227,7 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
         self.convert_to_rgb = convert_to_rgb
         self.data_mode = data_mode
         self.norm_dict = norm_dict
+        self.norm_on_device = norm_dict.get("on_device", False)
 
         # Save paths where the data is stored
         if data_mode == "not_in_memory":
@@ -459,8 +460,8 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
             img = np.load(f) if sample_id.endswith(".npy") else imread(f)
             img = np.squeeze(img)
 
-        # X normalization
-        if self.norm_dict["enable"] and not first_load:
+        # X normalization (done in the device by the workflow with 'norm_on_device')
+        if self.norm_dict["enable"] and not first_load and not self.norm_on_device:
             # Percentile clipping
             if "lower_bound" in self.norm_dict and self.norm_dict["application_mode"] == "image":
                 img, _, _ = percentile_clip(
@@ -468,6 +469,13 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
                     lower=self.norm_dict["lower_bound"],
                     upper=self.norm_dict["upper_bound"],
                 )
+            elif "dataset_X_lower_value" in self.norm_dict and self.data_mode != "in_memory":
+                # In memory data is clipped once, when the generator is created
+                img, _, _ = percentile_clip(
+                    img,
+                    lwr_perc_val=self.norm_dict["dataset_X_lower_value"],
+                    uppr_perc_val=self.norm_dict["dataset_X_upper_value"],
+                )
 
             if self.norm_dict["type"] == "div":
                 img, _ = norm_range01(img)
@@ -526,8 +534,8 @@ class SingleBaseDataGenerator(Dataset, metaclass=ABCMeta):
             img = self.apply_transform(img)
 
         # If no normalization was applied, as is done with torchvision models, it can be an image of uint16
-        # so we need to convert it to
-        if img.dtype == np.uint16:
+        # so we need to convert it to. When normalizing in the device the original dtype is kept if Pytorch supports it
+        if img.dtype == np.uint16 and not (self.norm_on_device and hasattr(torch, "uint16")):
             img = torch.from_numpy(img.copy().astype(np.float32))
         else:
             img = torch.from_numpy(img.copy())
@@ -4,15 +4,14 @@ import os
 import math
 import time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import matplotlib.transforms as transforms
 import fill_voids
 import edt
 from tqdm import tqdm
 from scipy import ndimage as ndi
-from scipy.signal import find_peaks
 from scipy.spatial import cKDTree
-from scipy.spatial.distance import cdist
 from scipy.ndimage.morphology import binary_erosion, binary_dilation
 from scipy.ndimage import rotate, grey_dilation
 from scipy.signal import savgol_filter
@@ -20,9 +19,9 @@ from scipy.ndimage.filters import median_filter
 from scipy.ndimage.measurements import center_of_mass
 from skimage import morphology
 from skimage.morphology import disk, ball, remove_small_objects, dilation, erosion
-from skimage.segmentation import watershed, find_boundaries, relabel_sequential
+from skimage.segmentation import watershed, relabel_sequential
 from skimage.filters import rank, threshold_otsu
-from skimage.measure import label, regionprops_table, marching_cubes, mesh_surface_area
+from skimage.measure import label, regionprops_table, marching_cubes, mesh_surface_area, perimeter
 from skimage.io import imread
 from skimage.exposure import equalize_adapthist
 
@@ -47,6 +46,10 @@ def watershed_by_channels(
     resolution=[1, 1, 1],
     watershed_by_2d_slices=False,
     save_dir=None,
+    num_workers=1,
+    block_size=[],
+    block_halo=[8, 32, 32],
+    otsu_max_samples=2**24,
 ):
     """
     Convert binary foreground probability maps and instance contours to instance masks via watershed segmentation
@@ -108,6 +111,23 @@ def watershed_by_channels(
 
     save_dir :  str, optional
         Directory to save watershed output into.
+
+    num_workers : int, optional
+        Number of processes used for the per-slice morphology, the per-slice watershed (``watershed_by_2d_slices``)
+        and the block-wise watershed (``block_size``). ``1`` runs everything serially and ``0`` uses all available
+        cores.
+
+    block_size : List of ints, optional
+        Block shape, in ``(z,y,x)`` order, in which the 3D volume is split to run the watershed block-wise in parallel.
+        Empty to run a single watershed over the whole volume. E.g. ``[128, 512, 512]``.
+
+    block_halo : List of ints, optional
+        Voxels added on each side of every block, in ``(z,y,x)`` order, so instances crossing block borders grow with
+        enough context. Only the core of each block is kept. E.g. ``[8, 32, 32]``.
+
+    otsu_max_samples : int, optional
+        Maximum number of values subsampled from each channel to build the histogram used to compute Otsu thresholds
+        when ``ths['TYPE']`` is ``'auto'``.
     """
 
     assert channels in [
@@ -123,6 +143,9 @@ def watershed_by_channels(
         "BD",
     ]
 
+    if num_workers == 0:
+        num_workers = os.cpu_count()
+
     def erode_seed_and_foreground():
         nonlocal seed_map
         nonlocal foreground
@@ -131,36 +154,52 @@ def watershed_by_channels(
         if erode_and_dilate_foreground:
             print("Foreground erosion . . .")
 
-        if len(seed_morph_sequence) != 0:
-            morph_funcs = []
-            for operation in seed_morph_sequence:
-                if operation == "dilate":
-                    morph_funcs.append(binary_dilation)
-                elif operation == "erode":
-                    morph_funcs.append(binary_erosion)
-
         image3d = True if seed_map.ndim == 3 else False
         if not image3d:
             seed_map = np.expand_dims(seed_map, 0)
-            foreground = np.expand_dims(foreground, 0)
-
-        for i in tqdm(range(seed_map.shape[0])):
-            if len(seed_morph_sequence) != 0:
-                for k, morph_function in enumerate(morph_funcs):
-                    seed_map[i] = morph_function(seed_map[i], disk(radius=seed_morph_radius[k]))
-
-            if erode_and_dilate_foreground:
-                foreground[i] = binary_dilation(foreground[i], disk(radius=fore_erosion_radius))
-                foreground[i] = binary_erosion(foreground[i], disk(radius=fore_dilation_radius))
+            if foreground is not None:
+                foreground = np.expand_dims(foreground, 0)
+
+        morph_args = (
+            seed_morph_sequence,
+            seed_morph_radius,
+            erode_and_dilate_foreground,
+            fore_erosion_radius,
+            fore_dilation_radius,
+        )
+        fore_slices = foreground if foreground is not None else [None] * len(seed_map)
+        if num_workers > 1 and len(seed_map) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = executor.map(
+                    _morph_seed_and_foreground_slice,
+                    seed_map,
+                    fore_slices,
+                    *[[arg] * len(seed_map) for arg in morph_args],
+                    chunksize=max(1, len(seed_map) // (4 * num_workers)),
+                )
+                for i, (seed_slice, fore_slice) in tqdm(enumerate(results), total=len(seed_map)):
+                    seed_map[i] = seed_slice
+                    if fore_slice is not None:
+                        foreground[i] = fore_slice
+        else:
+            for i in tqdm(range(seed_map.shape[0])):
+                seed_slice, fore_slice = _morph_seed_and_foreground_slice(seed_map[i], fore_slices[i], *morph_args)
+                seed_map[i] = seed_slice
+                if fore_slice is not None:
+                    foreground[i] = fore_slice
 
         if not image3d:
             seed_map = seed_map.squeeze()
-            foreground = foreground.squeeze()
+            if foreground is not None:
+                foreground = foreground.squeeze()
+
+    def otsu(x):
+        return subsampled_threshold_otsu(x, max_samples=otsu_max_samples)
 
     if channels in ["BC", "BCM"]:
         if ths["TYPE"] == "auto":
-            ths["TH_BINARY_MASK"] = threshold_otsu(data[..., 0])
-            ths["TH_CONTOUR"] = threshold_otsu(data[..., 1])
+            ths["TH_BINARY_MASK"] = otsu(data[..., 0])
+            ths["TH_CONTOUR"] = otsu(data[..., 1])
             ths["TH_FOREGROUND"] = ths["TH_BINARY_MASK"] / 2
         seed_map = (data[..., 0] > ths["TH_BINARY_MASK"]) * (data[..., 1] < ths["TH_CONTOUR"])
         foreground = data[..., 0] > ths["TH_FOREGROUND"]
@@ -173,8 +212,8 @@ def watershed_by_channels(
         seed_map = label(seed_map, connectivity=1)
     elif channels in ["C"]:
         if ths["TYPE"] == "auto":
-            ths["TH_BINARY_MASK"] = threshold_otsu(1 - data[..., 0])
-            ths["TH_CONTOUR"] = threshold_otsu(data[..., 0])
+            ths["TH_BINARY_MASK"] = otsu(1 - data[..., 0])
+            ths["TH_CONTOUR"] = otsu(data[..., 0])
             ths["TH_FOREGROUND"] = ths["TH_BINARY_MASK"] / 2
         seed_map = (1 - data[..., 0] > ths["TH_BINARY_MASK"]) * (data[..., 0] < ths["TH_CONTOUR"])
         foreground = 1 - data[..., 0] > ths["TH_FOREGROUND"]
@@ -192,8 +231,8 @@ def watershed_by_channels(
         foreground_probs = np.min(data, axis=-1)
 
         if ths["TYPE"] == "auto":
-            ths["TH_BINARY_MASK"] = threshold_otsu(foreground_probs)
-            ths["TH_CONTOUR"] = threshold_otsu(1 - foreground_probs)
+            ths["TH_BINARY_MASK"] = otsu(foreground_probs)
+            ths["TH_CONTOUR"] = otsu(1 - foreground_probs)
             ths["TH_FOREGROUND"] = ths["TH_BINARY_MASK"] / 2
         seed_map = (foreground_probs > ths["TH_BINARY_MASK"]) * (1 - foreground_probs < ths["TH_CONTOUR"])
         foreground = foreground_probs > ths["TH_FOREGROUND"]
@@ -207,8 +246,8 @@ def watershed_by_channels(
         seed_map = label(seed_map, connectivity=1)
     elif channels in ["BP"]:
         if ths["TYPE"] == "auto":
-            ths["TH_POINTS"] = threshold_otsu(data[..., 1])
-            ths["TH_FOREGROUND"] = threshold_otsu(data[..., 0])
+            ths["TH_POINTS"] = otsu(data[..., 1])
+            ths["TH_FOREGROUND"] = otsu(data[..., 0])
 
         seed_map = data[..., 1] > ths["TH_POINTS"]
         foreground = data[..., 0] > ths["TH_FOREGROUND"]
@@ -242,7 +281,7 @@ def watershed_by_channels(
     elif channels in ["BD"]:
         semantic = data[..., 0]
         if ths["TYPE"] == "auto":
-            ths["TH_BINARY_MASK"] = threshold_otsu(data[..., 0])
+            ths["TH_BINARY_MASK"] = otsu(data[..., 0])
             ths["TH_FOREGROUND"] = ths["TH_BINARY_MASK"] / 2
         seed_map = (data[..., 0] > ths["TH_BINARY_MASK"]) * (data[..., 1] < ths["TH_DISTANCE"])
         foreground = semantic > ths["TH_FOREGROUND"]
@@ -250,8 +289,8 @@ def watershed_by_channels(
     elif channels in ["BCD"]:
         semantic = data[..., 0]
         if ths["TYPE"] == "auto":
-            ths["TH_BINARY_MASK"] = threshold_otsu(data[..., 0])
-            ths["TH_CONTOUR"] = threshold_otsu(data[..., 1])
+            ths["TH_BINARY_MASK"] = otsu(data[..., 0])
+            ths["TH_CONTOUR"] = otsu(data[..., 1])
             ths["TH_FOREGROUND"] = ths["TH_BINARY_MASK"] / 2
 
         seed_map = (
@@ -269,8 +308,8 @@ def watershed_by_channels(
         foreground = None
         if channels == "BCDv2":  # 'BCDv2'
             if ths["TYPE"] == "auto":
-                ths["TH_BINARY_MASK"] = threshold_otsu(data[..., 0])
-                ths["TH_CONTOUR"] = threshold_otsu(data[..., 1])
+                ths["TH_BINARY_MASK"] = otsu(data[..., 0])
+                ths["TH_CONTOUR"] = otsu(data[..., 1])
             seed_map = (
                 (data[..., 0] > ths["TH_BINARY_MASK"])
                 * (data[..., 1] < ths["TH_CONTOUR"])
@@ -289,7 +328,7 @@ def watershed_by_channels(
             del background_seed
         elif channels == "BDv2":  # 'BDv2'
             if ths["TYPE"] == "auto":
-                ths["TH_BINARY_MASK"] = threshold_otsu(data[..., 0])
+                ths["TH_BINARY_MASK"] = otsu(data[..., 0])
             seed_map = (data[..., 0] > ths["TH_BINARY_MASK"]) * (data[..., 1] < ths["TH_DISTANCE"])
             background_seed = binary_dilation((data[..., 1] < ths["TH_DISTANCE"]).astype(np.uint8), iterations=2)
             seed_map = label(seed_map, connectivity=1)
@@ -334,8 +373,32 @@ def watershed_by_channels(
     if watershed_by_2d_slices:
         print("Doing watershed by 2D slices")
         segm = np.zeros(seed_map.shape, dtype=appropiate_dtype)
-        for z in tqdm(range(len(segm))):
-            segm[z] = watershed(-semantic[z], seed_map[z], mask=foreground[z])
+        fore_slices = foreground if foreground is not None else [None] * len(segm)
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = executor.map(
+                    _watershed_slice,
+                    semantic,
+                    seed_map,
+                    fore_slices,
+                    chunksize=max(1, len(segm) // (4 * num_workers)),
+                )
+                for z, segm_slice in tqdm(enumerate(results), total=len(segm)):
+                    segm[z] = segm_slice
+        else:
+            for z in tqdm(range(len(segm))):
+                segm[z] = _watershed_slice(semantic[z], seed_map[z], fore_slices[z])
+    elif len(block_size) > 0 and seed_map.ndim == 3:
+        print("Doing watershed by blocks of {} (halo: {})".format(block_size, block_halo))
+        segm = blockwise_watershed(
+            semantic,
+            seed_map,
+            foreground,
+            block_size,
+            block_halo,
+            num_workers=num_workers,
+            dtype=appropiate_dtype,
+        )
     else:
         segm = watershed(-semantic, seed_map, mask=foreground)
         segm = segm.astype(appropiate_dtype)
@@ -363,6 +426,163 @@ def watershed_by_channels(
     return segm
 
 
+def subsampled_threshold_otsu(data, max_samples=2**24, nbins=256):
+    """
+    Compute Otsu's threshold on the histogram of a regular subsample of ``data``. On large volumes this is much
+    faster than :func:`skimage.filters.threshold_otsu` over all the values.
+
+    Parameters
+    ----------
+    data : Numpy array
+        Data to compute the threshold of. E.g. ``(z, y, x)``.
+
+    max_samples : int, optional
+        Maximum number of values taken from ``data``. A regular stride is used so the subsample is deterministic.
+
+    nbins : int, optional
+        Number of bins of the histogram.
+
+    Returns
+    -------
+    th : float
+        Otsu threshold.
+    """
+    values = data.ravel()
+    if values.size > max_samples:
+        values = values[:: int(math.ceil(values.size / max_samples))]
+    vmin, vmax = float(values.min()), float(values.max())
+    if vmin == vmax:
+        return vmin
+    counts, bin_edges = np.histogram(values, bins=nbins, range=(vmin, vmax))
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    return float(threshold_otsu(hist=(counts, bin_centers)))
+
+
+def _morph_seed_and_foreground_slice(
+    seed_slice,
+    fore_slice,
+    seed_morph_sequence,
+    seed_morph_radius,
+    erode_and_dilate_foreground,
+    fore_erosion_radius,
+    fore_dilation_radius,
+):
+    """Apply the seed morphological sequence and the foreground closing to a single 2D slice."""
+    for k, operation in enumerate(seed_morph_sequence):
+        if operation == "dilate":
+            seed_slice = binary_dilation(seed_slice, disk(radius=seed_morph_radius[k]))
+        elif operation == "erode":
+            seed_slice = binary_erosion(seed_slice, disk(radius=seed_morph_radius[k]))
+
+    if erode_and_dilate_foreground and fore_slice is not None:
+        fore_slice = binary_dilation(fore_slice, disk(radius=fore_erosion_radius))
+        fore_slice = binary_erosion(fore_slice, disk(radius=fore_dilation_radius))
+    return seed_slice, fore_slice
+
+
+def _watershed_slice(semantic_slice, seed_slice, fore_slice):
+    """Run marker controlled watershed on a single 2D slice."""
+    return watershed(-semantic_slice, seed_slice, mask=fore_slice)
+
+
+def _watershed_block(semantic_block, seed_block, fore_block, core_slices):
+    """Run marker controlled watershed on a block (with halo) and return only its core."""
+    return watershed(-semantic_block, seed_block, mask=fore_block)[core_slices]
+
+
+def get_blocks_with_halo(shape, block_size, block_halo):
+    """
+    Split a 3D volume in blocks extended with a halo.
+
+    Parameters
+    ----------
+    shape : Tuple of 3 ints
+        Shape of the volume. E.g. ``(z, y, x)``.
+
+    block_size : List of 3 ints
+        Block shape in ``(z,y,x)`` order. E.g. ``[128, 512, 512]``.
+
+    block_halo : List of 3 ints
+        Voxels added on each side of every block in ``(z,y,x)`` order. E.g. ``[8, 32, 32]``.
+
+    Returns
+    -------
+    blocks : List of tuples
+        For each block, the slices of its core in the volume, the slices of the block plus its halo in the volume and
+        the slices of the core within the block plus its halo.
+    """
+    blocks = []
+    for z in range(0, shape[0], block_size[0]):
+        for y in range(0, shape[1], block_size[1]):
+            for x in range(0, shape[2], block_size[2]):
+                core, halo, core_in_block = [], [], []
+                for start, size, h, dim in zip((z, y, x), block_size, block_halo, shape):
+                    end = min(start + size, dim)
+                    hstart, hend = max(0, start - h), min(dim, end + h)
+                    core.append(slice(start, end))
+                    halo.append(slice(hstart, hend))
+                    core_in_block.append(slice(start - hstart, end - hstart))
+                blocks.append((tuple(core), tuple(halo), tuple(core_in_block)))
+    return blocks
+
+
+def blockwise_watershed(semantic, seed_map, foreground, block_size, block_halo, num_workers=1, dtype=np.uint32):
+    """
+    Run marker controlled watershed on a 3D volume split in blocks. Each block is extended with a halo so the
+    instances that cross block borders grow with enough context, and only its core is written back. As the seeds are
+    labeled over the whole volume before the split, labels are consistent between blocks and no relabeling is needed.
+    Voxels whose seed lies further than the halo from their block are not reached, so the halo should be close to the
+    expected instance radius.
+
+    Parameters
+    ----------
+    semantic : 3D Numpy array
+        Data to run the watershed on (its negative is flooded). E.g. ``(z, y, x)``.
+
+    seed_map : 3D Numpy array
+        Labeled seeds. E.g. ``(z, y, x)``.
+
+    foreground : 3D Numpy array
+        Foreground mask. ``None`` to not restrict the watershed. E.g. ``(z, y, x)``.
+
+    block_size : List of ints
+        Block shape in ``(z,y,x)`` order. E.g. ``[128, 512, 512]``.
+
+    block_halo : List of ints
+        Voxels added on each side of every block in ``(z,y,x)`` order. E.g. ``[8, 32, 32]``.
+
+    num_workers : int, optional
+        Number of processes to run the blocks with.
+
+    dtype : Numpy dtype, optional
+        Dtype of the output.
+
+    Returns
+    -------
+    segm : 3D Numpy array
+        Instances. E.g. ``(z, y, x)``.
+    """
+    segm = np.zeros(seed_map.shape, dtype=dtype)
+    blocks = get_blocks_with_halo(seed_map.shape, block_size, block_halo)
+
+    def block_args(halo, core_in_block):
+        fore_block = foreground[halo] if foreground is not None else None
+        return semantic[halo], seed_map[halo], fore_block, core_in_block
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                (core, executor.submit(_watershed_block, *block_args(halo, core_in_block)))
+                for core, halo, core_in_block in blocks
+            ]
+            for core, future in tqdm(futures, total=len(futures)):
+                segm[core] = future.result()
+    else:
+        for core, halo, core_in_block in tqdm(blocks, total=len(blocks)):
+            segm[core] = _watershed_block(*block_args(halo, core_in_block))
+    return segm
+
+
 def apply_median_filtering(data, axes="xy", mf_size=5):
     """
     Applies a median filtering to the specified axes of the provided data.
@@ -1004,7 +1224,7 @@ def create_th_plot(
     plt.show()
 
 
-def voronoi_on_mask(data, mask, th=0, verbose=False):
+def voronoi_on_mask(data, mask, th=0, verbose=False, block_size=[], block_halo=[8, 32, 32]):
     """Apply Voronoi to the voxels not labeled yet marked by the mask. It is done using distances from the un-labeled
     voxels to the cell perimeters.
 
@@ -1021,12 +1241,17 @@ def voronoi_on_mask(data, mask, th=0, verbose=False):
     th : float, optional
         Threshold used to binarize the input. If th=0, otsu threshold is used.
 
-    thres_small : int, optional
-        Theshold to remove small objects created by the watershed.
-
     verbose : bool, optional
          To print saving information.
 
+    block_size : List of ints, optional
+        Block shape, in ``(z,y,x)`` order, to process 3D volumes block-wise to bound the memory used. Empty to process
+        the whole volume at once. E.g. ``[128, 512, 512]``.
+
+    block_halo : List of ints, optional
+        Voxels added on each side of every block in ``(z,y,x)`` order. Voxels whose closest cell perimeter lies further
+        than the halo from their block take the closest label found within the block and its halo.
+
     Returns
     -------
     data : 4D Numpy array
@@ -1055,21 +1280,39 @@ def voronoi_on_mask(data, mask, th=0, verbose=False):
     else:
         mask = mask[..., 0] + mask[..., 1]
 
-    mask_shape = np.shape(mask)
-
     # Binarize
     if th == 0:
         thresh = threshold_otsu(mask)
     else:
         thresh = th
     binaryMask = mask > thresh
+    del mask
 
+    if len(block_size) == 0:
+        voronoiCyst = _voronoi_block(data, binaryMask)
+    else:
+        voronoiCyst = np.zeros(data.shape, dtype=data.dtype)
+        for core, halo, core_in_block in tqdm(
+            get_blocks_with_halo(data.shape, block_size, block_halo), disable=not verbose
+        ):
+            voronoiCyst[core] = _voronoi_block(data[halo], binaryMask[halo])[core_in_block]
+
+    if image3d:
+        voronoiCyst = voronoiCyst[0]
+
+    return voronoiCyst
+
+
+def _voronoi_block(data, binaryMask):
+    """
+    Assign to each voxel of ``binaryMask`` not labeled in ``data`` the label of its closest cell perimeter voxel, with
+    a single KD-tree query for all of them.
+    """
     # Close to fill holes
     closedBinaryMask = morphology.closing(binaryMask, morphology.ball(radius=5)).astype(np.uint8)
 
     voronoiCyst = data * closedBinaryMask
-    binaryVoronoiCyst = (voronoiCyst > 0) * 1
-    binaryVoronoiCyst = binaryVoronoiCyst.astype("uint8")
+    binaryVoronoiCyst = (voronoiCyst > 0).astype("uint8")
 
     # Cell Perimeter
     erodedVoronoiCyst = morphology.binary_erosion(binaryVoronoiCyst, morphology.ball(radius=2))
@@ -1077,28 +1320,18 @@ def voronoi_on_mask(data, mask, th=0, verbose=False):
 
     # Define ids to fill where there is mask but no labels
     idsToFill = np.argwhere((closedBinaryMask == 1) & (data == 0))
-    labelPerId = np.zeros(np.size(idsToFill))
-
     idsPerim = np.argwhere(cellPerimeter == 1)
-    labelsPerimIds = voronoiCyst[cellPerimeter == 1]
+    if len(idsToFill) == 0 or len(idsPerim) == 0:
+        return voronoiCyst
+    labelsPerimIds = voronoiCyst[tuple(idsPerim.T)]
 
     # Generating voronoi
-    for nId in tqdm(range(1, len(idsToFill))):
-        distCoord = cdist([idsToFill[nId]], idsPerim)
-        idSeedMin = np.argwhere(distCoord == np.min(distCoord))
-        idSeedMin = idSeedMin[0][1]
-        labelPerId[nId] = labelsPerimIds[idSeedMin]
-        voronoiCyst[idsToFill[nId][0], idsToFill[nId][1], idsToFill[nId][2]] = labelsPerimIds[idSeedMin]
-
-    if image3d:
-        data = data[0]
-        mask = mask[0]
-        voronoiCyst = voronoiCyst[0]
-
+    _, closest = cKDTree(idsPerim).query(idsToFill, k=1, workers=-1)
+    voronoiCyst[tuple(idsToFill.T)] = labelsPerimIds[closest]
     return voronoiCyst
 
 
-def remove_close_points(points, radius, resolution, classes=None, ndim=3, return_drops=False):
+def remove_close_points(points, radius, resolution, classes=None, ndim=3, return_drops=False, scores=None):
     """
     Remove all points from ``point_list`` that are at a ``radius``
     or less distance from each other.
@@ -1115,79 +1348,186 @@ def remove_close_points(points, radius, resolution, classes=None, ndim=3, return
         Resolution of the data, in ``(z,y,x)`` to calibrate coordinates.
         E.g. ``[30,8,8]``.
 
+    classes : ndarray of ints, optional
+        Class of each point.
+
     ndim : int, optional
         Number of dimension of the data.
 
     return_drops : bool, optional
         Whether to return or not a list containing the positions of the points removed.
 
+    scores : ndarray of floats, optional
+        Score of each point (e.g. its probability). When given, points with higher score are kept first (greedy
+        non-maximum suppression). If not, the points are visited in the order they are given.
+
     Returns
     -------
-    new_point_list : List of floats
+    new_point_list : ndarray
         New list of points after removing those at a distance of ``radius``
         or less from each other.
     """
     print("Removing close points . . .")
     print("Initial number of points: " + str(len(points)))
 
-    point_list = points.copy()
+    points = np.asarray(points)
     if classes is not None:
-        class_list = classes.copy()
-
-    # Resolution adjust
-    for i in range(len(point_list)):
-        point_list[i][0] = point_list[i][0] * resolution[0]
-        point_list[i][1] = point_list[i][1] * resolution[1]
-        if ndim == 3:
-            point_list[i][2] = point_list[i][2] * resolution[2]
-
-    mynumbers = [tuple(point) for point in point_list]
-
-    if len(mynumbers) == 0:
+        classes = np.asarray(classes)
+    if len(points) == 0:
         return []
 
-    tree = cKDTree(mynumbers)  # build k-dimensional tree
-
-    pairs = tree.query_pairs(radius)  # find all pairs closer than radius
-
-    neighbors = {}  # create dictionary of neighbors
-
-    for i, j in pairs:  # iterate over all pairs
-        if i not in neighbors:
-            neighbors[i] = {j}
-        else:
-            neighbors[i].add(j)
-        if j not in neighbors:
-            neighbors[j] = {i}
-        else:
-            neighbors[j].add(i)
-
-    positions = [i for i in range(0, len(point_list))]
-
-    keep = []
-    discard = set()
-    for node in positions:
-        if node not in discard:  # if node already in discard set: skip
-            keep.append(node)  # add node to keep list
-            discard.update(neighbors.get(node, set()))  # add node's neighbors to discard set
-
-    # points to keep
-    new_point_list = [points[i] for i in keep]
+    # Resolution adjust
+    point_list = points.astype(np.float64)
+    point_list[:, 0] *= resolution[0]
+    point_list[:, 1] *= resolution[1]
+    if ndim == 3:
+        point_list[:, 2] *= resolution[2]
+
+    tree = cKDTree(point_list)  # build k-dimensional tree
+    pairs = tree.query_pairs(radius, output_type="ndarray")  # find all pairs closer than radius
+
+    # Visiting order of the greedy suppression
+    if scores is not None:
+        order = np.argsort(-np.asarray(scores), kind="stable")
+    else:
+        order = np.arange(len(points))
+    rank = np.empty(len(points), dtype=np.int64)
+    rank[order] = np.arange(len(points))
+
+    suppressed = np.zeros(len(points), dtype=bool)
+    if len(pairs) > 0:
+        # Direct each pair from the point visited first to the one visited later, as only the former can suppress the
+        # latter, and group them by the suppressing point (CSR-like)
+        first = np.where(rank[pairs[:, 0]] < rank[pairs[:, 1]], pairs[:, 0], pairs[:, 1])
+        second = np.where(rank[pairs[:, 0]] < rank[pairs[:, 1]], pairs[:, 1], pairs[:, 0])
+        sort_idx = np.argsort(first, kind="stable")
+        first, second = first[sort_idx], second[sort_idx]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(first, minlength=len(points)))])
+
+        # Only the points with neighbors need to be visited
+        for node in order[np.diff(indptr)[order] > 0]:
+            if not suppressed[node]:
+                suppressed[second[indptr[node] : indptr[node + 1]]] = True
+
+    keep = np.nonzero(~suppressed)[0]
+    new_point_list = points[keep]
     print("Final number of points: " + str(len(new_point_list)))
 
+    dropped = np.nonzero(suppressed)[0]
     if classes is not None:
-        new_class_list = [classes[i] for i in keep]
+        new_class_list = classes[keep]
         if return_drops:
-            return new_point_list, new_class_list, list(discard)
+            return new_point_list, new_class_list, dropped
         else:
             return new_point_list, new_class_list
     else:
         if return_drops:
-            return new_point_list, list(discard)
+            return new_point_list, dropped
         else:
             return new_point_list
 
 
+def _donuts_line_analysis(lines):
+    """
+    Look for 'donuts' shape, i.e. a peak at each side of the center that is much brighter than the center, in a batch
+    of smoothed line profiles.
+
+    Parameters
+    ----------
+    lines : 2D Numpy array
+        Line profiles. E.g. ``(num_points, line_length)``.
+
+    Returns
+    -------
+    ushape : 1D Numpy array of bools
+        Whether each line has 'donuts' shape.
+
+    diff_dilation : 1D Numpy array of ints
+        Distance between the highest left and right peaks.
+
+    left_gradient : 1D Numpy array of bools
+        Whether the line decreases enough at the left of the highest left peak.
+
+    right_gradient : 1D Numpy array of bools
+        Whether the line decreases enough at the right of the highest right peak.
+    """
+    n, length = lines.shape
+    mid = length // 2
+    pos = np.arange(length)
+    rows = np.arange(n)
+
+    # Local maximums and minimums
+    peaks = np.zeros(lines.shape, dtype=bool)
+    mins = np.zeros(lines.shape, dtype=bool)
+    peaks[:, 1:-1] = (lines[:, 1:-1] > lines[:, :-2]) & (lines[:, 1:-1] > lines[:, 2:])
+    mins[:, 1:-1] = (lines[:, 1:-1] < lines[:, :-2]) & (lines[:, 1:-1] < lines[:, 2:])
+
+    # Value of the minimum closest to the center
+    has_min = mins.any(axis=1)
+    closest_min = np.argmin(np.where(mins, np.abs(pos - mid), length + 1), axis=1)
+    mid_value = lines[rows, closest_min]
+
+    valid = peaks & (lines >= mid_value[:, None] * 1.5) & has_min[:, None]
+    sides = []
+    for side in [valid & (pos <= mid), valid & (pos > mid)]:
+        values = np.where(side, lines, -np.inf)
+        max_pos = np.argmax(values, axis=1)
+        max_value = values[rows, max_pos]
+        found = side.any(axis=1)
+        max_pos = np.where(max_value > 0, max_pos, -1)
+        max_value = np.where(max_value > 0, max_value, 0.0)
+        sides.append((found, max_pos, max_value))
+    (found_left, max_left_pos, max_left), (found_right, max_right_pos, max_right) = sides
+
+    ushape = found_left & found_right
+    diff_dilation = max_right_pos - max_left_pos
+
+    # Minimum at the left (line[:max_left_pos]) and at the right (line[max_right_pos:]) of the highest peaks
+    prefix_min = np.minimum.accumulate(lines, axis=1)
+    suffix_min = np.minimum.accumulate(lines[:, ::-1], axis=1)[:, ::-1]
+    left_min = prefix_min[rows, np.where(max_left_pos > 0, max_left_pos - 1, length - 2)]
+    right_min = suffix_min[rows, max_right_pos % length]
+    left_gradient = left_min < max_left * 0.7
+    right_gradient = right_min < max_right * 0.7
+
+    return ushape, diff_dilation, left_gradient, right_gradient
+
+
+def _save_donuts_check(check_dir, l, img_patch, line_y, line_x, filtered_y, filtered_x, half_spatch):
+    """Save the patch and the line profiles used to analize a 'donuts' class point."""
+    aux = np.expand_dims(np.expand_dims((img_patch).astype(np.float32), -1), 0)
+    save_tif(aux, check_dir, ["{}_patch.tif".format(l)], verbose=False)
+
+    # Save the verticial and horizontal lines in the patch
+    center = tuple(min(h, s - 1) for h, s in zip(half_spatch, img_patch.shape))
+    patch_y = np.zeros(img_patch.shape, dtype=np.float32)
+    patch_y[center[:-2] + (slice(None), center[-1])] = img_patch[center[:-2] + (slice(None), center[-1])]
+    aux = np.expand_dims(np.expand_dims((patch_y).astype(np.float32), -1), 0)
+    save_tif(aux, check_dir, ["{}_y_line.tif".format(l)], verbose=False)
+
+    patch_x = np.zeros(img_patch.shape, dtype=np.float32)
+    patch_x[center[:-1] + (slice(None),)] = img_patch[center[:-1] + (slice(None),)]
+    aux = np.expand_dims(np.expand_dims((patch_x).astype(np.float32), -1), 0)
+    save_tif(aux, check_dir, ["{}_x_line.tif".format(l)], verbose=False)
+
+    # Save vertical and horizontal line plots, before and after smoothing them
+    for line, name in [
+        (line_y, "line_y"),
+        (line_x, "line_x"),
+        (filtered_y, "line_y_filtered"),
+        (filtered_x, "line_x_filtered"),
+    ]:
+        plt.title("Line graph")
+        plt.plot(list(range(len(line))), line, color="red")
+        plt.savefig(os.path.join(check_dir, "{}_{}.png".format(l, name)))
+        plt.clf()
+
+
+def _dilate_donuts_seed(seed_patch, l, footprint_shape):
+    """Dilate the seed of instance ``l`` within its patch."""
+    return grey_dilation((seed_patch == l) * l, footprint=np.ones(footprint_shape))
+
+
 def detection_watershed(
     seeds,
     coords,
@@ -1199,6 +1539,7 @@ def detection_watershed(
     donuts_patch=[13, 120, 120],
     donuts_nucleus_diameter=30,
     save_dir=None,
+    num_workers=1,
 ):
     """
     Grow given detection seeds.
@@ -1235,7 +1576,12 @@ def detection_watershed(
         Aproximate nucleus diameter for donuts type cells.
 
     save_dir :  str, optional
-        Directory to save watershed output into.
+        Directory to save watershed output into. The patches and line profiles used to analize each 'donuts' class point
+        are also saved there. Set to ``None`` to not save any of them.
+
+    num_workers : int, optional
+        Number of processes used to save the 'donuts' check files and to dilate the 'donuts' cells. ``1`` to run
+        serially and ``0`` to use all available cores.
 
     Returns
     -------
@@ -1252,20 +1598,15 @@ def detection_watershed(
     # Dilate first the seeds if needed
     print("Dilating a bit the seeds . . .")
     seeds = seeds.squeeze()
-    dilated = False
     new_seeds = np.zeros(seeds.shape, dtype=seeds.dtype)
     for i in range(nclasses):
+        class_seeds = (seeds == i + 1).astype(np.uint8)
         if all(x != 0 for x in first_dilation[i]):
-            new_seeds += (binary_dilation(seeds == i + 1, structure=np.ones(first_dilation[i])) * (i + 1)).astype(
-                np.uint8
-            )
-            dilated = True
-        else:
-            new_seeds += ((seeds == i + 1) * (i + 1)).astype(np.uint8)
-    if dilated:
-        seeds = np.clip(new_seeds, 0, nclasses)
+            # Rectangular structure, so a separable maximum filter is enough
+            class_seeds = grey_dilation(class_seeds, size=first_dilation[i], mode="constant", cval=0)
+        new_seeds += class_seeds * (i + 1)
     seeds = new_seeds
-    del new_seeds
+    del new_seeds, class_seeds
 
     # Background seed
     seeds = label(seeds)
@@ -1279,201 +1620,160 @@ def detection_watershed(
 
     # Try to dilate those instances that have 'donuts' like shape and that might have problems with the watershed
     if donuts_classes[0] != -1:
-        for dclass in donuts_classes:
-            class_coords = coords[dclass - 1]
-            nticks = [x // 8 for x in donuts_patch]
-            nticks = [x + (1 - x % 2) for x in nticks]
-            half_spatch = [x // 2 for x in donuts_patch]
-
-            class_check_dir = os.path.join(save_dir, "class_{}_check".format(dclass))
-
-            for i in tqdm(range(len(class_coords)), leave=False):
-                c = class_coords[i]
-
-                # Patch coordinates
-                l = seeds[c[0], c[1], c[2]]
-                if ndim == 2:
-                    y1, y2 = max(c[0] - half_spatch[0], 0), min(c[0] + half_spatch[0], img.shape[0])
-                    x1, x2 = max(c[1] - half_spatch[1], 0), min(c[1] + half_spatch[1], img.shape[1])
-                    img_patch = img[y1:y2, x1:x2]
-                    seed_patch = seeds[y1:y2, x1:x2]
-
-                    # Extract horizontal and vertical line
-                    line_y = img_patch[:, half_spatch[1]]
-                    line_x = img_patch[half_spatch[0], :]
-                else:
-                    z1, z2 = max(c[0] - half_spatch[0], 0), min(c[0] + half_spatch[0], img.shape[0])
-                    y1, y2 = max(c[1] - half_spatch[1], 0), min(c[1] + half_spatch[1], img.shape[1])
-                    x1, x2 = max(c[2] - half_spatch[2], 0), min(c[2] + half_spatch[2], img.shape[2])
-                    img_patch = img[z1:z2, y1:y2, x1:x2]
-                    seed_patch = seeds[z1:z2, y1:y2, x1:x2]
-
-                    # Extract horizontal and vertical line
-                    line_y = img_patch[half_spatch[0], :, half_spatch[2]]
-                    line_x = img_patch[half_spatch[0], half_spatch[1], :]
-
-                fillable_patch = seed_patch.copy()
-                seed_patch = (seed_patch == l) * l
-                fillable_patch = fillable_patch == 0
+        if num_workers == 0:
+            num_workers = os.cpu_count()
+        nticks = [x // 8 for x in donuts_patch]
+        nticks = [x + (1 - x % 2) for x in nticks]
+        half_spatch = [x // 2 for x in donuts_patch]
+        # Vertical (y) and horizontal (x) lines are the last two axes of the patch
+        half_y, half_x = half_spatch[-2], half_spatch[-1]
+
+        # Pad the image so the lines of all the points have the same length
+        pad = [(h, h) for h in half_spatch]
+        padded_img = np.pad(img, pad, mode="edge")
 
-                aux = np.expand_dims(np.expand_dims((img_patch).astype(np.float32), -1), 0)
-                save_tif(aux, class_check_dir, ["{}_patch.tif".format(l)], verbose=False)
+        for dclass in donuts_classes:
+            class_coords = np.array(coords[dclass - 1], dtype=int).reshape(-1, ndim)
+            if len(class_coords) == 0:
+                continue
+            labels = seeds[tuple(class_coords.T)]
+
+            # Extract all vertical and horizontal lines at once. Notice that in the padded image the point 'c' is placed
+            # in 'c + half_spatch'
+            ky, kx = np.arange(2 * half_y), np.arange(2 * half_x)
+            if ndim == 2:
+                lines_y = padded_img[class_coords[:, :1] + ky, class_coords[:, 1:2] + half_spatch[1]]
+                lines_x = padded_img[class_coords[:, :1] + half_spatch[0], class_coords[:, 1:2] + kx]
+            else:
+                lines_y = padded_img[
+                    class_coords[:, :1] + half_spatch[0],
+                    class_coords[:, 1:2] + ky,
+                    class_coords[:, 2:3] + half_spatch[2],
+                ]
+                lines_x = padded_img[
+                    class_coords[:, :1] + half_spatch[0],
+                    class_coords[:, 1:2] + half_spatch[1],
+                    class_coords[:, 2:3] + kx,
+                ]
+            lines_y, lines_x = lines_y.astype(np.float32), lines_x.astype(np.float32)
+
+            # Smooth them to analize easily
+            filtered_y = savgol_filter(lines_y, nticks[-2], 2, axis=-1)
+            filtered_x = savgol_filter(lines_x, nticks[-1], 2, axis=-1)
+
+            # Find the donuts shape cells
+            ushape_y, y_diff_dilation, y_left_gradient, y_right_gradient = _donuts_line_analysis(filtered_y)
+            ushape_x, x_diff_dilation, x_left_gradient, x_right_gradient = _donuts_line_analysis(filtered_x)
+            donuts = np.nonzero(ushape_y & ushape_x)[0]
+            print(
+                "Class {}: {} of {} instances have 'donuts' shape".format(dclass, len(donuts), len(class_coords))
+            )
 
-                # Save the verticial and horizontal lines in the patch to debug
-                patch_y = np.zeros(img_patch.shape, dtype=np.float32)
-                if ndim == 2:
-                    patch_y[:, half_spatch[1]] = img_patch[:, half_spatch[1]]
+            # Save the patches and lines to debug
+            if save_dir is not None:
+                class_check_dir = os.path.join(save_dir, "class_{}_check".format(dclass))
+                os.makedirs(class_check_dir, exist_ok=True)
+                check_args = []
+                for i, c in enumerate(class_coords):
+                    patch_slices = tuple(
+                        slice(max(c[d] - half_spatch[d], 0), min(c[d] + half_spatch[d], img.shape[d]))
+                        for d in range(ndim)
+                    )
+                    check_args.append(
+                        (
+                            class_check_dir,
+                            labels[i],
+                            img[patch_slices],
+                            lines_y[i],
+                            lines_x[i],
+                            filtered_y[i],
+                            filtered_x[i],
+                            half_spatch,
+                        )
+                    )
+                if num_workers > 1:
+                    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                        list(
+                            executor.map(
+                                _save_donuts_check,
+                                *zip(*check_args),
+                                chunksize=max(1, len(check_args) // (4 * num_workers)),
+                            )
+                        )
                 else:
-                    patch_y[half_spatch[0], :, half_spatch[2]] = img_patch[half_spatch[0], :, half_spatch[2]]
-
-                aux = np.expand_dims(np.expand_dims((patch_y).astype(np.float32), -1), 0)
-                save_tif(aux, class_check_dir, ["{}_y_line.tif".format(l)], verbose=False)
-
-                patch_x = np.zeros(img_patch.shape, dtype=np.float32)
+                    for args in tqdm(check_args, leave=False):
+                        _save_donuts_check(*args)
+                del check_args
+
+            # Calculate the dilation to be made based on the nucleus size
+            dilation_args = []
+            for i in donuts:
+                c, l = class_coords[i], labels[i]
                 if ndim == 2:
-                    patch_x[half_spatch[0], :] = img_patch[half_spatch[0], :]
+                    donuts_cell_dilation = [
+                        y_diff_dilation[i] - first_dilation[dclass - 1][0],
+                        x_diff_dilation[i] - first_dilation[dclass - 1][1],
+                    ]
+                    donuts_cell_dilation = [
+                        donuts_cell_dilation[0] - int(donuts_cell_dilation[0] * 0.4),
+                        donuts_cell_dilation[1] - int(donuts_cell_dilation[1] * 0.4),
+                    ]
                 else:
-                    patch_x[half_spatch[0], half_spatch[1], :] = img_patch[half_spatch[0], half_spatch[1], :]
-                aux = np.expand_dims(np.expand_dims((patch_x).astype(np.float32), -1), 0)
-                save_tif(aux, class_check_dir, ["{}_x_line.tif".format(l)], verbose=False)
-                # Save vertical and horizontal line plots to debug
-                plt.title("Line graph")
-                plt.plot(list(range(len(line_y))), line_y, color="red")
-                plt.savefig(os.path.join(class_check_dir, "{}_line_y.png".format(l)))
-                plt.clf()
-                plt.title("Line graph")
-                plt.plot(list(range(len(line_x))), line_x, color="red")
-                plt.savefig(os.path.join(class_check_dir, "{}_line_x.png".format(l)))
-                plt.clf()
-
-                # Smooth them to analize easily
-                line_y = savgol_filter(line_y, nticks[1], 2)
-                line_x = savgol_filter(line_x, nticks[2], 2)
-
-                # Save vertical and horizontal lines again but now filtered
-                plt.title("Line graph")
-                plt.plot(list(range(len(line_y))), line_y, color="red")
-                plt.savefig(os.path.join(class_check_dir, "{}_line_y_filtered.png".format(l)))
-                plt.clf()
-                plt.title("Line graph")
-                plt.plot(list(range(len(line_x))), line_x, color="red")
-                plt.savefig(os.path.join(class_check_dir, "{}_line_x_filtered.png".format(l)))
-                plt.clf()
-
-                # Find maximums
-                peak_y, _ = find_peaks(line_y)
-                peak_x, _ = find_peaks(line_x)
-
-                # Find minimums
-                mins_y, _ = find_peaks(-line_y)
-                mins_x, _ = find_peaks(-line_x)
-
-                # Find the donuts shape cells
-                # Vertical line
-                mid = len(line_y) // 2
-                mid_value = line_y[min(mins_y, key=lambda x: abs(x - mid))]
-                found_left_peak, found_right_peak = False, False
-                max_right, max_left = 0.0, 0.0
-                max_right_pos, max_left_pos = -1, -1
-                for peak_pos in peak_y:
-                    if line_y[peak_pos] >= mid_value * 1.5:
-                        # Left side
-                        if peak_pos <= mid:
-                            found_left_peak = True
-                            if line_y[peak_pos] > max_left:
-                                max_left = line_y[peak_pos]
-                                max_left_pos = peak_pos
-                        # Right side
-                        else:
-                            found_right_peak = True
-                            if line_y[peak_pos] > max_right:
-                                max_right = line_y[peak_pos]
-                                max_right_pos = peak_pos
-                ushape_in_liney = found_left_peak and found_right_peak
-                y_diff_dilation = max_right_pos - max_left_pos
-                if ushape_in_liney:
-                    y_left_gradient = min(line_y[:max_left_pos]) < max_left * 0.7
-                    y_right_gradient = min(line_y[max_right_pos:]) < max_right * 0.7
-
-                # Horizontal line
-                mid = len(line_x) // 2
-                mid_value = line_x[min(mins_x, key=lambda x: abs(x - mid))]
-                found_left_peak, found_right_peak = False, False
-                max_right, max_left = 0.0, 0.0
-                max_right_pos, max_left_pos = -1, -1
-                for peak_pos in peak_x:
-                    if line_x[peak_pos] >= mid_value * 1.5:
-                        # Left side
-                        if peak_pos <= mid:
-                            found_left_peak = True
-                            if line_x[peak_pos] > max_left:
-                                max_left = line_x[peak_pos]
-                                max_left_pos = peak_pos
-                        # Right side
-                        else:
-                            found_right_peak = True
-                            if line_x[peak_pos] > max_right:
-                                max_right = line_x[peak_pos]
-                                max_right_pos = peak_pos
-                ushape_in_linex = found_left_peak and found_right_peak
-                x_diff_dilation = max_right_pos - max_left_pos
-                if ushape_in_linex:
-                    x_left_gradient = min(line_x[:max_left_pos]) < max_left * 0.7
-                    x_right_gradient = min(line_x[max_right_pos:]) < max_right * 0.7
-
-                # Donuts shape cell found
-                if ushape_in_liney and ushape_in_linex:
-                    # Calculate the dilation to be made based on the nucleus size
-                    if ndim == 2:
-                        donuts_cell_dilation = [
-                            y_diff_dilation - first_dilation[dclass - 1][0],
-                            x_diff_dilation - first_dilation[dclass - 1][1],
-                        ]
-                        donuts_cell_dilation = [
-                            donuts_cell_dilation[0] - int(donuts_cell_dilation[0] * 0.4),
-                            donuts_cell_dilation[1] - int(donuts_cell_dilation[1] * 0.4),
-                        ]
-                    else:
-                        donuts_cell_dilation = [
-                            first_dilation[dclass - 1][0],
-                            y_diff_dilation - first_dilation[dclass - 1][1],
-                            x_diff_dilation - first_dilation[dclass - 1][2],
-                        ]
-                        donuts_cell_dilation = [
-                            donuts_cell_dilation[0],
-                            donuts_cell_dilation[1] - int(donuts_cell_dilation[1] * 0.4),
-                            donuts_cell_dilation[2] - int(donuts_cell_dilation[2] * 0.4),
-                        ]
-
-                    # If the center is not wide the cell is not very large
-                    dilate = True
-                    if x_diff_dilation + y_diff_dilation < donuts_nucleus_diameter * 2:
-                        print("Instance {} has 'donuts' shape but it seems to be not very large!".format(l))
-                    else:
-                        print("Instance {} has 'donuts' shape!".format(l))
-                        if not y_left_gradient:
-                            print("    - Its vertical left part seems to have low gradient")
-                            dilate = False
-                        if not y_right_gradient:
-                            print("    - Its vertical right part seems to have low gradient")
-                            dilate = False
-                        if not x_left_gradient:
-                            print("    - Its horizontal left part seems to have low gradient")
-                            dilate = False
-                        if not x_right_gradient:
-                            print("    - Its horizontal right part seems to have low gradient")
-                            dilate = False
-                    if dilate:
-                        if all(x > 0 for x in donuts_cell_dilation):
-                            seed_patch = grey_dilation(seed_patch, footprint=np.ones((donuts_cell_dilation)))
-                            if ndim == 2:
-                                seeds[y1:y2, x1:x2] += seed_patch * fillable_patch
-                            else:
-                                seeds[z1:z2, y1:y2, x1:x2] += seed_patch * fillable_patch
-                    else:
-                        print("    - Not dilating it!")
+                    donuts_cell_dilation = [
+                        first_dilation[dclass - 1][0],
+                        y_diff_dilation[i] - first_dilation[dclass - 1][1],
+                        x_diff_dilation[i] - first_dilation[dclass - 1][2],
+                    ]
+                    donuts_cell_dilation = [
+                        donuts_cell_dilation[0],
+                        donuts_cell_dilation[1] - int(donuts_cell_dilation[1] * 0.4),
+                        donuts_cell_dilation[2] - int(donuts_cell_dilation[2] * 0.4),
+                    ]
+
+                # If the center is not wide the cell is not very large
+                dilate = True
+                if x_diff_dilation[i] + y_diff_dilation[i] < donuts_nucleus_diameter * 2:
+                    print("Instance {} has 'donuts' shape but it seems to be not very large!".format(l))
                 else:
-                    print("Instance {} checked".format(l))
+                    print("Instance {} has 'donuts' shape!".format(l))
+                    if not y_left_gradient[i]:
+                        print("    - Its vertical left part seems to have low gradient")
+                        dilate = False
+                    if not y_right_gradient[i]:
+                        print("    - Its vertical right part seems to have low gradient")
+                        dilate = False
+                    if not x_left_gradient[i]:
+                        print("    - Its horizontal left part seems to have low gradient")
+                        dilate = False
+                    if not x_right_gradient[i]:
+                        print("    - Its horizontal right part seems to have low gradient")
+                        dilate = False
+                if not dilate:
+                    print("    - Not dilating it!")
+                elif all(x > 0 for x in donuts_cell_dilation):
+                    patch_slices = tuple(
+                        slice(max(c[d] - half_spatch[d], 0), min(c[d] + half_spatch[d], img.shape[d]))
+                        for d in range(ndim)
+                    )
+                    dilation_args.append((patch_slices, l, tuple(donuts_cell_dilation)))
+
+            # The dilation of each instance only depends on its own seed, so they can be computed in parallel. They are
+            # added sequentially as each one can only fill the area not occupied by the previous ones
+            seed_patches = [seeds[s] for s, _, _ in dilation_args]
+            labels_to_dilate = [l for _, l, _ in dilation_args]
+            footprints = [f for _, _, f in dilation_args]
+            if num_workers > 1 and len(dilation_args) > 1:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    dilated_patches = list(
+                        executor.map(_dilate_donuts_seed, seed_patches, labels_to_dilate, footprints)
+                    )
+            else:
+                dilated_patches = [
+                    _dilate_donuts_seed(p, l, f) for p, l, f in zip(seed_patches, labels_to_dilate, footprints)
+                ]
+            for (patch_slices, _, _), dilated_patch in zip(dilation_args, dilated_patches):
+                seeds[patch_slices] += dilated_patch * (seeds[patch_slices] == 0)
+            del seed_patches, dilated_patches
 
     print("Calculating gradient . . .")
     start = time.time()
@@ -1527,6 +1827,7 @@ def measure_morphological_props_and_filter(
     properties=[[]],
     prop_values=[[]],
     comp_signs=[[]],
+    num_workers=1,
 ):
     """
     Measures the properties of input image's instances. It calculates each instance id, number of pixels, area/volume
@@ -1559,6 +1860,9 @@ def measure_morphological_props_and_filter(
         List of lists of signs to compose the conditions, together ``properties`` ``prop_values``, that the instances must
         satify to be removed from the input ``img``. E.g. ``[['le'], ['lt', 'ge']]``.
 
+    num_workers : int, optional
+        Number of processes used to measure the instances. ``1`` to run serially and ``0`` to use all available cores.
+
     Returns
     -------
     img : 2D/3D Numpy array
@@ -1573,7 +1877,7 @@ def measure_morphological_props_and_filter(
             Instance label list.
 
         centers : Array of ints
-            Coordinates of the centers of each instance.
+            Coordinates of the centroid of each instance.
 
         npixels : Array of ints
             Number of pixels of each instance.
@@ -1600,7 +1904,7 @@ def measure_morphological_props_and_filter(
 
         perimeter : Array of ints
             In 2D, approximates the contour as a line through the centers of border pixels using a 4-connectivity.
-            In 3D, it is the surface area computed using
+            In 3D, it is the surface area of each instance, computed over its bounding box, using
             `Lewiner et al. algorithm <https://www.tandfonline.com/doi/abs/10.1080/10867651.2003.10487582>`__ using
             `marching_cubes <https://scikit-image.org/docs/stable/api/skimage.measure.html#skimage.measure.marching_cubes>`__ and
             `mesh_surface_area <https://scikit-image.org/docs/stable/api/skimage.measure.html#skimage.measure.mesh_surface_area>`__
@@ -1621,152 +1925,100 @@ def measure_morphological_props_and_filter(
             resolution = resolution + (resolution[-1],)
     else:
         image3d = False
+    if num_workers == 0:
+        num_workers = os.cpu_count()
 
     correct_str = "Correct"
     unsure_str = "Removed"
 
-    comment = []
-    label_list = []
     label_list, npixels = np.unique(img, return_counts=True)
 
     # Delete background instance '0'
     if label_list[0] == 0:
         label_list = label_list[1:]
         npixels = npixels[1:]
-
     total_labels = len(label_list)
-    comment = ["none" for i in range(total_labels)]
-
-    # Measure array definitions
-    areas = np.zeros(total_labels, dtype=np.uint32)
-    diameters = np.zeros(total_labels, dtype=np.uint32)
-    centers = np.zeros((total_labels, 3 if image3d else 2), dtype=np.uint16)
-    circularities = np.zeros(total_labels, dtype=np.float32)
-    perimeters = np.zeros(total_labels, dtype=np.uint32)
-    if not image3d:
-        elongations = np.zeros(total_labels, dtype=np.float32)
 
-    # Area, diameter, center, circularity (if 2D), elongation (if 2D) and perimeter (if 2D) calculation over the whole image
-    lprops = ["label", "bbox", "perimeter"] if not image3d else ["label", "bbox"]
-    props = regionprops_table(img, properties=(lprops))
-    for k, l in tqdm(enumerate(props["label"]), total=len(props["label"]), leave=False):
-        label_index = np.where(label_list == l)[0]
-        pixels = npixels[label_index]
-
-        if image3d:
-            vol = pixels * (resolution[0] + resolution[1] + resolution[2])
-            diam = max(
-                props["bbox-3"][k] - props["bbox-0"][k],
-                props["bbox-4"][k] - props["bbox-1"][k],
-                props["bbox-5"][k] - props["bbox-2"][k],
+    # Bounding box of each instance
+    objects = ndi.find_objects(img)
+    bboxes = [objects[l - 1] for l in label_list]
+    bbox_starts = np.array([[s.start for s in b] for b in bboxes], dtype=int).reshape(-1, img.ndim)
+    bbox_ends = np.array([[s.stop for s in b] for b in bboxes], dtype=int).reshape(-1, img.ndim)
+
+    # Centroid and perimeter/surface area, measured over the bounding box crop of each instance
+    masks = [img[b] == l for b, l in zip(bboxes, label_list)]
+    if num_workers > 1 and total_labels > 1:
+        chunk = max(1, math.ceil(total_labels / (4 * num_workers)))
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = executor.map(
+                _measure_instances_geometry,
+                [masks[i : i + chunk] for i in range(0, total_labels, chunk)],
+                [bbox_starts[i : i + chunk] for i in range(0, total_labels, chunk)],
+                [image3d] * len(range(0, total_labels, chunk)),
             )
-            center = [
-                (props["bbox-3"][k] - props["bbox-0"][k]) // 2,
-                (props["bbox-4"][k] - props["bbox-1"][k]) // 2,
-                (props["bbox-5"][k] - props["bbox-2"][k]) // 2,
-            ]
-        else:
-            vol = pixels * (resolution[0] + resolution[1])
-            diam = max(
-                props["bbox-2"][k] - props["bbox-0"][k],
-                props["bbox-3"][k] - props["bbox-1"][k],
-            )
-            center = [
-                (props["bbox-2"][k] - props["bbox-0"][k]) // 2,
-                (props["bbox-3"][k] - props["bbox-1"][k]) // 2,
-            ]
-            perimeter = props["perimeter"][k]
-            elongations[label_index] = (perimeter * perimeter) / (4 * math.pi * pixels) if pixels > 0 else 0
-            circularity = (4 * math.pi * pixels) / (perimeter * perimeter) if perimeter > 0 else 0
-
-            perimeters[label_index] = perimeter
-            circularities[label_index] = circularity
-
-        areas[label_index] = vol
-        diameters[label_index] = diam
-        centers[label_index] = center
-
-    # Calculate surface area (as in https://github.com/scikit-image/scikit-image/issues/3797) and sphericity
-    if image3d and total_labels > 0:
-        img_aux = img.copy()
-        img_aux, _, _ = relabel_sequential(img_aux)
-        img_aux[find_boundaries(img_aux, mode="outer")] = 0
-        try:
-            vts, fs, ns, cs = marching_cubes(img_aux, level=0, method="lewiner")
-        except:
-            print("Some error found during marching_cubes() call")
-        else:
-            lst = [[] for i in range(total_labels + 1)]
-            for i in fs:
-                lst[int(cs[i[0]])].append(i)
-            surface_area = [0 if len(i) == 0 else mesh_surface_area(vts, i) for i in lst]
-
-            for i in range(total_labels):
-                sphericity = (
-                    (36 * math.pi * pixels * pixels) / (surface_area[i + 1] * surface_area[i + 1] * surface_area[i + 1])
-                    if surface_area[i + 1] > 0
-                    else 0
-                )
-                perimeters[i] = surface_area[i + 1]
-                circularities[i] = sphericity
-
-    # Remove those instances that do not satisfy the properties
-    conditions = []
-    labels_removed = 0
-    for i in tqdm(range(len(circularities)), leave=False):
-        conditions.append([])
-        if filter_instances:
-            for k, list_of_conditions in enumerate(properties):
-                # Check each list of conditions
-                comps = []
-                for j, prop in enumerate(list_of_conditions):
-                    if prop in ["circularity", "sphericity"]:
-                        value_to_compare = circularities[i]
-                    elif prop == "npixels":
-                        value_to_compare = npixels[i]
-                    elif prop == "area":
-                        value_to_compare = areas[i]
-                    elif prop == "diameter":
-                        value_to_compare = diameters[i]
-                    elif prop == "perimeter":
-                        value_to_compare = perimeters[i]
-                    elif prop == "elongation":
-                        value_to_compare = elongations[i]
-
-                    if comp_signs[k][j] == "gt":
-                        if value_to_compare > prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-                    elif comp_signs[k][j] == "ge":
-                        if value_to_compare >= prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-                    elif comp_signs[k][j] == "lt":
-                        if value_to_compare < prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-                    elif comp_signs[k][j] == "le":
-                        if value_to_compare <= prop_values[k][j]:
-                            comps.append(True)
-                        else:
-                            comps.append(False)
-
-                # Check if the conditions where satified
-                if all(comps):
-                    conditions[-1].append(True)
-                else:
-                    conditions[-1].append(False)
+            results = [r for chunk_results in results for r in chunk_results]
+    else:
+        results = _measure_instances_geometry(masks, bbox_starts, image3d)
+    del masks
+    centroids = np.array([r[0] for r in results], dtype=np.float64).reshape(-1, img.ndim)
+    surfaces = np.array([r[1] for r in results], dtype=np.float64)
+
+    # Columnar table with all the measurements
+    areas = (npixels * np.sum(resolution[: img.ndim])).astype(np.uint32)
+    diameters = (bbox_ends - bbox_starts).max(axis=1).astype(np.uint32) if total_labels > 0 else np.zeros(0, np.uint32)
+    centers = np.round(centroids).astype(np.uint16)
+    perimeters = surfaces.astype(np.uint32)
+    if image3d:
+        # Sphericity
+        circularities = np.divide(
+            36 * math.pi * npixels.astype(np.float64) ** 2,
+            surfaces**3,
+            out=np.zeros(total_labels),
+            where=surfaces > 0,
+        ).astype(np.float32)
+    else:
+        circularities = np.divide(
+            4 * math.pi * npixels.astype(np.float64),
+            surfaces**2,
+            out=np.zeros(total_labels),
+            where=surfaces > 0,
+        ).astype(np.float32)
+        elongations = np.divide(
+            surfaces**2,
+            4 * math.pi * npixels.astype(np.float64),
+            out=np.zeros(total_labels),
+            where=npixels > 0,
+        ).astype(np.float32)
+    table = {
+        "npixels": npixels,
+        "area": areas,
+        "diameter": diameters,
+        "perimeter": perimeters,
+        "circularity": circularities,
+        "sphericity": circularities,
+    }
+    if not image3d:
+        table["elongation"] = elongations
+
+    # Evaluate the conditions over the whole table. An instance is removed if it satisfies all the conditions of
+    # any of the lists
+    comparisons = {"gt": np.greater, "ge": np.greater_equal, "lt": np.less, "le": np.less_equal}
+    satisfied = np.zeros((len(properties) if filter_instances else 0, total_labels), dtype=bool)
+    if filter_instances:
+        for k, list_of_conditions in enumerate(properties):
+            satisfied[k] = True
+            for j, prop in enumerate(list_of_conditions):
+                satisfied[k] &= comparisons[comp_signs[k][j]](table[prop], prop_values[k][j])
+    removed = satisfied.any(axis=0)
+    conditions = satisfied.T.tolist()
+    comment = [unsure_str if r else correct_str for r in removed]
+
+    # Remove those instances that satisfy the conditions
+    for i in np.nonzero(removed)[0]:
+        crop = img[bboxes[i]]
+        crop[crop == label_list[i]] = 0
+    labels_removed = int(removed.sum())
 
-        # If satisfied all conditions remove the instance
-        if any(conditions[-1]):
-            comment[i] = unsure_str
-            img[img == label_list[i]] = 0
-            labels_removed += 1
-        else:
-            comment[i] = correct_str
     cir_name = "sphericities" if image3d else "circularities"
     d_result = {
         "labels": label_list,
@@ -1792,6 +2044,28 @@ def measure_morphological_props_and_filter(
     return img, d_result
 
 
+def _measure_instances_geometry(masks, offsets, image3d):
+    """
+    Centroid and perimeter (2D) or surface area (3D) of a list of instances, each one given as the binary mask of its
+    bounding box.
+    """
+    results = []
+    for mask, offset in zip(masks, offsets):
+        centroid = np.argwhere(mask).mean(axis=0) + offset
+        if image3d:
+            # Pad the mask so the surface of the instance is closed at the bounding box borders
+            try:
+                vts, fs, _, _ = marching_cubes(np.pad(mask, 1).astype(np.uint8), level=0.5, method="lewiner")
+                surface = mesh_surface_area(vts, fs)
+            except Exception:
+                print("Some error found during marching_cubes() call")
+                surface = 0
+        else:
+            surface = perimeter(mask, neighborhood=4)
+        results.append((centroid, surface))
+    return results
+
+
 def find_neighbors(img, label, neighbors=1):
     """
     Find neighbors of a label in a given image.
@@ -67,6 +67,88 @@ def _window_2D(window_size, power=2):
     return wind
 
 
+def _gaussian_window(window_size, sigma_scale=1.0 / 8):
+    """
+    Gaussian window function centered in the window with ``sigma = window_size * sigma_scale``.
+    """
+    x = np.arange(window_size) - (window_size - 1) / 2
+    wind = np.exp(-(x**2) / (2 * (window_size * sigma_scale) ** 2))
+    wind = wind / np.average(wind)
+    return wind
+
+
+def blending_window_1D(window_size, mode="spline", power=2):
+    """
+    Make the 1D window function used to weight the patches when merging them.
+
+    Parameters
+    ----------
+    window_size : int
+        Size of the window.
+
+    mode : str, optional
+        Window function to use. Options: ``spline`` and ``gaussian``.
+
+    power : int, optional
+        Power of the spline window function.
+
+    Returns
+    -------
+    wind : 1D Numpy array
+        Window.
+    """
+    if mode not in ["spline", "gaussian"]:
+        raise ValueError("'mode' needs to be one between ['spline', 'gaussian']")
+
+    # Too small dimensions, e.g. z axis of some 3D patches, are not weighted
+    if window_size < 4:
+        return np.ones(window_size, dtype=np.float32)
+    elif mode == "spline":
+        wind = _spline_window(window_size, power)
+    else:
+        wind = _gaussian_window(window_size)
+
+    # Avoid (almost) zero weights as some border pixels are only covered by one patch
+    wind = np.maximum(wind, wind.max() * 0.05)
+    return wind.astype(np.float32)
+
+
+cached_blending_windows = dict()
+
+
+def blending_window(window_shape, mode="spline", power=2):
+    """
+    Make a N-D window function, as the outer product of the 1D window of each dimension, to weight the
+    patches when merging them. It is computed just once per patch shape.
+
+    Parameters
+    ----------
+    window_shape : tuple of ints
+        Shape of the patch without the channel. E.g. ``(y, x)`` in ``2D`` or ``(z, y, x)`` in ``3D``.
+
+    mode : str, optional
+        Window function to use. Options: ``spline`` and ``gaussian``.
+
+    power : int, optional
+        Power of the spline window function.
+
+    Returns
+    -------
+    wind : Numpy array
+        Window. E.g. ``(y, x, 1)`` in ``2D`` or ``(z, y, x, 1)`` in ``3D``.
+    """
+    key = "{}_{}_{}".format(tuple(window_shape), mode, power)
+    if key in cached_blending_windows:
+        return cached_blending_windows[key]
+
+    wind = np.ones((), dtype=np.float32)
+    for size in window_shape:
+        wind = np.multiply.outer(wind, blending_window_1D(size, mode, power))
+    wind = np.expand_dims(wind, -1)
+    cached_blending_windows[key] = wind
+    return wind
+
+
 def _pad_img(img, window_size, subdivisions):
     """
     Add borders to img for a "valid" border pattern according to "window_size" and
@@ -4,6 +4,7 @@ import scipy
 import h5py
 import zarr
 import sys
+import hashlib
 import numpy as np
 from tqdm import tqdm
 import pandas as pd
@@ -17,6 +18,7 @@ from skimage.feature import canny
 from skimage.exposure import equalize_adapthist
 from skimage.color import rgb2gray
 from skimage.filters import gaussian, median
+from concurrent.futures import ProcessPoolExecutor
 
 from biapy.utils.util import (
     load_data_from_dir,
@@ -25,9 +27,12 @@ from biapy.utils.util import (
     seg2aff_pni,
     seg_widen_border,
     write_chunked_data,
+    get_chunked_data_options,
+    chunked_dataset_kwargs,
     read_chunked_data,
     order_dimensions,
     read_img,
+    create_file_sha256sum,
 )
 from biapy.utils.misc import is_main_process
 from biapy.data.data_3D_manipulation import (
@@ -35,6 +40,11 @@ from biapy.data.data_3D_manipulation import (
     load_img_part_from_efficient_file,
 )
 
+# Number of bins of the histograms used to match float images (and integer images whose range exceeds
+# HISTOGRAM_MATCHING_MAX_INT_RANGE)
+HISTOGRAM_MATCHING_BINS = 65536
+HISTOGRAM_MATCHING_MAX_INT_RANGE = 2**24
+
 
 #########################
 # INSTANCE SEGMENTATION #
@@ -173,7 +183,12 @@ def create_instance_channels(cfg, data_type="train"):
                     out_data_order = getattr(cfg.DATA, tag).INPUT_IMG_AXES_ORDER
                     channel_pos = getattr(cfg.DATA, tag).INPUT_IMG_AXES_ORDER.index("C")
 
-                mask = fid_mask.create_dataset("data", shape=out_data_shape, dtype=dtype_str)
+                mask = fid_mask.create_dataset(
+                    "data",
+                    shape=out_data_shape,
+                    dtype=dtype_str,
+                    **chunked_dataset_kwargs("zarr", out_data_shape, out_data_order, **get_chunked_data_options(cfg)),
+                )
                 del data, imgfile, fname
 
             # Adjust slices to calculate where to insert the predicted patch. This slice does not have into account the
@@ -804,6 +819,7 @@ def create_detection_masks(cfg, data_type="train"):
                     img_filename,
                     dtype_str="uint8",
                     verbose=True,
+                    **get_chunked_data_options(cfg),
                 )
             else:
                 save_tif(np.expand_dims(mask, 0), out_dir, [img_filename])
@@ -865,7 +881,7 @@ def create_ssl_source_data_masks(cfg, data_type="train"):
             print("Source file {} found".format(os.path.join(img_dir, ids[i])))
 
 
-def crappify(input_img, resizing_factor, add_noise=True, noise_level=None, Down_up=True):
+def crappify(input_img, resizing_factor, add_noise=True, noise_level=None, Down_up=True, rng=None):
     """
     Crappifies input image by adding Gaussian noise and downsampling and upsampling it so the resolution
     gets worsen.
@@ -888,6 +904,9 @@ def crappify(input_img, resizing_factor, add_noise=True, noise_level=None, Down_
         same size as the original but with the corresponding loss of quality of downsizing and
         upsizing.
 
+    rng : Numpy Generator, optional
+        Random generator used to draw the noise. If not provided ``np.random`` is used.
+
     Returns
     -------
     img : 4D/5D Numpy array
@@ -912,7 +931,7 @@ def crappify(input_img, resizing_factor, add_noise=True, noise_level=None, Down_
 
     img = input_img.copy()
     if add_noise:
-        img = add_gaussian_noise(img, noise_level)
+        img = add_gaussian_noise(img, noise_level, rng=rng)
 
     img = resize(
         img,
@@ -938,7 +957,7 @@ def crappify(input_img, resizing_factor, add_noise=True, noise_level=None, Down_
     return img.astype(input_img.dtype)
 
 
-def add_gaussian_noise(image, percentage_of_noise):
+def add_gaussian_noise(image, percentage_of_noise, rng=None):
     """
     Adds Gaussian noise to an input image.
 
@@ -951,29 +970,276 @@ def add_gaussian_noise(image, percentage_of_noise):
         percentage of the maximum value of the image that will be used as the std of the Gaussian Noise
         distribution.
 
+    rng : Numpy Generator, optional
+        Random generator used to draw the noise. If not provided ``np.random`` is used.
+
     Returns
     -------
     out : 3D Numpy array
         Transformed image. E.g. ``(y, x, channels)``.
     """
     max_value = np.max(image)
+    # Normalized images can have negative values so they can not be clipped to 0
+    min_value = min(0, np.min(image))
     noise_level = percentage_of_noise * max_value
-    noise = np.random.normal(loc=0, scale=noise_level, size=image.shape)
-    noisy_img = np.clip(image + noise, 0, max_value).astype(image.dtype)
+    rng = np.random if rng is None else rng
+    noise = rng.normal(loc=0, scale=noise_level, size=image.shape)
+    noisy_img = np.clip(image + noise, min_value, max_value).astype(image.dtype)
     return noisy_img
 
 
+def crappify_batch(x, resizing_factor, noise_level=0, random_degradation=False, generator=None):
+    """
+    Crappifies a batch of images on its device. Equivalent to :func:`crappify` but operating over the whole batch
+    with ``torch`` so it can be done on GPU right before the forward pass.
+
+    Parameters
+    ----------
+    x : 4D/5D Torch tensor
+        Batch to be modified. E.g. ``(num_of_images, channels, y, x)`` if working with 2D images or
+        ``(num_of_images, channels, z, y, x)`` if working with 3D.
+
+    resizing_factor : float
+        Downsizing factor to reshape the images. If ``random_degradation`` is ``True`` this is the maximum value
+        and each sample will use a factor drawn uniformly from ``[1, resizing_factor]``.
+
+    noise_level : float, optional
+        Number between ``[0,1]`` indicating the std of the Gaussian noise N(0,std) relative to the maximum value of
+        each image. If ``random_degradation`` is ``True`` each sample will use a value drawn from ``[0, noise_level]``.
+
+    random_degradation : bool, optional
+        Whether to draw the resizing factor and noise level per sample.
+
+    generator : torch.Generator, optional
+        Random generator to use. Useful to obtain always the same degradation, e.g. in validation. Must be placed in
+        the same device as ``x``.
+
+    Returns
+    -------
+    out : 4D/5D Torch tensor
+        Crappified batch. E.g. ``(num_of_images, channels, y, x)`` if working with 2D images or
+        ``(num_of_images, channels, z, y, x)`` if working with 3D.
+    """
+    mode = "bilinear" if x.ndim == 4 else "trilinear"
+    org_sz = tuple(x.shape[2:])
+    out = x.float()
+    b = out.shape[0]
+
+    if random_degradation:
+        factors = 1 + torch.rand(b, generator=generator, device=x.device) * (resizing_factor - 1)
+        levels = torch.rand(b, generator=generator, device=x.device) * noise_level
+    else:
+        factors = torch.full((b,), float(resizing_factor), device=x.device)
+        levels = torch.full((b,), float(noise_level), device=x.device)
+
+    if noise_level > 0:
+        dims = tuple(range(1, out.ndim))
+        view_shape = (b,) + (1,) * (out.ndim - 1)
+        max_value = out.amax(dim=dims).view(view_shape)
+        min_value = torch.clamp(out.amin(dim=dims), max=0).view(view_shape)
+        noise = torch.randn(out.shape, generator=generator, device=x.device) * (levels.view(view_shape) * max_value)
+        out = torch.maximum(torch.minimum(out + noise, max_value), min_value)
+
+    # Samples of the batch may need different sizes so the resizing needs to be done one by one
+    crappified = []
+    for i in range(b):
+        targ_sz = [max(1, int(s / float(torch.sqrt(factors[i])))) for s in org_sz]
+        img = torch.nn.functional.interpolate(out[i : i + 1], size=targ_sz, mode=mode, align_corners=False)
+        img = torch.nn.functional.interpolate(img, size=org_sz, mode=mode, align_corners=False)
+        crappified.append(img)
+
+    return torch.cat(crappified).to(x.dtype)
+
+
 ################
 # SEMANTIC SEG #
 ################
+class ForegroundCropSampler:
+    def __init__(self, shape, indices, class_probs):
+        """
+        Sampler of the central voxel of the random crops of an image, biased towards its foreground. A class
+        (foreground or background) is drawn first and then a voxel of that class uniformly, so each draw costs O(1)
+        instead of scanning a dense probability map.
+
+        Voxels are split in three classes: foreground (0), background (1) and voxels that are never chosen (2). All of
+        them but the largest one are stored as sorted flat indices. The largest class is kept implicit, i.e. as the
+        voxels not listed in the other classes, and its voxels are drawn uniformly from the whole image rejecting the
+        listed ones. As it is the largest class less than three draws are needed on average, and the stored
+        indices are usually just the foreground voxels.
+
+        Parameters
+        ----------
+        shape : tuple of ints
+            Spatial shape of the image. E.g. ``(y, x)`` or ``(z, y, x)``.
+
+        indices : list of 3 1D Numpy arrays or None
+            Sorted flat indices of the voxels of each class. ``None`` for the implicit class.
+
+        class_probs : list of 2 floats or None
+            Probability of drawing a foreground and a background voxel. ``None`` to draw voxels uniformly from the
+            whole image.
+        """
+        self.shape = tuple(int(x) for x in shape)
+        self.size = int(np.prod(self.shape))
+        self.indices = indices
+        self.class_probs = class_probs
+
+    @classmethod
+    def from_mask(cls, mask, fg_value, w_foreground=0.94, w_background=0.06):
+        """
+        Create the sampler of a mask. As in the previous dense probability maps, objects touching the ``y``/``x``
+        borders of each 2D slice are not considered foreground. Foreground voxels are those equal to ``fg_value``
+        and background ones those equal to zero. With several channels a voxel is foreground if it is foreground in
+        any channel and background if it is background in all of them.
+
+        Parameters
+        ----------
+        mask : 3D/4D Numpy array
+            Mask. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+
+        fg_value : int
+            Value of the foreground voxels.
+
+        w_foreground : float, optional
+            Probability of drawing a foreground voxel.
+
+        w_background : float, optional
+            Probability of drawing a background voxel.
+
+        Returns
+        -------
+        sampler : ForegroundCropSampler
+            Sampler of ``mask``.
+        """
+        # Label objects only within each 2D slice and channel to find the ones connected to the slice border, which is
+        # what calling skimage's 'clear_border' slice by slice does
+        structure = np.zeros((3,) * mask.ndim, dtype=bool)
+        structure[(1,) * (mask.ndim - 3) + (slice(None), slice(None), 1)] = True
+        labels, _ = scipy.ndimage.label(mask != 0, structure=structure)
+        border_ids = np.unique(
+            np.concatenate(
+                [
+                    np.take(labels, [0, -1], axis=mask.ndim - 3).ravel(),
+                    np.take(labels, [0, -1], axis=mask.ndim - 2).ravel(),
+                ]
+            )
+        )
+        touching = np.isin(labels, border_ids[border_ids > 0])
+        del labels
+
+        fg = ((mask == fg_value) & ~touching).any(axis=-1).ravel()
+        bg = ((mask == 0) | touching).all(axis=-1).ravel()
+        classes = [fg, bg & ~fg, ~(fg | bg)]
+        counts = [int(c.sum()) for c in classes]
+        implicit = int(np.argmax(counts))
+        dtype = np.uint32 if fg.size < 2**32 else np.int64
+        indices = [None if i == implicit else np.flatnonzero(c).astype(dtype) for i, c in enumerate(classes)]
+
+        class_probs = [w_foreground if counts[0] > 0 else 0, w_background if counts[1] > 0 else 0]
+        if sum(class_probs) == 0:
+            class_probs = None
+        else:
+            class_probs = [p / sum(class_probs) for p in class_probs]
+        return cls(mask.shape[:-1], indices, class_probs)
+
+    def _is_listed(self, flat):
+        for idx in self.indices:
+            if idx is not None and len(idx) > 0:
+                pos = np.searchsorted(idx, flat)
+                if pos < len(idx) and idx[pos] == flat:
+                    return True
+        return False
+
+    def sample(self):
+        """
+        Draw a voxel.
+
+        Returns
+        -------
+        coords : tuple of ints
+            Coordinates of the voxel. E.g. ``(y, x)`` or ``(z, y, x)``.
+        """
+        if self.class_probs is None:
+            flat = np.random.randint(self.size)
+        else:
+            c = 0 if np.random.random() < self.class_probs[0] else 1
+            if self.indices[c] is not None:
+                flat = int(self.indices[c][np.random.randint(len(self.indices[c]))])
+            else:
+                flat = np.random.randint(self.size)
+                while self._is_listed(flat):
+                    flat = np.random.randint(self.size)
+        return tuple(int(x) for x in np.unravel_index(flat, self.shape))
+
+
+def save_crop_samplers(samplers, filename):
+    """
+    Save a list of :class:`ForegroundCropSampler` in a ``.npz`` file.
+    """
+    arrays = {}
+    for i, sampler in enumerate(samplers):
+        arrays[f"{i}_shape"] = np.array(sampler.shape)
+        arrays[f"{i}_class_probs"] = np.array(sampler.class_probs if sampler.class_probs is not None else [])
+        for c, idx in enumerate(sampler.indices):
+            if idx is not None:
+                arrays[f"{i}_indices_{c}"] = idx
+    np.savez(filename, num_samplers=len(samplers), **arrays)
+
+
+def load_crop_samplers(filename):
+    """
+    Load the list of :class:`ForegroundCropSampler` saved with :func:`save_crop_samplers`.
+    """
+    samplers = []
+    with np.load(filename) as f:
+        for i in range(int(f["num_samplers"])):
+            class_probs = f[f"{i}_class_probs"].tolist()
+            indices = [f[f"{i}_indices_{c}"] if f"{i}_indices_{c}" in f else None for c in range(3)]
+            samplers.append(
+                ForegroundCropSampler(f[f"{i}_shape"].tolist(), indices, class_probs if len(class_probs) > 0 else None)
+            )
+    return samplers
+
+
+def _calculate_crop_samplers(Y, Y_path, ndim, w_foreground, w_background, save_dir):
+    """
+    Create the :class:`ForegroundCropSampler` of each image of ``Y`` (or loaded from ``Y_path``).
+    """
+    if Y is not None:
+        if not isinstance(Y, list) and Y.ndim != ndim + 2:
+            raise ValueError("'Y' must be a {}D Numpy array".format(ndim + 2))
+
+    if Y is None and Y_path is None:
+        raise ValueError("'Y' or 'Y_path' need to be provided")
+
+    if Y is None:
+        f_name = load_data_from_dir if ndim == 2 else load_3d_images_from_dir
+        Y, _, _ = f_name(Y_path)
+    v = max(np.max(y) for y in Y)
+
+    print("Constructing the crop samplers . . .")
+    samplers = []
+    for y in tqdm(Y, total=len(Y), disable=not is_main_process()):
+        # Images loaded from a directory are returned with a leading dimension
+        y = y[0] if y.ndim == ndim + 2 else y
+        samplers.append(ForegroundCropSampler.from_mask(y, v, w_foreground, w_background))
+
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+        f = os.path.join(save_dir, "crop_samplers.npz")
+        print("Saving the crop samplers in {}".format(f))
+        save_crop_samplers(samplers, f)
+    return samplers
+
+
 def calculate_2D_volume_prob_map(Y, Y_path=None, w_foreground=0.94, w_background=0.06, save_dir=None):
     """
-    Calculate the probability map of the given 2D data.
+    Calculate the foreground-biased crop samplers of the given 2D data. See :class:`ForegroundCropSampler`.
 
     Parameters
     ----------
-    Y : 4D Numpy array
-        Data to calculate the probability map from. E. g. ``(num_of_images, y, x, channel)``
+    Y : 4D Numpy array or list of 3D Numpy arrays
+        Data to calculate the samplers from. E. g. ``(num_of_images, y, x, channel)``
 
     Y_path : str, optional
         Path to load the data from in case ``Y=None``.
@@ -985,116 +1251,29 @@ def calculate_2D_volume_prob_map(Y, Y_path=None, w_foreground=0.94, w_background
         Weight of the background. This value plus ``w_foreground`` must be equal ``1``.
 
     save_dir : str, optional
-        Path to the file where the probability map will be stored.
+        Directory where the samplers will be stored, in a ``crop_samplers.npz`` file.
 
     Raises
     ------
     ValueError
         if ``Y`` does not have 4 dimensions.
 
-    ValueError
-        if ``w_foreground + w_background > 1``.
-
     Returns
     -------
-    Array : Str or 4D Numpy array
-        Path where the probability map/s is/are stored if ``Y_path`` was given and there are images of different
-        shapes. Otherwise, an array that represents the probability map of ``Y`` or all loaded data files from
-        ``Y_path`` will be returned.
+    samplers : list of ForegroundCropSampler
+        Sampler of each image.
     """
-
-    if Y is not None:
-        if Y.ndim != 4:
-            raise ValueError("'Y' must be a 4D Numpy array")
-
-    if Y is None and Y_path is None:
-        raise ValueError("'Y' or 'Y_path' need to be provided")
-
-    if Y is not None:
-        prob_map = np.copy(Y).astype(np.float32)
-        l = prob_map.shape[0]
-        channels = prob_map.shape[-1]
-        v = np.max(prob_map)
-    else:
-        prob_map, _, _ = load_data_from_dir(Y_path)
-        l = len(prob_map)
-        channels = prob_map[0].shape[-1]
-        v = np.max(prob_map[0])
-
-    if isinstance(prob_map, list):
-        first_shape = prob_map[0][0].shape
-    else:
-        first_shape = prob_map[0].shape
-
-    print("Connstructing the probability map . . .")
-    maps = []
-    diff_shape = False
-    for i in tqdm(range(l), disable=not is_main_process()):
-        if isinstance(prob_map, list):
-            _map = prob_map[i][0].copy().astype(np.float32)
-        else:
-            _map = prob_map[i].copy().astype(np.float32)
-
-        for k in range(channels):
-            # Remove artifacts connected to image border
-            _map[:, :, k] = clear_border(_map[:, :, k])
-
-            foreground_pixels = (_map[:, :, k] == v).sum()
-            background_pixels = (_map[:, :, k] == 0).sum()
-
-            if foreground_pixels == 0:
-                _map[:, :, k][np.where(_map[:, :, k] == v)] = 0
-            else:
-                _map[:, :, k][np.where(_map[:, :, k] == v)] = w_foreground / foreground_pixels
-            if background_pixels == 0:
-                _map[:, :, k][np.where(_map[:, :, k] == 0)] = 0
-            else:
-                _map[:, :, k][np.where(_map[:, :, k] == 0)] = w_background / background_pixels
-
-            # Necessary to get all probs sum 1
-            s = _map[:, :, k].sum()
-            if s == 0:
-                t = 1
-                for x in _map[:, :, k].shape:
-                    t *= x
-                _map[:, :, k].fill(1 / t)
-            else:
-                _map[:, :, k] = _map[:, :, k] / _map[:, :, k].sum()
-
-        if first_shape != _map.shape:
-            diff_shape = True
-        maps.append(_map)
-
-    if save_dir is not None:
-        os.makedirs(save_dir, exist_ok=True)
-
-        if not diff_shape:
-            for i in range(len(maps)):
-                maps[i] = np.expand_dims(maps[i], 0)
-            maps = np.concatenate(maps)
-            print("Saving the probability map in {}".format(save_dir))
-            np.save(os.path.join(save_dir, "prob_map.npy"), maps)
-            return maps
-        else:
-            print(
-                "As the files loaded have different shapes, the probability map for each one will be stored"
-                " separately in {}".format(save_dir)
-            )
-            d = len(str(l))
-            for i in range(l):
-                f = os.path.join(save_dir, "prob_map" + str(i).zfill(d) + ".npy")
-                np.save(f, maps[i])
-            return save_dir
+    return _calculate_crop_samplers(Y, Y_path, 2, w_foreground, w_background, save_dir)
 
 
 def calculate_3D_volume_prob_map(Y, Y_path=None, w_foreground=0.94, w_background=0.06, save_dir=None):
     """
-    Calculate the probability map of the given 3D data.
+    Calculate the foreground-biased crop samplers of the given 3D data. See :class:`ForegroundCropSampler`.
 
     Parameters
     ----------
-    Y : 5D Numpy array
-        Data to calculate the probability map from. E. g. ``(num_subvolumes, z, y, x, channel)``
+    Y : 5D Numpy array or list of 4D Numpy arrays
+        Data to calculate the samplers from. E. g. ``(num_subvolumes, z, y, x, channel)``
 
     Y_path : str, optional
         Path to load the data from in case ``Y=None``.
@@ -1106,104 +1285,19 @@ def calculate_3D_volume_prob_map(Y, Y_path=None, w_foreground=0.94, w_background
         Weight of the background. This value plus ``w_foreground`` must be equal ``1``.
 
     save_dir : str, optional
-        Path to the directory where the probability map will be stored.
+        Directory where the samplers will be stored, in a ``crop_samplers.npz`` file.
 
     Returns
     -------
-    Array : Str or 5D Numpy array
-        Path where the probability map/s is/are stored if ``Y_path`` was given and there are images of different
-        shapes. Otherwise, an array that represents the probability map of ``Y`` or all loaded data files from
-        ``Y_path`` will be returned.
+    samplers : list of ForegroundCropSampler
+        Sampler of each volume.
 
     Raises
     ------
     ValueError
         if ``Y`` does not have 5 dimensions.
-    ValueError
-        if ``w_foreground + w_background > 1``.
     """
-
-    if Y is not None:
-        if Y.ndim != 5:
-            raise ValueError("'Y' must be a 5D Numpy array")
-
-    if Y is None and Y_path is None:
-        raise ValueError("'Y' or 'Y_path' need to be provided")
-
-    if Y is not None:
-        prob_map = np.copy(Y).astype(np.float32)
-        l = prob_map.shape[0]
-        channels = prob_map.shape[-1]
-        v = np.max(prob_map)
-    else:
-        prob_map, _, _ = load_3d_images_from_dir(Y_path)
-        l = len(prob_map)
-        channels = prob_map[0].shape[-1]
-        v = np.max(prob_map[0])
-
-    if isinstance(prob_map, list):
-        first_shape = prob_map[0][0].shape
-    else:
-        first_shape = prob_map[0].shape
-
-    print("Constructing the probability map . . .")
-    maps = []
-    diff_shape = False
-    for i in range(l):
-        if isinstance(prob_map, list):
-            _map = prob_map[i][0].copy().astype(np.float64)
-        else:
-            _map = prob_map[i].copy().astype(np.float64)
-
-        for k in range(channels):
-            for j in range(_map.shape[0]):
-                # Remove artifacts connected to image border
-                _map[j, :, :, k] = clear_border(_map[j, :, :, k])
-            foreground_pixels = (_map[:, :, :, k] == v).sum()
-            background_pixels = (_map[:, :, :, k] == 0).sum()
-
-            if foreground_pixels == 0:
-                _map[:, :, :, k][np.where(_map[:, :, :, k] == v)] = 0
-            else:
-                _map[:, :, :, k][np.where(_map[:, :, :, k] == v)] = w_foreground / foreground_pixels
-            if background_pixels == 0:
-                _map[:, :, :, k][np.where(_map[:, :, :, k] == 0)] = 0
-            else:
-                _map[:, :, :, k][np.where(_map[:, :, :, k] == 0)] = w_background / background_pixels
-
-            # Necessary to get all probs sum 1
-            s = _map[:, :, :, k].sum()
-            if s == 0:
-                t = 1
-                for x in _map[:, :, :, k].shape:
-                    t *= x
-                _map[:, :, :, k].fill(1 / t)
-            else:
-                _map[:, :, :, k] = _map[:, :, :, k] / _map[:, :, :, k].sum()
-
-        if first_shape != _map.shape:
-            diff_shape = True
-        maps.append(_map)
-
-    if save_dir is not None:
-        os.makedirs(save_dir, exist_ok=True)
-        if not diff_shape:
-            for i in range(len(maps)):
-                maps[i] = np.expand_dims(maps[i], 0)
-            maps = np.concatenate(maps)
-            print("Saving the probability map in {}".format(save_dir))
-            np.save(os.path.join(save_dir, "prob_map.npy"), maps)
-            return maps
-        else:
-            print(
-                "As the files loaded have different shapes, the probability map for each one will be stored "
-                "separately in {}".format(save_dir)
-            )
-            d = len(str(l))
-            for i in range(l):
-                f = os.path.join(save_dir, "prob_map" + str(i).zfill(d) + ".npy")
-                np.save(f, maps[i])
-            return save_dir
+    return _calculate_crop_samplers(Y, Y_path, 3, w_foreground, w_background, save_dir)
 
 
 ###########
@@ -1363,6 +1457,309 @@ def percentile_clip(x, lower=0.1, upper=99.9, lwr_perc_val=None, uppr_perc_val=N
     return np.clip(x, x_lwr, x_upr, out=x), x_lwr, x_upr
 
 
+class DatasetStatistics:
+    def __init__(self, compression=500, max_int_range=2**24):
+        """
+        Streaming estimation of the percentiles, mean and standard deviation of a dataset, updated image by image (or
+        chunk by chunk) so the whole dataset never needs to be in memory.
+
+        Integer data is counted in a histogram with one bin per value, so its percentiles are exactly the ones
+        :func:`numpy.percentile` would return. Float data (or integer data whose range exceeds ``max_int_range``) is
+        summarized in a t-digest like sketch: a sorted set of weighted centroids that are kept small close to the
+        tails, where the clipping percentiles lie, and merged in the middle of the distribution.
+
+        Parameters
+        ----------
+        compression : int, optional
+            Maximum number of centroids of the float sketch, approximately. Higher values give more precise
+            percentiles.
+
+        max_int_range : int, optional
+            Maximum range of integer values counted in the histogram.
+        """
+        self.compression = compression
+        self.max_int_range = max_int_range
+        self.n = 0
+        self.mean_ = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        # Whether all the data seen is integer and whether it is summarized in the float sketch
+        self.integer_data = True
+        self.is_float = False
+        # Integer histogram: counts of the values starting at 'hist_offset'
+        self.hist = None
+        self.hist_offset = 0
+        # Float sketch
+        self.means = np.zeros(0, dtype=np.float64)
+        self.weights = np.zeros(0, dtype=np.float64)
+
+    def update(self, x):
+        """
+        Add the values of ``x`` to the statistics.
+
+        Parameters
+        ----------
+        x : Numpy array
+            Image or chunk of an image of any shape.
+        """
+        x = np.asarray(x).ravel()
+        if x.size == 0:
+            return
+        xmin, xmax = x.min(), x.max()
+
+        # Mean and variance merged with Chan et al. parallel algorithm
+        x_mean = float(np.mean(x, dtype=np.float64))
+        x_m2 = float(np.sum(np.square(x - x_mean, dtype=np.float64)))
+        delta = x_mean - self.mean_
+        total = self.n + x.size
+        self.m2 += x_m2 + delta**2 * self.n * x.size / total
+        self.mean_ += delta * x.size / total
+        self.n = total
+
+        self.min, self.max = min(self.min, float(xmin)), max(self.max, float(xmax))
+        self.integer_data = self.integer_data and bool(np.issubdtype(x.dtype, np.integer))
+        if not self.is_float and (not self.integer_data or self.max - self.min >= self.max_int_range):
+            self._histogram_to_sketch()
+
+        if self.is_float:
+            self._update_sketch(x, float(xmin), float(xmax))
+        else:
+            lo = int(self.min)
+            size = int(self.max) - lo + 1
+            if self.hist is None:
+                self.hist = np.zeros(size, dtype=np.int64)
+            elif lo != self.hist_offset or size != len(self.hist):
+                # Grow the histogram to the new range of values
+                hist = np.zeros(size, dtype=np.int64)
+                hist[self.hist_offset - lo : self.hist_offset - lo + len(self.hist)] = self.hist
+                self.hist = hist
+            self.hist_offset = lo
+            self.hist += np.bincount(x.astype(np.int64) - lo, minlength=size)
+
+    def _histogram_to_sketch(self):
+        """
+        Convert the integer histogram into centroids of the float sketch.
+        """
+        self.is_float = True
+        if self.hist is not None:
+            nonzero = np.nonzero(self.hist)[0]
+            self.means = (nonzero + self.hist_offset).astype(np.float64)
+            self.weights = self.hist[nonzero].astype(np.float64)
+            self.hist = None
+            self._compress()
+
+    def _update_sketch(self, x, xmin, xmax):
+        """
+        Summarize ``x`` into ``compression`` * 8 equal-width bins, whose means become new centroids, and merge them
+        into the sketch.
+        """
+        nbins = self.compression * 8
+        if xmax > xmin:
+            idx = np.minimum(((x - xmin) * (nbins / (xmax - xmin))).astype(np.int64), nbins - 1)
+        else:
+            idx = np.zeros(x.shape, dtype=np.int64)
+        counts = np.bincount(idx, minlength=nbins).astype(np.float64)
+        sums = np.bincount(idx, weights=x, minlength=nbins)
+        nonzero = counts > 0
+        self.means = np.concatenate([self.means, sums[nonzero] / counts[nonzero]])
+        self.weights = np.concatenate([self.weights, counts[nonzero]])
+        self._compress()
+
+    def _compress(self):
+        """
+        Merge the centroids of the sketch so each one spans at most one unit of the t-digest ``k1`` scale function,
+        which keeps centroids close to the tails small.
+        """
+        order = np.argsort(self.means, kind="stable")
+        means, weights = self.means[order], self.weights[order]
+        q = (np.cumsum(weights) - weights / 2) / np.sum(weights)
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        _, groups = np.unique(np.floor(k), return_inverse=True)
+        self.weights = np.bincount(groups, weights=weights)
+        self.means = np.bincount(groups, weights=weights * means) / self.weights
+
+    def percentile(self, q):
+        """
+        Percentile of the data seen so far.
+
+        Parameters
+        ----------
+        q : float
+            Percentile to compute, in ``[0, 100]`` range.
+
+        Returns
+        -------
+        value : float
+            Percentile value.
+        """
+        if self.n == 0:
+            raise ValueError("No data has been added to the statistics")
+        if not self.is_float:
+            # Same linear interpolation as numpy.percentile
+            cum = np.cumsum(self.hist)
+            pos = (q / 100) * (self.n - 1)
+            lwr, upr = int(np.floor(pos)), int(np.ceil(pos))
+            v_lwr = self.hist_offset + int(np.searchsorted(cum, lwr + 1))
+            v_upr = self.hist_offset + int(np.searchsorted(cum, upr + 1))
+            return v_lwr + (v_upr - v_lwr) * (pos - lwr)
+
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(
+            np.interp(
+                (q / 100) * self.n,
+                np.concatenate([[0], centers, [self.n]]),
+                np.concatenate([[self.min], self.means, [self.max]]),
+            )
+        )
+
+    def clip_values(self, lower, upper):
+        """
+        Values of the ``lower`` and ``upper`` percentiles, used to clip the data. As in :func:`percentile_clip`, they
+        are truncated to integers if the data is not float.
+
+        Parameters
+        ----------
+        lower : float
+            Lower percentile, in ``[0, 100]`` range.
+
+        upper : float
+            Upper percentile, in ``[0, 100]`` range.
+
+        Returns
+        -------
+        x_lwr : float or int
+            Lower clipping value.
+
+        x_upr : float or int
+            Upper clipping value.
+        """
+        x_lwr, x_upr = float(self.percentile(lower)), float(self.percentile(upper))
+        if self.integer_data:
+            x_lwr, x_upr = int(x_lwr), int(x_upr)
+        return x_lwr, x_upr
+
+    def moments(self, lower=None, upper=None):
+        """
+        Mean and standard deviation of the data seen so far, optionally as if it had been clipped to
+        ``[lower, upper]`` first. With clipping, the moments of float data are approximated from the sketch.
+
+        Parameters
+        ----------
+        lower : float, optional
+            Lower clipping value.
+
+        upper : float, optional
+            Upper clipping value.
+
+        Returns
+        -------
+        mean : float
+            Mean of the data.
+
+        std : float
+            Standard deviation of the data.
+        """
+        if lower is None and upper is None:
+            return self.mean_, float(np.sqrt(self.m2 / max(self.n, 1)))
+        if self.is_float:
+            values, weights = self.means, self.weights
+        else:
+            values = np.arange(self.hist_offset, self.hist_offset + len(self.hist), dtype=np.float64)
+            weights = self.hist
+        values = np.clip(values, lower, upper)
+        mean = float(np.sum(values * weights) / self.n)
+        return mean, float(np.sqrt(np.sum(weights * (values - mean) ** 2) / self.n))
+
+
+def batch_percentile(x, q):
+    """
+    Per-sample percentile of a batch, with the linear interpolation used by :func:`numpy.percentile`. Built on
+    ``kthvalue`` as :func:`torch.quantile` does not accept large inputs.
+
+    Parameters
+    ----------
+    x : Torch tensor
+        Batch of data. E.g. ``(batch, channels, y, x)``.
+
+    q : float
+        Percentile to compute, in ``[0, 100]`` range.
+
+    Returns
+    -------
+    values : Torch tensor
+        Percentile of each sample. E.g. ``(batch,)``.
+    """
+    x = x.flatten(1)
+    pos = (q / 100) * (x.shape[1] - 1)
+    lwr, upr = int(np.floor(pos)), int(np.ceil(pos))
+    v_lwr = x.kthvalue(lwr + 1, dim=1).values
+    if upr == lwr:
+        return v_lwr
+    v_upr = x.kthvalue(upr + 1, dim=1).values
+    return v_lwr + (v_upr - v_lwr) * (pos - lwr)
+
+
+def normalize_on_device(x, norm_dict, dtype=torch.float32):
+    """
+    Torch counterpart of the normalization done by the generators (percentile clipping, ``div``, ``scale_range`` and
+    ``custom``) for a whole batch that is already on the device. Statistics that depend on the image are computed
+    per sample.
+
+    Parameters
+    ----------
+    x : Torch tensor
+        Batch in its original dtype. E.g. ``(batch, channels, y, x)``.
+
+    norm_dict : dict
+        Normalization instructions, as created in :func:`~biapy.data.generators.create_train_val_augmentors`.
+
+    dtype : Torch dtype, optional
+        Dtype of the normalized batch.
+
+    Returns
+    -------
+    x : Torch tensor
+        Normalized batch. E.g. ``(batch, channels, y, x)``.
+    """
+    is_uint8 = x.dtype == torch.uint8
+    is_float = x.is_floating_point()
+    x = x.to(dtype)
+    shape = (-1,) + (1,) * (x.ndim - 1)
+    dims = tuple(range(1, x.ndim))
+
+    # Percentile clipping
+    if "lower_bound" in norm_dict and norm_dict["application_mode"] == "image":
+        x_lwr = batch_percentile(x, norm_dict["lower_bound"])
+        x_upr = batch_percentile(x, norm_dict["upper_bound"])
+        if not is_float:
+            x_lwr, x_upr = x_lwr.trunc(), x_upr.trunc()
+        x = torch.maximum(torch.minimum(x, x_upr.view(shape)), x_lwr.view(shape))
+
+    if norm_dict["type"] in ["div", "scale_range"]:
+        x_max = x.amax(dim=dims, keepdim=True)
+        if norm_dict["type"] == "div":
+            if is_uint8:
+                x = x / 255
+            else:
+                scale = torch.ones_like(x_max)
+                scale = torch.where(x_max > 2, torch.full_like(x_max, 1 / 255), scale)
+                scale = torch.where(x_max > 255, torch.full_like(x_max, 1 / 65535), scale)
+                x = x * scale
+        else:
+            x_min = x.amin(dim=dims, keepdim=True)
+            scaled = (x - x_min) / (x_max - x_min + sys.float_info.epsilon)
+            x = scaled if is_uint8 else torch.where(x_max > 2, scaled, x)
+    elif norm_dict["type"] == "custom":
+        if norm_dict["application_mode"] == "image":
+            mean = x.mean(dim=dims, keepdim=True)
+            std = x.std(dim=dims, keepdim=True, unbiased=False)
+            x = torch.where(std == 0, x, (x - mean) / std)
+        elif norm_dict["std"] != 0:
+            x = (x - norm_dict["mean"]) / norm_dict["std"]
+    return x.to(dtype)
+
+
 def resize_images(images, **kwards):
     """
     The function resizes all the images using the specified parameters or default values if not provided.
@@ -1499,6 +1896,110 @@ def detect_edges(images, **kwards):
     return edges
 
 
+def _image_histogram(images, value_range=None):
+    """
+    Histogram of the values of ``images``. Integer data is counted per value with ``np.bincount``, which is linear
+    in the number of pixels, while float data (or integers with a very wide range) is binned in
+    ``HISTOGRAM_MATCHING_BINS`` equal-width bins.
+
+    Parameters
+    ----------
+    images : Numpy array or list of numpy arrays
+        Images to count. All of them must share the same data type.
+
+    value_range : tuple of 2 floats, optional
+        Minimum and maximum value of ``images``. Computed if not given.
+
+    Returns
+    -------
+    values : 1D Numpy array
+        Value represented by each histogram bin: each integer value, or the center of each float bin.
+
+    counts : 1D Numpy array
+        Number of pixels in each bin.
+
+    bin_index : Callable
+        Function that maps an image with the same data type as ``images`` to the bin index of each pixel.
+    """
+    if value_range is None:
+        value_range = (min(np.min(img) for img in images), max(np.max(img) for img in images))
+    vmin, vmax = value_range
+    is_int = np.issubdtype(np.asarray(images[0]).dtype, np.integer)
+
+    if is_int and int(vmax) - int(vmin) < HISTOGRAM_MATCHING_MAX_INT_RANGE:
+        vmin = int(vmin)
+        nbins = int(vmax) - vmin + 1
+
+        def bin_index(img):
+            # int64 so unsigned values below the offset can not wrap around
+            return img.astype(np.int64, copy=False) - vmin
+
+        values = np.arange(vmin, vmin + nbins)
+    else:
+        nbins = HISTOGRAM_MATCHING_BINS
+        width = (float(vmax) - float(vmin)) / nbins if vmax > vmin else 1.0
+
+        def bin_index(img):
+            return np.clip(((img - vmin) / width).astype(np.int64), 0, nbins - 1)
+
+        values = float(vmin) + (np.arange(nbins) + 0.5) * width
+
+    counts = np.zeros(nbins, dtype=np.int64)
+    for img in images:
+        counts += np.bincount(bin_index(np.asarray(img)).ravel(), minlength=nbins)[:nbins]
+    return values, counts, bin_index
+
+
+def _histogram_reference_cdf(target_imgs):
+    """
+    Cumulative distribution of the histogram of the given target images. It only needs to be computed once for all
+    the images to match.
+
+    Parameters
+    ----------
+    target_imgs: Numpy array or list of numpy arrays
+        The target domain images, from which the histogram will be obtained.
+
+    Returns
+    -------
+    reference_cdf : tuple of 2 1D Numpy arrays
+        Values of the histogram bins and their normalized cumulative count.
+    """
+    values, counts, _ = _image_histogram(target_imgs)
+    return values, np.cumsum(counts) / np.sum(counts)
+
+
+def _match_cumulative_cdf(source, reference_cdf):
+    """
+    Match the histogram of ``source`` to the distribution given by ``reference_cdf``. Based on scikit implementation.
+    Source: https://github.com/scikit-image/scikit-image/blob/v0.18.0/skimage/exposure/histogram_matching.py#L22-L70
+
+    Instead of sorting the source values with ``np.unique``, their histogram is counted (see ``_image_histogram``) and
+    the matched value of each bin is stored in a lookup table indexed by the bin of each pixel.
+
+    Parameters
+    ----------
+    source: Numpy array
+        Image to match.
+
+    reference_cdf : tuple of 2 1D Numpy arrays
+        Cumulative distribution to match. See ``_histogram_reference_cdf``.
+
+    Returns
+    -------
+    matched : Numpy array
+        Matched image. Same shape as ``source``.
+    """
+    tmpl_values, tmpl_quantiles = reference_cdf
+    _, src_counts, bin_index = _image_histogram([source])
+
+    # calculate normalized quantiles
+    src_quantiles = np.cumsum(src_counts) / source.size
+    lut = np.interp(src_quantiles, tmpl_quantiles, tmpl_values)
+
+    return lut[bin_index(source)]
+
+
 def _histogram_matching(source_imgs, target_imgs):
     """
     Given a set of target images, it will obtain their mean histogram
@@ -1517,30 +2018,11 @@ def _histogram_matching(source_imgs, target_imgs):
     matched_images : list of numpy arrays
         A set of source images with target's histogram
     """
-
-    hist_mean, _ = np.histogram(target_imgs.ravel(), bins=np.arange(np.iinfo(target_imgs.dtype).max + 1))
-    hist_mean = hist_mean / target_imgs.shape[0]  # number of images
-
-    # calculate normalized quantiles
-    tmpl_size = np.sum(hist_mean)
-    tmpl_quantiles = np.cumsum(hist_mean) / tmpl_size
-
+    reference_cdf = _histogram_reference_cdf(target_imgs)
     del target_imgs
 
-    # based on scikit implementation.
-    # source: https://github.com/scikit-image/scikit-image/blob/v0.18.0/skimage/exposure/histogram_matching.py#L22-L70
-    def _match_cumulative_cdf(source, tmpl_quantiles):
-        src_values, src_unique_indices, src_counts = np.unique(source.ravel(), return_inverse=True, return_counts=True)
-
-        # calculate normalized quantiles
-        src_size = source.size  # number of pixels
-        src_quantiles = np.cumsum(src_counts) / src_size  # normalize
-        interp_a_values = np.interp(src_quantiles, tmpl_quantiles, np.arange(len(tmpl_quantiles)))
-
-        return interp_a_values[src_unique_indices].reshape(source.shape)
-
     # apply histogram matching
-    results = [_match_cumulative_cdf(image, tmpl_quantiles).astype(image.dtype) for image in source_imgs]
+    results = [_match_cumulative_cdf(image, reference_cdf).astype(image.dtype) for image in source_imgs]
     return results
 
 
@@ -1614,9 +2096,129 @@ def apply_clahe(images, **kwards):
     return processed_images
 
 
-def preprocess_data(cfg, x_data=[], y_data=[], is_2d=True, is_y_mask=False):
+def _preprocess_image(cfg, img, is_y, is_y_mask=False, reference_cdf=None):
     """
-    The function preprocesses data by applying various image processing techniques.
+    Apply the preprocessing chain selected in ``cfg`` to a single image. Target images (``is_y``) are only resized.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        ``DATA.PREPROCESS`` configuration.
+
+    img : 3D/4D Numpy array
+        Image to preprocess. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+
+    is_y : bool
+        Whether ``img`` is a target image.
+
+    is_y_mask : bool, optional
+        Whether ``img`` is a mask, so nearest neighbor interpolation is used to resize it.
+
+    reference_cdf : tuple of 2 1D Numpy arrays, optional
+        Cumulative distribution of the reference images used for histogram matching. See
+        ``_histogram_reference_cdf``.
+
+    Returns
+    -------
+    img : 3D/4D Numpy array
+        Preprocessed image.
+    """
+    if cfg.RESIZE.ENABLE:
+        # if y is a mask, then use nearest
+        img = resize_images(
+            [img],
+            output_shape=cfg.RESIZE.OUTPUT_SHAPE,
+            order=0 if is_y and is_y_mask else cfg.RESIZE.ORDER,
+            mode=cfg.RESIZE.MODE,
+            cval=cfg.RESIZE.CVAL,
+            clip=cfg.RESIZE.CLIP,
+            preserve_range=cfg.RESIZE.PRESERVE_RANGE,
+            anti_aliasing=cfg.RESIZE.ANTI_ALIASING,
+        )[0]
+    if is_y:
+        return img
+
+    if cfg.GAUSSIAN_BLUR.ENABLE:
+        img = apply_gaussian_blur(
+            [img],
+            sigma=cfg.GAUSSIAN_BLUR.SIGMA,
+            mode=cfg.GAUSSIAN_BLUR.MODE,
+            channel_axis=cfg.GAUSSIAN_BLUR.CHANNEL_AXIS,
+        )[0]
+    if cfg.MEDIAN_BLUR.ENABLE:
+        img = apply_median_blur([img], footprint=cfg.MEDIAN_BLUR.FOOTPRINT)[0]
+    if cfg.MATCH_HISTOGRAM.ENABLE:
+        img = _match_cumulative_cdf(img, reference_cdf).astype(img.dtype)
+    if cfg.CLAHE.ENABLE:
+        img = apply_clahe(
+            [img],
+            kernel_size=cfg.CLAHE.KERNEL_SIZE,
+            clip_limit=cfg.CLAHE.CLIP_LIMIT,
+        )[0]
+    if cfg.CANNY.ENABLE:
+        img = detect_edges(
+            [img],
+            low_threshold=cfg.CANNY.LOW_THRESHOLD,
+            high_threshold=cfg.CANNY.HIGH_THRESHOLD,
+        )[0]
+    return img
+
+
+def _preprocess_cached_image(cfg, img, is_y, is_y_mask, reference_cdf, cache_file):
+    """
+    Run ``_preprocess_image`` and store its output in ``cache_file``, if given.
+    """
+    img = _preprocess_image(cfg, img, is_y, is_y_mask=is_y_mask, reference_cdf=reference_cdf)
+    if cache_file is not None:
+        # Write to a temporal file first so concurrent jobs never read a partially written image
+        tmp_file = cache_file + ".{}.tmp.npy".format(os.getpid())
+        np.save(tmp_file, img)
+        os.replace(tmp_file, cache_file)
+    return img
+
+
+def _preprocess_cache_key(cfg, img, filename, is_y, is_y_mask, is_2d, reference_key):
+    """
+    Key under which the preprocessed version of ``img`` is cached. It is derived from the hash of the file the image
+    was read from (or of the image itself when no file is given) and from the options that change the output.
+    """
+    opts = {k: cfg[k] for k in ["RESIZE", "GAUSSIAN_BLUR", "MEDIAN_BLUR", "MATCH_HISTOGRAM", "CLAHE", "CANNY"]}
+    if filename is not None and os.path.isfile(filename):
+        content_key = create_file_sha256sum(filename)
+    else:
+        content_key = hashlib.sha256(np.ascontiguousarray(img).tobytes()).hexdigest()
+    key = "-".join(
+        [
+            content_key,
+            str(img.shape),
+            str(img.dtype),
+            str(opts),
+            str(is_y),
+            str(is_y_mask),
+            str(is_2d),
+            reference_key,
+        ]
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _histogram_reference_key(reference_path):
+    """
+    Hash of the files placed in ``reference_path``, so cached images are invalidated when the reference changes.
+    """
+    h = hashlib.sha256()
+    for root, _, files in sorted(os.walk(reference_path)):
+        for f in sorted(files):
+            h.update(os.path.relpath(os.path.join(root, f), reference_path).encode())
+            h.update(create_file_sha256sum(os.path.join(root, f)).encode())
+    return h.hexdigest()
+
+
+def preprocess_data(cfg, x_data=[], y_data=[], is_2d=True, is_y_mask=False, filenames=None):
+    """
+    The function preprocesses data by applying various image processing techniques. The whole chain is applied to
+    each image in turn, using ``cfg.NUM_WORKERS`` processes, and the results are cached on disk when ``cfg.CACHE`` is
+    enabled.
 
     Parameters
     ----------
@@ -1646,6 +2248,10 @@ def preprocess_data(cfg, x_data=[], y_data=[], is_2d=True, is_y_mask=False):
         method (order=0), otherwise it will use the interpolation method specified in the cfg.RESIZE.ORDER
         parameter. Defaults to False.
 
+    filenames: list of str, optional
+        Paths of the files each image was read from. Used to derive the cache key of each image. If not given, the
+        cache key is derived from the image contents.
+
     Returns
     -------
     x_data: 4D/5D numpy array or list of 3D/4D numpy arrays, optional
@@ -1654,71 +2260,87 @@ def preprocess_data(cfg, x_data=[], y_data=[], is_2d=True, is_y_mask=False):
     y_data: 4D/5D numpy array or list of 3D/4D numpy arrays, optional
         Preprocessed data. The same structure and dimensionality of the given data will be returned.
     """
-
+    steps = []
     if cfg.RESIZE.ENABLE:
-        print("Preprocessing: applying resize . . .")
-        if len(x_data) > 0:
-            x_data = resize_images(
-                x_data,
-                output_shape=cfg.RESIZE.OUTPUT_SHAPE,
-                order=cfg.RESIZE.ORDER,
-                mode=cfg.RESIZE.MODE,
-                cval=cfg.RESIZE.CVAL,
-                clip=cfg.RESIZE.CLIP,
-                preserve_range=cfg.RESIZE.PRESERVE_RANGE,
-                anti_aliasing=cfg.RESIZE.ANTI_ALIASING,
-            )
-        if len(y_data) > 0:
-            # if y is a mask, then use nearest
-            y_order = 0 if is_y_mask else cfg.RESIZE.ORDER
-            y_data = resize_images(
-                y_data,
-                output_shape=cfg.RESIZE.OUTPUT_SHAPE,
-                order=y_order,
-                mode=cfg.RESIZE.MODE,
-                cval=cfg.RESIZE.CVAL,
-                clip=cfg.RESIZE.CLIP,
-                preserve_range=cfg.RESIZE.PRESERVE_RANGE,
-                anti_aliasing=cfg.RESIZE.ANTI_ALIASING,
-            )
-
+        steps.append("resize")
     if len(x_data) > 0:
-        if cfg.GAUSSIAN_BLUR.ENABLE:
-            print("Preprocessing: applying gaussian blur . . .")
-            x_data = apply_gaussian_blur(
-                x_data,
-                sigma=cfg.GAUSSIAN_BLUR.SIGMA,
-                mode=cfg.GAUSSIAN_BLUR.MODE,
-                channel_axis=cfg.GAUSSIAN_BLUR.CHANNEL_AXIS,
-            )
-        if cfg.MEDIAN_BLUR.ENABLE:
-            print("Preprocessing: applying median blur . . .")
-            x_data = apply_median_blur(
-                x_data,
-                footprint=cfg.MEDIAN_BLUR.FOOTPRINT,
-            )
-        if cfg.MATCH_HISTOGRAM.ENABLE:
-            print("Preprocessing: applying histogram matching . . .")
-            x_data = apply_histogram_matching(
-                x_data,
-                reference_path=cfg.MATCH_HISTOGRAM.REFERENCE_PATH,
-                is_2d=is_2d,
-            )
-        if cfg.CLAHE.ENABLE:
-            print("Preprocessing: applying CLAHE . . .")
-            x_data = apply_clahe(
-                x_data,
-                kernel_size=cfg.CLAHE.KERNEL_SIZE,
-                clip_limit=cfg.CLAHE.CLIP_LIMIT,
-            )
-        if cfg.CANNY.ENABLE:
-            print("Preprocessing: applying Canny . . .")
-            x_data = detect_edges(
-                x_data,
-                low_threshold=cfg.CANNY.LOW_THRESHOLD,
-                high_threshold=cfg.CANNY.HIGH_THRESHOLD,
+        for step, name in [
+            ("GAUSSIAN_BLUR", "gaussian blur"),
+            ("MEDIAN_BLUR", "median blur"),
+            ("MATCH_HISTOGRAM", "histogram matching"),
+            ("CLAHE", "CLAHE"),
+            ("CANNY", "Canny"),
+        ]:
+            if cfg[step].ENABLE:
+                steps.append(name)
+    print("Preprocessing: applying {} . . .".format(", ".join(steps) if len(steps) > 0 else "nothing"))
+
+    num_workers = cfg.NUM_WORKERS if cfg.NUM_WORKERS > 0 else os.cpu_count()
+    use_cache = cfg.CACHE and cfg.CACHE_DIR != ""
+    if use_cache:
+        os.makedirs(cfg.CACHE_DIR, exist_ok=True)
+    reference_key = ""
+    if use_cache and len(x_data) > 0 and cfg.MATCH_HISTOGRAM.ENABLE:
+        reference_key = _histogram_reference_key(cfg.MATCH_HISTOGRAM.REFERENCE_PATH)
+
+    def _process(data, is_y):
+        if len(data) == 0:
+            return data
+
+        # Look up the cache first
+        results = [None] * len(data)
+        cache_files = [None] * len(data)
+        if use_cache:
+            for i, img in enumerate(data):
+                fname = filenames[i] if filenames is not None else None
+                key = _preprocess_cache_key(cfg, img, fname, is_y, is_y_mask, is_2d, reference_key)
+                cache_files[i] = os.path.join(cfg.CACHE_DIR, key + ".npy")
+                if os.path.exists(cache_files[i]):
+                    results[i] = np.load(cache_files[i])
+        pending = [i for i in range(len(data)) if results[i] is None]
+        if use_cache:
+            print(
+                "Preprocessing: {} images loaded from cache ({}), {} to process".format(
+                    len(data) - len(pending), cfg.CACHE_DIR, len(pending)
+                )
             )
 
+        if len(pending) > 0:
+            reference_cdf = None
+            if not is_y and cfg.MATCH_HISTOGRAM.ENABLE:
+                f_name = load_data_from_dir if is_2d else load_3d_images_from_dir
+                references, *_ = f_name(cfg.MATCH_HISTOGRAM.REFERENCE_PATH)
+                reference_cdf = _histogram_reference_cdf(references)
+                del references
+
+            args = [(cfg, data[i], is_y, is_y_mask, reference_cdf, cache_files[i]) for i in pending]
+            if num_workers > 1 and len(pending) > 1:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    processed = list(
+                        tqdm(
+                            executor.map(
+                                _preprocess_cached_image,
+                                *zip(*args),
+                                chunksize=max(1, len(pending) // (4 * num_workers)),
+                            ),
+                            total=len(pending),
+                            disable=not is_main_process(),
+                        )
+                    )
+            else:
+                processed = [
+                    _preprocess_cached_image(*a) for a in tqdm(args, total=len(args), disable=not is_main_process())
+                ]
+            for i, img in zip(pending, processed):
+                results[i] = img
+
+        if isinstance(data, np.ndarray):
+            results = np.array(results)
+        return results
+
+    x_data = _process(x_data, is_y=False)
+    y_data = _process(y_data, is_y=True)
+
     if len(x_data) > 0 and len(y_data) > 0:
         return x_data, y_data
     if len(y_data) > 0:
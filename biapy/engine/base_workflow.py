@@ -1,8 +1,10 @@
 import math
 import os
+import itertools
 import datetime
 import time
 import json
+import copy
 import torch
 import h5py
 import argparse
@@ -28,6 +30,8 @@ from biapy.models import (
     check_bmz_args,
 )
 from biapy.engine import prepare_optimizer, build_callbacks
+from biapy.engine.inference_backend import build_inference_backend
+from biapy.engine.quantization import build_quantized_model, QuantizedModel
 from biapy.data.generators import (
     create_train_val_augmentors,
     create_test_augmentor,
@@ -45,6 +49,7 @@ from biapy.utils.misc import (
     to_numpy_format,
     is_dist_avail_and_initialized,
     setup_for_distributed,
+    StageTimer,
 )
 from biapy.utils.util import (
     load_data_from_dir,
@@ -56,6 +61,9 @@ from biapy.utils.util import (
     read_chunked_data,
     order_dimensions,
     read_img,
+    chunked_dataset_kwargs,
+    get_chunked_data_options,
+    MultiscalePyramid,
 )
 from biapy.engine.train_engine import train_one_epoch, evaluate
 from biapy.data.data_2D_manipulation import (
@@ -64,12 +72,14 @@ from biapy.data.data_2D_manipulation import (
     load_and_prepare_2D_train_data,
 )
 from biapy.data.data_3D_manipulation import (
-    crop_3D_data_with_overlap,
-    merge_3D_data_with_overlap,
+    pad_3D_data_for_crop,
+    get_3D_overlap_tiling,
+    get_3D_merge_normalization,
     load_and_prepare_3D_data,
     load_and_prepare_3D_efficient_format_data,
     load_3D_efficient_files,
     extract_3D_patch_with_overlap_yield,
+    close_cached_efficient_files,
 )
 from biapy.data.post_processing.post_processing import (
     ensemble8_2d_predictions,
@@ -77,6 +87,7 @@ from biapy.data.post_processing.post_processing import (
     apply_binary_mask,
 )
 from biapy.data.post_processing import apply_post_processing
+from biapy.data.post_processing.smooth_tiled_predictions import blending_window
 from biapy.data.pre_processing import preprocess_data
 
 
@@ -142,6 +153,7 @@ class Base_Workflow(metaclass=ABCMeta):
         self.all_gt = []
 
         self.stats = {}
+        self.stage_timer = StageTimer(enabled=False)
 
         # Per crop
         self.stats["per_crop"] = {}
@@ -440,7 +452,35 @@ class Base_Workflow(metaclass=ABCMeta):
             Resulting targets.
         """
         # We do not use 'batch' input but in SSL workflow
-        return to_pytorch_format(targets, self.axis_order, self.device)
+        return self.batch_to_device(targets, is_mask=True)
+
+    def batch_to_device(self, x, dtype=torch.float32, is_mask=False):
+        """
+        Convert a training/validation batch into Pytorch format and send it to the device. If
+        ``DATA.NORMALIZATION.ON_DEVICE`` is selected the batch arrives in its original dtype and it is normalized
+        there (masks only when they are normalized as images).
+
+        Parameters
+        ----------
+        x : Torch Tensor
+            Batch to convert.
+
+        dtype : Torch dtype, optional
+            Dtype of the resulting tensor.
+
+        is_mask : bool, optional
+            Whether ``x`` is a batch of masks or not.
+
+        Returns
+        -------
+        x : Torch tensor
+            Resulting batch.
+        """
+        norm_dict = None
+        if self.cfg.DATA.NORMALIZATION.ON_DEVICE and self.data_norm is not None:
+            if not is_mask or self.data_norm["mask_norm"] == "as_image":
+                norm_dict = self.data_norm
+        return to_pytorch_format(x, self.axis_order, self.device, dtype=dtype, norm_dict=norm_dict)
 
     def load_train_data(self):
         """
@@ -855,7 +895,10 @@ class Base_Workflow(metaclass=ABCMeta):
             Image prediction.
         """
         if to_pytorch:
-            in_img = to_pytorch_format(in_img, self.axis_order, self.device)
+            if is_train:
+                in_img = self.batch_to_device(in_img)
+            else:
+                in_img = to_pytorch_format(in_img, self.axis_order, self.device)
         if self.cfg.MODEL.SOURCE == "biapy":
             p = self.model(in_img)
         elif self.cfg.MODEL.SOURCE == "bmz":
@@ -978,6 +1021,7 @@ class Base_Workflow(metaclass=ABCMeta):
 
         print(f"Start training in epoch {self.start_epoch+1} - Total: {self.cfg.TRAIN.EPOCHS}")
         start_time = time.time()
+        self.stage_timer = StageTimer(enabled=self.cfg.LOG.STAGE_TIMING)
         self.val_best_metric = np.zeros(len(self.train_metric_names), dtype=np.float32)
         self.val_best_loss = np.Inf
         for epoch in range(self.start_epoch, self.cfg.TRAIN.EPOCHS):
@@ -1007,6 +1051,7 @@ class Base_Workflow(metaclass=ABCMeta):
                 lr_scheduler=self.lr_scheduler,
                 start_steps=epoch * self.num_training_steps_per_epoch,
                 verbose=self.cfg.TRAIN.VERBOSE,
+                stage_timer=self.stage_timer,
             )
 
             # Save checkpoint
@@ -1039,6 +1084,7 @@ class Base_Workflow(metaclass=ABCMeta):
                     epoch=epoch,
                     data_loader=self.val_generator,
                     lr_scheduler=self.lr_scheduler,
+                    stage_timer=self.stage_timer,
                 )
 
                 # Save checkpoint is val loss improved
@@ -1146,6 +1192,10 @@ class Base_Workflow(metaclass=ABCMeta):
                 print("Validation {}: {}".format(self.train_metric_names[i], self.val_best_metric[i]))
 
         print("Finished Training")
+        if is_main_process():
+            self.stage_timer.save(self.cfg.PATHS.STAGE_TIMING_DIR, "train")
+        # Release the files opened to read training patches when the data was loaded in the main process
+        close_cached_efficient_files()
 
         # Save two samples to export the model to BMZ
         if "test_input" not in self.bmz_config:
@@ -1329,6 +1379,96 @@ class Base_Workflow(metaclass=ABCMeta):
         else:
             return pred
 
+    def quantization_calibration_batches(self):
+        """
+        Collect ``TEST.QUANTIZATION.CALIBRATION_SAMPLES`` training patches, normalized and in CPU, to calibrate the
+        quantized model.
+
+        Returns
+        -------
+        batches : list of Tensors
+            Calibration batches. Empty if there is no training generator.
+        """
+        batches, samples = [], 0
+        if getattr(self, "train_generator", None) is None:
+            return batches
+        for batch in self.train_generator:
+            x = self.batch_to_device(batch[0]).to("cpu")
+            batches.append(x)
+            samples += x.shape[0]
+            if samples >= self.cfg.TEST.QUANTIZATION.CALIBRATION_SAMPLES:
+                break
+        return batches
+
+    def prepare_quantized_model(self):
+        """
+        Replace the model by its INT8 version and, if ``TEST.QUANTIZATION.REPORT`` is enabled, report the loss and
+        metric drift with respect to the fp32 model in the validation set.
+        """
+        print("#####################")
+        print("#  QUANTIZE MODEL   #")
+        print("#####################")
+        qmodel = build_quantized_model(
+            self.cfg,
+            self.model_without_ddp,
+            self.device,
+            self.quantization_calibration_batches,
+            checkpoint_path=self.checkpoint_path,
+        )
+
+        if self.cfg.TEST.QUANTIZATION.REPORT:
+            if getattr(self, "val_generator", None) is None:
+                print("No validation data available, so the quantization report will not be created")
+            else:
+                # Both models are run in CPU so the speedup compares the same device
+                fp32_model = QuantizedModel(copy.deepcopy(self.model_without_ddp).to("cpu").eval(), self.device)
+                stats, times = {}, {}
+                for name, model in [("fp32", fp32_model), ("int8", qmodel)]:
+                    print(f"Evaluating {name} model (CPU) in validation data . . .")
+                    self.model = model
+                    start_time = time.time()
+                    stats[name] = evaluate(
+                        self.cfg,
+                        model=model,
+                        model_call_func=self.model_call_func,
+                        loss_function=self.loss,
+                        activations=self.apply_model_activations,
+                        metric_function=self.metric_calculation,
+                        prepare_targets=self.prepare_targets,
+                        epoch=-1,
+                        data_loader=self.val_generator,
+                        lr_scheduler=None,
+                    )
+                    times[name] = time.time() - start_time
+                del fp32_model
+
+                report = {
+                    k: {
+                        "fp32": float(stats["fp32"][k]),
+                        "int8": float(stats["int8"][k]),
+                        "drift": float(stats["int8"][k]) - float(stats["fp32"][k]),
+                    }
+                    for k in stats["fp32"]
+                }
+                report["time"] = {
+                    "fp32": times["fp32"],
+                    "int8": times["int8"],
+                    "speedup": times["fp32"] / max(times["int8"], 1e-8),
+                }
+                report["device"] = "cpu"
+                print("Quantization report (validation data, both models in CPU):")
+                print("{:<20} {:>12} {:>12} {:>12}".format("", "fp32", "int8", "drift/speedup"))
+                for k, v in report.items():
+                    if isinstance(v, dict):
+                        print("{:<20} {:>12.5f} {:>12.5f} {:>12.5f}".format(k, *v.values()))
+                if is_main_process():
+                    os.makedirs(os.path.dirname(self.cfg.PATHS.QUANTIZATION_REPORT), exist_ok=True)
+                    with open(self.cfg.PATHS.QUANTIZATION_REPORT, "w") as f:
+                        json.dump(report, f, indent=4)
+                    print(f"Quantization report saved in {self.cfg.PATHS.QUANTIZATION_REPORT}")
+
+        self.model = qmodel
+
     @torch.no_grad()
     def test(self):
         """
@@ -1356,6 +1496,21 @@ class Base_Workflow(metaclass=ABCMeta):
         if self.start_epoch == -1:
             raise ValueError("There was a problem loading the checkpoint. Test phase aborted!")
 
+        # Replace the model by the selected inference backend
+        if self.cfg.MODEL.SOURCE == "biapy" and self.cfg.TEST.BACKEND.TYPE != "eager":
+            self.model, artifact = build_inference_backend(
+                self.cfg,
+                self.model_without_ddp,
+                self.device,
+                checkpoint_path=self.checkpoint_path,
+            )
+            if self.cfg.TEST.BACKEND.TYPE == "torchscript":
+                self.bmz_config["torchscript_file"] = artifact
+
+        # Quantize the model to INT8 for CPU inference
+        if self.cfg.MODEL.SOURCE == "biapy" and self.cfg.TEST.QUANTIZATION.ENABLE:
+            self.prepare_quantized_model()
+
         image_counter = 0
 
         print("###############")
@@ -1368,6 +1523,8 @@ class Base_Workflow(metaclass=ABCMeta):
             setup_for_distributed(True)
 
         # Process all the images
+        self.stage_timer = StageTimer(enabled=self.cfg.LOG.STAGE_TIMING)
+        load_start = time.perf_counter()
         for i, gen_obj in tqdm(
             enumerate(self.test_generator),
             total=len(self.test_generator),
@@ -1376,6 +1533,10 @@ class Base_Workflow(metaclass=ABCMeta):
             self._X, X_norm, self._Y, Y_norm = None, None, None, None
             if "X" in gen_obj:
                 self._X = gen_obj["X"]
+            # Loading includes the normalization made by the generator, except in 'TEST.BY_CHUNKS'
+            self.stage_timer.record(
+                "load", load_start, items=np.prod(self._X.shape[1:-1]) if isinstance(self._X, np.ndarray) else 0
+            )
             if "X_norm" in gen_obj:
                 X_norm = gen_obj["X_norm"]
             if "Y" in gen_obj:
@@ -1398,11 +1559,13 @@ class Base_Workflow(metaclass=ABCMeta):
                     self.process_test_sample(norm=(X_norm, Y_norm))
 
             image_counter += 1
+            load_start = time.perf_counter()
 
         self.destroy_test_data()
 
         if is_main_process():
-            self.after_all_images()
+            with self.stage_timer.stage("post_processing"):
+                self.after_all_images()
 
             print("#############")
             print("#  RESULTS  #")
@@ -1439,11 +1602,13 @@ class Base_Workflow(metaclass=ABCMeta):
                         )
                     )
             self.print_stats(image_counter)
+            self.stage_timer.save(self.cfg.PATHS.STAGE_TIMING_DIR, "test")
 
     def process_test_sample_by_chunks(self, filenames):
         """
         Function to process a sample in the inference phase. A final H5/Zarr file is created in "TZCYX" or "TZYXC" order
-        depending on ``TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER`` ('T' is always included).
+        depending on ``TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER`` ('T' is always included). If
+        ``TEST.BY_CHUNKS.PYRAMID.ENABLE`` is selected its downsampled levels are written along with it, block by block.
 
         Parameters
         ----------
@@ -1546,12 +1711,18 @@ class Base_Workflow(metaclass=ABCMeta):
             if self.cfg.TEST.VERBOSE and self.cfg.SYSTEM.NUM_GPUS > 1:
                 print(f"[Rank {get_rank()} ({os.getpid()})] Doing inference ")
             while True:
+                # Waiting for the patches extracted by the loading process
+                load_start = time.perf_counter()
                 obj = self.input_queue.get(timeout=60)
                 if obj == None:
                     break
 
                 img, patch_coords = obj
-                img, _ = self.test_generator.norm_X(img)
+                voxels = np.prod(img.shape[1:-1])
+                self.stage_timer.record("load", load_start, items=voxels)
+                with self.stage_timer.stage("normalize", items=voxels):
+                    img, _ = self.test_generator.norm_X(img)
+                forward_start = time.perf_counter()
                 if self.cfg.TEST.AUGMENTATION:
                     p = ensemble16_3d_predictions(
                         img[0],
@@ -1570,7 +1741,9 @@ class Base_Workflow(metaclass=ABCMeta):
                 if isinstance(p, list):
                     p = torch.cat((p[0], torch.argmax(p[1], axis=1).unsqueeze(1)), dim=1)
                 p = to_numpy_format(p, self.axis_order_back)
+                self.stage_timer.record("tta" if self.cfg.TEST.AUGMENTATION else "forward", forward_start, items=voxels)
 
+                merge_start = time.perf_counter()
                 t_dim, z_dim, y_dim, x_dim, c_dim = order_dimensions(
                     self.cfg.DATA.PREPROCESS.ZOOM.ZOOM_FACTOR,
                     input_order=self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER,
@@ -1586,13 +1759,21 @@ class Base_Workflow(metaclass=ABCMeta):
                     y_dim * self.cfg.DATA.TEST.PADDING[1] : p.shape[2] - y_dim * self.cfg.DATA.TEST.PADDING[1],
                     x_dim * self.cfg.DATA.TEST.PADDING[2] : p.shape[3] - x_dim * self.cfg.DATA.TEST.PADDING[2],
                 ]
-                m = np.ones(p.shape, dtype=np.uint8)
+                if self.cfg.DATA.TEST.BLENDING != "average":
+                    # Weight the patch so the division made afterwards gives the weighted average
+                    window = blending_window(p.shape[:-1], mode=self.cfg.DATA.TEST.BLENDING)
+                    p = p * window
+                    m = np.broadcast_to(window, p.shape)
+                else:
+                    m = np.ones(p.shape, dtype=np.uint8)
                 patch_coords = np.array(
                     [patch_coords[:, 0], patch_coords[:, 0] + np.array(p.shape)[:-1]]
                 ).T  # should not be necessary?
+                self.stage_timer.record("merge", merge_start, items=voxels)
 
-                # Put the prediction into queue
-                self.output_queue.put([p, m, patch_coords])
+                # Put the prediction into queue. It waits while the writing process is behind
+                with self.stage_timer.stage("write", items=np.prod(p.shape[:-1])):
+                    self.output_queue.put([p, m, patch_coords])
 
             # Get some auxiliar variables
             self.stats["patch_by_batch_counter"] = self.extract_info_queue.get(timeout=60)
@@ -1611,6 +1792,7 @@ class Base_Workflow(metaclass=ABCMeta):
 
         # Create the final H5/Zarr file that contains all the individual parts
         if is_main_process():
+            merge_start = time.perf_counter()
             if not self.cfg.TEST.REUSE_PREDICTIONS:
                 if "C" not in self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:
                     out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER + "C"
@@ -1655,13 +1837,19 @@ class Base_Workflow(metaclass=ABCMeta):
 
                         if "data" not in locals():
                             all_data_filename = os.path.join(self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filename + ext)
+                            storage_kwargs = chunked_dataset_kwargs(
+                                self.cfg.TEST.BY_CHUNKS.FORMAT,
+                                data_part.shape,
+                                out_data_order,
+                                **get_chunked_data_options(self.cfg),
+                            )
                             if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                                 allfile = h5py.File(all_data_filename, "w")
                                 data = allfile.create_dataset(
                                     "data",
                                     data_part.shape,
                                     dtype=self.dtype_str,
-                                    compression="gzip",
+                                    **storage_kwargs,
                                 )
                             else:
                                 allfile = zarr.open_group(all_data_filename, mode="w")
@@ -1669,8 +1857,9 @@ class Base_Workflow(metaclass=ABCMeta):
                                     "data",
                                     shape=data_part.shape,
                                     dtype=self.dtype_str,
-                                    compression="gzip",
+                                    **storage_kwargs,
                                 )
+                            pyramid = self.create_output_pyramid(allfile, data, out_data_order, filename)
 
                         for j, k in enumerate(list_of_vols_in_z[i]):
 
@@ -1690,9 +1879,11 @@ class Base_Workflow(metaclass=ABCMeta):
 
                             if self.cfg.TEST.VERBOSE:
                                 print(f"Filling {k} [{z_vol_info[k][0]}:{z_vol_info[k][1]}]")
-                            data[data_ordered_slices] = (
-                                data_part[data_ordered_slices] / data_mask_part[data_ordered_slices]
-                            )
+                            slab = data_part[data_ordered_slices] / data_mask_part[data_ordered_slices]
+                            data[data_ordered_slices] = slab
+                            if pyramid is not None:
+                                pyramid.write_z_slab(slab, z_vol_info[k][0])
+                            del slab
 
                             if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                                 allfile.flush()
@@ -1732,38 +1923,40 @@ class Base_Workflow(metaclass=ABCMeta):
                     mask_file, mask = read_chunked_data(out_data_mask_filename)
 
                     # Create new file
+                    storage_kwargs = chunked_dataset_kwargs(
+                        self.cfg.TEST.BY_CHUNKS.FORMAT,
+                        pred.shape,
+                        out_data_order,
+                        **get_chunked_data_options(self.cfg),
+                    )
                     if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                         fid_div = h5py.File(out_data_div_filename, "w")
-                        pred_div = fid_div.create_dataset("data", pred.shape, dtype=pred.dtype, compression="gzip")
+                        pred_div = fid_div.create_dataset("data", pred.shape, dtype=pred.dtype, **storage_kwargs)
                     else:
                         fid_div = zarr.open_group(out_data_div_filename, mode="w")
-                        pred_div = fid_div.create_dataset("data", shape=pred.shape, dtype=pred.dtype)
+                        pred_div = fid_div.create_dataset("data", shape=pred.shape, dtype=pred.dtype, **storage_kwargs)
+                    pyramid = self.create_output_pyramid(fid_div, pred_div, out_data_order, filename)
 
                     t_dim, z_dim, c_dim, y_dim, x_dim = order_dimensions(
                         out_data_shape, self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
                     )
 
-                    # Fill the new data
-                    z_vols = math.ceil(z_dim / self.cfg.DATA.PATCH_SIZE[0])
-                    y_vols = math.ceil(y_dim / self.cfg.DATA.PATCH_SIZE[1])
-                    x_vols = math.ceil(x_dim / self.cfg.DATA.PATCH_SIZE[2])
+                    # Fill the new data. With a pyramid, blocks are enlarged to multiples of its coarsest level
+                    # factors so each downsampled voxel is computed from a single block
+                    block_size = np.array(self.cfg.DATA.PATCH_SIZE[:3])
+                    if pyramid is not None:
+                        block_size = np.ceil(block_size / pyramid.alignment).astype(int) * pyramid.alignment
+                    z_vols = math.ceil(z_dim / block_size[0])
+                    y_vols = math.ceil(y_dim / block_size[1])
+                    x_vols = math.ceil(x_dim / block_size[2])
                     for z in tqdm(range(z_vols), disable=not is_main_process()):
                         for y in range(y_vols):
                             for x in range(x_vols):
 
                                 slices = (
-                                    slice(
-                                        z * self.cfg.DATA.PATCH_SIZE[0],
-                                        min(z_dim, self.cfg.DATA.PATCH_SIZE[0] * (z + 1)),
-                                    ),
-                                    slice(
-                                        y * self.cfg.DATA.PATCH_SIZE[1],
-                                        min(y_dim, self.cfg.DATA.PATCH_SIZE[1] * (y + 1)),
-                                    ),
-                                    slice(
-                                        x * self.cfg.DATA.PATCH_SIZE[2],
-                                        min(x_dim, self.cfg.DATA.PATCH_SIZE[2] * (x + 1)),
-                                    ),
+                                    slice(z * block_size[0], min(z_dim, block_size[0] * (z + 1))),
+                                    slice(y * block_size[1], min(y_dim, block_size[1] * (y + 1))),
+                                    slice(x * block_size[2], min(x_dim, block_size[2] * (x + 1))),
                                     slice(0, pred.shape[c_index]),  # Channel
                                 )
 
@@ -1773,7 +1966,10 @@ class Base_Workflow(metaclass=ABCMeta):
                                     output_order=out_data_order,
                                     default_value=0,
                                 )
-                                pred_div[data_ordered_slices] = pred[data_ordered_slices] / mask[data_ordered_slices]
+                                block = pred[data_ordered_slices] / mask[data_ordered_slices]
+                                pred_div[data_ordered_slices] = block
+                                if pyramid is not None:
+                                    pyramid.write(block, slices)
 
                         if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
                             fid_div.flush()
@@ -1808,12 +2004,16 @@ class Base_Workflow(metaclass=ABCMeta):
                         pred_file.close()
                         mask_file.close()
                         fid_div.close()
+                voxels = np.prod(order_dimensions(out_data_shape, self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER, "ZYX"))
+                self.stage_timer.record("merge", merge_start, items=voxels)
 
+            post_start = time.perf_counter()
             if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS:
                 if self.cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE == "chunk_by_chunk":
                     self.after_merge_patches_by_chunks_proccess_patch(out_data_div_filename)
                 else:
                     self.after_merge_patches_by_chunks_proccess_entire_pred(out_data_div_filename)
+            self.stage_timer.record("post_processing", post_start)
 
         # Wait until the main thread is done to predict the next sample
         if self.cfg.SYSTEM.NUM_GPUS > 1:
@@ -1824,6 +2024,42 @@ class Base_Workflow(metaclass=ABCMeta):
             if self.cfg.TEST.VERBOSE:
                 print(f"[Rank {get_rank()} ({os.getpid()})] Synched with main thread. Go for the next sample")
 
+    def create_output_pyramid(self, group, data, axes_order, name):
+        """
+        Create the downsampled levels of the final prediction of ``TEST.BY_CHUNKS``, if selected with
+        ``TEST.BY_CHUNKS.PYRAMID.ENABLE``.
+
+        Parameters
+        ----------
+        group : H5 file or Zarr group
+            File that contains the final prediction.
+
+        data : H5 dataset or Zarr array
+            Final prediction.
+
+        axes_order : str
+            Axes order of ``data``. E.g. ``TZCYX``.
+
+        name : str
+            Name of the image.
+
+        Returns
+        -------
+        pyramid : MultiscalePyramid or None
+            Levels to write each finished block of the prediction into. ``None`` if no pyramid is created.
+        """
+        if not self.cfg.TEST.BY_CHUNKS.PYRAMID.ENABLE or self.cfg.TEST.BY_CHUNKS.FORMAT != "zarr":
+            return None
+        return MultiscalePyramid(
+            group,
+            data,
+            axes_order,
+            levels=self.cfg.TEST.BY_CHUNKS.PYRAMID.LEVELS,
+            downscale=self.cfg.TEST.BY_CHUNKS.PYRAMID.DOWNSCALE,
+            name=name,
+            **get_chunked_data_options(self.cfg),
+        )
+
     def process_test_sample(self, norm):
         """
         Function to process a sample in the inference phase.
@@ -1893,59 +2129,28 @@ class Base_Workflow(metaclass=ABCMeta):
                         )
 
                     if self.cfg.PROBLEM.NDIM == "2D":
-                        obj = crop_data_with_overlap(
-                            self._X,
-                            self.cfg.DATA.PATCH_SIZE,
-                            data_mask=self._Y,
-                            overlap=self.cfg.DATA.TEST.OVERLAP,
-                            padding=self.cfg.DATA.TEST.PADDING,
-                            verbose=self.cfg.TEST.VERBOSE,
-                        )
-                        if self._Y is not None:
-                            self._X, self._Y = obj
-                        else:
-                            self._X = obj
-                        del obj
-                    else:
-                        if self.cfg.TEST.REDUCE_MEMORY:
-                            self._X = crop_3D_data_with_overlap(
-                                self._X[0],
-                                self.cfg.DATA.PATCH_SIZE,
-                                overlap=self.cfg.DATA.TEST.OVERLAP,
-                                padding=self.cfg.DATA.TEST.PADDING,
-                                verbose=self.cfg.TEST.VERBOSE,
-                                median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING,
-                            )
-                            if self._Y is not None:
-                                self._Y = crop_3D_data_with_overlap(
-                                    self._Y[0],
-                                    self.cfg.DATA.PATCH_SIZE[:-1] + (self._Y.shape[-1],),
-                                    overlap=self.cfg.DATA.TEST.OVERLAP,
-                                    padding=self.cfg.DATA.TEST.PADDING,
-                                    verbose=self.cfg.TEST.VERBOSE,
-                                    median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING,
-                                )
-                        else:
-                            if self._Y is not None:
-                                self._Y = self._Y[0]
-                            obj = crop_3D_data_with_overlap(
-                                self._X[0],
+                        with self.stage_timer.stage("crop", items=np.prod(self._X.shape[:-1])):
+                            obj = crop_data_with_overlap(
+                                self._X,
                                 self.cfg.DATA.PATCH_SIZE,
                                 data_mask=self._Y,
                                 overlap=self.cfg.DATA.TEST.OVERLAP,
                                 padding=self.cfg.DATA.TEST.PADDING,
                                 verbose=self.cfg.TEST.VERBOSE,
-                                median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING,
                             )
-                            if self._Y is not None:
-                                self._X, self._Y = obj
-                            else:
-                                self._X = obj
-                            del obj
+                        if self._Y is not None:
+                            self._X, self._Y = obj
+                        else:
+                            self._X = obj
+                        del obj
 
                 # Predict each patch
-                if self.cfg.TEST.AUGMENTATION:
+                if self.cfg.PROBLEM.NDIM == "3D" and original_data_shape[1:-1] != self.cfg.DATA.PATCH_SIZE[:-1]:
+                    # Predict and merge patch by patch to not create the stack of patches
+                    pred = self.predict_3D_volume_by_patches()
+                elif self.cfg.TEST.AUGMENTATION:
                     for k in tqdm(range(self._X.shape[0]), leave=False):
+                        forward_start = time.perf_counter()
                         if self.cfg.PROBLEM.NDIM == "2D":
                             p = ensemble8_2d_predictions(
                                 self._X[k],
@@ -1969,8 +2174,10 @@ class Base_Workflow(metaclass=ABCMeta):
                         # Multi-head concatenation
                         if isinstance(p, list):
                             p = torch.cat((p[0], torch.argmax(p[1], axis=1).unsqueeze(1)), dim=1)
+                        self.stage_timer.record("tta", forward_start, items=np.prod(self._X.shape[1:-1]), sync=True)
 
                         # Calculate the metrics
+                        metrics_start = time.perf_counter()
                         if self._Y is not None:
                             metric_values = self.metric_calculation(
                                 p,
@@ -1986,6 +2193,7 @@ class Base_Workflow(metaclass=ABCMeta):
                                 if str(metric).lower() not in self.stats["per_crop"]:
                                     self.stats["per_crop"][str(metric).lower()] = 0
                                 self.stats["per_crop"][str(metric).lower()] += metric_values[metric]
+                            self.stage_timer.record("metrics", metrics_start, items=np.prod(self._X.shape[1:-1]))
                         self.stats["patch_by_batch_counter"] += 1
 
                         p = to_numpy_format(p, self.axis_order_back)
@@ -2000,6 +2208,8 @@ class Base_Workflow(metaclass=ABCMeta):
                             if (k + 1) * self.cfg.TRAIN.BATCH_SIZE < self._X.shape[0]
                             else self._X.shape[0]
                         )
+                        voxels = np.prod(self._X[k * self.cfg.TRAIN.BATCH_SIZE : top].shape[:-1])
+                        forward_start = time.perf_counter()
                         with torch.cuda.amp.autocast():
                             p = self.apply_model_activations(
                                 self.model_call_func(self._X[k * self.cfg.TRAIN.BATCH_SIZE : top])
@@ -2010,8 +2220,10 @@ class Base_Workflow(metaclass=ABCMeta):
                                     (p[0], torch.argmax(p[1], axis=1).unsqueeze(1)),
                                     dim=1,
                                 )
+                        self.stage_timer.record("forward", forward_start, items=voxels, sync=True)
 
                         # Calculate the metrics
+                        metrics_start = time.perf_counter()
                         if self._Y is not None:
                             metric_values = self.metric_calculation(
                                 p,
@@ -2027,6 +2239,7 @@ class Base_Workflow(metaclass=ABCMeta):
                                 if str(metric).lower() not in self.stats["per_crop"]:
                                     self.stats["per_crop"][str(metric).lower()] = 0
                                 self.stats["per_crop"][str(metric).lower()] += metric_values[metric]
+                            self.stage_timer.record("metrics", metrics_start, items=voxels)
                         self.stats["patch_by_batch_counter"] += 1
 
                         p = to_numpy_format(p, self.axis_order_back)
@@ -2036,24 +2249,22 @@ class Base_Workflow(metaclass=ABCMeta):
 
                 # Delete self._X as in 3D there is no full image
                 if self.cfg.PROBLEM.NDIM == "3D":
-                    del self._X, p
-
-                # Reconstruct the predictions
-                if original_data_shape[1:-1] != self.cfg.DATA.PATCH_SIZE[:-1]:
-                    if self.cfg.PROBLEM.NDIM == "3D":
-                        original_data_shape = original_data_shape[1:]
-                    f_name = merge_data_with_overlap if self.cfg.PROBLEM.NDIM == "2D" else merge_3D_data_with_overlap
+                    del self._X
 
+                # Reconstruct the predictions (3D volumes are already merged in predict_3D_volume_by_patches())
+                if self.cfg.PROBLEM.NDIM == "2D" and original_data_shape[1:-1] != self.cfg.DATA.PATCH_SIZE[:-1]:
+                    merge_start = time.perf_counter()
                     if self.cfg.TEST.REDUCE_MEMORY:
-                        pred = f_name(
+                        pred = merge_data_with_overlap(
                             pred,
                             original_data_shape[:-1] + (pred.shape[-1],),
                             padding=self.cfg.DATA.TEST.PADDING,
                             overlap=self.cfg.DATA.TEST.OVERLAP,
                             verbose=self.cfg.TEST.VERBOSE,
+                            blending=self.cfg.DATA.TEST.BLENDING,
                         )
                         if self._Y is not None:
-                            self._Y = f_name(
+                            self._Y = merge_data_with_overlap(
                                 self._Y,
                                 original_data_shape[:-1] + (self._Y.shape[-1],),
                                 padding=self.cfg.DATA.TEST.PADDING,
@@ -2061,26 +2272,23 @@ class Base_Workflow(metaclass=ABCMeta):
                                 verbose=self.cfg.TEST.VERBOSE,
                             )
                     else:
-                        obj = f_name(
+                        obj = merge_data_with_overlap(
                             pred,
                             original_data_shape[:-1] + (pred.shape[-1],),
                             data_mask=self._Y,
                             padding=self.cfg.DATA.TEST.PADDING,
                             overlap=self.cfg.DATA.TEST.OVERLAP,
                             verbose=self.cfg.TEST.VERBOSE,
+                            blending=self.cfg.DATA.TEST.BLENDING,
                         )
                         if self._Y is not None:
                             pred, self._Y = obj
                         else:
                             pred = obj
                         del obj
-                    if self.cfg.PROBLEM.NDIM != "3D":
-                        self._X = X_original.copy()
-                        del X_original
-                    else:
-                        pred = np.expand_dims(pred, 0)
-                        if self._Y is not None:
-                            self._Y = np.expand_dims(self._Y, 0)
+                    self._X = X_original.copy()
+                    del X_original
+                    self.stage_timer.record("merge", merge_start, items=np.prod(original_data_shape[:-1]))
 
                 if self.cfg.DATA.REFLECT_TO_COMPLETE_SHAPE:
                     if self.cfg.PROBLEM.NDIM == "2D":
@@ -2111,13 +2319,15 @@ class Base_Workflow(metaclass=ABCMeta):
                     pred = np.expand_dims(apply_binary_mask(pred[0], self.cfg.DATA.TEST.BINARY_MASKS), 0)
 
                 # Save image
+                voxels = np.prod(pred.shape[:-1])
                 if self.cfg.PATHS.RESULT_DIR.PER_IMAGE != "":
-                    save_tif(
-                        pred,
-                        self.cfg.PATHS.RESULT_DIR.PER_IMAGE,
-                        self.processing_filenames,
-                        verbose=self.cfg.TEST.VERBOSE,
-                    )
+                    with self.stage_timer.stage("write", items=voxels):
+                        save_tif(
+                            pred,
+                            self.cfg.PATHS.RESULT_DIR.PER_IMAGE,
+                            self.processing_filenames,
+                            verbose=self.cfg.TEST.VERBOSE,
+                        )
 
                 # Argmax if needed
                 if self.cfg.MODEL.N_CLASSES > 2 and self.cfg.DATA.TEST.ARGMAX_TO_OUTPUT:
@@ -2128,6 +2338,7 @@ class Base_Workflow(metaclass=ABCMeta):
 
                 # Calculate the metrics
                 if self._Y is not None:
+                    metrics_start = time.perf_counter()
                     metric_values = self.metric_calculation(
                         to_pytorch_format(pred, self.axis_order, self.device),
                         to_pytorch_format(
@@ -2142,14 +2353,17 @@ class Base_Workflow(metaclass=ABCMeta):
                         if str(metric).lower() not in self.stats["merge_patches"]:
                             self.stats["merge_patches"][str(metric).lower()] = 0
                         self.stats["merge_patches"][str(metric).lower()] += metric_values[metric]
+                    self.stage_timer.record("metrics", metrics_start, items=voxels)
 
                 ############################
                 ### POST-PROCESSING (3D) ###
                 ############################
                 if self.post_processing["per_image"]:
-                    pred = apply_post_processing(self.cfg, pred)
+                    with self.stage_timer.stage("post_processing", items=voxels):
+                        pred = apply_post_processing(self.cfg, pred)
 
                     # Calculate the metrics
+                    metrics_start = time.perf_counter()
                     if self._Y is not None:
                         metric_values = self.metric_calculation(
                             to_pytorch_format(pred, self.axis_order, self.device),
@@ -2165,13 +2379,15 @@ class Base_Workflow(metaclass=ABCMeta):
                             if str(metric).lower() not in self.stats["merge_patches_post"]:
                                 self.stats["merge_patches_post"][str(metric).lower()] = 0
                             self.stats["merge_patches_post"][str(metric).lower()] += metric_values[metric]
+                        self.stage_timer.record("metrics", metrics_start, items=voxels)
 
-                    save_tif(
-                        pred,
-                        self.cfg.PATHS.RESULT_DIR.PER_IMAGE_POST_PROCESSING,
-                        self.processing_filenames,
-                        verbose=self.cfg.TEST.VERBOSE,
-                    )
+                    with self.stage_timer.stage("write", items=voxels):
+                        save_tif(
+                            pred,
+                            self.cfg.PATHS.RESULT_DIR.PER_IMAGE_POST_PROCESSING,
+                            self.processing_filenames,
+                            verbose=self.cfg.TEST.VERBOSE,
+                        )
             else:
                 # Load prediction from file
                 folder = (
@@ -2183,7 +2399,8 @@ class Base_Workflow(metaclass=ABCMeta):
                 pred = read_img(test_file, is_3d=self.cfg.PROBLEM.NDIM == "3D")
                 pred = np.expand_dims(pred, 0)  # expand dimensions to include "batch"
 
-            self.after_merge_patches(pred)
+            with self.stage_timer.stage("post_processing", items=np.prod(pred.shape[:-1])):
+                self.after_merge_patches(pred)
 
             if self.cfg.TEST.ANALIZE_2D_IMGS_AS_3D_STACK:
                 self.all_pred.append(pred)
@@ -2200,6 +2417,8 @@ class Base_Workflow(metaclass=ABCMeta):
                     self._Y, _ = check_downsample_division(self._Y, len(self.cfg.MODEL.FEATURE_MAPS) - 1)
 
                 # Make the prediction
+                voxels = np.prod(self._X.shape[:-1])
+                forward_start = time.perf_counter()
                 if self.cfg.TEST.AUGMENTATION:
                     pred = ensemble8_2d_predictions(
                         self._X[0],
@@ -2217,6 +2436,7 @@ class Base_Workflow(metaclass=ABCMeta):
                 if isinstance(pred, list):
                     pred = torch.cat((pred[0], torch.argmax(pred[1], axis=1).unsqueeze(1)), dim=1)
                 pred = to_numpy_format(pred, self.axis_order_back)
+                self.stage_timer.record("tta" if self.cfg.TEST.AUGMENTATION else "forward", forward_start, items=voxels)
                 del self._X
 
                 # Recover original shape if padded with check_downsample_division
@@ -2225,12 +2445,13 @@ class Base_Workflow(metaclass=ABCMeta):
                     self._Y = self._Y[:, : o_test_shape[1], : o_test_shape[2]]
 
                 # Save image
-                save_tif(
-                    pred,
-                    self.cfg.PATHS.RESULT_DIR.FULL_IMAGE,
-                    self.processing_filenames,
-                    verbose=self.cfg.TEST.VERBOSE,
-                )
+                with self.stage_timer.stage("write", items=voxels):
+                    save_tif(
+                        pred,
+                        self.cfg.PATHS.RESULT_DIR.FULL_IMAGE,
+                        self.processing_filenames,
+                        verbose=self.cfg.TEST.VERBOSE,
+                    )
 
                 # Argmax if needed
                 if self.cfg.MODEL.N_CLASSES > 2 and self.cfg.DATA.TEST.ARGMAX_TO_OUTPUT:
@@ -2244,6 +2465,7 @@ class Base_Workflow(metaclass=ABCMeta):
 
                 # Calculate the metrics
                 if self._Y is not None:
+                    metrics_start = time.perf_counter()
                     metric_values = self.metric_calculation(
                         to_pytorch_format(pred, self.axis_order, self.device),
                         to_pytorch_format(
@@ -2258,6 +2480,7 @@ class Base_Workflow(metaclass=ABCMeta):
                         if str(metric).lower() not in self.stats["full_image"]:
                             self.stats["full_image"][str(metric).lower()] = 0
                         self.stats["full_image"][str(metric).lower()] += metric_values[metric]
+                    self.stage_timer.record("metrics", metrics_start, items=voxels)
             else:
                 # load prediction from file
                 test_file = os.path.join(
@@ -2272,7 +2495,8 @@ class Base_Workflow(metaclass=ABCMeta):
                 if self._Y is not None:
                     self.all_gt.append(self._Y)
 
-            self.after_full_image(pred)
+            with self.stage_timer.stage("post_processing", items=np.prod(pred.shape[:-1])):
+                self.after_full_image(pred)
 
         # Save test_output if the user wants to export the model to BMZ later
         if "test_output" not in self.bmz_config:
@@ -2285,6 +2509,148 @@ class Base_Workflow(metaclass=ABCMeta):
                     : self.cfg.DATA.PATCH_SIZE[0], : self.cfg.DATA.PATCH_SIZE[1], : self.cfg.DATA.PATCH_SIZE[2]
                 ].copy()
 
+    def predict_3D_volume_by_patches(self):
+        """
+        Predict the 3D volume in ``self._X`` patch by patch, adding each prediction directly into the output volume,
+        so neither the stack of patches nor the stack of their predictions are created. The overlapping regions are
+        merged as set in ``DATA.TEST.BLENDING`` and normalized in closed form from the tiling geometry. The per crop
+        metrics are calculated with the corresponding patches of ``self._Y``, if provided.
+
+        Returns
+        -------
+        pred : 5D Numpy array
+            Predicted volume. E.g. ``(1, z, y, x, channels)``.
+        """
+        vol_shape = self.cfg.DATA.PATCH_SIZE[:-1]
+        padding = self.cfg.DATA.TEST.PADDING
+        orig_vol_shape = self._X.shape[1:-1]
+        for i in range(3):
+            if vol_shape[i] > orig_vol_shape[i]:
+                raise ValueError(
+                    "'DATA.PATCH_SIZE[{}]' {} greater than {} (you can reduce 'DATA.PATCH_SIZE' or use "
+                    "'DATA.REFLECT_TO_COMPLETE_SHAPE')".format(i, vol_shape[i], orig_vol_shape[i])
+                )
+            if padding[i] >= vol_shape[i] // 2:
+                raise ValueError(
+                    "'DATA.TEST.PADDING' can not be greater than the half of 'DATA.PATCH_SIZE'. Max value for this {} "
+                    "input shape is {}".format(vol_shape, [(x // 2) - 1 for x in vol_shape])
+                )
+
+        starts = get_3D_overlap_tiling(
+            orig_vol_shape,
+            vol_shape,
+            overlap=self.cfg.DATA.TEST.OVERLAP,
+            padding=padding,
+        )
+        patch_coords = list(itertools.product(*starts))
+        core_shape = tuple(v - 2 * p for v, p in zip(vol_shape, padding))
+        windows, norms = get_3D_merge_normalization(
+            starts,
+            core_shape,
+            orig_vol_shape,
+            blending=self.cfg.DATA.TEST.BLENDING,
+        )
+        window = None
+        if self.cfg.DATA.TEST.BLENDING != "average":
+            window = np.multiply.outer(np.multiply.outer(windows[0], windows[1]), windows[2])[..., None]
+        if self.cfg.TEST.VERBOSE:
+            print("{} patches per (z,y,x) axis".format(tuple(len(x) for x in starts)))
+
+        padded_X = pad_3D_data_for_crop(self._X[0], padding, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+        padded_Y = pad_3D_data_for_crop(self._Y[0], padding) if self._Y is not None else None
+
+        def get_patches(data, coords):
+            return np.stack(
+                [
+                    data[
+                        c[0] : c[0] + vol_shape[0],
+                        c[1] : c[1] + vol_shape[1],
+                        c[2] : c[2] + vol_shape[2],
+                    ]
+                    for c in coords
+                ]
+            )
+
+        merged = None
+        batch_size = 1 if self.cfg.TEST.AUGMENTATION else self.cfg.TRAIN.BATCH_SIZE
+        for k in tqdm(range(math.ceil(len(patch_coords) / batch_size)), leave=False):
+            coords = patch_coords[k * batch_size : (k + 1) * batch_size]
+            patches = get_patches(padded_X, coords)
+            voxels = np.prod(patches.shape[:-1])
+            forward_start = time.perf_counter()
+            if self.cfg.TEST.AUGMENTATION:
+                p = ensemble16_3d_predictions(
+                    patches[0],
+                    batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
+                    axis_order_back=self.axis_order_back,
+                    pred_func=self.model_call_func,
+                    axis_order=self.axis_order,
+                    device=self.device,
+                    mode=self.cfg.TEST.AUGMENTATION_MODE,
+                )
+                p = self.apply_model_activations(p)
+                # Multi-head concatenation
+                if isinstance(p, list):
+                    p = torch.cat((p[0], torch.argmax(p[1], axis=1).unsqueeze(1)), dim=1)
+            else:
+                with torch.cuda.amp.autocast():
+                    p = self.apply_model_activations(self.model_call_func(patches))
+                    # Multi-head concatenation
+                    if isinstance(p, list):
+                        p = torch.cat((p[0], torch.argmax(p[1], axis=1).unsqueeze(1)), dim=1)
+            self.stage_timer.record(
+                "tta" if self.cfg.TEST.AUGMENTATION else "forward", forward_start, items=voxels, sync=True
+            )
+
+            # Calculate the metrics
+            metrics_start = time.perf_counter()
+            if padded_Y is not None:
+                metric_values = self.metric_calculation(
+                    p,
+                    to_pytorch_format(
+                        get_patches(padded_Y, coords),
+                        self.axis_order,
+                        self.device,
+                        dtype=self.loss_dtype,
+                    ),
+                    train=False,
+                )
+                for metric in metric_values:
+                    if str(metric).lower() not in self.stats["per_crop"]:
+                        self.stats["per_crop"][str(metric).lower()] = 0
+                    self.stats["per_crop"][str(metric).lower()] += metric_values[metric]
+                self.stage_timer.record("metrics", metrics_start, items=voxels)
+            self.stats["patch_by_batch_counter"] += 1
+
+            # Remove the padding and add the predictions into the volume
+            merge_start = time.perf_counter()
+            p = to_numpy_format(p, self.axis_order_back)
+            p = p[
+                :,
+                padding[0] : p.shape[1] - padding[0],
+                padding[1] : p.shape[2] - padding[1],
+                padding[2] : p.shape[3] - padding[2],
+            ]
+            if merged is None:
+                merged = np.zeros(tuple(orig_vol_shape) + (p.shape[-1],), dtype=np.float32)
+            for j, c in enumerate(coords):
+                slices = (
+                    slice(c[0], c[0] + core_shape[0]),
+                    slice(c[1], c[1] + core_shape[1]),
+                    slice(c[2], c[2] + core_shape[2]),
+                )
+                merged[slices] += p[j] * window if window is not None else p[j]
+            self.stage_timer.record("merge", merge_start, items=voxels)
+        del padded_X, padded_Y
+
+        # The weight map is separable so the volume can be normalized axis by axis without creating it
+        merge_start = time.perf_counter()
+        merged /= norms[0][:, None, None, None]
+        merged /= norms[1][None, :, None, None]
+        merged /= norms[2][None, None, :, None]
+        self.stage_timer.record("merge", merge_start, items=np.prod(merged.shape[:-1]))
+        return np.expand_dims(merged.astype(self.dtype, copy=False), 0)
+
     def normalize_stats(self, image_counter):
         """
         Normalize statistics.
@@ -2696,12 +3062,15 @@ def insert_patch_into_dataset(
                 out_data_shape = tuple(out_data_shape)
                 out_data_order = cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
 
+            storage_kwargs = chunked_dataset_kwargs(
+                file_type, out_data_shape, out_data_order, **get_chunked_data_options(cfg)
+            )
             if file_type == "h5":
-                data = fid.create_dataset("data", out_data_shape, dtype=dtype_str, compression="gzip")
-                mask = fid_mask.create_dataset("data", out_data_shape, dtype=dtype_str, compression="gzip")
+                data = fid.create_dataset("data", out_data_shape, dtype=dtype_str, **storage_kwargs)
+                mask = fid_mask.create_dataset("data", out_data_shape, dtype=dtype_str, **storage_kwargs)
             else:
-                data = fid.create_dataset("data", shape=out_data_shape, dtype=dtype_str)
-                mask = fid_mask.create_dataset("data", shape=out_data_shape, dtype=dtype_str)
+                data = fid.create_dataset("data", shape=out_data_shape, dtype=dtype_str, **storage_kwargs)
+                mask = fid_mask.create_dataset("data", shape=out_data_shape, dtype=dtype_str, **storage_kwargs)
 
         # Adjust slices to calculate where to insert the predicted patch. This slice does not have into account the
         # channel so any of them can be inserted
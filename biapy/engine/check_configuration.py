@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import collections
+import importlib.util
 from biapy.utils.misc import get_checkpoint_path
 from biapy.utils.util import check_value
 
@@ -12,6 +13,8 @@ def check_configuration(cfg, jobname, check_data_paths=True):
 
     if cfg.SYSTEM.NUM_WORKERS < 0:
         raise ValueError("'SYSTEM.NUM_WORKERS' can not be less than 0")
+    if cfg.SYSTEM.PREFETCH_FACTOR < 1:
+        raise ValueError("'SYSTEM.PREFETCH_FACTOR' needs to be 1 or greater")
 
     dim_count = 2 if cfg.PROBLEM.NDIM == "2D" else 3
 
@@ -113,6 +116,8 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                         dim_count, cfg.PROBLEM.NDIM
                     )
                 )
+        if cfg.TEST.POST_PROCESSING.DET_WATERSHED_NUM_WORKERS < 0:
+            raise ValueError("'TEST.POST_PROCESSING.DET_WATERSHED_NUM_WORKERS' can not be less than 0")
 
     if not (
         len(cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.PROPS)
@@ -124,6 +129,9 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             "'TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.SIGN' need to have same length"
         )
 
+    if cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.NUM_WORKERS < 0:
+        raise ValueError("'TEST.POST_PROCESSING.MEASURE_PROPERTIES.NUM_WORKERS' can not be less than 0")
+
     if (
         cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.ENABLE
         and cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.ENABLE
@@ -440,6 +448,37 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             "does not support float16 data type."
         )
 
+    if cfg.TEST.BACKEND.TYPE not in ["eager", "compile", "torchscript", "onnx"]:
+        raise ValueError("'TEST.BACKEND.TYPE' must be one between ['eager', 'compile', 'torchscript', 'onnx']")
+    if cfg.TEST.BACKEND.TYPE != "eager":
+        if cfg.MODEL.SOURCE != "biapy":
+            raise ValueError("'TEST.BACKEND.TYPE' different from 'eager' is only available when 'MODEL.SOURCE' is 'biapy'")
+        if cfg.MODEL.ARCHITECTURE.lower() == "mae":
+            raise ValueError(
+                "'TEST.BACKEND.TYPE' different from 'eager' is not available for 'mae' as its random masking can not "
+                "be exported"
+            )
+        if cfg.TEST.BACKEND.TYPE == "onnx" and importlib.util.find_spec("onnxruntime") is None:
+            raise ValueError("'onnxruntime' package is needed to use 'TEST.BACKEND.TYPE' = 'onnx'")
+
+    if cfg.TEST.QUANTIZATION.ENABLE:
+        from biapy.engine.quantization import STATIC_QUANTIZATION_ARCHS, DYNAMIC_QUANTIZATION_ARCHS
+
+        if cfg.MODEL.SOURCE != "biapy":
+            raise ValueError("'TEST.QUANTIZATION.ENABLE' is only available when 'MODEL.SOURCE' is 'biapy'")
+        if cfg.MODEL.ARCHITECTURE.lower() not in STATIC_QUANTIZATION_ARCHS + DYNAMIC_QUANTIZATION_ARCHS:
+            raise ValueError(
+                "'TEST.QUANTIZATION.ENABLE' is only available for the following architectures: {}".format(
+                    STATIC_QUANTIZATION_ARCHS + DYNAMIC_QUANTIZATION_ARCHS
+                )
+            )
+        if cfg.TEST.BACKEND.TYPE != "eager":
+            raise ValueError("'TEST.QUANTIZATION.ENABLE' can only be used with 'TEST.BACKEND.TYPE' = 'eager'")
+        if cfg.TEST.QUANTIZATION.CALIBRATION_SAMPLES <= 0:
+            raise ValueError("'TEST.QUANTIZATION.CALIBRATION_SAMPLES' must be greater than 0")
+        if cfg.SYSTEM.NUM_GPUS > 0:
+            print("WARNING: quantized models run only in CPU, so GPUs will not be used during inference")
+
     if cfg.MODEL.N_CLASSES > 2 and cfg.PROBLEM.TYPE not in [
         "SEMANTIC_SEG",
         "INSTANCE_SEG",
@@ -519,6 +558,15 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                 )
             if not check_value(cfg.TEST.POST_PROCESSING.VORONOI_TH):
                 raise ValueError("'TEST.POST_PROCESSING.VORONOI_TH' not in [0, 1] range")
+            if len(cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_SIZE) > 0 and (
+                len(cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_SIZE) != 3
+                or any(x <= 0 for x in cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_SIZE)
+            ):
+                raise ValueError("'TEST.POST_PROCESSING.VORONOI_BLOCK_SIZE' must be a list of 3 positive integers (z,y,x)")
+            if len(cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_HALO) != 3 or any(
+                x < 0 for x in cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_HALO
+            ):
+                raise ValueError("'TEST.POST_PROCESSING.VORONOI_BLOCK_HALO' must be a list of 3 non-negative integers (z,y,x)")
         if (
             cfg.PROBLEM.INSTANCE_SEG.DATA_CHANNELS not in ["C", "BC", "BCM", "BCD", "BP"]
             and cfg.PROBLEM.INSTANCE_SEG.ERODE_AND_DILATE_FOREGROUND
@@ -557,6 +605,24 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                     "'PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICE' can only be activated when 'PROBLEM.NDIM' == 3D or "
                     "in 2D when 'TEST.ANALIZE_2D_IMGS_AS_3D_STACK' is enabled"
                 )
+        if cfg.PROBLEM.INSTANCE_SEG.WATERSHED_NUM_WORKERS < 0:
+            raise ValueError("'PROBLEM.INSTANCE_SEG.WATERSHED_NUM_WORKERS' can not be less than 0")
+        if len(cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE) > 0:
+            if cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICES:
+                raise ValueError(
+                    "'PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE' can not be set when 'PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICES' "
+                    "is enabled"
+                )
+            if len(cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE) != 3 or any(
+                x <= 0 for x in cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE
+            ):
+                raise ValueError("'PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE' must be a list of 3 positive integers (z,y,x)")
+        if len(cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_HALO) != 3 or any(
+            x < 0 for x in cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_HALO
+        ):
+            raise ValueError("'PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_HALO' must be a list of 3 non-negative integers (z,y,x)")
+        if cfg.PROBLEM.INSTANCE_SEG.DATA_MW_TH_OTSU_MAX_SAMPLES <= 0:
+            raise ValueError("'PROBLEM.INSTANCE_SEG.DATA_MW_TH_OTSU_MAX_SAMPLES' must be greater than 0")
         if cfg.MODEL.SOURCE == "torchvision":
             if cfg.MODEL.TORCHVISION_MODEL_NAME not in [
                 "maskrcnn_resnet50_fpn",
@@ -623,6 +689,14 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                     )
         if cfg.TEST.DET_POINT_CREATION_FUNCTION not in ["peak_local_max", "blob_log"]:
             raise ValueError("'TEST.DET_POINT_CREATION_FUNCTION' must be one between: ['peak_local_max', 'blob_log']")
+        if cfg.TEST.DET_PRED_IDS_FORMAT not in ["none", "csv", "parquet"]:
+            raise ValueError("'TEST.DET_PRED_IDS_FORMAT' must be one between: ['none', 'csv', 'parquet']")
+        if (
+            cfg.TEST.DET_PRED_IDS_FORMAT == "parquet"
+            and importlib.util.find_spec("pyarrow") is None
+            and importlib.util.find_spec("fastparquet") is None
+        ):
+            raise ValueError("'pyarrow' or 'fastparquet' package is needed to use 'TEST.DET_PRED_IDS_FORMAT' = 'parquet'")
         if cfg.MODEL.SOURCE == "torchvision":
             if cfg.MODEL.TORCHVISION_MODEL_NAME not in [
                 "fasterrcnn_mobilenet_v3_large_320_fpn",
@@ -682,6 +756,21 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                 raise ValueError(
                     "'MODEL.ARCHITECTURE' can not be 'mae' when 'PROBLEM.SELF_SUPERVISED.PRETEXT_TASK' is 'crappify'"
                 )
+            if cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY:
+                if cfg.DATA.TEST.USE_VAL_AS_TEST:
+                    raise ValueError(
+                        "'DATA.TEST.USE_VAL_AS_TEST' can not be used with 'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY' "
+                        "as no crappified validation data is created"
+                    )
+            else:
+                if cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE:
+                    raise ValueError(
+                        "'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE' requires 'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY'"
+                    )
+                if cfg.PROBLEM.SELF_SUPERVISED.RANDOM_DEGRADATION:
+                    raise ValueError(
+                        "'PROBLEM.SELF_SUPERVISED.RANDOM_DEGRADATION' requires 'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY'"
+                    )
         elif cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking":
             if model_arch != "mae":
                 raise ValueError(
@@ -708,6 +797,15 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             )
         if not check_value(cfg.PROBLEM.DENOISING.N2V_PERC_PIX):
             raise ValueError("PROBLEM.DENOISING.N2V_PERC_PIX not in [0, 1] range")
+        if cfg.PROBLEM.DENOISING.N2V_ON_DEVICE and cfg.PROBLEM.DENOISING.N2V_MANIPULATOR not in [
+            "uniform_withCP",
+            "normal_additive",
+            "identity",
+        ]:
+            raise ValueError(
+                "'PROBLEM.DENOISING.N2V_MANIPULATOR' needs to be one between ['uniform_withCP', 'normal_additive', 'identity'] "
+                "when 'PROBLEM.DENOISING.N2V_ON_DEVICE' is enabled"
+            )
         if cfg.MODEL.SOURCE == "torchvision":
             raise ValueError("'MODEL.SOURCE' as 'torchvision' is not available in denoising workflow")
 
@@ -870,6 +968,10 @@ def check_configuration(cfg, jobname, check_data_paths=True):
 
     ### Pre-processing ###
     if cfg.DATA.PREPROCESS.TRAIN or cfg.DATA.PREPROCESS.TEST or cfg.DATA.PREPROCESS.VAL:
+        if cfg.DATA.PREPROCESS.NUM_WORKERS < 0:
+            raise ValueError("'DATA.PREPROCESS.NUM_WORKERS' can not be less than 0")
+        if cfg.DATA.PREPROCESS.CACHE and cfg.DATA.PREPROCESS.CACHE_DIR == "":
+            raise ValueError("'DATA.PREPROCESS.CACHE_DIR' can not be empty when 'DATA.PREPROCESS.CACHE' is enabled")
         if cfg.DATA.PREPROCESS.RESIZE.ENABLE:
             if cfg.PROBLEM.TYPE == "DETECTION":
                 raise ValueError("Resizing preprocessing is not available for the DETECTION workflow.")
@@ -972,6 +1074,41 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             "zarr",
         ], "'TEST.BY_CHUNKS.FORMAT' needs to be one between ['H5', 'Zarr']"
         opts.extend(["TEST.BY_CHUNKS.FORMAT", cfg.TEST.BY_CHUNKS.FORMAT.lower()])
+        if cfg.TEST.BY_CHUNKS.COMPRESSION not in ["default", "blosc-lz4", "blosc-zstd", "gzip", "none"]:
+            raise ValueError(
+                "'TEST.BY_CHUNKS.COMPRESSION' needs to be one between ['default', 'blosc-lz4', 'blosc-zstd', 'gzip', "
+                "'none']"
+            )
+        if (
+            cfg.TEST.BY_CHUNKS.FORMAT.lower() == "h5"
+            and cfg.TEST.BY_CHUNKS.COMPRESSION.startswith("blosc")
+            and importlib.util.find_spec("hdf5plugin") is None
+        ):
+            raise ValueError(
+                "'hdf5plugin' package is needed to use Blosc compression ('TEST.BY_CHUNKS.COMPRESSION') with H5 files"
+            )
+        if not (0 <= cfg.TEST.BY_CHUNKS.COMPRESSION_LEVEL <= 9):
+            raise ValueError("'TEST.BY_CHUNKS.COMPRESSION_LEVEL' needs to be in [0, 9] range")
+        if cfg.TEST.BY_CHUNKS.COMPRESSION_THREADS < 0:
+            raise ValueError("'TEST.BY_CHUNKS.COMPRESSION_THREADS' can not be less than 0")
+        if cfg.TEST.BY_CHUNKS.PYRAMID.ENABLE:
+            if cfg.TEST.BY_CHUNKS.FORMAT.lower() != "zarr":
+                raise ValueError("'TEST.BY_CHUNKS.PYRAMID.ENABLE' can only be used when 'TEST.BY_CHUNKS.FORMAT' is 'Zarr'")
+            if cfg.TEST.BY_CHUNKS.PYRAMID.LEVELS < 1:
+                raise ValueError("'TEST.BY_CHUNKS.PYRAMID.LEVELS' needs to be 1 or greater")
+            if len(cfg.TEST.BY_CHUNKS.PYRAMID.DOWNSCALE) != 3 or any(
+                not isinstance(x, int) or x < 1 for x in cfg.TEST.BY_CHUNKS.PYRAMID.DOWNSCALE
+            ):
+                raise ValueError(
+                    "'TEST.BY_CHUNKS.PYRAMID.DOWNSCALE' needs to be a list of 3 integers greater than 0, in (z, y, x) order"
+                )
+            axes = cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
+            axes = axes if "C" in axes else axes + "C"
+            if [a for a in "TCZYX" if a in axes] != list(axes):
+                print(
+                    "WARNING: the multiscale image will be written in '{}' axes order, which does not follow OME-Zarr "
+                    "'TCZYX' order, so some viewers may not open it".format(axes)
+                )
         if cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.ENABLE:
             assert cfg.TEST.BY_CHUNKS.WORKFLOW_PROCESS.TYPE in [
                 "chunk_by_chunk",
@@ -1106,6 +1243,8 @@ def check_configuration(cfg, jobname, check_data_paths=True):
                 cfg.PROBLEM.NDIM, dim_count, cfg.DATA.TEST.PADDING
             )
         )
+    if cfg.DATA.TEST.BLENDING not in ["average", "spline", "gaussian"]:
+        raise ValueError("'DATA.TEST.BLENDING' needs to be one between ['average', 'spline', 'gaussian']")
     if len(cfg.DATA.PATCH_SIZE) != dim_count + 1:
         if cfg.MODEL.SOURCE != "bmz":
             raise ValueError(
@@ -1128,9 +1267,17 @@ def check_configuration(cfg, jobname, check_data_paths=True):
         "image",
         "dataset",
     ], "'DATA.NORMALIZATION.APPLICATION_MODE' needs to be one between ['image', 'dataset']"
-    if cfg.TRAIN.ENABLE and not cfg.DATA.TRAIN.IN_MEMORY and cfg.DATA.NORMALIZATION.APPLICATION_MODE == "dataset":
+    if (
+        cfg.TRAIN.ENABLE
+        and cfg.DATA.NORMALIZATION.ON_DEVICE
+        and cfg.DATA.NORMALIZATION.PERC_CLIP
+        and cfg.DATA.NORMALIZATION.APPLICATION_MODE == "dataset"
+        and (not cfg.DATA.TRAIN.IN_MEMORY or (not cfg.DATA.VAL.FROM_TRAIN and not cfg.DATA.VAL.IN_MEMORY))
+    ):
         raise ValueError(
-            "'DATA.NORMALIZATION.APPLICATION_MODE' == 'dataset' can only be applied if 'DATA.TRAIN.IN_MEMORY' == True"
+            "'DATA.NORMALIZATION.ON_DEVICE' can not be combined with dataset percentile clipping "
+            "('DATA.NORMALIZATION.PERC_CLIP' and 'DATA.NORMALIZATION.APPLICATION_MODE' == 'dataset') unless "
+            "'DATA.TRAIN.IN_MEMORY' and 'DATA.VAL.IN_MEMORY' are enabled"
         )
     if cfg.DATA.NORMALIZATION.PERC_CLIP:
         if cfg.DATA.NORMALIZATION.PERC_LOWER == -1:
@@ -1145,6 +1292,38 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             raise ValueError("'DATA.NORMALIZATION.PERC_LOWER' not in [0, 100] range")
         if not check_value(cfg.DATA.NORMALIZATION.PERC_UPPER, value_range=(0, 100)):
             raise ValueError("'DATA.NORMALIZATION.PERC_UPPER' not in [0, 100] range")
+    if cfg.DATA.NORMALIZATION.ON_DEVICE:
+        if cfg.MODEL.SOURCE != "biapy":
+            raise ValueError("'DATA.NORMALIZATION.ON_DEVICE' can only be used when 'MODEL.SOURCE' is 'biapy'")
+        intensity_da = [
+            "GAMMA_CONTRAST",
+            "BRIGHTNESS",
+            "CONTRAST",
+            "CUTNOISE",
+            "GRID_INVERT",
+            "GAUSSIAN_NOISE",
+            "POISSON_NOISE",
+            "SALT",
+            "PEPPER",
+            "SALT_AND_PEPPER",
+        ]
+        if cfg.AUGMENTOR.ENABLE and any(cfg.AUGMENTOR[x] for x in intensity_da):
+            raise ValueError(
+                "'DATA.NORMALIZATION.ON_DEVICE' can not be used with intensity transformations, as they expect normalized "
+                "data: {}".format(["AUGMENTOR." + x for x in intensity_da])
+            )
+        if cfg.PROBLEM.TYPE == "DENOISING" and not cfg.PROBLEM.DENOISING.N2V_ON_DEVICE:
+            raise ValueError("'DATA.NORMALIZATION.ON_DEVICE' requires 'PROBLEM.DENOISING.N2V_ON_DEVICE' in denoising")
+        if (
+            cfg.PROBLEM.TYPE == "SELF_SUPERVISED"
+            and cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY
+            and not cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE
+        ):
+            raise ValueError(
+                "'DATA.NORMALIZATION.ON_DEVICE' requires 'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE' when "
+                "'PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY' is enabled"
+            )
+
     if cfg.DATA.TRAIN.REPLICATE:
         if cfg.PROBLEM.TYPE == "CLASSIFICATION" or (
             cfg.PROBLEM.TYPE == "SELF_SUPERVISED" and cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking"
@@ -1179,6 +1358,39 @@ def check_configuration(cfg, jobname, check_data_paths=True):
             "mae",
             "unext_v1",
         ], "MODEL.ARCHITECTURE not in ['unet', 'resunet', 'resunet++', 'attention_unet', 'multiresunet', 'seunet', 'simple_cnn', 'efficientnet_b[0-7]', 'unetr', 'edsr', 'rcan', 'dfcan', 'wdsr', 'vit', 'mae', 'unext_v1']"
+        if cfg.MODEL.ACTIVATION_CHECKPOINTING and model_arch not in [
+            "unet",
+            "resunet",
+            "attention_unet",
+            "seunet",
+            "multiresunet",
+            "unetr",
+            "mae",
+            "vit",
+        ]:
+            raise ValueError(
+                "'MODEL.ACTIVATION_CHECKPOINTING' is only available for the following architectures: 'unet', 'resunet', "
+                "'attention_unet', 'seunet', 'multiresunet', 'unetr', 'mae' and 'vit'"
+            )
+        if cfg.TRAIN.ENABLE and cfg.TRAIN.AUTO_PATCH_BATCH.ENABLE:
+            if cfg.SYSTEM.NUM_GPUS < 1:
+                raise ValueError("'TRAIN.AUTO_PATCH_BATCH.ENABLE' requires a GPU as memory is measured on CUDA devices")
+            if cfg.TRAIN.AUTO_PATCH_BATCH.MEMORY_BUDGET <= 0:
+                raise ValueError("'TRAIN.AUTO_PATCH_BATCH.MEMORY_BUDGET' needs to be greater than 0")
+            if len(cfg.TRAIN.AUTO_PATCH_BATCH.PATCH_SIZES) == 0 or len(cfg.TRAIN.AUTO_PATCH_BATCH.BATCH_SIZES) == 0:
+                raise ValueError(
+                    "'TRAIN.AUTO_PATCH_BATCH.PATCH_SIZES' and 'TRAIN.AUTO_PATCH_BATCH.BATCH_SIZES' can not be empty"
+                )
+            for patch_size in cfg.TRAIN.AUTO_PATCH_BATCH.PATCH_SIZES:
+                if len(patch_size) != len(cfg.DATA.PATCH_SIZE) or patch_size[-1] != cfg.DATA.PATCH_SIZE[-1]:
+                    raise ValueError(
+                        "Each patch size in 'TRAIN.AUTO_PATCH_BATCH.PATCH_SIZES' needs to have the same number of "
+                        "dimensions and channels as 'DATA.PATCH_SIZE'. Provided: {}".format(patch_size)
+                    )
+            if any(b < 1 for b in cfg.TRAIN.AUTO_PATCH_BATCH.BATCH_SIZES):
+                raise ValueError("'TRAIN.AUTO_PATCH_BATCH.BATCH_SIZES' values need to be 1 or greater")
+            if cfg.TRAIN.AUTO_PATCH_BATCH.STEPS < 1:
+                raise ValueError("'TRAIN.AUTO_PATCH_BATCH.STEPS' needs to be 1 or greater")
         if (
             model_arch
             not in [
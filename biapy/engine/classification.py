@@ -12,7 +12,7 @@ from biapy.engine.base_workflow import Base_Workflow
 from biapy.data.pre_processing import norm_range01
 from biapy.data.data_2D_manipulation import load_data_classification
 from biapy.data.data_3D_manipulation import load_3d_data_classification
-from biapy.utils.misc import is_main_process
+from biapy.utils.misc import is_main_process, nan_to_zero
 from biapy.data.pre_processing import preprocess_data
 
 
@@ -142,7 +142,7 @@ class Classification_Workflow(Base_Workflow):
             for i, metric in enumerate(list_to_use):
                 val = metric(output, targets)
                 if torch.is_tensor(val):
-                    val = val.item() if not torch.isnan(val) else 0
+                    val = nan_to_zero(val, to_host=metric_logger is None)
                 out_metrics[list_names_to_use[i]] = val
 
                 if metric_logger is not None:
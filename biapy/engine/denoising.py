@@ -19,7 +19,7 @@ from biapy.data.post_processing.post_processing import (
 )
 from biapy.engine.base_workflow import Base_Workflow
 from biapy.utils.util import save_tif, pad_and_reflect
-from biapy.utils.misc import to_pytorch_format, to_numpy_format, is_main_process
+from biapy.utils.misc import to_pytorch_format, to_numpy_format, is_main_process, nan_to_zero
 from biapy.data.pre_processing import denormalize, undo_norm_range01
 from biapy.engine.metrics import n2v_loss_mse
 
@@ -58,6 +58,16 @@ class Denoising_Workflow(Base_Workflow):
         self.mask_path = None
         self.load_Y_val = False
 
+        # Noise2Void batch created in the device. It is stored in prepare_targets() to be used in model_call_func()
+        self.n2v_batch = None
+        # Random generator of the validation masks. Created, with a fixed seed, at the start of each evaluation
+        self.val_generator_rng = None
+        if self.cfg.PROBLEM.DENOISING.N2V_ON_DEVICE:
+            self.n2v_box_size = int(np.round(np.sqrt(100 / self.cfg.PROBLEM.DENOISING.N2V_PERC_PIX)))
+            self.n2v_structMask = (
+                np.array([[0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0]]) if self.cfg.PROBLEM.DENOISING.N2V_STRUCTMASK else None
+            )
+
     def define_metrics(self):
         """
         This function must define the following variables:
@@ -147,13 +157,79 @@ class Denoising_Workflow(Base_Workflow):
         with torch.no_grad():
             for i, metric in enumerate(list_to_use):
                 val = metric(output.squeeze(), targets[:, 0].squeeze())
-                val = val.item() if not torch.isnan(val) else 0
+                val = nan_to_zero(val, to_host=metric_logger is None)
                 out_metrics[list_names_to_use[i]] = val
 
                 if metric_logger is not None:
                     metric_logger.meters[list_names_to_use[i]].update(val)
         return out_metrics
 
+    def prepare_targets(self, targets, batch):
+        """
+        Location to perform any necessary data transformations to ``targets``
+        before calculating the loss. If ``PROBLEM.DENOISING.N2V_ON_DEVICE`` is selected the Noise2Void
+        masks are created here for the whole batch.
+
+        Parameters
+        ----------
+        targets : Torch Tensor
+            Ground truth to compare the prediction with.
+
+        batch : Torch Tensor
+            Input batch of the model.
+
+        Returns
+        -------
+        targets : Torch tensor
+            Resulting targets.
+        """
+        if not self.cfg.PROBLEM.DENOISING.N2V_ON_DEVICE:
+            return super().prepare_targets(targets, batch)
+
+        # Same masks each epoch for validation
+        if self.model.training:
+            self.val_generator_rng = None
+        elif self.val_generator_rng is None:
+            self.val_generator_rng = torch.Generator(device=self.device)
+            self.val_generator_rng.manual_seed(self.cfg.SYSTEM.SEED)
+        generator = None if self.model.training else self.val_generator_rng
+        x, targets = prepare_n2v_batch(
+            self.batch_to_device(batch),
+            self.n2v_box_size,
+            n2v_manipulator=self.cfg.PROBLEM.DENOISING.N2V_MANIPULATOR,
+            n2v_neighborhood_radius=self.cfg.PROBLEM.DENOISING.N2V_NEIGHBORHOOD_RADIUS,
+            n2v_structMask=self.n2v_structMask,
+            generator=generator,
+        )
+        self.n2v_batch = (batch, x)
+        return targets.to(self.loss_dtype)
+
+    def model_call_func(self, in_img, to_pytorch=True, is_train=False):
+        """
+        Call a regular Pytorch model. If ``PROBLEM.DENOISING.N2V_ON_DEVICE`` is selected the batch manipulated
+        in :func:`prepare_targets` is used instead of ``in_img`` during training.
+
+        Parameters
+        ----------
+        in_img : Tensor
+            Input image to pass through the model.
+
+        to_pytorch : bool, optional
+            Whether if the input image needs to be converted into pytorch format or not.
+
+        is_train : bool, optional
+            Whether if the call is during training or inference.
+
+        Returns
+        -------
+        prediction : Tensor
+            Image prediction.
+        """
+        if is_train and self.n2v_batch is not None and in_img is self.n2v_batch[0]:
+            in_img, to_pytorch = self.n2v_batch[1], False
+            self.n2v_batch = None
+        return super().model_call_func(in_img, to_pytorch=to_pytorch, is_train=is_train)
+
     def process_test_sample(self, norm):
         """
         Function to process a sample in the inference phase.
@@ -273,6 +349,7 @@ class Denoising_Workflow(Base_Workflow):
                     padding=self.cfg.DATA.TEST.PADDING,
                     overlap=self.cfg.DATA.TEST.OVERLAP,
                     verbose=self.cfg.TEST.VERBOSE,
+                    blending=self.cfg.DATA.TEST.BLENDING,
                 )
             else:
                 obj = f_name(
@@ -281,6 +358,7 @@ class Denoising_Workflow(Base_Workflow):
                     padding=self.cfg.DATA.TEST.PADDING,
                     overlap=self.cfg.DATA.TEST.OVERLAP,
                     verbose=self.cfg.TEST.VERBOSE,
+                    blending=self.cfg.DATA.TEST.BLENDING,
                 )
                 pred = obj
                 del obj
@@ -435,20 +513,21 @@ def get_subpatch(patch, coord, local_sub_patch_radius, crop_patch=True):
     return patch[tuple(slices)], crop_neg, crop_pos
 
 
-def random_neighbor(shape, coord):
-    rand_coords = sample_coords(shape, coord)
+def random_neighbor(shape, coord, rng=None):
+    rand_coords = sample_coords(shape, coord, rng=rng)
     while np.any(rand_coords == coord):
-        rand_coords = sample_coords(shape, coord)
+        rand_coords = sample_coords(shape, coord, rng=rng)
 
     return rand_coords
 
 
-def sample_coords(shape, coord, sigma=4):
-    return [normal_int(c, sigma, s) for c, s in zip(coord, shape)]
+def sample_coords(shape, coord, sigma=4, rng=None):
+    return [normal_int(c, sigma, s, rng=rng) for c, s in zip(coord, shape)]
 
 
-def normal_int(mean, sigma, w):
-    return int(np.clip(np.round(np.random.normal(mean, sigma)), 0, w - 1))
+def normal_int(mean, sigma, w, rng=None):
+    rng = np.random if rng is None else rng
+    return int(np.clip(np.round(rng.normal(mean, sigma)), 0, w - 1))
 
 
 def mask_center(local_sub_patch_radius, ndims=2):
@@ -464,10 +543,10 @@ def mask_center(local_sub_patch_radius, ndims=2):
 
 
 def pm_normal_withoutCP(local_sub_patch_radius):
-    def normal_withoutCP(patch, coords, dims, structN2Vmask=None):
+    def normal_withoutCP(patch, coords, dims, structN2Vmask=None, rng=None):
         vals = []
         for coord in zip(*coords):
-            rand_coords = random_neighbor(patch.shape, coord)
+            rand_coords = random_neighbor(patch.shape, coord, rng=rng)
             vals.append(patch[tuple(rand_coords)])
         return vals
 
@@ -475,7 +554,7 @@ def pm_normal_withoutCP(local_sub_patch_radius):
 
 
 def pm_mean(local_sub_patch_radius):
-    def patch_mean(patch, coords, dims, structN2Vmask=None):
+    def patch_mean(patch, coords, dims, structN2Vmask=None, rng=None):
         patch_wo_center = mask_center(local_sub_patch_radius, ndims=dims)
         vals = []
         for coord in zip(*coords):
@@ -489,7 +568,7 @@ def pm_mean(local_sub_patch_radius):
 
 
 def pm_median(local_sub_patch_radius):
-    def patch_median(patch, coords, dims, structN2Vmask=None):
+    def patch_median(patch, coords, dims, structN2Vmask=None, rng=None):
         patch_wo_center = mask_center(local_sub_patch_radius, ndims=dims)
         vals = []
         for coord in zip(*coords):
@@ -503,147 +582,154 @@ def pm_median(local_sub_patch_radius):
 
 
 def pm_uniform_withCP(local_sub_patch_radius):
-    def random_neighbor_withCP_uniform(patch, coords, dims, structN2Vmask=None):
-        vals = []
-        for coord in zip(*coords):
-            sub_patch, _, _ = get_subpatch(patch, coord, local_sub_patch_radius)
-            rand_coords = [np.random.randint(0, s) for s in sub_patch.shape[0:dims]]
-            vals.append(sub_patch[tuple(rand_coords)])
-        return vals
+    def random_neighbor_withCP_uniform(patch, coords, dims, structN2Vmask=None, rng=None):
+        rng = np.random if rng is None else rng
+        coords = np.array(coords, dtype=int).reshape(dims, -1)
+        shape = np.array(patch.shape[:dims])[:, None]
+        # Neighborhood of each coordinate cropped to the patch boundaries (as done in get_subpatch)
+        start = np.maximum(coords - local_sub_patch_radius, 0)
+        end = np.minimum(coords + local_sub_patch_radius + 1, shape)
+        rand_coords = start + (rng.random(coords.shape) * (end - start)).astype(int)
+        return patch[tuple(rand_coords)]
 
     return random_neighbor_withCP_uniform
 
 
 def pm_uniform_withoutCP(local_sub_patch_radius):
-    def random_neighbor_withoutCP_uniform(patch, coords, dims, structN2Vmask=None):
+    def random_neighbor_withoutCP_uniform(patch, coords, dims, structN2Vmask=None, rng=None):
+        rng = np.random if rng is None else rng
         patch_wo_center = mask_center(local_sub_patch_radius, ndims=dims)
         vals = []
         for coord in zip(*coords):
             sub_patch, crop_neg, crop_pos = get_subpatch(patch, coord, local_sub_patch_radius)
             slices = [slice(-n, s - p) for n, p, s in zip(crop_neg, crop_pos, patch_wo_center.shape)]
             sub_patch_mask = (structN2Vmask or patch_wo_center)[tuple(slices)]
-            vals.append(np.random.permutation(sub_patch[sub_patch_mask])[0])
+            vals.append(rng.permutation(sub_patch[sub_patch_mask])[0])
         return vals
 
     return random_neighbor_withoutCP_uniform
 
 
 def pm_normal_additive(pixel_gauss_sigma):
-    def pixel_gauss(patch, coords, dims, structN2Vmask=None):
-        vals = []
-        for coord in zip(*coords):
-            vals.append(np.random.normal(patch[tuple(coord)], pixel_gauss_sigma))
-        return vals
+    def pixel_gauss(patch, coords, dims, structN2Vmask=None, rng=None):
+        rng = np.random if rng is None else rng
+        return rng.normal(patch[tuple(coords)], pixel_gauss_sigma)
 
     return pixel_gauss
 
 
 def pm_normal_fitted(local_sub_patch_radius):
-    def local_gaussian(patch, coords, dims, structN2Vmask=None):
+    def local_gaussian(patch, coords, dims, structN2Vmask=None, rng=None):
+        rng = np.random if rng is None else rng
         vals = []
         for coord in zip(*coords):
             sub_patch, _, _ = get_subpatch(patch, coord, local_sub_patch_radius)
             axis = tuple(range(dims))
-            vals.append(np.random.normal(np.mean(sub_patch, axis=axis), np.std(sub_patch, axis=axis)))
+            vals.append(rng.normal(np.mean(sub_patch, axis=axis), np.std(sub_patch, axis=axis)))
         return vals
 
     return local_gaussian
 
 
 def pm_identity(local_sub_patch_radius):
-    def identity(patch, coords, dims, structN2Vmask=None):
-        vals = []
-        for coord in zip(*coords):
-            vals.append(patch[coord])
-        return vals
+    def identity(patch, coords, dims, structN2Vmask=None, rng=None):
+        return patch[tuple(coords)]
 
     return identity
 
 
-def get_stratified_coords2D(box_size, shape):
-    box_count_Y = int(np.ceil(shape[0] / box_size))
-    box_count_X = int(np.ceil(shape[1] / box_size))
-    x_coords = []
-    y_coords = []
-    for i in range(box_count_Y):
-        for j in range(box_count_X):
-            y, x = np.random.rand() * box_size, np.random.rand() * box_size
-            y = int(i * box_size + y)
-            x = int(j * box_size + x)
-            if y < shape[0] and x < shape[1]:
-                y_coords.append(y)
-                x_coords.append(x)
-    return (y_coords, x_coords)
-
-
-def get_stratified_coords3D(box_size, shape):
-    box_count_z = int(np.ceil(shape[0] / box_size))
-    box_count_Y = int(np.ceil(shape[1] / box_size))
-    box_count_X = int(np.ceil(shape[2] / box_size))
-    x_coords = []
-    y_coords = []
-    z_coords = []
-    for i in range(box_count_z):
-        for j in range(box_count_Y):
-            for k in range(box_count_X):
-                z, y, x = (
-                    np.random.rand() * box_size,
-                    np.random.rand() * box_size,
-                    np.random.rand() * box_size,
-                )
-                z = int(i * box_size + z)
-                y = int(j * box_size + y)
-                x = int(k * box_size + x)
-                if z < shape[0] and y < shape[1] and x < shape[2]:
-                    z_coords.append(z)
-                    y_coords.append(y)
-                    x_coords.append(x)
-    return (z_coords, y_coords, x_coords)
+def get_stratified_coords(box_size, shape, rng=None):
+    """
+    Draws a random coordinate inside each box of a grid of ``box_size`` boxes that covers ``shape``.
 
+    Parameters
+    ----------
+    box_size : int
+        Size of the boxes.
+
+    shape : tuple of ints
+        Spatial shape of the patch. E.g. ``(y, x)`` in ``2D`` or ``(z, y, x)`` in ``3D``.
 
-def apply_structN2Vmask(patch, coords, mask):
+    rng : Numpy Generator, optional
+        Random generator to use. If not provided ``np.random`` is used.
+
+    Returns
+    -------
+    coords : tuple of 1D Numpy arrays
+        Coordinates of each dimension.
     """
-    each point in coords corresponds to the center of the mask.
-    then for point in the mask with value=1 we assign a random value
+    rng = np.random if rng is None else rng
+    shape = np.array(shape, dtype=int)
+    box_count = np.ceil(shape / box_size).astype(int)
+    box_starts = np.stack(
+        np.meshgrid(*[np.arange(c) * box_size for c in box_count], indexing="ij"),
+        axis=-1,
+    ).reshape(-1, len(shape))
+    coords = (box_starts + rng.random(box_starts.shape) * box_size).astype(int)
+    coords = coords[np.all(coords < shape, axis=1)]
+    return tuple(coords.T)
+
+
+def get_stratified_coords2D(box_size, shape, rng=None):
+    return get_stratified_coords(box_size, shape[:2], rng=rng)
+
+
+def get_stratified_coords3D(box_size, shape, rng=None):
+    return get_stratified_coords(box_size, shape[:3], rng=rng)
+
+
+def get_structN2Vmask_displacements(mask, ndim):
+    """
+    Displacements, with respect to the center of ``mask``, of the pixels to hide. If ``mask`` has less dimensions
+    than ``ndim``, e.g. a 2D mask used with 3D data, it is applied in the plane of the last dimensions.
+
+    Parameters
+    ----------
+    mask : Numpy array
+        StructN2V mask. Value 1 = 'hidden', Value 0 = 'non hidden'.
+
+    ndim : int
+        Number of spatial dimensions of the data.
+
+    Returns
+    -------
+    dx : 2D Numpy array
+        Displacements. E.g. ``(ndim, num_of_hidden_pixels)``.
     """
-    coords = np.array(coords, dtype=int)
-    ndim = mask.ndim
+    mask = np.array(mask).copy()
     center = np.array(mask.shape) // 2
     ## leave the center value alone
     mask[tuple(center.T)] = 0
     ## displacements from center
     dx = np.indices(mask.shape)[:, mask == 1] - center[:, None]
-    ## combine all coords (ndim, npts,) with all displacements (ncoords,ndim,)
-    mix = dx.T[..., None] + coords[None]
-    mix = mix.transpose([1, 0, 2]).reshape([ndim, -1]).T
+    if dx.shape[0] < ndim:
+        dx = np.concatenate([np.zeros((ndim - dx.shape[0], dx.shape[1]), dtype=dx.dtype), dx])
+    return dx
+
+
+def apply_structN2Vmask(patch, coords, mask, rng=None):
+    """
+    each point in coords corresponds to the center of the mask.
+    then for point in the mask with value=1 we assign a random value
+    """
+    rng = np.random if rng is None else rng
+    coords = np.array(coords, dtype=int).reshape(patch.ndim, -1)
+    dx = get_structN2Vmask_displacements(mask, patch.ndim)
+    ## combine all coords (ndim, npts,) with all displacements (ndim, ndisp,)
+    mix = (coords[:, None, :] + dx[:, :, None]).reshape(patch.ndim, -1)
     ## stay within patch boundary
-    mix = mix.clip(min=np.zeros(ndim), max=np.array(patch.shape) - 1).astype(np.uint)
+    mix = np.clip(mix, 0, np.array(patch.shape)[:, None] - 1)
     ## replace neighbouring pixels with random values from flat dist
-    patch[tuple(mix.T)] = np.random.rand(mix.shape[0]) * 4 - 2
+    patch[tuple(mix)] = rng.random(mix.shape[1]) * 4 - 2
 
 
-def apply_structN2Vmask3D(patch, coords, mask):
+def apply_structN2Vmask3D(patch, coords, mask, rng=None):
     """
     each point in coords corresponds to the center of the mask.
-    then for point in the mask with value=1 we assign a random value
+    then for point in the mask with value=1 we assign a random value. A 2D mask is applied in the
+    z plane of each point
     """
-    z_coords = coords[0]
-    coords = coords[1:]
-    for z in z_coords:
-        coords = np.array(coords, dtype=int)
-        ndim = mask.ndim
-        center = np.array(mask.shape) // 2
-        ## leave the center value alone
-        mask[tuple(center.T)] = 0
-        ## displacements from center
-        dx = np.indices(mask.shape)[:, mask == 1] - center[:, None]
-        ## combine all coords (ndim, npts,) with all displacements (ncoords,ndim,)
-        mix = dx.T[..., None] + coords[None]
-        mix = mix.transpose([1, 0, 2]).reshape([ndim, -1]).T
-        ## stay within patch boundary
-        mix = mix.clip(min=np.zeros(ndim), max=np.array(patch.shape[1:]) - 1).astype(np.uint)
-        ## replace neighbouring pixels with random values from flat dist
-        patch[z][tuple(mix.T)] = np.random.rand(mix.shape[0]) * 4 - 2
+    apply_structN2Vmask(patch, coords, mask, rng=rng)
 
 
 def manipulate_val_data(
@@ -651,34 +737,173 @@ def manipulate_val_data(
     Y_val,
     perc_pix=0.198,
     shape=(64, 64),
-    value_manipulation=pm_uniform_withCP(5),
+    n2v_manipulator="uniform_withCP",
+    n2v_neighborhood_radius=5,
+    rng=None,
 ):
-    dims = len(shape)
-    if dims == 2:
-        box_size = np.round(np.sqrt(100 / perc_pix), dtype=int)
-        get_stratified_coords = get_stratified_coords2D
-    elif dims == 3:
-        box_size = np.round(np.sqrt(100 / perc_pix), dtype=int)
-        get_stratified_coords = get_stratified_coords3D
+    """
+    Creates the Noise2Void masks of a whole set of images at once. The pixels to manipulate, one per box of a
+    stratified grid and shared by all the channels of an image, are drawn for all the images in one pass.
 
+    Parameters
+    ----------
+    X_val : 4D/5D Numpy array
+        Images. Modified in place. E.g. ``(num_of_images, y, x, channels)`` in ``2D`` or
+        ``(num_of_images, z, y, x, channels)`` in ``3D``.
+
+    Y_val : 4D/5D Numpy array
+        Array to store the Noise2Void masks in. E.g. ``(num_of_images, y, x, channels*2)`` in ``2D`` or
+        ``(num_of_images, z, y, x, channels*2)`` in ``3D``.
+
+    perc_pix : float, optional
+        Percentage of pixels to manipulate.
+
+    shape : tuple of ints, optional
+        Spatial shape of the images. E.g. ``(y, x)`` in ``2D`` or ``(z, y, x)`` in ``3D``.
+
+    n2v_manipulator : str, optional
+        How to manipulate the input pixels. ``uniform_withCP``, ``normal_additive`` and ``identity`` are applied to
+        all the images at once; the rest image by image.
+
+    n2v_neighborhood_radius : int, optional
+        Neighborhood size to use when manipulating the values.
+
+    rng : Numpy Generator, optional
+        Random generator to use. If not provided ``np.random`` is used.
+    """
+    rng = np.random if rng is None else rng
+    dims = len(shape)
+    box_size = int(np.round(np.sqrt(100 / perc_pix)))
     n_chan = X_val.shape[-1]
+    spatial = np.array(X_val.shape[1:-1], dtype=int)
+
+    # Stratified coordinates of all the images
+    box_starts = np.stack(
+        np.meshgrid(*[np.arange(c) * box_size for c in np.ceil(spatial / box_size).astype(int)], indexing="ij"),
+        axis=-1,
+    ).reshape(-1, dims)
+    coords = (box_starts + rng.random((X_val.shape[0],) + box_starts.shape) * box_size).astype(int)
+    b_idx, p_idx = np.nonzero(np.all(coords < spatial, axis=-1))
+    coords = coords[b_idx, p_idx].T
+    channels = np.arange(n_chan)[None, :]
+    # (num_of_points, channels) indexing of each manipulated pixel
+    indexing = (b_idx[:, None],) + tuple(c[:, None] for c in coords) + (channels,)
+    indexing_mask = indexing[:-1] + (channels + n_chan,)
+
+    y_val = X_val[indexing]
+    if n2v_manipulator == "uniform_withCP":
+        # Neighborhood of each coordinate cropped to the image boundaries, one random neighbor per channel
+        start = np.maximum(coords - n2v_neighborhood_radius, 0)[..., None]
+        end = np.minimum(coords + n2v_neighborhood_radius + 1, spatial[:, None])[..., None]
+        rand_coords = start + (rng.random(coords.shape + (n_chan,)) * (end - start)).astype(int)
+        x_val = X_val[(b_idx[:, None],) + tuple(rand_coords) + (channels,)]
+    elif n2v_manipulator == "normal_additive":
+        x_val = rng.normal(y_val, n2v_neighborhood_radius)
+    elif n2v_manipulator == "identity":
+        x_val = y_val.copy()
+    else:
+        value_manipulation = get_value_manipulation(n2v_manipulator, n2v_neighborhood_radius)
+        x_val = np.zeros(y_val.shape, dtype=np.float32)
+        for j in np.unique(b_idx):
+            sel = b_idx == j
+            for c in range(n_chan):
+                x_val[sel, c] = value_manipulation(X_val[j, ..., c], tuple(coords[:, sel]), dims, rng=rng)
 
     Y_val *= 0
-    for j in tqdm(
-        range(X_val.shape[0]),
-        desc="Preparing validation data: ",
-        disable=not is_main_process(),
-    ):
-        coords = get_stratified_coords(box_size=box_size, shape=np.array(X_val.shape)[1:-1])
-        for c in range(n_chan):
-            indexing = (j,) + coords + (c,)
-            indexing_mask = (j,) + coords + (c + n_chan,)
-            y_val = X_val[indexing]
-            x_val = value_manipulation(X_val[j, ..., c], coords, dims)
-
-            Y_val[indexing] = y_val
-            Y_val[indexing_mask] = 1
-            X_val[indexing] = x_val
+    Y_val[indexing] = y_val
+    Y_val[indexing_mask] = 1
+    X_val[indexing] = x_val
+
+
+def prepare_n2v_batch(
+    x,
+    box_size,
+    n2v_manipulator="uniform_withCP",
+    n2v_neighborhood_radius=5,
+    n2v_structMask=None,
+    generator=None,
+):
+    """
+    Creates Noise2Void masks for a whole batch in its device. Equivalent to the ``prepare_n2v`` function of the
+    generators but done in batch so the data loader workers only need to load the data.
+
+    Parameters
+    ----------
+    x : 4D/5D Torch tensor
+        Batch of images. E.g. ``(num_of_images, channels, y, x)`` in ``2D`` or
+        ``(num_of_images, channels, z, y, x)`` in ``3D``.
+
+    box_size : int
+        Size of the boxes used to sample the pixels to manipulate. One pixel is manipulated per box.
+
+    n2v_manipulator : str, optional
+        How to manipulate the input pixels. Options: ``uniform_withCP``, ``normal_additive`` and ``identity``.
+
+    n2v_neighborhood_radius : int, optional
+        Neighborhood size to use when manipulating the values.
+
+    n2v_structMask : Numpy array, optional
+        Masking kernel for StructN2V to hide pixels adjacent to main blind spot.
+
+    generator : torch.Generator, optional
+        Random generator to use. Useful to obtain always the same masks, e.g. in validation. Must be placed in
+        the same device as ``x``.
+
+    Returns
+    -------
+    out : 4D/5D Torch tensor
+        Input batch with the selected pixels manipulated. Same shape as ``x``.
+
+    mask : 4D/5D Torch tensor
+        Noise2Void mask. E.g. ``(num_of_images, channels*2, y, x)`` in ``2D`` or
+        ``(num_of_images, channels*2, z, y, x)`` in ``3D``.
+    """
+    b, c = x.shape[:2]
+    spatial = tuple(x.shape[2:])
+    ndim = len(spatial)
+    shape = torch.tensor(spatial, device=x.device)
+
+    # Stratified coordinates of each image and channel
+    grids = torch.meshgrid(
+        *[torch.arange(math.ceil(s / box_size), device=x.device) * box_size for s in spatial],
+        indexing="ij",
+    )
+    box_starts = torch.stack([g.reshape(-1) for g in grids], dim=-1)
+    offsets = torch.rand((b, c) + tuple(box_starts.shape), generator=generator, device=x.device) * box_size
+    coords = (box_starts + offsets).long()
+    b_idx, c_idx, p_idx = (coords < shape).all(dim=-1).nonzero(as_tuple=True)
+    coords = coords[b_idx, c_idx, p_idx].T
+    indexing = (b_idx, c_idx) + tuple(coords)
+
+    values = x[indexing]
+    if n2v_manipulator == "uniform_withCP":
+        start = (coords - n2v_neighborhood_radius).clamp(min=0)
+        end = torch.minimum(coords + n2v_neighborhood_radius + 1, shape[:, None])
+        rand = torch.rand(coords.shape, generator=generator, device=x.device)
+        new_values = x[(b_idx, c_idx) + tuple(start + (rand * (end - start)).long())]
+    elif n2v_manipulator == "normal_additive":
+        noise = torch.randn(values.shape, generator=generator, device=x.device)
+        new_values = values + noise * n2v_neighborhood_radius
+    elif n2v_manipulator == "identity":
+        new_values = values
+    else:
+        raise ValueError(f"'{n2v_manipulator}' manipulator can not be applied in batch")
+
+    out = x.clone()
+    mask = torch.zeros((b, c * 2) + spatial, dtype=x.dtype, device=x.device)
+    mask[indexing] = values
+    mask[(b_idx, c_idx + c) + tuple(coords)] = 1
+    out[indexing] = new_values
+
+    if n2v_structMask is not None:
+        dx = torch.from_numpy(get_structN2Vmask_displacements(n2v_structMask, ndim)).to(x.device)
+        mix = coords[:, None, :] + dx[:, :, None]
+        mix = torch.minimum(mix.clamp(min=0), (shape - 1)[:, None, None]).reshape(ndim, -1)
+        n_disp = dx.shape[1]
+        hidden = (b_idx.repeat(n_disp), c_idx.repeat(n_disp)) + tuple(mix)
+        out[hidden] = (torch.rand(mix.shape[1], generator=generator, device=x.device) * 4 - 2).to(x.dtype)
+
+    return out, mask
 
 
 def get_value_manipulation(n2v_manipulator, n2v_neighborhood_radius):
@@ -4,9 +4,10 @@ import torch
 import torch.distributed as dist
 import numpy as np
 import pandas as pd
+import h5py
 from skimage.feature import peak_local_max, blob_log
-from skimage.morphology import disk, dilation
-from concurrent.futures import ThreadPoolExecutor
+from skimage.morphology import disk, ball, dilation
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from biapy.data.post_processing.post_processing import (
     remove_close_points,
@@ -16,10 +17,12 @@ from biapy.data.post_processing.post_processing import (
 from biapy.utils.misc import (
     is_main_process,
     is_dist_avail_and_initialized,
+    nan_to_zero,
 )
 from biapy.utils.util import (
     save_tif,
     write_chunked_data,
+    get_chunked_data_options,
     order_dimensions,
     read_chunked_data,
 )
@@ -190,7 +193,7 @@ class Detection_Workflow(Base_Workflow):
         with torch.no_grad():
             for i, metric in enumerate(list_to_use):
                 val = metric(output, targets)
-                val = val.item() if not torch.isnan(val) else 0
+                val = nan_to_zero(val, to_host=metric_logger is None)
                 out_metrics[list_names_to_use[i]] = val
 
                 if metric_logger is not None:
@@ -302,41 +305,22 @@ class Detection_Workflow(Base_Workflow):
                 print("Creating the images with detected points . . .")
             points_pred = np.zeros(pred.shape[:-1], dtype=np.uint8)
             for n, pred_coordinates in enumerate(all_points):
-                if self.use_gt:
-                    pred_id_img = np.zeros(pred_shape[:-1], dtype=np.uint32)
-                for j, coord in enumerate(pred_coordinates):
-                    z, y, x = coord
-                    points_pred[z, y, x] = n + 1
-                    if self.use_gt:
-                        pred_id_img[z, y, x] = j + 1
-
-                # Dilate and save the prediction ids for the current class
-                if self.use_gt:
-                    for i in range(pred_id_img.shape[0]):
-                        pred_id_img[i] = dilation(pred_id_img[i], disk(3))
-                    if file_ext in [".hdf5", ".h5", ".zarr"]:
-                        write_chunked_data(
-                            np.expand_dims(np.expand_dims(pred_id_img, -1), 0),
-                            self.cfg.PATHS.RESULT_DIR.DET_ASSOC_POINTS,
-                            os.path.splitext(filenames[0])[0] + "_class" + str(n + 1) + "_pred_ids" + file_ext,
-                            dtype_str="uint32",
-                            verbose=self.cfg.TEST.VERBOSE,
-                        )
-                    else:
-                        save_tif(
-                            np.expand_dims(np.expand_dims(pred_id_img, 0), -1),
-                            self.cfg.PATHS.RESULT_DIR.DET_ASSOC_POINTS,
-                            [os.path.splitext(filenames[0])[0] + "_class" + str(n + 1) + "_pred_ids.tif"],
-                            verbose=self.cfg.TEST.VERBOSE,
-                        )
+                class_coords = np.asarray(pred_coordinates, dtype=int).reshape(-1, 3)
+                points_pred[tuple(class_coords.T)] = n + 1
 
-            if self.use_gt:
-                del pred_id_img
+                # Save the prediction ids of the current class, only the points (sparse)
+                if self.use_gt and self.cfg.TEST.DET_PRED_IDS_FORMAT != "none":
+                    save_sparse_point_ids(
+                        class_coords,
+                        self.cfg.PATHS.RESULT_DIR.DET_ASSOC_POINTS,
+                        os.path.splitext(filenames[0])[0] + "_class" + str(n + 1) + "_pred_ids",
+                        ndim=ndim,
+                        file_format=self.cfg.TEST.DET_PRED_IDS_FORMAT,
+                    )
 
             # Dilate and save the detected point image
-            if len(pred_coordinates) > 0:
-                for i in range(points_pred.shape[0]):
-                    points_pred[i] = dilation(points_pred[i], disk(3))
+            if points_pred.any():
+                points_pred = dilate_points(points_pred, ndim=ndim)
             if file_ext in [".hdf5", ".h5", ".zarr"]:
                 write_chunked_data(
                     np.expand_dims(np.expand_dims(points_pred, -1), 0),
@@ -344,6 +328,7 @@ class Detection_Workflow(Base_Workflow):
                     filenames[0],
                     dtype_str="uint8",
                     verbose=self.cfg.TEST.VERBOSE,
+                    **get_chunked_data_options(self.cfg),
                 )
             else:
                 save_tif(
@@ -369,6 +354,7 @@ class Detection_Workflow(Base_Workflow):
                     donuts_patch=self.cfg.TEST.POST_PROCESSING.DET_WATERSHED_DONUTS_PATCH,
                     donuts_nucleus_diameter=self.cfg.TEST.POST_PROCESSING.DET_WATERSHED_DONUTS_NUCLEUS_DIAMETER,
                     save_dir=check_wa,
+                    num_workers=self.cfg.TEST.POST_PROCESSING.DET_WATERSHED_NUM_WORKERS,
                 )
 
                 # Instance filtering by properties
@@ -378,6 +364,7 @@ class Detection_Workflow(Base_Workflow):
                     properties=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.PROPS,
                     prop_values=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.VALUES,
                     comp_signs=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.SIGN,
+                    num_workers=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.NUM_WORKERS,
                 )
 
                 if file_ext in [".hdf5", ".h5", ".zarr"]:
@@ -387,6 +374,7 @@ class Detection_Workflow(Base_Workflow):
                         filenames[0],
                         dtype_str="uint8",
                         verbose=self.cfg.TEST.VERBOSE,
+                        **get_chunked_data_options(self.cfg),
                     )
                 else:
                     save_tif(
@@ -731,57 +719,37 @@ class Detection_Workflow(Base_Workflow):
                         if dfs[ch][1] is not None:
                             fp = dfs[ch][1]
 
-                    # TP and FN
-                    gt_id_img = np.zeros(pred_shape[:-1], dtype=np.uint32)
-                    for j, cor in enumerate(gt_coords):
-                        z, y, x = cor
-                        z, y, x = int(z), int(y), int(x)
-                        if gt_assoc is not None:
-                            if gt_assoc[gt_assoc["gt_id"] == j + 1]["tag"].iloc[0] == "TP":
-                                points_pred[z, y, x] = (0, 255, 0)  # Green
-                            elif gt_assoc[gt_assoc["gt_id"] == j + 1]["tag"].iloc[0] == "NC":
-                                points_pred[z, y, x] = (150, 150, 150)  # Gray
-                            else:
-                                points_pred[z, y, x] = (255, 0, 0)  # Red
-                        else:
-                            points_pred[z, y, x] = (255, 0, 0)  # Red
-
-                        gt_id_img[z, y, x] = j + 1
-
-                    # Dilate and save the GT ids for the current class
-                    for i in range(gt_id_img.shape[0]):
-                        gt_id_img[i] = dilation(gt_id_img[i], disk(3))
-                    if file_ext in [".hdf5", ".h5", ".zarr"]:
-                        write_chunked_data(
-                            np.expand_dims(np.expand_dims(gt_id_img, -1), 0),
-                            self.cfg.PATHS.RESULT_DIR.DET_ASSOC_POINTS,
-                            os.path.splitext(filenames[0])[0] + "_class" + str(ch + 1) + "_gt_ids" + file_ext,
-                            dtype_str="uint32",
-                            verbose=self.cfg.TEST.VERBOSE,
+                    # TP (green), NC (gray) and FN (red)
+                    gt_coords = np.asarray(gt_coords, dtype=float).astype(int).reshape(-1, 3)
+                    colors = np.tile(np.array([255, 0, 0], dtype=np.uint8), (len(gt_coords), 1))
+                    if gt_assoc is not None:
+                        tags = (
+                            gt_assoc.drop_duplicates("gt_id")
+                            .set_index("gt_id")["tag"]
+                            .reindex(np.arange(1, len(gt_coords) + 1))
+                            .to_numpy()
                         )
-                    else:
-                        save_tif(
-                            np.expand_dims(np.expand_dims(gt_id_img, 0), -1),
+                        colors[tags == "TP"] = (0, 255, 0)
+                        colors[tags == "NC"] = (150, 150, 150)
+                    points_pred[tuple(gt_coords.T)] = colors
+
+                    # Save the GT ids for the current class, only the points (sparse)
+                    if self.cfg.TEST.DET_PRED_IDS_FORMAT != "none":
+                        save_sparse_point_ids(
+                            gt_coords,
                             self.cfg.PATHS.RESULT_DIR.DET_ASSOC_POINTS,
-                            [os.path.splitext(filenames[0])[0] + "_class" + str(ch + 1) + "_gt_ids.csv"],
-                            verbose=self.cfg.TEST.VERBOSE,
+                            os.path.splitext(filenames[0])[0] + "_class" + str(ch + 1) + "_gt_ids",
+                            ndim=ndim,
+                            file_format=self.cfg.TEST.DET_PRED_IDS_FORMAT,
                         )
 
-                    # FP
+                    # FP (blue)
                     if fp is not None:
-                        for cor in zip(
-                            fp["axis-0"].tolist(),
-                            fp["axis-1"].tolist(),
-                            fp["axis-2"].tolist(),
-                        ):
-                            z, y, x = cor
-                            z, y, x = int(z), int(y), int(x)
-                            points_pred[z, y, x] = (0, 0, 255)  # Blue
+                        fp_coords = fp[["axis-0", "axis-1", "axis-2"]].to_numpy().astype(int)
+                        points_pred[tuple(fp_coords.T)] = (0, 0, 255)
 
                 # Dilate and save the predicted points for the current class
-                for i in range(points_pred.shape[0]):
-                    for j in range(points_pred.shape[-1]):
-                        points_pred[i, ..., j] = dilation(points_pred[i, ..., j], disk(3))
+                points_pred = dilate_points(points_pred, channel_axis=True, ndim=ndim)
                 if file_ext in [".hdf5", ".h5", ".zarr"]:
                     write_chunked_data(
                         np.expand_dims(points_pred, 0),
@@ -789,6 +757,7 @@ class Detection_Workflow(Base_Workflow):
                         filenames[0],
                         dtype_str="uint8",
                         verbose=self.cfg.TEST.VERBOSE,
+                        **get_chunked_data_options(self.cfg),
                     )
                 else:
                     save_tif(
@@ -820,142 +789,31 @@ class Detection_Workflow(Base_Workflow):
         else:
             raise NotImplementedError
 
-    def process_patch(
-        self,
-        z,
-        y,
-        x,
-        _filename,
-        total_patches,
-        c,
-        pred,
-        d,
-        file_ext,
-        z_dim,
-        y_dim,
-        x_dim,
-    ):
+    def after_merge_patches_by_chunks_proccess_patch(self, filename):
         """
-        Process a patch for the detection workflow.
+        Place any code that needs to be done after merging all predicted patches into the original image
+        but in the process made chunk by chunk. This function will operate patch by patch defined by
+        ``DATA.PATCH_SIZE`` + ``DATA.PADDING``.
 
         Parameters
         ----------
-        z : int
-            Patch z index.
-
-        y : int
-            Patch y index.
-
-        x : int
-            Patch x index.
-
-        _filename : str
+        filename : List of str
             Filename of the predicted image H5/Zarr.
-
-        total_patches : int
-            Total number of patches.
-
-        c : int
-            Current patch number.
-
-        pred : 4D numpy array
-            Model prediction.
-
-        d : int
-            Number of digits of the total patches.
-
-        file_ext : str
-            File extension of the predicted image.
-
-        z_dim : int
-            Dimension of the z axis.
-
-        y_dim : int
-            Dimension of the y axis.
-
-        x_dim : int
-            Dimension of the x axis.
-
-        Returns
-        -------
-        df_patch : DataFrame
-            Detected points in the patch.
-
-        fname : str
-            Filename of the patch.
-
         """
-        print("Processing patch {}/{} of image".format(c, total_patches))
-        if self.cfg.TEST.VERBOSE:
-            print(
-                "D: z: {}-{}, y: {}-{}, x: {}-{}".format(
-                    max(
-                        0,
-                        z * self.cfg.DATA.PATCH_SIZE[0] - self.cfg.DATA.TEST.PADDING[0],
-                    ),
-                    min(
-                        z_dim,
-                        self.cfg.DATA.PATCH_SIZE[0] * (z + 1) + self.cfg.DATA.TEST.PADDING[0],
-                    ),
-                    max(
-                        0,
-                        y * self.cfg.DATA.PATCH_SIZE[1] - self.cfg.DATA.TEST.PADDING[1],
-                    ),
-                    min(
-                        y_dim,
-                        self.cfg.DATA.PATCH_SIZE[1] * (y + 1) + self.cfg.DATA.TEST.PADDING[1],
-                    ),
-                    max(
-                        0,
-                        x * self.cfg.DATA.PATCH_SIZE[2] - self.cfg.DATA.TEST.PADDING[2],
-                    ),
-                    min(
-                        x_dim,
-                        self.cfg.DATA.PATCH_SIZE[2] * (x + 1) + self.cfg.DATA.TEST.PADDING[2],
-                    ),
-                )
-            )
 
-        fname = _filename + "_patch" + str(c).zfill(d) + file_ext
+        _filename, file_ext = os.path.splitext(os.path.basename(filename))
+        print("Detection workflow pipeline continues for image {}".format(_filename))
 
-        slices = (
-            slice(None),
-            slice(
-                max(0, z * self.cfg.DATA.PATCH_SIZE[0] - self.cfg.DATA.TEST.PADDING[0]),
-                min(
-                    z_dim,
-                    self.cfg.DATA.PATCH_SIZE[0] * (z + 1) + self.cfg.DATA.TEST.PADDING[0],
-                ),
-            ),
-            slice(
-                max(0, y * self.cfg.DATA.PATCH_SIZE[1] - self.cfg.DATA.TEST.PADDING[1]),
-                min(
-                    y_dim,
-                    self.cfg.DATA.PATCH_SIZE[1] * (y + 1) + self.cfg.DATA.TEST.PADDING[1],
-                ),
-            ),
-            slice(
-                max(0, x * self.cfg.DATA.PATCH_SIZE[2] - self.cfg.DATA.TEST.PADDING[2]),
-                min(
-                    x_dim,
-                    self.cfg.DATA.PATCH_SIZE[2] * (x + 1) + self.cfg.DATA.TEST.PADDING[2],
-                ),
-            ),
-            slice(None),  # Channel
-        )
+        # Load H5/Zarr
+        pred_file, pred = read_chunked_data(filename)
 
-        data_ordered_slices = order_dimensions(
-            slices,
-            input_order="TZYXC",
-            output_order=self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER,
-            default_value=0,
-        )
+        t_dim, z_dim, c_dim, y_dim, x_dim = order_dimensions(pred.shape, self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER)
+        pred_shape = [z_dim, y_dim, x_dim]
 
         if "C" not in self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER:
             expected_out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER + "C"
         else:
             expected_out_data_order = self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER
-
         current_order = np.array(range(len(pred.shape)))
         transpose_order = order_dimensions(
             current_order,
@@ -965,141 +823,102 @@ class Detection_Workflow(Base_Workflow):
         )
         transpose_order = [x for x in transpose_order if not np.isnan(x)]
         transpose_order = current_order[np.array(transpose_order)]
-        raw_patch = pred[data_ordered_slices]
-        patch = raw_patch.transpose(transpose_order)
-
-        patch_pos = [(k.start, k.stop) for k in slices[1:]]
-        df_patch = self.detection_process(patch, [fname], patch_pos=patch_pos)
-        if df_patch is not None:  # if there is at least one point detected
-
-            if z * self.cfg.DATA.PATCH_SIZE[0] - self.cfg.DATA.TEST.PADDING[0] >= 0:  # if a patch was added
-                df_patch["axis-0"] = (
-                    df_patch["axis-0"] - self.cfg.DATA.TEST.PADDING[0]
-                )  # shift the coordinates to the correct patch position
-            if y * self.cfg.DATA.PATCH_SIZE[1] - self.cfg.DATA.TEST.PADDING[1] >= 0:
-                df_patch["axis-1"] = df_patch["axis-1"] - self.cfg.DATA.TEST.PADDING[1]
-            if x * self.cfg.DATA.PATCH_SIZE[2] - self.cfg.DATA.TEST.PADDING[2] >= 0:
-                df_patch["axis-2"] = df_patch["axis-2"] - self.cfg.DATA.TEST.PADDING[2]
-
-            df_patch = df_patch[df_patch["axis-0"] >= 0]  # remove all coordinate from the previous patch
-            df_patch = df_patch[
-                df_patch["axis-0"] < self.cfg.DATA.PATCH_SIZE[0]
-            ]  # remove all coordinate from the next patch
-            df_patch = df_patch[df_patch["axis-1"] >= 0]
-            df_patch = df_patch[df_patch["axis-1"] < self.cfg.DATA.PATCH_SIZE[1]]
-            df_patch = df_patch[df_patch["axis-2"] >= 0]
-            df_patch = df_patch[df_patch["axis-2"] < self.cfg.DATA.PATCH_SIZE[2]]
-
-            df_patch = df_patch.reset_index(drop=True)
-
-            # add the patch shift to the detected coordinates
-            shift = np.array(
-                [
-                    z * self.cfg.DATA.PATCH_SIZE[0],
-                    y * self.cfg.DATA.PATCH_SIZE[1],
-                    x * self.cfg.DATA.PATCH_SIZE[2],
-                ]
-            )
-
-            df_patch["axis-0"] = df_patch["axis-0"] + shift[0]
-            df_patch["axis-1"] = df_patch["axis-1"] + shift[1]
-            df_patch["axis-2"] = df_patch["axis-2"] + shift[2]
-
-            return df_patch, fname
-
-        return None, None
-
-    def after_merge_patches_by_chunks_proccess_patch(self, filename):
-        """
-        Place any code that needs to be done after merging all predicted patches into the original image
-        but in the process made chunk by chunk. This function will operate patch by patch defined by
-        ``DATA.PATCH_SIZE`` + ``DATA.PADDING``.
-
-        Parameters
-        ----------
-        filename : List of str
-            Filename of the predicted image H5/Zarr.
-        """
-
-        _filename, file_ext = os.path.splitext(os.path.basename(filename))
-        print("Detection workflow pipeline continues for image {}".format(_filename))
-
-        # Load H5/Zarr
-        pred_file, pred = read_chunked_data(filename)
-
-        t_dim, z_dim, c_dim, y_dim, x_dim = order_dimensions(pred.shape, self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER)
-        pred_shape = [z_dim, y_dim, x_dim]
+        if isinstance(pred_file, h5py.File):
+            pred_file.close()
 
-        # Fill the new data
+        peak_args = {
+            "function": self.cfg.TEST.DET_POINT_CREATION_FUNCTION,
+            "min_th_to_be_peak": self.cfg.TEST.DET_MIN_TH_TO_BE_PEAK,
+            "min_distance": self.cfg.TEST.DET_PEAK_LOCAL_MAX_MIN_DISTANCE,
+            "exclude_border": self.cfg.TEST.DET_EXCLUDE_BORDER,
+            "blob_log_min_sigma": self.cfg.TEST.DET_BLOB_LOG_MIN_SIGMA,
+            "blob_log_max_sigma": self.cfg.TEST.DET_BLOB_LOG_MAX_SIGMA,
+            "blob_log_num_sigma": self.cfg.TEST.DET_BLOB_LOG_NUM_SIGMA,
+        }
+
+        # Each chunk is read, with a halo of 'DATA.TEST.PADDING', and processed in a different process. Only the
+        # points inside the chunk's core ('DATA.PATCH_SIZE') are kept, so there are no duplicates between chunks
         z_vols = math.ceil(z_dim / self.cfg.DATA.PATCH_SIZE[0])
         y_vols = math.ceil(y_dim / self.cfg.DATA.PATCH_SIZE[1])
         x_vols = math.ceil(x_dim / self.cfg.DATA.PATCH_SIZE[2])
         total_patches = z_vols * y_vols * x_vols
         d = len(str(total_patches))
-        c = 1
-
+        patch_fnames = []
         workers = self.cfg.SYSTEM.NUM_WORKERS if self.cfg.SYSTEM.NUM_WORKERS > 0 else None
-        with ThreadPoolExecutor(max_workers=workers) as executor:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
             futures = []
-            for z in tqdm(range(z_vols), disable=not is_main_process()):
+            for z in range(z_vols):
                 for y in range(y_vols):
                     for x in range(x_vols):
+                        core = [
+                            (k * p, min((k + 1) * p, dim))
+                            for k, p, dim in zip([z, y, x], self.cfg.DATA.PATCH_SIZE[:3], pred_shape)
+                        ]
+                        slices = (slice(None),)
+                        for (start, end), pad, dim in zip(core, self.cfg.DATA.TEST.PADDING, pred_shape):
+                            slices += (slice(max(0, start - pad), min(dim, end + pad)),)
+                        slices += (slice(None),)  # Channel
+                        data_ordered_slices = order_dimensions(
+                            slices,
+                            input_order="TZYXC",
+                            output_order=self.cfg.TEST.BY_CHUNKS.INPUT_IMG_AXES_ORDER,
+                            default_value=0,
+                        )
                         futures.append(
                             executor.submit(
-                                self.process_patch,
-                                z,
-                                y,
-                                x,
-                                _filename,
-                                total_patches,
-                                c,
-                                pred,
-                                d,
-                                file_ext,
-                                z_dim,
-                                y_dim,
-                                x_dim,
+                                _detect_points_in_chunk,
+                                filename,
+                                data_ordered_slices,
+                                transpose_order,
+                                [k.start for k in slices[1:4]],
+                                core,
+                                peak_args,
                             )
                         )
-                        c += 1
-        df = None
-        for future in futures:
-            df_patch, fname = future.result()
-            if df_patch is not None:
-                if "df" not in locals():
-                    df = df_patch.copy()
-                    df["file"] = fname
-                else:
-                    df_patch["file"] = fname
-                    df = pd.concat([df, df_patch], ignore_index=True)
+                        patch_fnames.append(_filename + "_patch" + str(len(patch_fnames) + 1).zfill(d) + file_ext)
 
-        # Take point coords
-        pred_coordinates = []
-        if df is None:
+            results = [f.result() for f in tqdm(futures, disable=not is_main_process())]
+
+        # Combine the points of all chunks at once
+        points = np.concatenate([r[0] for r in results], axis=0)
+        probs = np.concatenate([r[1] for r in results], axis=0)
+        point_classes = np.concatenate([r[2] for r in results], axis=0)
+        patch_ids = np.concatenate([np.full(len(r[0]), i) for i, r in enumerate(results)], axis=0)
+        del results
+        if len(points) == 0:
             print("No points created, skipping evaluation . . .")
             return
-        coordz = df["axis-0"].tolist()
-        coordy = df["axis-1"].tolist()
-        coordx = df["axis-2"].tolist()
-        for z, y, x in zip(coordz, coordy, coordx):
-            pred_coordinates.append([z, y, x])
 
-        # Apply post-processing of removing points
+        # Apply post-processing of removing points, keeping the most probable ones first
         if self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS and self.by_chunks:
             radius = self.cfg.TEST.POST_PROCESSING.REMOVE_CLOSE_POINTS_RADIUS[0]
-            pred_coordinates, dropped_pos = remove_close_points(
-                pred_coordinates,
+            points, dropped_pos = remove_close_points(
+                points,
                 radius,
                 self.cfg.DATA.TEST.RESOLUTION,
                 ndim=3,
                 return_drops=True,
+                scores=probs,
             )
-
-            # Remove points from dataframe
-            df = df.drop(dropped_pos)
+            keep = np.ones(len(probs), dtype=bool)
+            keep[dropped_pos] = False
+            probs, point_classes, patch_ids = probs[keep], point_classes[keep], patch_ids[keep]
+        pred_coordinates = points.tolist()
+
+        df = pd.DataFrame(
+            {
+                "pred_id": np.arange(1, len(points) + 1),
+                "axis-0": points[:, 0],
+                "axis-1": points[:, 1],
+                "axis-2": points[:, 2],
+                "probability": probs,
+                "class": point_classes,
+                "file": np.array(patch_fnames)[patch_ids],
+            }
+        )
 
         # Save large csv with all point of all patches
-        df = df.sort_values(by=["file"])
+        df = df.sort_values(by=["file"], kind="stable")
 
         t_dim, z_dim, y_dim, x_dim, c_dim = order_dimensions(
             self.cfg.DATA.PREPROCESS.ZOOM.ZOOM_FACTOR,
@@ -1111,6 +930,7 @@ class Detection_Workflow(Base_Workflow):
         df["axis-0"] = df["axis-0"] / z_dim
         df["axis-1"] = df["axis-1"] / y_dim
         df["axis-2"] = df["axis-2"] / x_dim
+        os.makedirs(self.cfg.PATHS.RESULT_DIR.DET_LOCAL_MAX_COORDS_CHECK, exist_ok=True)
         df.to_csv(
             os.path.join(
                 self.cfg.PATHS.RESULT_DIR.DET_LOCAL_MAX_COORDS_CHECK,
@@ -1118,9 +938,6 @@ class Detection_Workflow(Base_Workflow):
             )
         )
 
-        if self.cfg.TEST.BY_CHUNKS.FORMAT == "h5":
-            pred_file.close()
-
         # Calculate metrics with all the points
         if self.use_gt:
             print("Calculating detection metrics with all the points found . . .")
@@ -1450,3 +1267,153 @@ class Detection_Workflow(Base_Workflow):
         self.cfg.merge_from_list(opts)
 
         return original_test_mask_path
+
+
+def dilate_points(img, radius=3, channel_axis=False, ndim=3):
+    """
+    Dilate ``img`` in a single call over the whole volume: with a ball in ``3D`` and, in ``2D``, with a disk in each
+    ``z`` slice. The footprint is decomposed in a sequence of smaller ones so the cost does not grow with its size.
+
+    Parameters
+    ----------
+    img : 3D/4D Numpy array
+        Image to dilate. E.g. ``(z, y, x)`` or ``(z, y, x, channels)`` if ``channel_axis`` is set.
+
+    radius : int, optional
+        Radius of the ball/disk.
+
+    channel_axis : bool, optional
+        Whether the last axis of ``img`` are channels, which are dilated independently.
+
+    ndim : int, optional
+        Number of spatial dimensions of the data. With ``2`` the ``z`` slices are dilated independently.
+
+    Returns
+    -------
+    img : 3D/4D Numpy array
+        Dilated image.
+    """
+    footprint = []
+    sequence = ball(radius, decomposition="sequence") if ndim == 3 else disk(radius, decomposition="sequence")
+    for fp, num_iter in sequence:
+        if ndim == 2:
+            fp = fp[np.newaxis]
+        if channel_axis:
+            fp = fp[..., np.newaxis]
+        footprint.append((fp, num_iter))
+    return dilation(img, footprint=tuple(footprint))
+
+
+def save_sparse_point_ids(coords, out_dir, name, ndim=3, file_format="csv"):
+    """
+    Save the ids of a list of points, i.e. the position of each point plus one, in a sparse table instead of in an
+    image where each point is painted with its id.
+
+    Parameters
+    ----------
+    coords : 2D Numpy array
+        Coordinates of the points. E.g. ``(num_points, 3)``.
+
+    out_dir : str
+        Directory to save the file into.
+
+    name : str
+        Name of the file, without extension.
+
+    ndim : int, optional
+        Number of dimensions. In ``2`` the first coordinate (``z``) is dropped.
+
+    file_format : str, optional
+        Format of the file. Options: ``'csv'`` and ``'parquet'``.
+    """
+    coords = np.asarray(coords).reshape(-1, 3)
+    if ndim == 2:
+        coords = coords[:, 1:]
+    df = pd.DataFrame(coords, columns=["axis-{}".format(i) for i in range(coords.shape[1])])
+    df.insert(0, "id", np.arange(1, len(coords) + 1))
+
+    os.makedirs(out_dir, exist_ok=True)
+    if file_format == "parquet":
+        df.to_parquet(os.path.join(out_dir, name + ".parquet"), index=False)
+    else:
+        df.to_csv(os.path.join(out_dir, name + ".csv"), index=False)
+
+
+def _detect_points_in_chunk(filename, data_slices, transpose_order, chunk_start, core, peak_args):
+    """
+    Find the points of each channel within a chunk (core plus halo) of the prediction stored in ``filename``.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the H5/Zarr prediction.
+
+    data_slices : tuple of slices
+        Slices to read the chunk, with its halo, in the axes order of the file.
+
+    transpose_order : array of ints
+        Order to transpose the chunk into ``(z, y, x, channels)``.
+
+    chunk_start : List of 3 ints
+        Position of the first voxel of the chunk in the prediction. E.g. ``(z, y, x)``.
+
+    core : List of 3 tuples of ints
+        Start and end of the chunk's core, in the prediction, for each axis. Points outside it are discarded.
+
+    peak_args : dict
+        Point creation function (``TEST.DET_POINT_CREATION_FUNCTION``) and its arguments.
+
+    Returns
+    -------
+    points : 2D Numpy array
+        Coordinates of the points, in the prediction. E.g. ``(num_points, 3)``.
+
+    probs : 1D Numpy array
+        Prediction value of each point.
+
+    classes : 1D Numpy array
+        Class (channel) of each point.
+    """
+    fid, pred = read_chunked_data(filename)
+    patch = np.asarray(pred[data_slices]).transpose(transpose_order)
+    if isinstance(fid, h5py.File):
+        fid.close()
+
+    points, probs, classes = [], [], []
+    for channel in range(patch.shape[-1]):
+        if len(peak_args["min_th_to_be_peak"]) == 1:
+            min_th_peak = peak_args["min_th_to_be_peak"][0]
+        else:
+            min_th_peak = peak_args["min_th_to_be_peak"][channel]
+
+        if peak_args["function"] == "peak_local_max":
+            coords = peak_local_max(
+                patch[..., channel].astype(np.float32),
+                min_distance=peak_args["min_distance"],
+                threshold_abs=min_th_peak,
+                exclude_border=peak_args["exclude_border"],
+            )
+        else:
+            coords = blob_log(
+                patch[..., channel] * 255,
+                min_sigma=peak_args["blob_log_min_sigma"],
+                max_sigma=peak_args["blob_log_max_sigma"],
+                num_sigma=peak_args["blob_log_num_sigma"],
+                threshold=min_th_peak,
+                exclude_border=peak_args["exclude_border"],
+            )
+            coords = coords[:, :3]  # Remove sigma
+        coords = coords.astype(int).reshape(-1, 3)
+
+        # Keep only the points of the core
+        global_coords = coords + np.array(chunk_start)
+        in_core = np.all(
+            [(global_coords[:, k] >= core[k][0]) & (global_coords[:, k] < core[k][1]) for k in range(3)], axis=0
+        )
+        coords, global_coords = coords[in_core], global_coords[in_core]
+
+        points.append(global_coords)
+        probs.append(patch[coords[:, 0], coords[:, 1], coords[:, 2], channel])
+        classes.append(np.full(len(coords), channel))
+
+    return np.concatenate(points, axis=0), np.concatenate(probs, axis=0), np.concatenate(classes, axis=0)
@@ -10,7 +10,7 @@ from torchmetrics.image.inception import InceptionScore
 
 from biapy.engine.base_workflow import Base_Workflow
 from biapy.utils.util import save_tif, pad_and_reflect
-from biapy.utils.misc import to_pytorch_format, to_numpy_format
+from biapy.utils.misc import to_pytorch_format, to_numpy_format, nan_to_zero
 from biapy.data.pre_processing import undo_norm_range01, denormalize
 from biapy.data.post_processing.post_processing import (
     ensemble8_2d_predictions,
@@ -204,7 +204,7 @@ class Image_to_Image_Workflow(Base_Workflow):
                     raise NotImplementedError
 
                 if m_name in ["mse", "mae", "ssim", "psnr"]:
-                    val = val.item() if not torch.isnan(val) else 0
+                    val = nan_to_zero(val, to_host=metric_logger is None)
                     out_metrics[m_name] = val
 
                 if metric_logger is not None:
@@ -357,6 +357,7 @@ class Image_to_Image_Workflow(Base_Workflow):
                     padding=self.cfg.DATA.TEST.PADDING,
                     overlap=self.cfg.DATA.TEST.OVERLAP,
                     verbose=self.cfg.TEST.VERBOSE,
+                    blending=self.cfg.DATA.TEST.BLENDING,
                 )
                 self._Y = f_name(
                     self._Y,
@@ -373,6 +374,7 @@ class Image_to_Image_Workflow(Base_Workflow):
                     padding=self.cfg.DATA.TEST.PADDING,
                     overlap=self.cfg.DATA.TEST.OVERLAP,
                     verbose=self.cfg.TEST.VERBOSE,
+                    blending=self.cfg.DATA.TEST.BLENDING,
                 )
                 if self._Y is not None:
                     pred, self._Y = obj
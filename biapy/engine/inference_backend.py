@@ -0,0 +1,246 @@
+"""
+Inference backends for BiaPy models.
+
+The model built by BiaPy is a regular eager Pytorch module. At inference time it can be replaced by a faster runner
+("compile", "torchscript" or "onnx") whose input shape is fixed to ``DATA.PATCH_SIZE``. The TorchScript and ONNX
+artifacts are stored next to the checkpoint they were created from and their name contains the hash of that checkpoint
+and of the device they were prepared for, so repeated jobs reuse them instead of exporting (and warming up) again.
+"""
+import os
+import copy
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from biapy.utils.util import create_file_sha256sum
+
+
+def fold_batchnorm(model):
+    """
+    Fold the ``BatchNorm`` layers that directly follow a convolution into the weights of that convolution.
+    The model must be in evaluation mode. Only pairs defined consecutively inside a ``nn.Sequential`` container are
+    folded, which covers all the convolutional blocks of BiaPy models (see ``biapy/models/blocks.py``).
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model to modify inplace.
+
+    Returns
+    -------
+    folded : int
+        Number of folded convolution + batch normalization pairs.
+    """
+    pairs = []
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        children = list(module._modules.items())
+        for (conv_name, conv), (bn_name, bn) in zip(children[:-1], children[1:]):
+            if (
+                isinstance(conv, (nn.Conv1d, nn.Conv2d, nn.Conv3d))
+                and isinstance(bn, nn.modules.batchnorm._BatchNorm)
+                and bn.track_running_stats
+                and bn.running_mean is not None
+            ):
+                pairs.append((module, conv_name, bn_name))
+
+    for module, conv_name, bn_name in pairs:
+        module._modules[conv_name] = fuse_conv_bn_eval(module._modules[conv_name], module._modules[bn_name])
+        module._modules[bn_name] = nn.Identity()
+    return len(pairs)
+
+
+class ONNXRuntimeModel(nn.Module):
+    def __init__(self, onnx_file, device):
+        """
+        Run an ONNX model with ONNX Runtime (CPU) behind a Pytorch module interface.
+
+        Parameters
+        ----------
+        onnx_file : str
+            Path to the ONNX model.
+
+        device : Torch device
+            Device where the outputs are placed.
+        """
+        super(ONNXRuntimeModel, self).__init__()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_file, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = device
+
+    def forward(self, x):
+        x = np.ascontiguousarray(x.detach().to("cpu", torch.float32).numpy())
+        outs = [torch.from_numpy(o).to(self.device) for o in self.session.run(None, {self.input_name: x})]
+        return outs[0] if len(outs) == 1 else outs
+
+
+class InferenceBackend(nn.Module):
+    def __init__(self, runner, eager_model, input_shape, backend):
+        """
+        Call the exported/compiled ``runner`` when the input matches the shape it was prepared for and fall back to
+        the eager model otherwise (e.g. when the whole image is passed through the network with ``TEST.FULL_IMG``).
+
+        Parameters
+        ----------
+        runner : nn.Module
+            Compiled/exported model.
+
+        eager_model : nn.Module
+            Original model.
+
+        input_shape : tuple of ints
+            Input shape, without the batch dimension, ``runner`` accepts. E.g. ``(C, Y, X)``.
+
+        backend : str
+            Name of the backend.
+        """
+        super(InferenceBackend, self).__init__()
+        self.runner = runner
+        self.eager_model = eager_model
+        self.input_shape = tuple(input_shape)
+        self.backend = backend
+        self.warned = False
+
+    def forward(self, x):
+        if tuple(x.shape[1:]) != self.input_shape:
+            if not self.warned:
+                print(
+                    f"WARNING: input shape {tuple(x.shape[1:])} differs from the one the '{self.backend}' backend was "
+                    f"prepared for {self.input_shape}. Falling back to the eager model for those inputs"
+                )
+                self.warned = True
+            return self.eager_model(x)
+        return self.runner(x)
+
+
+def get_backend_artifact_path(cfg, checkpoint_path, input_shape, device):
+    """
+    Path where the artifact of ``cfg.TEST.BACKEND.TYPE`` is cached. It is placed in the same folder as the checkpoint and
+    its name is derived from the checkpoint hash, from the options that change the exported graph and from the device
+    (and CUDA/cuDNN versions and compute capability on GPU), as frozen and optimized graphs are device specific.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        Configuration.
+
+    checkpoint_path : str
+        Checkpoint the model weights were loaded from.
+
+    input_shape : tuple of ints
+        Input shape, without the batch dimension, of the exported model.
+
+    device : Torch device
+        Device the artifact is prepared for.
+
+    Returns
+    -------
+    path : str
+        Path of the artifact. The extension depends on the backend.
+    """
+    device = torch.device(device)
+    fields = [
+        create_file_sha256sum(checkpoint_path),
+        cfg.TEST.BACKEND.TYPE,
+        str(cfg.TEST.BACKEND.FOLD_BN),
+        "x".join(str(s) for s in input_shape),
+        torch.__version__,
+        device.type,
+    ]
+    if device.type == "cuda":
+        fields += [
+            str(torch.version.cuda),
+            str(torch.backends.cudnn.version()),
+            "x".join(str(c) for c in torch.cuda.get_device_capability(device)),
+        ]
+    key = hashlib.sha256("-".join(fields).encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0] + "-" + cfg.TEST.BACKEND.TYPE + "-" + key
+    ext = {"torchscript": ".pt", "onnx": ".onnx"}[cfg.TEST.BACKEND.TYPE]
+    return os.path.join(os.path.dirname(checkpoint_path), name + ext)
+
+
+def build_inference_backend(cfg, model, device, checkpoint_path=None):
+    """
+    Create the inference runner selected in ``cfg.TEST.BACKEND.TYPE`` for ``model``.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        Configuration.
+
+    model : nn.Module
+        Model, with its weights already loaded, in evaluation mode. It is not modified.
+
+    device : Torch device
+        Device used.
+
+    checkpoint_path : str, optional
+        Checkpoint the model weights were loaded from. If not provided the artifacts are not cached.
+
+    Returns
+    -------
+    model : nn.Module
+        Model to use during inference.
+
+    artifact : str
+        Path to the exported artifact. ``None`` if nothing was saved to disk.
+    """
+    backend = cfg.TEST.BACKEND.TYPE
+    input_shape = (cfg.DATA.PATCH_SIZE[-1],) + tuple(cfg.DATA.PATCH_SIZE[:-1])
+    # Compiled kernels are not stored by BiaPy. Inductor keeps its own cache, whose location can be set with the
+    # TORCHINDUCTOR_CACHE_DIR environment variable before launching the job
+    artifact = None
+    if backend != "compile":
+        if checkpoint_path is not None and cfg.TEST.BACKEND.CACHE and os.path.exists(checkpoint_path):
+            artifact = get_backend_artifact_path(cfg, checkpoint_path, input_shape, device)
+        else:
+            print("Inference backend artifacts will not be cached as there is no checkpoint to associate them with")
+
+    print(f"Preparing '{backend}' inference backend for input shape {input_shape} . . .")
+    runner_model = copy.deepcopy(model).eval()
+    if cfg.TEST.BACKEND.FOLD_BN:
+        print(f"Folded {fold_batchnorm(runner_model)} BatchNorm layers into their convolutions")
+
+    example = torch.zeros((cfg.TRAIN.BATCH_SIZE,) + input_shape, dtype=torch.float32, device=device)
+    if backend == "compile":
+        runner = torch.compile(runner_model, dynamic=False)
+        runner(example)
+    elif backend == "torchscript":
+        if artifact is not None and os.path.exists(artifact):
+            print(f"Loading cached TorchScript model from {artifact}")
+            runner = torch.jit.load(artifact, map_location=device)
+        else:
+            runner = torch.jit.trace(runner_model, example, strict=False)
+            runner = torch.jit.optimize_for_inference(torch.jit.freeze(runner))
+            if artifact is not None:
+                torch.jit.save(runner, artifact)
+                print(f"TorchScript model saved in {artifact}")
+    elif backend == "onnx":
+        if artifact is None or not os.path.exists(artifact):
+            onnx_file = artifact if artifact is not None else os.path.join(cfg.PATHS.CHECKPOINT, "model.onnx")
+            outputs = runner_model(example)
+            output_names = ["output"] if torch.is_tensor(outputs) else [f"output{i}" for i in range(len(outputs))]
+            torch.onnx.export(
+                runner_model.to("cpu"),
+                example.to("cpu"),
+                onnx_file,
+                input_names=["input"],
+                output_names=output_names,
+                dynamic_axes={n: {0: "batch"} for n in ["input"] + output_names},
+                opset_version=17,
+            )
+            print(f"ONNX model saved in {onnx_file}")
+            if artifact is None:
+                artifact = onnx_file
+        else:
+            print(f"Loading cached ONNX model from {artifact}")
+        runner = ONNXRuntimeModel(artifact, device)
+
+    return InferenceBackend(runner, model, input_shape, backend), artifact
@@ -32,7 +32,7 @@ from biapy.engine.metrics import (
     instance_metrics,
 )
 from biapy.engine.base_workflow import Base_Workflow
-from biapy.utils.misc import is_main_process, is_dist_avail_and_initialized
+from biapy.utils.misc import is_main_process, is_dist_avail_and_initialized, nan_to_zero
 
 
 class Instance_Segmentation_Workflow(Base_Workflow):
@@ -330,13 +330,13 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                 val = metric(output, targets)
                 if isinstance(val, dict):
                     for m in val:
-                        v = val[m].item() if not torch.isnan(val[m]) else 0
+                        v = nan_to_zero(val[m], to_host=metric_logger is None)
                         out_metrics[list_names_to_use[k]] = v
                         if metric_logger is not None:
                             metric_logger.meters[list_names_to_use[k]].update(v)
                         k += 1
                 else:
-                    val = val.item() if not torch.isnan(val) else 0
+                    val = nan_to_zero(val, to_host=metric_logger is None)
                     out_metrics[list_names_to_use[i]] = val
                     if metric_logger is not None:
                         metric_logger.meters[list_names_to_use[i]].update(val)
@@ -392,6 +392,10 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                 resolution=resolution,
                 save_dir=check_wa,
                 watershed_by_2d_slices=self.cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BY_2D_SLICES,
+                num_workers=self.cfg.PROBLEM.INSTANCE_SEG.WATERSHED_NUM_WORKERS,
+                block_size=self.cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_SIZE,
+                block_halo=self.cfg.PROBLEM.INSTANCE_SEG.WATERSHED_BLOCK_HALO,
+                otsu_max_samples=self.cfg.PROBLEM.INSTANCE_SEG.DATA_MW_TH_OTSU_MAX_SAMPLES,
             )
 
             # Multi-head: instances + classification
@@ -623,11 +627,16 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                 w_pred = np.expand_dims(w_pred, 0)
 
         if self.cfg.TEST.POST_PROCESSING.VORONOI_ON_MASK:
+            voronoi_block_size = self.cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_SIZE
+            if len(voronoi_block_size) == 0 and self.by_chunks and self.cfg.PROBLEM.NDIM == "3D":
+                voronoi_block_size = self.cfg.DATA.PATCH_SIZE[:-1]
             w_pred = voronoi_on_mask(
                 w_pred,
                 pred,
                 th=self.cfg.TEST.POST_PROCESSING.VORONOI_TH,
                 verbose=self.cfg.TEST.VERBOSE,
+                block_size=voronoi_block_size,
+                block_halo=self.cfg.TEST.POST_PROCESSING.VORONOI_BLOCK_HALO,
             )
         del pred
 
@@ -652,6 +661,7 @@ class Instance_Segmentation_Workflow(Base_Workflow):
                 properties=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.PROPS,
                 prop_values=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.VALUES,
                 comp_signs=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.REMOVE_BY_PROPERTIES.SIGN,
+                num_workers=self.cfg.TEST.POST_PROCESSING.MEASURE_PROPERTIES.NUM_WORKERS,
             )
             if self.cfg.PROBLEM.NDIM == "2D":
                 w_pred = np.expand_dims(w_pred, 0)
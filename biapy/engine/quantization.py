@@ -0,0 +1,203 @@
+"""
+INT8 post-training quantization of BiaPy models for CPU inference.
+
+Convolutional models are statically quantized (weights and activations) through FX graph mode quantization, using a
+few training patches to calibrate the activation ranges, while ``nn.Linear`` layers are dynamically quantized. The
+quantized model is traced with TorchScript and cached next to the checkpoint so later jobs do not need to calibrate
+again.
+"""
+import os
+import copy
+import hashlib
+import torch
+import torch.nn as nn
+
+from biapy.utils.util import create_file_sha256sum
+
+# Architectures where convolutions are statically quantized
+STATIC_QUANTIZATION_ARCHS = [
+    "unet",
+    "resunet",
+    "resunet++",
+    "attention_unet",
+    "multiresunet",
+    "seunet",
+    "resunet_se",
+    "edsr",
+    "rcan",
+    "dfcan",
+    "wdsr",
+]
+# Architectures where only nn.Linear layers are (dynamically) quantized
+DYNAMIC_QUANTIZATION_ARCHS = ["vit", "unetr"]
+
+
+class QuantizedModel(nn.Module):
+    def __init__(self, model, device):
+        """
+        Run a model in CPU, as quantized models only work there, and place its outputs in ``device``.
+
+        Parameters
+        ----------
+        model : nn.Module or ScriptModule
+            Quantized model, or any model placed in CPU.
+
+        device : Torch device
+            Device where the outputs are placed.
+        """
+        super(QuantizedModel, self).__init__()
+        self.model = model
+        self.device = device
+
+    def forward(self, x):
+        out = self.model(x.to("cpu", torch.float32))
+        if isinstance(out, (list, tuple)):
+            return [o.to(self.device) for o in out]
+        return out.to(self.device)
+
+
+def get_quantized_model_path(cfg, checkpoint_path):
+    """
+    Path where the quantized model created from ``checkpoint_path`` is cached.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        Configuration.
+
+    checkpoint_path : str
+        Checkpoint the model weights were loaded from.
+
+    Returns
+    -------
+    path : str
+        Path of the TorchScript quantized model.
+    """
+    key = hashlib.sha256(
+        "-".join(
+            [
+                create_file_sha256sum(checkpoint_path),
+                cfg.MODEL.ARCHITECTURE.lower(),
+                torch.backends.quantized.engine,
+                str(cfg.TEST.QUANTIZATION.CALIBRATION_SAMPLES),
+                "x".join(str(s) for s in cfg.DATA.PATCH_SIZE),
+                torch.__version__,
+            ]
+        ).encode()
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(checkpoint_path))[0] + "-int8-" + key + ".pt"
+    return os.path.join(os.path.dirname(checkpoint_path), name)
+
+
+def quantize_model(model, architecture, calibration_batches):
+    """
+    Quantize ``model`` to INT8.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model to quantize, with its weights loaded. It is not modified.
+
+    architecture : str
+        Architecture of the model (``MODEL.ARCHITECTURE``).
+
+    calibration_batches : list of Tensors
+        Batches, in CPU, used to calibrate the activation ranges. E.g. ``(B, C, Y, X)`` tensors.
+
+    Raises
+    ------
+    ValueError
+        if the model can not be prepared for static quantization or, in dynamically quantized architectures, if it has
+        no ``nn.Linear`` layers. In both cases nothing would be quantized.
+
+    Returns
+    -------
+    model : nn.Module
+        Quantized model.
+
+    mode : str
+        Quantization applied. One between ``'static'`` and ``'dynamic'``.
+    """
+    model = copy.deepcopy(model).to("cpu").eval()
+    if architecture in STATIC_QUANTIZATION_ARCHS:
+        from torch.ao.quantization import get_default_qconfig_mapping, default_dynamic_qconfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine).set_object_type(
+            nn.Linear, default_dynamic_qconfig
+        )
+        try:
+            prepared = prepare_fx(model, qconfig_mapping, example_inputs=(calibration_batches[0],))
+        except Exception as e:
+            raise ValueError(
+                f"The model could not be prepared for static quantization ({e}). Disable 'TEST.QUANTIZATION.ENABLE' "
+                "to run the fp32 model"
+            )
+        print(f"Calibrating the quantized model with {len(calibration_batches)} batches . . .")
+        with torch.no_grad():
+            for x in calibration_batches:
+                prepared(x)
+        return convert_fx(prepared), "static"
+
+    if not any(isinstance(m, nn.Linear) for m in model.modules()):
+        raise ValueError(
+            "The model has no nn.Linear layers, so dynamic quantization would not quantize anything. Disable "
+            "'TEST.QUANTIZATION.ENABLE' to run the fp32 model"
+        )
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8), "dynamic"
+
+
+def build_quantized_model(cfg, model, device, calibration_fn, checkpoint_path=None):
+    """
+    Create, or load from cache, the INT8 version of ``model``.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        Configuration.
+
+    model : nn.Module
+        Model, with its weights already loaded. It is not modified.
+
+    device : Torch device
+        Device where the outputs of the quantized model are placed.
+
+    calibration_fn : Callable
+        Function that returns the list of batches used for calibration. Only called if the quantized model is not
+        cached.
+
+    checkpoint_path : str, optional
+        Checkpoint the model weights were loaded from. If not provided the quantized model is not cached.
+
+    Returns
+    -------
+    model : QuantizedModel
+        Quantized model.
+    """
+    qfile = None
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        qfile = get_quantized_model_path(cfg, checkpoint_path)
+        if os.path.exists(qfile):
+            print(f"Loading cached INT8 model from {qfile}")
+            return QuantizedModel(torch.jit.load(qfile, map_location="cpu"), device)
+
+    calibration_batches = calibration_fn()
+    if len(calibration_batches) == 0:
+        raise ValueError(
+            "No calibration data available to quantize the model. Training data ('DATA.TRAIN.PATH' with "
+            "'TRAIN.ENABLE') is needed the first time a checkpoint is quantized"
+        )
+    qmodel, mode = quantize_model(model, cfg.MODEL.ARCHITECTURE.lower(), calibration_batches)
+    print(f"Model quantized to INT8 ({mode} quantization, '{torch.backends.quantized.engine}' engine)")
+
+    if qfile is not None:
+        try:
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(qmodel, calibration_batches[0], strict=False))
+            torch.jit.save(traced, qfile)
+            print(f"INT8 model saved in {qfile}")
+            qmodel = traced
+        except Exception as e:
+            print(f"WARNING: the quantized model could not be traced to be cached ({e})")
+
+    return QuantizedModel(qmodel, device)
@@ -28,10 +28,12 @@ from biapy.utils.misc import (
     to_numpy_format,
     is_main_process,
     is_dist_avail_and_initialized,
+    nan_to_zero,
 )
 from biapy.engine.base_workflow import Base_Workflow
 from biapy.data.pre_processing import (
     create_ssl_source_data_masks,
+    crappify_batch,
     denormalize,
     undo_norm_range01,
 )
@@ -73,7 +75,13 @@ class Self_supervised_Workflow(Base_Workflow):
 
         # Workflow specific training variables
         self.mask_path = None
-        if cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking":
+        self.crappify_on_the_fly = (
+            cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "crappify" and cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY
+        )
+        self.crappify_on_device = self.crappify_on_the_fly and cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE
+        # Random generator of the validation degradation. Created, with a fixed seed, at the start of each evaluation
+        self.val_generator_rng = None
+        if cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking" or self.crappify_on_the_fly:
             self.load_Y_val = False
         else:
             self.mask_path = cfg.DATA.TRAIN.GT_PATH
@@ -247,7 +255,7 @@ class Self_supervised_Workflow(Base_Workflow):
                     raise NotImplementedError
 
                 if m_name in ["mse", "mae", "ssim", "psnr"]:
-                    val = val.item() if not torch.isnan(val) else 0
+                    val = nan_to_zero(val, to_host=metric_logger is None)
                     out_metrics[m_name] = val
 
                 if metric_logger is not None:
@@ -272,11 +280,52 @@ class Self_supervised_Workflow(Base_Workflow):
         targets : Torch tensor
             Resulting targets.
         """
-        if self.cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking":
+        if self.cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking" or self.crappify_on_device:
             # Swap with original images so we can calculate PSNR metric afterwards
-            return to_pytorch_format(batch, self.axis_order, self.device, dtype=self.loss_dtype)
+            return self.batch_to_device(batch, dtype=self.loss_dtype)
         else:
-            return to_pytorch_format(targets, self.axis_order, self.device, dtype=self.loss_dtype)
+            return self.batch_to_device(targets, dtype=self.loss_dtype, is_mask=True)
+
+    def model_call_func(self, in_img, to_pytorch=True, is_train=False):
+        """
+        Call a regular Pytorch model. If ``PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_DEVICE`` is selected the input batch
+        is crappified in the device before passing it through the model during training.
+
+        Parameters
+        ----------
+        in_img : Tensor
+            Input image to pass through the model.
+
+        to_pytorch : bool, optional
+            Whether if the input image needs to be converted into pytorch format or not.
+
+        is_train : bool, optional
+            Whether if the call is during training or inference.
+
+        Returns
+        -------
+        prediction : Tensor
+            Image prediction.
+        """
+        if is_train and self.crappify_on_device:
+            if to_pytorch:
+                in_img = self.batch_to_device(in_img)
+                to_pytorch = False
+            # Same degradation each epoch for validation
+            if self.model.training:
+                self.val_generator_rng = None
+            elif self.val_generator_rng is None:
+                self.val_generator_rng = torch.Generator(device=in_img.device)
+                self.val_generator_rng.manual_seed(self.cfg.SYSTEM.SEED)
+            generator = None if self.model.training else self.val_generator_rng
+            in_img = crappify_batch(
+                in_img,
+                resizing_factor=self.cfg.PROBLEM.SELF_SUPERVISED.RESIZING_FACTOR,
+                noise_level=self.cfg.PROBLEM.SELF_SUPERVISED.NOISE,
+                random_degradation=self.cfg.PROBLEM.SELF_SUPERVISED.RANDOM_DEGRADATION,
+                generator=generator,
+            )
+        return super().model_call_func(in_img, to_pytorch=to_pytorch, is_train=is_train)
 
     def process_test_sample(self, norm):
         """
@@ -420,6 +469,7 @@ class Self_supervised_Workflow(Base_Workflow):
                 padding=self.cfg.DATA.TEST.PADDING,
                 overlap=self.cfg.DATA.TEST.OVERLAP,
                 verbose=self.cfg.TEST.VERBOSE,
+                blending=self.cfg.DATA.TEST.BLENDING,
             )
             if self.cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking":
                 pred_mask = f_name(
@@ -632,18 +682,25 @@ class Self_supervised_Workflow(Base_Workflow):
         """
         Creates self supervised "ground truth" images, if ``crappify`` was selected, to train the model based
         on the input images provided. They will be saved in a separate folder in the root path of the inout images.
+        If ``PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY`` is selected only the test data is created this way.
         """
         if self.cfg.PROBLEM.SELF_SUPERVISED.PRETEXT_TASK == "masking":
             print("No SSL data needs to be prepared for masking, as it will be generated on the fly")
             return
 
+        on_the_fly = self.cfg.PROBLEM.SELF_SUPERVISED.CRAPPIFY_ON_THE_FLY
+        if on_the_fly:
+            print("Train and validation SSL data will be crappified on the fly")
+            if not self.cfg.TEST.ENABLE:
+                return
+
         if is_main_process():
             print("############################")
             print("#  PREPARE DETECTION DATA  #")
             print("############################")
 
             # Create selected channels for train data
-            if self.cfg.TRAIN.ENABLE:
+            if self.cfg.TRAIN.ENABLE and not on_the_fly:
                 create_mask = False
                 if not os.path.isdir(self.cfg.DATA.TRAIN.SSL_SOURCE_DIR):
                     print(
@@ -669,7 +726,7 @@ class Self_supervised_Workflow(Base_Workflow):
                     create_ssl_source_data_masks(self.cfg, data_type="train")
 
             # Create selected channels for val data
-            if self.cfg.TRAIN.ENABLE and not self.cfg.DATA.VAL.FROM_TRAIN:
+            if self.cfg.TRAIN.ENABLE and not self.cfg.DATA.VAL.FROM_TRAIN and not on_the_fly:
                 create_mask = False
                 if not os.path.isdir(self.cfg.DATA.VAL.SSL_SOURCE_DIR):
                     print(
@@ -724,7 +781,7 @@ class Self_supervised_Workflow(Base_Workflow):
             dist.barrier()
 
         opts = []
-        if self.cfg.TRAIN.ENABLE or self.cfg.DATA.TEST.USE_VAL_AS_TEST:
+        if (self.cfg.TRAIN.ENABLE or self.cfg.DATA.TEST.USE_VAL_AS_TEST) and not on_the_fly:
             print(
                 "DATA.TRAIN.PATH changed from {} to {}".format(
                     self.cfg.DATA.TRAIN.PATH, self.cfg.DATA.TRAIN.SSL_SOURCE_DIR
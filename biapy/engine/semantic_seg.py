@@ -5,7 +5,7 @@ from skimage.transform import resize
 from biapy.data.post_processing.post_processing import apply_binary_mask
 from biapy.engine.base_workflow import Base_Workflow
 from biapy.utils.util import save_tif, check_masks
-from biapy.utils.misc import to_pytorch_format, to_numpy_format
+from biapy.utils.misc import to_pytorch_format, to_numpy_format, nan_to_zero
 from biapy.engine.metrics import (
     jaccard_index,
     CrossEntropyLoss_wrapper,
@@ -263,7 +263,7 @@ class Semantic_Segmentation_Workflow(Base_Workflow):
         with torch.no_grad():
             for i, metric in enumerate(list_to_use):
                 val = metric(output, targets)
-                val = val.item() if not torch.isnan(val) else 0
+                val = nan_to_zero(val, to_host=metric_logger is None)
                 out_metrics[list_names_to_use[i]] = val
 
                 if metric_logger is not None:
@@ -289,7 +289,7 @@ class Semantic_Segmentation_Workflow(Base_Workflow):
             Resulting targets.
         """
         # We do not use 'batch' input but in SSL workflow
-        return to_pytorch_format(targets, self.axis_order, self.device, dtype=self.loss_dtype)
+        return self.batch_to_device(targets, dtype=self.loss_dtype, is_mask=True)
 
     def after_merge_patches(self, pred):
         """
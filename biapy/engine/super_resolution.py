@@ -22,7 +22,7 @@ from biapy.data.post_processing.post_processing import (
     ensemble16_3d_predictions,
 )
 from biapy.utils.util import save_tif
-from biapy.utils.misc import to_pytorch_format, to_numpy_format, is_main_process
+from biapy.utils.misc import to_pytorch_format, to_numpy_format, is_main_process, nan_to_zero
 from biapy.engine.base_workflow import Base_Workflow
 from biapy.engine.metrics import dfcan_loss
 from biapy.data.pre_processing import (
@@ -218,7 +218,7 @@ class Super_resolution_Workflow(Base_Workflow):
                     raise NotImplementedError
 
                 if m_name in ["mse", "mae", "ssim", "psnr"]:
-                    val = val.item() if not torch.isnan(val) else 0
+                    val = nan_to_zero(val, to_host=metric_logger is None)
                     out_metrics[m_name] = val
 
                 if metric_logger is not None:
@@ -347,6 +347,7 @@ class Super_resolution_Workflow(Base_Workflow):
                 padding=pad,
                 overlap=ov,
                 verbose=self.cfg.TEST.VERBOSE,
+                blending=self.cfg.DATA.TEST.BLENDING,
             )
 
             if self.cfg.PROBLEM.NDIM == "3D":
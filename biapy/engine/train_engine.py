@@ -1,8 +1,9 @@
 import torch
 import math
 import sys
+import time
 
-from biapy.utils.misc import MetricLogger, SmoothedValue, all_reduce_mean
+from biapy.utils.misc import MetricLogger, SmoothedValue, StageTimer
 
 
 def train_one_epoch(
@@ -22,9 +23,11 @@ def train_one_epoch(
     lr_scheduler=None,
     start_steps=0,
     verbose=False,
+    stage_timer=None,
 ):
 
     model.train(True)
+    stage_timer = stage_timer if stage_timer is not None else StageTimer(enabled=False)
 
     # Ensure correct order of each epoch info by adding loss first
     metric_logger = MetricLogger(delimiter="  ", verbose=verbose)
@@ -35,7 +38,10 @@ def train_one_epoch(
 
     optimizer.zero_grad()
 
+    data_start = time.perf_counter()
     for step, (batch, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        voxels = math.prod(batch.shape[:-1])
+        stage_timer.record("data", data_start, items=voxels)
 
         # Apply warmup cosine decay scheduler if selected
         # (notice we use a per iteration (instead of per epoch) lr scheduler)
@@ -55,19 +61,25 @@ def train_one_epoch(
 
         # Pass the images through the model
         # TODO: control autocast and mixed precision
-        with torch.cuda.amp.autocast(enabled=False):
-            outputs = activations(model_call_func(batch, is_train=True), training=True)
-            loss = loss_function(outputs, targets)
-
-        loss_value = loss.item()
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
+        with stage_timer.stage("forward", items=voxels, sync=True):
+            with torch.cuda.amp.autocast(enabled=False):
+                outputs = activations(model_call_func(batch, is_train=True), training=True)
+                loss = loss_function(outputs, targets)
+
+        # The loss stays in the device and it is only checked when logging, so the host does not wait for the
+        # device every step
+        loss_value = loss.detach()
+        log_step = step % print_freq == 0 or step == len(data_loader) - 1
+        if log_step and not math.isfinite(loss_value.item()):
+            print("Loss is {}, stopping training".format(loss_value.item()))
             sys.exit(1)
 
         # Calculate the metrics
-        metric_function(outputs, targets, metric_logger=metric_logger)
+        with stage_timer.stage("metrics", items=voxels):
+            metric_function(outputs, targets, metric_logger=metric_logger)
 
         # Forward pass scaling the loss
+        backward_start = time.perf_counter()
         loss /= cfg.TRAIN.ACCUM_ITER
         if (step + 1) % cfg.TRAIN.ACCUM_ITER == 0:
             loss.backward()
@@ -75,15 +87,13 @@ def train_one_epoch(
             optimizer.zero_grad()
             if lr_scheduler is not None and cfg.TRAIN.LR_SCHEDULER.NAME == "onecycle":
                 lr_scheduler.step()
+        stage_timer.record("backward", backward_start, items=voxels, sync=True)
 
-        if device.type != "cpu":
-            getattr(torch, device.type).synchronize()
-
-        # Update loss in loggers
+        # Update loss in loggers. The values across processes are reduced once per epoch in
+        # synchronize_between_processes()
         metric_logger.update(loss=loss_value)
-        loss_value_reduce = all_reduce_mean(loss_value)
-        if log_writer is not None:
-            log_writer.update(loss=loss_value_reduce, head="loss")
+        if log_writer is not None and log_step:
+            log_writer.update(loss=loss_value, head="loss", step=it)
 
         # Update lr in loggers
         max_lr = 0.0
@@ -92,8 +102,9 @@ def train_one_epoch(
         if step == 0:
             metric_logger.add_meter("lr", SmoothedValue(window_size=1, fmt="{value:.6f}"))
         metric_logger.update(lr=max_lr)
-        if log_writer is not None:
-            log_writer.update(lr=max_lr, head="opt")
+        if log_writer is not None and log_step:
+            log_writer.update(lr=max_lr, head="opt", step=it)
+        data_start = time.perf_counter()
 
     # Gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -113,7 +124,9 @@ def evaluate(
     epoch,
     data_loader,
     lr_scheduler,
+    stage_timer=None,
 ):
+    stage_timer = stage_timer if stage_timer is not None else StageTimer(enabled=False)
 
     # Ensure correct order of each epoch info by adding loss first
     metric_logger = MetricLogger(delimiter="  ")
@@ -123,22 +136,28 @@ def evaluate(
     # Switch to evaluation mode
     model.eval()
 
+    data_start = time.perf_counter()
     for batch in metric_logger.log_every(data_loader, 10, header):
         # Gather inputs
         images = batch[0]
         targets = batch[1]
+        voxels = math.prod(images.shape[:-1])
+        stage_timer.record("val_data", data_start, items=voxels)
         targets = prepare_targets(targets, images)
 
         # Pass the images through the model
         # TODO: control autocast and mixed precision
-        with torch.cuda.amp.autocast(enabled=False):
-            outputs = activations(model_call_func(images, is_train=True), training=True)
-            loss = loss_function(outputs, targets)
+        with stage_timer.stage("val_forward", items=voxels, sync=True):
+            with torch.cuda.amp.autocast(enabled=False):
+                outputs = activations(model_call_func(images, is_train=True), training=True)
+                loss = loss_function(outputs, targets)
 
         # Calculate the metrics
-        metric_function(outputs, targets, metric_logger=metric_logger)
+        with stage_timer.stage("val_metrics", items=voxels):
+            metric_function(outputs, targets, metric_logger=metric_logger)
 
-        metric_logger.update(loss=loss.item())
+        metric_logger.update(loss=loss.detach())
+        data_start = time.perf_counter()
 
     # Gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -1,10 +1,14 @@
 import importlib
 import os
+import time
+from functools import partial
+from contextlib import contextmanager, nullcontext
 import json
 from pathlib import Path
 import pooch
 import yaml
 import torch
+import torch.utils.checkpoint
 import numpy as np
 import torch.nn as nn
 from torchinfo import summary
@@ -25,7 +29,7 @@ from bioimageio.spec._internal.types import ImportantFileSource
 from biapy.config.config import Config
 
 
-def build_model(cfg, job_identifier, device):
+def build_model(cfg, job_identifier, device, show_summary=True):
     """
     Build selected model
 
@@ -40,6 +44,10 @@ def build_model(cfg, job_identifier, device):
     device : Torch device
         Using device. Most commonly "cpu" or "cuda" for GPU, but also potentially "mps",
         "xpu", "xla" or "meta".
+
+    show_summary : bool, optional
+        Whether to print the summary of the model or not.
+
     Returns
     -------
     model : Keras model
@@ -260,6 +268,9 @@ def build_model(cfg, job_identifier, device):
             )
             model = MaskedAutoencoderViT(**args)
             callable_model = MaskedAutoencoderViT
+    if cfg.MODEL.ACTIVATION_CHECKPOINTING:
+        set_activation_checkpointing(model, modelname)
+
     # Check the network created
     model.to(device)
     if cfg.PROBLEM.NDIM == "2D":
@@ -277,19 +288,217 @@ def build_model(cfg, job_identifier, device):
             cfg.DATA.PATCH_SIZE[1],
             cfg.DATA.PATCH_SIZE[2],
         )
-    summary(
-        model,
-        input_size=sample_size,
-        col_names=("input_size", "output_size", "num_params"),
-        depth=10,
-        device=device.type,
-    )
+    if show_summary:
+        summary(
+            model,
+            input_size=sample_size,
+            col_names=("input_size", "output_size", "num_params"),
+            depth=10,
+            device=device.type,
+        )
 
     model_file += ":" + str(callable_model.__name__)
     model_name = model_file.rsplit(":", 1)[-1]
     return model, model_file, model_name, args
 
 
+def set_activation_checkpointing(model, modelname):
+    """
+    Enable activation checkpointing on each encoder/decoder level (U-Net like models) or transformer block
+    (``unetr``, ``mae`` and ``vit``) of the model. The activations inside those modules are not stored during training
+    but recomputed in the backward pass. The forward of each module is replaced in place, so the ``state_dict`` of the
+    model does not change. The running statistics of the batch normalization layers inside checkpointed modules are
+    restored after the recomputation, so they are updated once per step as without checkpointing.
+
+    Parameters
+    ----------
+    model : Torch model
+        Model to modify.
+
+    modelname : str
+        Name of the architecture. E.g. ``'unet'``.
+    """
+    if modelname in ["unet", "resunet", "attention_unet", "seunet"]:
+        modules = list(model.down_path) + [model.bottleneck] + list(model.up_path)
+    elif modelname == "multiresunet":
+        modules = [getattr(model, "multiresblock{}".format(i)) for i in range(1, 10)]
+        modules += [getattr(model, "respath{}".format(i)) for i in range(1, 5)]
+    elif modelname == "unetr":
+        modules = list(model.blocks) + list(model.mid_blue_block) + list(model.up_green_layers)
+    elif modelname == "mae":
+        modules = list(model.blocks) + list(model.decoder_blocks)
+    elif modelname == "vit":
+        modules = list(model.blocks)
+    else:
+        raise ValueError("Activation checkpointing not available for '{}'".format(modelname))
+
+    def checkpointed_forward(module, forward, *args, **kwargs):
+        if module.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(
+                forward,
+                *args,
+                use_reentrant=False,
+                context_fn=lambda: (nullcontext(), preserve_batchnorm_stats(module)),
+                **kwargs,
+            )
+        return forward(*args, **kwargs)
+
+    for module in modules:
+        module.forward = partial(checkpointed_forward, module, module.forward)
+    print("Activation checkpointing enabled in {} modules".format(len(modules)))
+
+
+@contextmanager
+def preserve_batchnorm_stats(module):
+    """
+    Restore, on exit, the running statistics of the batch normalization layers of ``module``. Used while the forward
+    of a checkpointed module is recomputed so those statistics are not updated twice.
+
+    Parameters
+    ----------
+    module : Torch module
+        Module whose batch normalization layers are preserved.
+    """
+    bn_layers = [
+        m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats
+    ]
+    saved = [{k: v.clone() for k, v in m.named_buffers(recurse=False) if v is not None} for m in bn_layers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, buffers in zip(bn_layers, saved):
+                for k, v in buffers.items():
+                    getattr(m, k).copy_(v)
+
+
+def find_patch_and_batch_size(
+    cfg,
+    device,
+    memory_budget,
+    patch_sizes,
+    batch_sizes,
+    steps=3,
+):
+    """
+    Choose the patch and batch size to train with under a memory budget. For each candidate dry-run training steps
+    (forward, backward and optimizer step) are made with random data to measure the peak memory and the time per step,
+    and the configuration with the highest throughput (voxels per second) among those that fit is selected. The model
+    is built as :func:`build_model` does, so ``MODEL.ACTIVATION_CHECKPOINTING`` is taken into account, and the optimizer
+    as in training (``TRAIN.OPTIMIZER``), so its state (e.g. the moment buffers of Adam) is included in the peak.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        Configuration.
+
+    device : Torch device
+        Device to measure on. Only CUDA devices are supported.
+
+    memory_budget : float
+        Memory available, in GB.
+
+    patch_sizes : List of tuples
+        Candidate patch sizes, in ``DATA.PATCH_SIZE`` format. E.g. ``[(64, 128, 128, 1), (96, 192, 192, 1)]``.
+
+    batch_sizes : List of ints
+        Candidate batch sizes. E.g. ``[1, 2, 4]``.
+
+    steps : int, optional
+        Number of measured steps per candidate, after one warm-up step that allocates the optimizer state. Must be 1 or
+        greater.
+
+    Returns
+    -------
+    best : dict
+        Selected configuration with ``patch_size``, ``batch_size``, ``peak_memory`` (GB) and ``throughput``
+        (voxels/s). ``None`` if no candidate fits.
+
+    results : List of dicts
+        Measurements of all the candidates. The ones that did not fit have ``peak_memory`` set to ``None``.
+    """
+    if device.type != "cuda":
+        raise ValueError("Peak memory can only be measured on CUDA devices")
+    if steps < 1:
+        raise ValueError("'steps' must be 1 or greater")
+    from biapy.engine import prepare_optimizer
+
+    def dry_run_losses(out):
+        # Mean of each output that requires grad
+        if torch.is_tensor(out):
+            return [out.float().mean()] if out.requires_grad else []
+        if isinstance(out, dict):
+            out = list(out.values())
+        if isinstance(out, (list, tuple)):
+            return [loss for o in out for loss in dry_run_losses(o)]
+        return []
+
+    def dry_run_step(model, optimizer, x):
+        optimizer.zero_grad(set_to_none=True)
+        losses = dry_run_losses(model(x))
+        if len(losses) == 0:
+            raise ValueError("None of the model outputs requires grad, so no backward pass can be measured")
+        sum(losses).backward()
+        optimizer.step()
+
+    results = []
+    for patch_size in patch_sizes:
+        _cfg = cfg.clone()
+        _cfg.defrost()
+        _cfg.DATA.PATCH_SIZE = tuple(patch_size)
+        model = build_model(_cfg, "", device, show_summary=False)[0]
+        model.train()
+        optimizer = prepare_optimizer(_cfg, model, steps_per_epoch=1)[0]
+        for batch_size in batch_sizes:
+            x = torch.rand((batch_size, patch_size[-1]) + tuple(patch_size[:-1]), device=device)
+            peak, step_time = None, None
+            try:
+                torch.cuda.empty_cache()
+                # Warm-up step. It also allocates the optimizer state, which is kept in the measured steps
+                dry_run_step(model, optimizer, x)
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+                start = time.time()
+                for _ in range(steps):
+                    dry_run_step(model, optimizer, x)
+                torch.cuda.synchronize(device)
+                step_time = (time.time() - start) / steps
+                peak = torch.cuda.max_memory_allocated(device) / 1024**3
+            except torch.cuda.OutOfMemoryError:
+                pass
+            optimizer.zero_grad(set_to_none=True)
+            del x
+            torch.cuda.empty_cache()
+
+            fits = peak is not None and peak <= memory_budget
+            results.append(
+                {
+                    "patch_size": tuple(patch_size),
+                    "batch_size": batch_size,
+                    "peak_memory": peak,
+                    "throughput": batch_size * np.prod(patch_size[:-1]) / step_time if fits else 0,
+                }
+            )
+            print(
+                "Patch size {} - batch size {}: {}".format(
+                    patch_size,
+                    batch_size,
+                    (
+                        "{:.2f}GB, {:.0f} voxels/s".format(peak, results[-1]["throughput"])
+                        if fits
+                        else "does not fit in {}GB".format(memory_budget)
+                    ),
+                )
+            )
+        del model, optimizer
+
+    fitting = [r for r in results if r["throughput"] > 0]
+    best = max(fitting, key=lambda r: r["throughput"]) if len(fitting) > 0 else None
+    if best is not None:
+        print("Selected patch size {} and batch size {}".format(best["patch_size"], best["batch_size"]))
+    return best, results
+
+
 def build_bmz_model(cfg: type[Config], model: ModelDescr_v0_4 | ModelDescr_v0_5, device: type[torch.device]):
     """
     Build a model from Bioimage Model Zoo (BMZ).
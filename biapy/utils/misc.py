@@ -1,6 +1,8 @@
 import os
+import json
 import builtins
 import time
+import contextlib
 import glob
 import random
 import datetime
@@ -263,11 +265,30 @@ def all_reduce_mean(x):
         return x
 
 
-def to_pytorch_format(x, axis_order, device, dtype=torch.float32):
-    if torch.is_tensor(x):
-        return x.to(dtype).permute(axis_order).to(device, non_blocking=True)
-    else:
-        return torch.from_numpy(x).to(dtype).permute(axis_order).to(device, non_blocking=True)
+def nan_to_zero(val, to_host=True):
+    # NaN metric values are counted as 0. With 'to_host' disabled the value stays in the device so no synchronization
+    # is forced
+    if to_host:
+        return val.item() if not torch.isnan(val) else 0
+    val = val.detach()
+    return torch.where(torch.isnan(val), torch.zeros_like(val), val)
+
+
+def to_pytorch_format(x, axis_order, device, dtype=torch.float32, norm_dict=None):
+    # The data is copied in its original dtype (e.g. uint8/uint16) and the cast, permutation and normalization (if
+    # 'norm_dict' is provided) are done on the device. The copy is asynchronous when 'x' is already in pinned memory,
+    # as the DataLoader batches are with 'SYSTEM.PIN_MEM'. Other arrays are not pinned here, as for large inference
+    # volumes that would be an extra full-size synchronous copy in the host
+    if not torch.is_tensor(x):
+        if x.dtype == np.uint16 and not hasattr(torch, "uint16"):
+            x = x.astype(np.int32)
+        x = torch.from_numpy(x)
+    x = x.to(device, non_blocking=True).permute(axis_order)
+    if norm_dict is not None:
+        from biapy.data.pre_processing import normalize_on_device
+
+        return normalize_on_device(x, norm_dict, dtype=dtype)
+    return x.to(dtype)
 
 
 def to_numpy_format(x, axis_order_back):
@@ -347,7 +368,9 @@ class TensorboardLogger(object):
 class SmoothedValue(object):
     """
     Track a series of values and provide access to smoothed values over a
-    window or the global series average.
+    window or the global series average. Tensor values are accumulated in
+    their device and only moved to the host when the meter is read, so
+    updating it does not force a synchronization.
     """
 
     def __init__(self, window_size=20, fmt=None):
@@ -359,14 +382,33 @@ class SmoothedValue(object):
         self.fmt = fmt
 
     def update(self, value, n=1):
+        if torch.is_tensor(value):
+            value = value.detach()
         self.deque.append(value)
         self.count += n
         self.total += value * n
 
+    def to_host(self):
+        """
+        Move the pending device values to the host with a single synchronization.
+        """
+        idx = [i for i, v in enumerate(self.deque) if torch.is_tensor(v)]
+        tensors = [self.deque[i] for i in idx]
+        if torch.is_tensor(self.total):
+            tensors.append(self.total)
+        if len(tensors) == 0:
+            return
+        values = torch.stack([t.float().reshape(()) for t in tensors]).tolist()
+        if torch.is_tensor(self.total):
+            self.total = values.pop()
+        for i, v in zip(idx, values):
+            self.deque[i] = v
+
     def synchronize_between_processes(self):
         """
         Warning: does not synchronize the deque!
         """
+        self.to_host()
         if not is_dist_avail_and_initialized():
             return
         t = torch.tensor([self.count, self.total], dtype=torch.float64, device="cuda")
@@ -378,24 +420,29 @@ class SmoothedValue(object):
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        # Lower median, as torch.median
+        self.to_host()
+        d = sorted(self.deque)
+        return d[(len(d) - 1) // 2]
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        self.to_host()
+        return sum(self.deque) / len(self.deque)
 
     @property
     def global_avg(self):
+        self.to_host()
         return self.total / self.count
 
     @property
     def max(self):
+        self.to_host()
         return max(self.deque)
 
     @property
     def value(self):
+        self.to_host()
         return self.deque[-1]
 
     def __str__(self):
@@ -419,8 +466,9 @@ class MetricLogger(object):
             if v is None:
                 continue
             if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+                v = v.detach()
+            else:
+                assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
     def __getattr__(self, attr):
@@ -494,3 +542,154 @@ class MetricLogger(object):
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print("{} Total time: {} ({:.4f} s / it)".format(header, total_time_str, total_time / len(iterable)))
+
+
+class StageTimer(object):
+    def __init__(self, enabled=True, max_trace_events=500000):
+        """
+        Record the wall time and the number of items (e.g. voxels) processed by each stage of a run, so a summary
+        table and a Chrome trace (to be opened in ``chrome://tracing`` or Perfetto) can be created at the end.
+
+        Parameters
+        ----------
+        enabled : bool, optional
+            Whether to record anything. If ``False`` all the methods do nothing.
+
+        max_trace_events : int, optional
+            Maximum number of events kept for the trace. Once reached, the stages are still added to the summary.
+        """
+        self.enabled = enabled
+        self.max_trace_events = max_trace_events
+        self.totals = {}
+        self.events = []
+        self.dropped_events = 0
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0, sync=False):
+        """
+        Record the code run within the context as ``name`` stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage. E.g. ``forward``.
+
+        items : int, optional
+            Number of items processed, to calculate the throughput.
+
+        sync : bool, optional
+            Wait for CUDA kernels to finish before stopping the clock. Needed to measure GPU stages.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, items=items, sync=sync)
+
+    def record(self, name, start, items=0, sync=False):
+        """
+        Record a stage that started at ``start`` and finishes now.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage. E.g. ``forward``.
+
+        start : float
+            Start time of the stage, taken with ``time.perf_counter()``.
+
+        items : int, optional
+            Number of items processed, to calculate the throughput.
+
+        sync : bool, optional
+            Wait for CUDA kernels to finish before stopping the clock. Needed to measure GPU stages.
+        """
+        if not self.enabled:
+            return
+        if sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        duration = time.perf_counter() - start
+
+        if name not in self.totals:
+            self.totals[name] = {"calls": 0, "time": 0.0, "items": 0}
+        self.totals[name]["calls"] += 1
+        self.totals[name]["time"] += duration
+        self.totals[name]["items"] += int(items)
+
+        if len(self.events) < self.max_trace_events:
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": get_rank(),
+                    "tid": 0,
+                    "args": {"items": int(items)},
+                }
+            )
+        else:
+            self.dropped_events += 1
+
+    def summary(self, items_name="voxels"):
+        """
+        Create a table with the calls, total and mean time, share of the wall time and throughput of each stage.
+
+        Parameters
+        ----------
+        items_name : str, optional
+            Name of the items processed, used in the throughput column.
+
+        Returns
+        -------
+        table : str
+            Summary table.
+        """
+        wall_time = time.perf_counter() - self.origin
+        header = "{:<20} {:>8} {:>12} {:>7} {:>12} {:>16}".format(
+            "Stage", "Calls", "Total (s)", "%", "Mean (ms)", items_name + "/s"
+        )
+        lines = [header, "-" * len(header)]
+        for name, t in self.totals.items():
+            lines.append(
+                "{:<20} {:>8} {:>12.2f} {:>7.1f} {:>12.2f} {:>16}".format(
+                    name,
+                    t["calls"],
+                    t["time"],
+                    100 * t["time"] / wall_time if wall_time > 0 else 0,
+                    1000 * t["time"] / t["calls"],
+                    "{:.4g}".format(t["items"] / t["time"]) if t["items"] > 0 and t["time"] > 0 else "-",
+                )
+            )
+        lines.append("-" * len(header))
+        lines.append("Wall time: {:.2f} s".format(wall_time))
+        return "\n".join(lines)
+
+    def save(self, out_dir, prefix):
+        """
+        Print the summary table and save it, together with the Chrome trace, in ``out_dir``.
+
+        Parameters
+        ----------
+        out_dir : str
+            Directory to save the files into.
+
+        prefix : str
+            Prefix of the files. E.g. ``test``, that creates ``test_stage_summary.txt`` and ``test_stage_trace.json``.
+        """
+        if not self.enabled or len(self.totals) == 0:
+            return
+        table = self.summary()
+        print("Time spent in each stage:")
+        print(table)
+
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, prefix + "_stage_summary.txt"), "w") as f:
+            f.write(table + "\n")
+        trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+        if self.dropped_events > 0:
+            trace["otherData"] = {"dropped_events": self.dropped_events}
+        with open(os.path.join(out_dir, prefix + "_stage_trace.json"), "w") as f:
+            json.dump(trace, f)
+        print("Stage timing saved in {}".format(out_dir))
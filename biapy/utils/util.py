@@ -455,18 +455,24 @@ def save_img(
                     im.save(f)
 
 
-def make_weight_map(label, binary=True, w0=10, sigma=5):
+def make_weight_map(label, binary=True, w0=10, sigma=5, ndim=2):
     """
     Generates a weight map in order to make the U-Net learn better the borders of cells and distinguish individual
     cells that are tightly packed. These weight maps follow the methodology of the original U-Net paper.
 
     Based on `unet/py_files/helpers.py <https://github.com/deepimagej/python4deepimagej/blob/499955a264e1b66c4ed2c014cb139289be0e98a4/unet/py_files/helpers.py>`_.
 
+    The distances to the closest (``d1``) and second closest (``d2``) objects are computed without one distance
+    transform per object over the whole image: ``d1`` comes from a single distance transform of the background, and
+    ``d2`` from a distance transform per object, with that object masked out, only within its bounding box dilated by
+    the distance where the weight drops below ``w0 * 1e-6``. Background further than that from any pair of objects
+    gets no border weight.
+
     Parameters
     ----------
 
-    label : 3D numpy array
-       Corresponds to a label image. E.g. ``(y, x, channels)``.
+    label : 3D/4D numpy array
+       Corresponds to a label image. E.g. ``(y, x, channels)`` for 2D or ``(z, y, x, channels)`` for 3D.
 
     binary : bool, optional
        Corresponds to whether or not the labels are binary.
@@ -477,6 +483,14 @@ def make_weight_map(label, binary=True, w0=10, sigma=5):
     sigma : int, optional
        Represents the standard deviation of the Gaussian used for the weight map.
 
+    ndim : int, optional
+       Number of spatial dimensions of ``label``. Use ``3`` for volumes.
+
+    Returns
+    -------
+    map_weight : 2D/3D numpy array
+       Weight map. E.g. ``(y, x)`` for 2D or ``(z, y, x)`` for 3D.
+
     Examples
     --------
 
@@ -490,71 +504,64 @@ def make_weight_map(label, binary=True, w0=10, sigma=5):
 
     # Initialization.
     lab = np.array(label)
-    lab_multi = lab
-
-    if len(lab.shape) == 3:
-        lab = lab[:, :, 0]
-
-    # Get shape of label.
-    rows, cols = lab.shape
+    if lab.ndim == ndim + 1:
+        lab = lab[..., 0]
 
     if binary:
-
         # Converts the label into a binary image with background = 0
-        # and cells = 1.
+        # and cells = 1, and labels each object (cell) separately.
         lab[lab == 255] = 1
-
-        # Builds w_c which is the class balancing map. In our case, we want
-        # cells to have weight 2 as they are more important than background
-        # which is assigned weight 1.
-        w_c = np.array(lab, dtype=float)
-        w_c[w_c == 1] = 1
-        w_c[w_c == 0] = 0.5
-
-        # Converts the labels to have one class per object (cell).
-        lab_multi = measure.label(lab, neighbors=8, background=0)
+        lab_multi = measure.label(lab, connectivity=ndim, background=0)
     else:
-
-        # Converts the label into a binary image with background = 0.
-        # and cells = 1.
+        # Labels are already one class per object (cell).
+        lab_multi = lab.astype(np.int64, copy=True)
         lab[lab > 0] = 1
 
-        # Builds w_c which is the class balancing map. In our case, we want
-        # cells to have weight 2 as they are more important than background
-        # which is assigned weight 1.
-        w_c = np.array(lab, dtype=float)
-        w_c[w_c == 1] = 1
-        w_c[w_c == 0] = 0.5
-    components = np.unique(lab_multi)
-
-    n_comp = len(components) - 1
-
-    maps = np.zeros((n_comp, rows, cols))
-
-    map_weight = np.zeros((rows, cols))
-
-    if n_comp >= 2:
-        for i in range(n_comp):
-
-            # Only keeps current object.
-            tmp = lab_multi == components[i + 1]
-
-            # Invert tmp so that it can have the correct distance.
-            # transform
-            tmp = ~tmp
-
-            # For each pixel, computes the distance transform to
-            # each object.
-            maps[i][:][:] = scipy.ndimage.distance_transform_edt(tmp)
-
-        maps = np.sort(maps, axis=0)
+    # Builds w_c which is the class balancing map. In our case, we want
+    # cells to have weight 2 as they are more important than background
+    # which is assigned weight 1.
+    w_c = np.array(lab, dtype=float)
+    w_c[w_c == 0] = 0.5
 
-        # Get distance to the closest object (d1) and the distance to the second
-        # object (d2).
-        d1 = maps[0][:][:]
-        d2 = maps[1][:][:]
+    map_weight = np.zeros(lab.shape)
 
-        map_weight = w0 * np.exp(-((d1 + d2) ** 2) / (2 * (sigma**2))) * (lab == 0).astype(int)
+    components = np.unique(lab_multi)
+    n_comp = len(components) - 1 if components[0] == 0 else len(components)
+
+    if n_comp >= 2 and w0 > 0:
+        background = lab_multi == 0
+
+        # Distance to the closest object (d1) and which object it is.
+        d1, indices = scipy.ndimage.distance_transform_edt(background, return_indices=True)
+        nearest = lab_multi[tuple(indices)]
+        del indices
+
+        # Border weight is below w0 * 1e-6 when d1 + d2 is over this distance, so the second closest object only
+        # needs to be searched within it.
+        max_dist = sigma * math.sqrt(2 * math.log(1e6))
+        margin = int(math.ceil(max_dist))
+
+        # Distance to the second closest object (d2). For the background whose closest object is 'obj', it is the
+        # distance to the rest of objects, computed within the bounding box of 'obj' dilated by 'margin'.
+        d2 = np.full(lab.shape, np.inf)
+        for obj, obj_slices in enumerate(scipy.ndimage.find_objects(lab_multi), start=1):
+            if obj_slices is None:
+                continue
+            box = tuple(
+                slice(max(sl.start - margin, 0), min(sl.stop + margin, size))
+                for sl, size in zip(obj_slices, lab.shape)
+            )
+            box_lab = lab_multi[box]
+            others = (box_lab == 0) | (box_lab == obj)
+            if others.all():
+                continue
+            pixels = (nearest[box] == obj) & background[box] & (d1[box] < max_dist)
+            if not pixels.any():
+                continue
+            box_d2 = d2[box]
+            box_d2[pixels] = scipy.ndimage.distance_transform_edt(others)[pixels]
+
+        map_weight = w0 * np.exp(-((d1 + d2) ** 2) / (2 * (sigma**2))) * background
 
     map_weight += w_c
 
@@ -1108,9 +1115,20 @@ def load_data_from_dir(
     if preprocess_f != None:
         if is_mask:
             # data contains masks
-            data = preprocess_f(preprocess_cfg, y_data=data, is_2d=True, is_y_mask=is_mask)
+            data = preprocess_f(
+                preprocess_cfg,
+                y_data=data,
+                is_2d=True,
+                is_y_mask=is_mask,
+                filenames=[os.path.join(data_dir, f) for f in filenames],
+            )
         else:
-            data = preprocess_f(preprocess_cfg, x_data=data, is_2d=True)
+            data = preprocess_f(
+                preprocess_cfg,
+                x_data=data,
+                is_2d=True,
+                filenames=[os.path.join(data_dir, f) for f in filenames],
+            )
 
         _data = []
         for img_num in range(len(data)):
@@ -1429,9 +1447,20 @@ def load_3d_images_from_dir(
     if preprocess_f != None:
         if is_mask:
             # data contains masks
-            data = preprocess_f(preprocess_cfg, y_data=data, is_2d=False, is_y_mask=is_mask)
+            data = preprocess_f(
+                preprocess_cfg,
+                y_data=data,
+                is_2d=False,
+                is_y_mask=is_mask,
+                filenames=[os.path.join(data_dir, f) for f in filenames],
+            )
         else:
-            data = preprocess_f(preprocess_cfg, x_data=data, is_2d=False)
+            data = preprocess_f(
+                preprocess_cfg,
+                x_data=data,
+                is_2d=False,
+                filenames=[os.path.join(data_dir, f) for f in filenames],
+            )
 
         _data = []
         for img_num in range(len(data)):
@@ -1665,6 +1694,11 @@ def data_range(x):
 def read_chunked_data(filename):
     if isinstance(filename, str):
         if filename.endswith(".hdf5") or filename.endswith(".h5"):
+            # Registers the filters needed to read H5 files compressed with Blosc (see chunked_dataset_kwargs)
+            try:
+                import hdf5plugin  # noqa: F401
+            except ImportError:
+                pass
             fid = h5py.File(filename, "r")
             data = fid[list(fid)[0]]
         elif filename.endswith(".zarr"):
@@ -1715,7 +1749,129 @@ def read_chunked_nested_data(zarrfile, data_path=""):
     return fid, data
 
 
-def write_chunked_data(data, data_dir, filename, dtype_str="float32", verbose=True):
+def get_chunked_data_options(cfg):
+    """
+    Storage options of the H5/Zarr files written, taken from ``TEST.BY_CHUNKS`` configuration. To be passed to
+    :func:`write_chunked_data` or :func:`chunked_dataset_kwargs`.
+
+    Parameters
+    ----------
+    cfg : YACS CN object
+        Configuration.
+
+    Returns
+    -------
+    options : dict
+        Patch size, compression codec, compression level and number of compression threads.
+    """
+    return {
+        "patch_size": cfg.DATA.PATCH_SIZE,
+        "compression": cfg.TEST.BY_CHUNKS.COMPRESSION,
+        "compression_level": cfg.TEST.BY_CHUNKS.COMPRESSION_LEVEL,
+        "num_threads": cfg.TEST.BY_CHUNKS.COMPRESSION_THREADS,
+    }
+
+
+def chunked_dataset_kwargs(
+    file_type,
+    shape,
+    axes_order,
+    patch_size=None,
+    compression="default",
+    compression_level=5,
+    num_threads=0,
+):
+    """
+    Keyword arguments to create a dataset with ``create_dataset`` of H5/Zarr files: chunk shape and compression.
+
+    Parameters
+    ----------
+    file_type : str
+        Type of the file. One between ``'h5'`` and ``'zarr'``.
+
+    shape : tuple of ints
+        Shape of the dataset to create.
+
+    axes_order : str
+        Axes order of the dataset. E.g. ``TZCYX``.
+
+    patch_size : tuple of ints, optional
+        Size of the patches written into the dataset. E.g. ``(z, y, x, channels)`` or ``(y, x, channels)``. The chunks
+        span a patch in ``Z``, ``Y`` and ``X`` axes, all channels and one ``T`` position. If not provided the chunk
+        shape is chosen by H5/Zarr.
+
+    compression : str, optional
+        Codec to compress the data with. One between ``'default'``, ``'blosc-lz4'``, ``'blosc-zstd'``, ``'gzip'`` and
+        ``'none'``. ``'default'`` is ``'gzip'`` in H5 files, readable by any HDF5 tool, and ``'blosc-lz4'`` in Zarr
+        files. Blosc codecs in H5 files need ``hdf5plugin`` package, otherwise ``'gzip'`` is used instead.
+
+    compression_level : int, optional
+        Compression level, from 0 to 9.
+
+    num_threads : int, optional
+        Number of threads used by Blosc to compress each chunk of Zarr files. ``0`` means all the cores available.
+
+    Returns
+    -------
+    kwargs : dict
+        Keyword arguments for ``create_dataset``.
+    """
+    chunks = None
+    if patch_size is not None:
+        sizes = {"Y": patch_size[-3], "X": patch_size[-2], "Z": patch_size[0] if len(patch_size) == 4 else 1, "T": 1}
+        chunks = tuple(max(1, min(int(sizes.get(a, s)), s)) for a, s in zip(axes_order, shape))
+
+    if compression == "default":
+        compression = "gzip" if file_type == "h5" else "blosc-lz4"
+
+    if file_type == "h5":
+        kwargs = {"chunks": chunks if chunks is not None else True}
+        if compression == "gzip":
+            kwargs.update({"compression": "gzip", "compression_opts": compression_level})
+        elif compression.startswith("blosc"):
+            try:
+                import hdf5plugin
+
+                kwargs.update(
+                    hdf5plugin.Blosc(
+                        cname=compression.split("-")[1],
+                        clevel=compression_level,
+                        shuffle=hdf5plugin.Blosc.SHUFFLE,
+                    )
+                )
+            except ImportError:
+                print(
+                    f"WARNING: 'hdf5plugin' is not installed so '{compression}' can not be used. Using 'gzip' instead"
+                )
+                kwargs.update({"compression": "gzip", "compression_opts": compression_level})
+    else:
+        from numcodecs import Blosc, GZip, blosc
+
+        if compression.startswith("blosc"):
+            blosc.set_nthreads(num_threads if num_threads > 0 else (os.cpu_count() or 1))
+            compressor = Blosc(cname=compression.split("-")[1], clevel=compression_level, shuffle=Blosc.SHUFFLE)
+        elif compression == "gzip":
+            compressor = GZip(level=compression_level)
+        else:
+            compressor = None
+        kwargs = {"compressor": compressor}
+        if chunks is not None:
+            kwargs["chunks"] = chunks
+
+    return kwargs
+
+
+def write_chunked_data(
+    data,
+    data_dir,
+    filename,
+    dtype_str="float32",
+    verbose=True,
+    patch_size=None,
+    compression="default",
+    compression_level=5,
+    num_threads=0,
+):
     """
     Save images in the given directory.
 
@@ -1735,6 +1891,18 @@ def write_chunked_data(data, data_dir, filename, dtype_str="float32", verbose=Tr
 
     verbose : bool, optional
         To print saving information.
+
+    patch_size : tuple of ints, optional
+        Patch size the chunks are derived from. See :func:`chunked_dataset_kwargs`.
+
+    compression : str, optional
+        Codec to compress the data with. See :func:`chunked_dataset_kwargs`.
+
+    compression_level : int, optional
+        Compression level, from 0 to 9.
+
+    num_threads : int, optional
+        Number of threads used by Blosc to compress Zarr files. ``0`` means all the cores available.
     """
     if data.ndim != 5:
         raise ValueError(f"Expected data needs to have 5 dimensions (in 'TZYXC' order). Given data shape: {data.shape}")
@@ -1748,13 +1916,178 @@ def write_chunked_data(data, data_dir, filename, dtype_str="float32", verbose=Tr
 
     os.makedirs(data_dir, exist_ok=True)
 
-    if ext in [".hdf5", ".h5"]:
+    file_type = "h5" if ext in [".hdf5", ".h5"] else "zarr"
+    kwargs = chunked_dataset_kwargs(
+        file_type,
+        data.shape,
+        "TZCYX",
+        patch_size=patch_size,
+        compression=compression,
+        compression_level=compression_level,
+        num_threads=num_threads,
+    )
+    if file_type == "h5":
         fid = h5py.File(os.path.join(data_dir, filename), "w")
-        data = fid.create_dataset("data", data=data, dtype=dtype_str, compression="gzip")
+        data = fid.create_dataset("data", data=data, dtype=dtype_str, **kwargs)
+        fid.close()
     # Zarr
     else:
         fid = zarr.open_group(os.path.join(data_dir, filename), mode="w")
-        data = fid.create_dataset("data", data=data, dtype=dtype_str)
+        data = fid.create_dataset("data", data=data, dtype=dtype_str, **kwargs)
+
+
+def downsample_mean(data, factors):
+    """
+    Downsample ``data`` by averaging non-overlapping windows. The data is padded with its edge values when its shape
+    is not divisible by the factors.
+
+    Parameters
+    ----------
+    data : Numpy array
+        Data to downsample.
+
+    factors : List of ints
+        Downsampling factor of each axis of ``data``.
+
+    Returns
+    -------
+    data : Numpy array
+        Downsampled data, of the same dtype as the input.
+    """
+    pad = [(0, -s % f) for s, f in zip(data.shape, factors)]
+    padded = np.pad(data, pad, mode="edge") if any(p[1] > 0 for p in pad) else data
+    shape = []
+    for s, f in zip(padded.shape, factors):
+        shape.extend([s // f, f])
+    out = padded.reshape(shape).mean(axis=tuple(range(1, 2 * data.ndim, 2)), dtype=np.float32)
+    if np.issubdtype(data.dtype, np.integer):
+        out = np.rint(out)
+    return out.astype(data.dtype)
+
+
+class MultiscalePyramid:
+    def __init__(self, group, data, axes_order, levels=3, downscale=(1, 2, 2), name="", **storage_options):
+        """
+        Downsampled levels of a Zarr array, built block by block while its full resolution data is written, so the
+        Zarr group becomes an OME-Zarr multiscale image. The levels are stored next to ``data`` as ``data_s1``,
+        ``data_s2``, etc. Each voxel of a level is the mean of the full resolution voxels it covers.
+
+        Parameters
+        ----------
+        group : Zarr group
+            Group that contains ``data``. The levels and the ``multiscales`` metadata are written in it.
+
+        data : Zarr array
+            Full resolution array. It must be named ``data``.
+
+        axes_order : str
+            Axes order of ``data``. E.g. ``TZCYX``.
+
+        levels : int, optional
+            Number of downsampled levels.
+
+        downscale : List of ints, optional
+            Downsampling factor between consecutive levels in ``(z, y, x)``.
+
+        name : str, optional
+            Name of the image stored in the metadata.
+
+        storage_options : dict, optional
+            Patch size and compression options of the levels. See :func:`chunked_dataset_kwargs`.
+        """
+        self.axes_order = axes_order
+        # T axis is always indexed with an integer when writing, so blocks do not have it
+        self.block_axes = axes_order.replace("T", "")
+        self.z_size = order_dimensions(data.shape, axes_order, "ZYXC")[0]
+        self.factors = []
+        self.levels = []
+        datasets = [{"path": "data", "coordinateTransformations": [{"type": "scale", "scale": [1.0] * data.ndim}]}]
+        for l in range(1, levels + 1):
+            factors = {"Z": downscale[0] ** l, "Y": downscale[1] ** l, "X": downscale[2] ** l}
+            shape = tuple(math.ceil(s / factors.get(a, 1)) for a, s in zip(axes_order, data.shape))
+            self.levels.append(
+                group.create_dataset(
+                    f"data_s{l}",
+                    shape=shape,
+                    dtype=data.dtype,
+                    **chunked_dataset_kwargs("zarr", shape, axes_order, **storage_options),
+                )
+            )
+            self.factors.append(factors)
+            datasets.append(
+                {
+                    "path": f"data_s{l}",
+                    "coordinateTransformations": [
+                        {"type": "scale", "scale": [float(factors.get(a, 1)) for a in axes_order]}
+                    ],
+                }
+            )
+        # Blocks need to start in multiples of the coarsest factors so each level voxel is computed from one block
+        self.alignment = [self.factors[-1][a] for a in "ZYX"] if levels > 0 else [1, 1, 1]
+        self._pending = None
+        self._pending_start = 0
+
+        axes_type = {"T": "time", "C": "channel"}
+        group.attrs["multiscales"] = [
+            {
+                "version": "0.4",
+                "name": name,
+                "axes": [{"name": a.lower(), "type": axes_type.get(a, "space")} for a in axes_order],
+                "datasets": datasets,
+                "type": "mean",
+                "metadata": {"description": "Local mean", "downscale": list(downscale)},
+            }
+        ]
+
+    def write(self, block, slices):
+        """
+        Write the downsampled versions of a block of the full resolution data into each level.
+
+        Parameters
+        ----------
+        block : Numpy array
+            Block written into the full resolution data, in its axes order without ``T``.
+
+        slices : Tuple of slices
+            Position of the block in the full resolution data, in ``ZYXC`` order. Its start in Z, Y and X needs to be
+            a multiple of ``alignment``.
+        """
+        for factors, level in zip(self.factors, self.levels):
+            down = downsample_mean(block, [factors.get(a, 1) for a in self.block_axes])
+            level_slices = []
+            for s, a in zip(slices[:3], "ZYX"):
+                start = (s.start or 0) // factors[a]
+                level_slices.append(slice(start, start + down.shape[self.block_axes.index(a)]))
+            level_slices.append(slices[3])
+            level[tuple(order_dimensions(level_slices, "ZYXC", self.axes_order, default_value=0))] = down
+
+    def write_z_slab(self, slab, z_start):
+        """
+        Write a slab of the full resolution data that spans all Y and X. Slabs need to be passed in Z order. The last
+        Z slices of a slab that do not complete a window of the coarsest level are kept until the next slab arrives.
+
+        Parameters
+        ----------
+        slab : Numpy array
+            Slab written into the full resolution data, in its axes order without ``T``.
+
+        z_start : int
+            First Z slice of the slab in the full resolution data.
+        """
+        z_axis = self.block_axes.index("Z")
+        if self._pending is not None:
+            slab = np.concatenate([self._pending, slab], axis=z_axis)
+            z_start = self._pending_start
+        z_end = z_start + slab.shape[z_axis]
+        cut = z_end if z_end >= self.z_size else (z_end // self.alignment[0]) * self.alignment[0]
+
+        split = [slice(None)] * slab.ndim
+        split[z_axis] = slice(cut - z_start, None)
+        self._pending = slab[tuple(split)] if cut < z_end else None
+        self._pending_start = cut
+        if cut > z_start:
+            split[z_axis] = slice(0, cut - z_start)
+            self.write(slab[tuple(split)], (slice(z_start, cut), slice(None), slice(None), slice(None)))
 
 
 def order_dimensions(data, input_order, output_order="TZCYX", default_value=1):